@@ -1,55 +1,112 @@
 import os
-from flask import Flask, request, jsonify, make_response, send_file
+from flask import Flask, request, jsonify, make_response, send_file, url_for, Response
 from flask_cors import CORS
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy import text
+from sqlalchemy.orm import scoped_session
 from sqlalchemy.exc import SQLAlchemyError
 import logging
-from uuid import UUID
+from uuid import UUID, uuid4
 import json
 from datetime import datetime # ¡Nueva importación!
 
 from flask_jwt_extended import create_access_token, jwt_required, JWTManager, get_jwt_identity
 
-from user_service import register_new_user, verify_user_login
-# ¡CAMBIOS AQUÍ! Importa los nuevos modelos
-from models import Base, User, Document, DocumentVersion, DocumentChunk
-from file_processor_service import FileProcessorService
-from tasks import process_uploaded_file, get_ollama_embedding, get_ollama_generation
-
-# Carga las variables de entorno
+# Carga las variables de entorno antes de importar los módulos del proyecto, que las leen al importarse
+# (database.py crea el engine con ellas).
 dotenv_path = os.path.join(os.path.dirname(__file__), '..', 'nuevo1')
 if os.path.exists(dotenv_path):
     load_dotenv(dotenv_path)
 else:
     load_dotenv()
 
+from user_service import register_new_user, verify_user_login
+# ¡CAMBIOS AQUÍ! Importa los nuevos modelos
+from models import Base, User, Document, DocumentVersion, DocumentChunk
+from database import engine, SessionLocal
+import db_routing
+from file_processor_service import FileProcessorService
+# La API solo encola tareas: no importa tasks.py ni sus librerías de extracción (pypdf, pytesseract, PIL).
+from celery_client import celery_app, GENERATE_ANSWER_TASK, PURGE_DOCUMENT_TASK
+import ingest_scheduler
+import ingest_admission
+import document_purge
+import rag_service
+import ask_jobs
+import chat_sessions
+import metrics
+from celery.result import AsyncResult
+
 # --- Configuración de Logging (sin cambios) ---
 logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format='%(asctime)s - %(levelname)s - %(message)s')
 
-# --- Configuración de la Base de Datos (sin cambios, excepto en create_tables) ---
-POSTGRES_HOST = os.getenv("POSTGRES_HOST")
-POSTGRES_PORT = os.getenv("POSTGRES_PORT")
-POSTGRES_DB = os.getenv("POSTGRES_DB")
-POSTGRES_USER = os.getenv("POSTGRES_USER")
-POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD")
-
-DATABASE_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
-engine = None
-
-def init_db_engine():
-    global engine
-    if engine is None:
-        try:
-            engine = create_engine(DATABASE_URL, pool_size=10, max_overflow=20)
-            logging.info("Motor de base de datos PostgreSQL inicializado.")
-            return engine
-        except Exception as e:
-            logging.error(f"Error al inicializar el motor de la base de datos: {e}")
-            raise
-
-Session = scoped_session(sessionmaker(autocommit=False, autoflush=False))
+# --- Configuración de la Base de Datos ---
+# Engine y pool compartidos con user_service y tasks (database.py), dimensionados según DB_PROCESS_ROLE.
+Session = scoped_session(SessionLocal)
+
+# Cambios de esquema sobre tablas existentes, idempotentes (se ejecutan en cada `init-db`).
+SCHEMA_UPGRADES = [
+    # Checkpoint de la indexación (tasks.index_document_for_rag)
+    "ALTER TABLE document_versions ADD COLUMN IF NOT EXISTS chunks_total integer",
+    "ALTER TABLE document_versions ADD COLUMN IF NOT EXISTS chunks_indexed integer NOT NULL DEFAULT 0",
+    "ALTER TABLE document_versions ADD COLUMN IF NOT EXISTS index_fingerprint text",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_document_chunks_version_order ON document_chunks (document_version_id, chunk_order)",
+    # Filtros de /ask y búsqueda HNSW (rag_service). El índice HNSW tarda en crearse sobre una tabla grande.
+    "CREATE INDEX IF NOT EXISTS ix_documents_created_by_category ON documents (created_by, category)",
+    "CREATE INDEX IF NOT EXISTS ix_documents_tags ON documents USING gin (tags)",
+    "CREATE INDEX IF NOT EXISTS ix_document_versions_document_latest ON document_versions (document_id, is_latest_version)",
+    "CREATE INDEX IF NOT EXISTS ix_document_versions_upload_timestamp ON document_versions (upload_timestamp)",
+    """CREATE INDEX IF NOT EXISTS ix_document_versions_unindexed ON document_versions (uploaded_by, upload_timestamp)
+       WHERE processed_status IN ('pending', 'processing', 'deferred')""",
+    # chunks_total de las versiones indexadas antes del checkpoint: rag_service lo usa para elegir el plan de búsqueda
+    """UPDATE document_versions dv
+       SET chunks_total = (SELECT COUNT(*) FROM document_chunks dc WHERE dc.document_version_id = dv.id),
+           chunks_indexed = (SELECT COUNT(*) FROM document_chunks dc WHERE dc.document_version_id = dv.id)
+       WHERE dv.processed_status = 'indexed' AND dv.chunks_total IS NULL""",
+    # Texto y embedding de los chunks en chunk_contents, compartidos por los duplicados (chunk_dedup.py). Los chunks
+    # anteriores pasan a contenidos 'legacy' (un contenido por texto normalizado) y document_chunks pierde su
+    # columna de embedding y su índice HNSW; crear el índice de chunk_contents tarda sobre una tabla grande.
+    "ALTER TABLE document_chunks ADD COLUMN IF NOT EXISTS content_id uuid REFERENCES chunk_contents (id)",
+    "ALTER TABLE document_chunks ALTER COLUMN chunk_text DROP NOT NULL",
+    "CREATE INDEX IF NOT EXISTS ix_document_chunks_content ON document_chunks (content_id)",
+    """DO $$
+       BEGIN
+         IF EXISTS (SELECT 1 FROM information_schema.columns
+                    WHERE table_name = 'document_chunks' AND column_name = 'chunk_embedding') THEN
+           INSERT INTO chunk_contents (embedding_model, content_hash, chunk_text, chunk_embedding)
+           SELECT DISTINCT ON (content_hash) 'legacy', content_hash, chunk_text, chunk_embedding
+           FROM (SELECT encode(sha256(convert_to(lower(btrim(regexp_replace(chunk_text, '\\s+', ' ', 'g'))), 'UTF8')), 'hex')
+                        AS content_hash, chunk_text, chunk_embedding
+                 FROM document_chunks WHERE content_id IS NULL AND chunk_embedding IS NOT NULL) legacy
+           ORDER BY content_hash
+           ON CONFLICT (embedding_model, content_hash) DO NOTHING;
+           UPDATE document_chunks dc
+           SET content_id = cc.id, chunk_text = CASE WHEN dc.chunk_text = cc.chunk_text THEN NULL ELSE dc.chunk_text END
+           FROM chunk_contents cc
+           WHERE dc.content_id IS NULL AND cc.embedding_model = 'legacy'
+             AND cc.content_hash = encode(sha256(convert_to(lower(btrim(regexp_replace(dc.chunk_text, '\\s+', ' ', 'g'))), 'UTF8')), 'hex');
+           DROP INDEX IF EXISTS ix_document_chunks_embedding_hnsw;
+           ALTER TABLE document_chunks DROP COLUMN chunk_embedding;
+         END IF;
+       END $$""",
+    "CREATE INDEX IF NOT EXISTS ix_chunk_contents_embedding_hnsw ON chunk_contents USING hnsw (chunk_embedding vector_cosine_ops)",
+    # Embedding resumen de cada versión para la búsqueda en dos etapas; las indexadas antes lo calculan aquí
+    "ALTER TABLE document_versions ADD COLUMN IF NOT EXISTS summary_embedding vector(768)",
+    """UPDATE document_versions dv
+       SET summary_embedding = (SELECT AVG(cc.chunk_embedding)
+                                FROM document_chunks dc JOIN chunk_contents cc ON cc.id = dc.content_id
+                                WHERE dc.document_version_id = dv.id)
+       WHERE dv.processed_status = 'indexed' AND dv.summary_embedding IS NULL
+         AND EXISTS (SELECT 1 FROM document_chunks dc WHERE dc.document_version_id = dv.id)""",
+    # Retención de versiones (version_retention.py): las restauradas a mano no se vuelven a archivar
+    "ALTER TABLE document_versions ADD COLUMN IF NOT EXISTS retention_pinned boolean NOT NULL DEFAULT false",
+    # Borrado asíncrono (document_purge.py): tombstone de los documentos e índice para conciliar MinIO
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS deleted_at timestamptz",
+    "CREATE INDEX IF NOT EXISTS ix_documents_tombstoned ON documents (deleted_at) WHERE deleted_at IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS ix_document_versions_ceph_path ON document_versions (ceph_path)",
+    "CREATE INDEX IF NOT EXISTS ix_chunk_content_bands_content ON chunk_content_bands (content_id)",
+    "CREATE INDEX IF NOT EXISTS ix_document_versions_sha256 ON document_versions ((file_metadata->>'sha256'))",
+]
 
 def create_tables():
     """
@@ -68,10 +125,15 @@ def create_tables():
                 logging.info("Extensión 'vector' asegurada en PostgreSQL.")
 
             Base.metadata.create_all(engine)
+            # create_all no añade columnas ni índices a tablas que ya existen
+            with engine.connect() as connection:
+                for statement in SCHEMA_UPGRADES:
+                    connection.execute(text(statement))
+                connection.commit()
             logging.info("¡Tablas de la base de datos creadas/actualizadas exitosamente!")
             return True
         else:
-            logging.error("No se pudo obtener el motor de la base de datos para crear las tablas. Asegúrate de llamar init_app_db_session() al inicio.")
+            logging.error("No se pudo obtener el motor de la base de datos para crear las tablas. Revisa la configuración de database.py.")
             return False
     except SQLAlchemyError as e:
         logging.error(f"Error de SQLAlchemy al crear las tablas: {e}", exc_info=True)
@@ -87,16 +149,13 @@ CORS(app)
 app.config["JWT_SECRET_KEY"] = os.getenv("JWT_SECRET_KEY", "super-secret-jwt-key")
 jwt = JWTManager(app)
 
-def init_app_db_session():
-    global engine
-    if engine is None:
-        engine = init_db_engine()
-    Session.configure(bind=engine)
-    logging.info("Sesión de SQLAlchemy configurada con el motor de base de datos.")
-
-with app.app_context():
-    init_app_db_session()
-    create_tables()
+# El esquema se crea con un comando explícito (`flask --app app init-db`), una sola vez por despliegue,
+# en lugar de en cada import de app.py (es decir, en cada worker de gunicorn).
+@app.cli.command("init-db")
+def init_db_command():
+    """Crea la extensión vector y las tablas que falten."""
+    if not create_tables():
+        raise SystemExit(1)
 
 
 # Configuración del servicio de procesamiento de archivos (sin cambios)
@@ -117,9 +176,23 @@ def before_request():
 
 @app.teardown_request
 def teardown_request(exception=None):
+    read_session = getattr(request, 'read_db_session', None)
+    if read_session is not None and read_session is not getattr(request, 'db_session', None):
+        read_session.close()
     if hasattr(request, 'db_session'):
         Session.remove()
 
+def get_read_session(user_id):
+    """
+    Sesión para las consultas de solo lectura de la petición: una réplica si está al día
+    con las escrituras del usuario (db_routing.py); sin réplicas, la misma request.db_session.
+    """
+    if not db_routing.DATABASE_REPLICA_URLS:
+        return request.db_session
+    if getattr(request, 'read_db_session', None) is None:
+        request.read_db_session = db_routing.read_session(user_id)
+    return request.read_db_session
+
 # Resto de las rutas que no se modifican directamente aquí (login, register, test-db, home)
 # ...
 
@@ -130,11 +203,19 @@ def teardown_request(exception=None):
 def home():
     return "Digital Vault Project API is running!"
 
+# Métricas Prometheus (agrega los valores de todos los procesos en modo multiproceso)
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    if not metrics.scrape_allowed(request.headers.get('Authorization'), request.remote_addr):
+        return jsonify({"error": "Forbidden"}), 403
+    payload, content_type = metrics.generate_metrics()
+    return Response(payload, mimetype=content_type)
+
 @app.route('/vault/test-db', methods=['GET'])
 def test_db_connection():
     session = request.db_session
     try:
-        session.execute("SELECT 1")
+        session.execute(text("SELECT 1"))
         return jsonify({"message": "Database connection successful!"}), 200
     except Exception as e:
         logging.error(f"Error testing database connection: {e}", exc_info=True)
@@ -189,6 +270,14 @@ def upload_document():
     user_id = UUID(current_user_id_str)
     session = request.db_session
 
+    # Admisión antes de leer el cuerpo: una subida rechazada no llega a MinIO
+    try:
+        admission = ingest_admission.admit_upload(session, user_id, request.content_length)
+    except ingest_admission.AdmissionDenied as e:
+        response = jsonify({"error": str(e), "reason": e.reason, "retry_after": e.retry_after})
+        response.headers.set('Retry-After', str(e.retry_after))
+        return response, e.status
+
     if 'file' not in request.files:
         return jsonify({"error": "No file part in the request"}), 400
     file = request.files['file']
@@ -218,7 +307,7 @@ def upload_document():
 
         if existing_document_id:
             # Subir una nueva versión de un documento existente
-            document = session.query(Document).filter_by(id=existing_document_id, created_by=user_id).first()
+            document = session.query(Document).filter_by(id=existing_document_id, created_by=user_id, deleted_at=None).first()
             if not document:
                 return jsonify({"error": "Document not found or you don't have permission to add a version to it."}), 404
 
@@ -261,7 +350,7 @@ def upload_document():
         # Ahora creamos la nueva entrada en DocumentVersion
         # `process_and_store_file` manejará la carga a MinIO y encriptación
         # y devolverá la información necesaria para crear DocumentVersion
-        file_info = file_processor.process_and_store_file(file, user_id, session) # user_id is uploaded_by here
+        file_info = file_processor.process_and_store_file(file, user_id) # user_id is uploaded_by here
 
         new_document_version = DocumentVersion(
             document_id=document.id,
@@ -271,17 +360,31 @@ def upload_document():
             encryption_key_encrypted=file_info['encryption_key_encrypted'],
             original_filename=file.filename,
             mimetype=file.mimetype,
-            size_bytes=file.content_length,
-            processed_status='pending',
-            uploaded_by=user_id
-            # file_metadata (JSONB) no se está usando directamente aquí, podrías pasarlo si es relevante a la versión.
+            size_bytes=file_info['file_size'],
+            processed_status='deferred' if admission == 'deferred' else 'pending',
+            uploaded_by=user_id,
+            # El hash del contenido permite reutilizar el texto ya extraído (text_artifacts.py)
+            file_metadata={"sha256": file_info['sha256']}
         )
         session.add(new_document_version)
         session.commit() # ¡Commit aquí para guardar el documento y la versión!
-
-        logging.info(f"Despachando tarea Celery para document_version_id: {new_document_version.id} y ceph_path: {new_document_version.ceph_path}")
-        # Pasa el ID de la DocumentVersion, no el del Document
-        process_uploaded_file.delay(str(new_document_version.id), new_document_version.ceph_path, new_document_version.original_filename)
+        db_routing.record_write(session, user_id)
+        ingest_admission.record_upload(file_info['file_size'])
+
+        if admission == 'deferred':
+            # Backlog por encima de INGEST_DEFER_BACKLOG: los workers la encolarán cuando baje
+            logging.info(f"Indexación de document_version_id {new_document_version.id} diferida por el backlog de indexación.")
+            return jsonify({
+                "message": "Document uploaded/new version created; indexing deferred until the ingestion backlog drains",
+                "document_id": str(document.id),
+                "document_version_id": str(new_document_version.id),
+                "version_number": new_document_version.version_number,
+                "processed_status": new_document_version.processed_status
+            }), 202
+
+        # Pasa el ID de la DocumentVersion, no el del Document. El scheduler reparte la indexación entre usuarios
+        lane = ingest_scheduler.submit(user_id, new_document_version.id, file_info['file_size'])
+        logging.info(f"Indexación de document_version_id {new_document_version.id} en cola (carril {lane}), ceph_path: {new_document_version.ceph_path}")
 
         return jsonify({
             "message": "Document uploaded/new version created and processing started",
@@ -302,10 +405,10 @@ def upload_document():
 @jwt_required()
 def list_documents():
     current_user_id = UUID(get_jwt_identity())
-    session = request.db_session
+    session = get_read_session(current_user_id)
 
     try:
-        query = session.query(Document).filter_by(created_by=current_user_id)
+        query = session.query(Document).filter_by(created_by=current_user_id, deleted_at=None)
 
         # Filtros (opcionales)
         category = request.args.get('category')
@@ -366,7 +469,7 @@ def update_document_metadata(document_id):
     data = request.get_json()
 
     try:
-        document = session.query(Document).filter_by(id=document_id, created_by=current_user_id).first()
+        document = session.query(Document).filter_by(id=document_id, created_by=current_user_id, deleted_at=None).first()
         if not document:
             return jsonify({"error": "Document not found or you don't have permission to update it."}), 404
 
@@ -382,6 +485,7 @@ def update_document_metadata(document_id):
         # `last_modified_at` se actualiza automáticamente con `onupdate=func.now()` en el modelo.
 
         session.commit()
+        db_routing.record_write(session, current_user_id)
         return jsonify({"message": "Document metadata updated successfully", "document_id": str(document.id)}), 200
 
     except Exception as e:
@@ -397,11 +501,11 @@ def update_document_metadata(document_id):
 @jwt_required()
 def list_document_versions(document_id):
     current_user_id = UUID(get_jwt_identity())
-    session = request.db_session
+    session = get_read_session(current_user_id)
 
     try:
         # Verifica que el documento exista y pertenezca al usuario
-        document = session.query(Document).filter_by(id=document_id, created_by=current_user_id).first()
+        document = session.query(Document).filter_by(id=document_id, created_by=current_user_id, deleted_at=None).first()
         if not document:
             return jsonify({"error": "Document not found or you don't have permission to view its versions."}), 404
 
@@ -418,6 +522,7 @@ def list_document_versions(document_id):
                 "original_filename": version.original_filename,
                 "is_latest_version": version.is_latest_version,
                 "processed_status": version.processed_status,
+                "indexing_progress": version.indexing_progress,
                 "upload_timestamp": version.upload_timestamp.isoformat(),
                 "ceph_path": version.ceph_path # Puedes decidir si quieres exponer esto o no
             })
@@ -437,7 +542,7 @@ def list_document_versions(document_id):
 def download_document_version(version_id):
     try:
         current_user_id = UUID(get_jwt_identity())
-        session = request.db_session
+        session = get_read_session(current_user_id)
 
         # Encuentra la versión del documento
         document_version = session.query(DocumentVersion).filter_by(id=version_id).first()
@@ -446,7 +551,8 @@ def download_document_version(version_id):
             return jsonify({"error": "Document version not found"}), 404
 
         # Verifica los permisos del usuario (que sea dueño del documento lógico)
-        document = session.query(Document).filter_by(id=document_version.document_id, created_by=current_user_id).first()
+        document = session.query(Document).filter_by(id=document_version.document_id, created_by=current_user_id,
+                                                    deleted_at=None).first()
         if not document:
             logging.warning(f"Unauthorized download attempt for version {version_id} by user {current_user_id}. Document owner mismatch.")
             return jsonify({"error": "Unauthorized access: You do not have permission to download this document version"}), 403
@@ -464,8 +570,48 @@ def download_document_version(version_id):
         return jsonify({"error": "Internal server error during file download", "details": str(e)}), 500
 
 
+# Restaurar una versión archivada (POST /documents/versions/<version_id>/restore) ♻️
+# La retención (version_retention.py) saca de la búsqueda las versiones antiguas; esto la vuelve a indexar
+# reutilizando los embeddings archivados.
+
+@app.route('/documents/versions/<uuid:version_id>/restore', methods=['POST'])
+@jwt_required()
+def restore_document_version(version_id):
+    current_user_id = UUID(get_jwt_identity())
+    session = request.db_session
+
+    try:
+        document_version = session.query(DocumentVersion).join(Document)\
+                                  .filter(DocumentVersion.id == version_id, Document.created_by == current_user_id,
+                                          Document.deleted_at.is_(None))\
+                                  .with_for_update(of=DocumentVersion).first()
+        if not document_version:
+            return jsonify({"error": "Document version not found or you don't have permission to restore it."}), 404
+        if document_version.processed_status != 'archived':
+            return jsonify({"error": f"Document version is not archived (status: {document_version.processed_status})."}), 409
+
+        document_version.processed_status = 'pending'
+        document_version.retention_pinned = True
+        session.commit()
+        db_routing.record_write(session, current_user_id)
+        lane = ingest_scheduler.submit(document_version.uploaded_by or current_user_id, document_version.id,
+                                       document_version.size_bytes)
+        logging.info(f"Restauración de document_version_id {version_id} en cola (carril {lane}).")
+        return jsonify({
+            "message": "Document version restore queued",
+            "document_version_id": str(version_id),
+            "processed_status": document_version.processed_status
+        }), 202
+
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Error restoring document version {version_id}: {e}", exc_info=True)
+        return jsonify({"error": "Internal server error while restoring document version", "details": str(e)}), 500
+
+
 # Eliminar un Documento Lógico Completo (DELETE /documents/<document_id>) 🗑️
-# Este endpoint eliminará un documento lógico y, debido a ON DELETE CASCADE en la base de datos, todas sus versiones asociadas y sus chunks de RAG se eliminarán automáticamente. Además, eliminará los archivos físicos de MinIO.
+# Este endpoint solo marca el documento como borrado (tombstone) y sus versiones dejan de verse y de buscarse.
+# La tarea tasks.purge_document borra después los archivos de MinIO y los chunks por lotes (document_purge.py).
 
 @app.route('/documents/<uuid:document_id>', methods=['DELETE'])
 @jwt_required()
@@ -474,28 +620,25 @@ def delete_document(document_id):
     session = request.db_session
 
     try:
-        document = session.query(Document).filter_by(id=document_id, created_by=current_user_id).first()
+        document = session.query(Document).filter_by(id=document_id, created_by=current_user_id, deleted_at=None)\
+                          .with_for_update().first()
         if not document:
             return jsonify({"error": "Document not found or you don't have permission to delete it."}), 404
 
-        file_processor = app.config['FILE_PROCESSOR_SERVICE']
-        
-        # Obtener todas las versiones para eliminar los archivos de MinIO
-        versions_to_delete = session.query(DocumentVersion).filter_by(document_id=document_id).all()
-        for version in versions_to_delete:
-            try:
-                file_processor.delete_file_from_minio(version.ceph_path)
-                logging.info(f"Deleted file {version.ceph_path} from MinIO for document version {version.id}")
-            except Exception as e:
-                logging.error(f"Failed to delete file {version.ceph_path} from Minio for version {version.id}: {e}")
-                # Considerar si parar o continuar si falla la eliminación de MinIO
-
-        # Eliminar el documento lógico. Esto, gracias a ON DELETE CASCADE,
-        # eliminará automáticamente todas las entradas relacionadas en document_versions y document_chunks.
-        session.delete(document)
+        document_purge.tombstone(session, document_id)
         session.commit()
+        db_routing.record_write(session, current_user_id)
+
+        try:
+            celery_app.send_task(PURGE_DOCUMENT_TASK, args=[str(document_id)])
+        except Exception as e:
+            # El tombstone ya está confirmado: el GC de almacenamiento purga los que lleven PURGE_STALE_SECONDS.
+            logging.error(f"Could not queue the purge of document {document_id}: {e}")
 
-        return jsonify({"message": f"Document {document_id} and all its versions deleted successfully."}), 200
+        return jsonify({
+            "message": f"Document {document_id} deleted. Its files and versions are being purged.",
+            "document_id": str(document_id)
+        }), 202
 
     except Exception as e:
         session.rollback()
@@ -514,66 +657,158 @@ def ask_question():
     current_user_id_str = get_jwt_identity()
     user_id_from_token = UUID(current_user_id_str)
 
+    # Alcance de la búsqueda: categoría, etiquetas, documentos, versiones fijadas y fechas de subida
+    raw_filters = request.json.get('filters')
+    try:
+        filters = rag_service.parse_filters(raw_filters)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Modo job: se encola la pregunta y se devuelve el id inmediatamente
+    ask_mode = request.json.get('mode', ask_jobs.ASK_DEFAULT_MODE)
+    if ask_mode == 'job':
+        response, status_code = enqueue_ask_job(user_id_from_token, user_question, raw_filters)
+        metrics.ASK_REQUESTS.labels(mode='job', outcome='queued' if status_code == 202 else str(status_code)).inc()
+        return response, status_code
+
     # 1. Obtener embedding de la pregunta del usuario
-    OLLAMA_EMBEDDING_MODEL = os.getenv("OLLAMA_EMBEDDING_MODEL")
-    question_embedding = get_ollama_embedding(user_question, model_name=OLLAMA_EMBEDDING_MODEL)
+    question_embedding = rag_service.embed_question(user_question)
     if question_embedding is None: # Asegúrate de manejar el caso donde el embedding sea None
+        metrics.ASK_REQUESTS.labels(mode='sync', outcome='error').inc()
         return jsonify({"error": "No se pudo generar el embedding de la pregunta."}), 500
 
-    retrieved_chunks = []
-    session = request.db_session
-
+    # 2. Buscar los chunks relevantes (en una réplica si está al día con las escrituras del usuario)
+    session = get_read_session(user_id_from_token)
     try:
-        # Consulta SQL para buscar chunks relevantes
-        # Realiza un JOIN para filtrar por los documentos del usuario y la última versión
-        # Se usa document_versions.is_latest_version = TRUE para asegurar que se consulta
-        # solo la versión más reciente y relevante de cada documento.
-        result = session.execute(
-            text("""
-                SELECT
-                    dc.chunk_text
-                FROM
-                    document_chunks dc
-                JOIN
-                    document_versions dv ON dc.document_version_id = dv.id
-                JOIN
-                    documents d ON dv.document_id = d.id
-                WHERE
-                    d.created_by = :user_id AND dv.is_latest_version = TRUE AND dv.processed_status = 'indexed'
-                ORDER BY
-                    dc.chunk_embedding <=> CAST(:embedding AS vector)
-                LIMIT 5;
-            """),
-            {"embedding": question_embedding, "user_id": user_id_from_token}
-        )
-        retrieved_chunks = [row.chunk_text for row in result.fetchall()]
-
+        retrieved_chunks = rag_service.retrieve_chunks(session, user_id_from_token, question_embedding, filters=filters)
     except Exception as e:
         logging.error(f"Error al buscar en la base de datos para usuario {user_id_from_token}: {e}", exc_info=True)
+        metrics.ASK_REQUESTS.labels(mode='sync', outcome='error').inc()
         return jsonify({"error": "Error al buscar información relevante en los documentos del usuario."}), 500
 
     if not retrieved_chunks:
-        return jsonify({"answer": "No pude encontrar información relevante en los documentos indexados disponibles para ti."})
+        metrics.ASK_REQUESTS.labels(mode='sync', outcome='no_context').inc()
+        return jsonify({"answer": rag_service.NO_CONTEXT_ANSWER})
 
     # 3. Construir el prompt para el modelo de generación
-    context = "\n".join(retrieved_chunks)
-
-    prompt_for_llm = (
-        f"Basado en el siguiente contexto, responde a la pregunta. "
-        f"Si la respuesta no se encuentra directamente en el contexto, indica que no tienes suficiente información "
-        f"y no intentes inventar la respuesta.\n\n"
-        f"Contexto:\n{context}\n\n"
-        f"Pregunta: {user_question}\n"
-        f"Respuesta:"
-    )
-
+    prompt_for_llm, sources = rag_service.build_prompt(user_question, retrieved_chunks)
     logging.info(f"Enviando prompt al LLM: {prompt_for_llm[:200]}...")
 
     # 4. Obtener la respuesta del modelo de generación
-    OLLAMA_GENERATION_MODEL = os.getenv("OLLAMA_GENERATION_MODEL")
-    llm_response = get_ollama_generation(prompt_for_llm, model_name=OLLAMA_GENERATION_MODEL)
+    llm_response = rag_service.generate_answer(prompt_for_llm)
+    metrics.ASK_REQUESTS.labels(mode='sync', outcome='answered').inc()
+
+    return jsonify({"answer": llm_response, "sources": sources})
+
+
+def enqueue_ask_job(user_id, user_question, raw_filters=None):
+    """
+    Admite (o rechaza con 429) una pregunta en modo job y la encola en la cola de generación.
+    Los filtros viajan tal como llegaron (JSON) y el worker los vuelve a validar.
+    """
+    model_name = rag_service.OLLAMA_GENERATION_MODEL
+    job_id = str(uuid4())
+    try:
+        ask_jobs.admit_job(job_id, user_id, model_name)
+    except ask_jobs.AdmissionDenied as e:
+        response = jsonify({"error": str(e), "retry_after": e.retry_after})
+        response.headers.set('Retry-After', str(e.retry_after))
+        return response, 429
+
+    try:
+        ask_jobs.register_job(job_id, user_id, model_name)
+        celery_app.send_task(GENERATE_ANSWER_TASK, args=[str(user_id), user_question, model_name],
+                             kwargs={"filters": raw_filters or None}, task_id=job_id)
+    except Exception as e:
+        ask_jobs.release_user_slot(user_id, job_id)
+        logging.error(f"Error al encolar la pregunta del usuario {user_id}: {e}", exc_info=True)
+        return jsonify({"error": "No se pudo encolar la pregunta."}), 500
+
+    status_url = url_for('get_ask_job', job_id=job_id)
+    response = jsonify({"job_id": job_id, "status": "queued", "status_url": status_url})
+    response.headers.set('Location', status_url)
+    return response, 202
+
+
+# Consulta el resultado de una pregunta encolada en modo job. Responde sin esperar: el long-polling
+# (?wait=<segundos>) ocuparía durante la espera uno de los workers síncronos de gunicorn, así que solo lo
+# atiende la API asíncrona (asgi_app.py); aquí `wait` se ignora y el cliente vuelve a consultar.
+@app.route('/ask/jobs/<job_id>', methods=['GET'])
+@jwt_required()
+def get_ask_job(job_id):
+    current_user_id = get_jwt_identity()
+    job = ask_jobs.get_job(job_id)
+    if not job or job.get('user_id') != current_user_id:
+        return jsonify({"error": "Job not found"}), 404
 
-    return jsonify({"answer": llm_response})
+    result = AsyncResult(job_id, app=celery_app)
+    if result.successful():
+        return jsonify({"job_id": job_id, "status": "completed", **result.result}), 200
+    if result.failed():
+        logging.error(f"El job {job_id} falló: {result.result}")
+        return jsonify({"job_id": job_id, "status": "failed", "error": "No se pudo generar la respuesta."}), 200
+
+    status = "running" if result.state == 'STARTED' else "queued"
+    return jsonify({"job_id": job_id, "status": status}), 200
+
+
+# --- Conversaciones: preguntas de seguimiento sobre el contexto que Ollama ya procesó ---
+@app.route('/chat/sessions', methods=['POST'])
+@jwt_required()
+def create_chat_session():
+    user_id_from_token = UUID(get_jwt_identity())
+    try:
+        session = chat_sessions.create_session(user_id_from_token, (request.get_json(silent=True) or {}).get('filters'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logging.error(f"Error al crear la sesión de chat del usuario {user_id_from_token}: {e}", exc_info=True)
+        return jsonify({"error": "No se pudo crear la sesión de chat."}), 500
+
+    session_url = url_for('get_chat_session', session_id=session["session_id"])
+    response = jsonify({"session_id": session["session_id"], "expires_in": chat_sessions.CHAT_SESSION_TTL_SECONDS,
+                        "messages_url": url_for('post_chat_message', session_id=session["session_id"])})
+    response.headers.set('Location', session_url)
+    return response, 201
+
+
+@app.route('/chat/sessions/<session_id>/messages', methods=['POST'])
+@jwt_required()
+def post_chat_message(session_id):
+    user_question = request.json.get('question')
+    if not user_question:
+        return jsonify({"error": "No se proporcionó ninguna pregunta."}), 400
+
+    user_id_from_token = UUID(get_jwt_identity())
+    session = get_read_session(user_id_from_token)
+    try:
+        result = chat_sessions.answer_turn(session, session_id, user_id_from_token, user_question)
+    except chat_sessions.SessionBusy as e:
+        return jsonify({"error": str(e)}), 409
+    except Exception as e:
+        logging.error(f"Error en el turno de la sesión de chat {session_id}: {e}", exc_info=True)
+        metrics.ASK_REQUESTS.labels(mode='chat', outcome='error').inc()
+        return jsonify({"error": "No se pudo generar la respuesta."}), 500
+    if result is None:
+        return jsonify({"error": "Chat session not found"}), 404
+    return jsonify(result), 200
+
+
+@app.route('/chat/sessions/<session_id>', methods=['GET'])
+@jwt_required()
+def get_chat_session(session_id):
+    session = chat_sessions.get_session(session_id, get_jwt_identity())
+    if not session:
+        return jsonify({"error": "Chat session not found"}), 404
+    return jsonify(chat_sessions.describe_session(session)), 200
+
+
+@app.route('/chat/sessions/<session_id>', methods=['DELETE'])
+@jwt_required()
+def delete_chat_session(session_id):
+    if not chat_sessions.delete_session(session_id, get_jwt_identity()):
+        return jsonify({"error": "Chat session not found"}), 404
+    return jsonify({"message": "Chat session deleted"}), 200
 
 
 # --- Punto de entrada principal ---
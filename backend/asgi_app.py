@@ -0,0 +1,631 @@
+# backend/asgi_app.py
+"""
+Modo de servicio asíncrono (ASGI) para los endpoints limitados por E/S.
+
+/ask (y /ask/batch) pasan casi todo su tiempo esperando a Ollama y a PostgreSQL; con la API de
+Flask cada pregunta ocupa un worker síncrono de gunicorn durante toda la
+generación. Aquí las mismas rutas, con la misma autenticación JWT y los mismos
+JSON, se sirven con Starlette sobre un bucle de eventos:
+
+* PostgreSQL con asyncpg (pool ASGI_DB_POOL_SIZE, tipo `vector` de pgvector registrado),
+  con la conexión ocupada solo durante cada consulta, no durante la generación.
+* Ollama con un cliente httpx asíncrono compartido (hasta ASGI_OLLAMA_MAX_CONNECTIONS
+  peticiones en vuelo).
+* Lo que sigue siendo bloqueante (MinIO y descifrado en las descargas, Valkey y Celery
+  en el modo job, embeddings ONNX en proceso) va a un hilo con `run_in_threadpool`.
+
+Un proceso mantiene así cientos de preguntas en vuelo. Las rutas de escritura
+(registro, login, subidas, edición, borrado) siguen en app.py, y este modo lee
+siempre del primario (DATABASE_REPLICA_URLS solo se aplica en app.py).
+
+Arranque (desde backend/, usa también gunicorn.conf.py):
+    gunicorn -k uvicorn_worker.UvicornWorker --workers 2 --bind 0.0.0.0:5001 asgi_app:app
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import functools
+from types import SimpleNamespace
+from urllib.parse import quote
+from uuid import UUID, uuid4
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+
+load_dotenv() # Antes de importar los módulos del proyecto, que leen la configuración al importarse
+
+import jwt
+import httpx
+import asyncpg
+from pgvector.asyncpg import register_vector
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+from sqlalchemy.engine import make_url
+
+import metrics
+import ask_jobs
+import ask_batch
+import rag_service
+import context_builder
+import model_residency
+from rag_service import OLLAMA_EMBEDDING_MODEL
+from database import DATABASE_URL, DB_PROCESS_ROLE, DB_PGBOUNCER, DB_POOL_TIMEOUT
+from embedding_providers import EMBEDDING_BACKEND, OLLAMA_EMBEDDING_TIMEOUT
+from ollama_client import OLLAMA_API_BASE_URL, OLLAMA_GENERATION_TIMEOUT, get_ollama_embedding
+from file_processor_service import FileProcessorService
+from models import indexing_progress
+from celery_client import celery_app, GENERATE_ANSWER_TASK
+from celery.result import AsyncResult
+from metrics import observe_stage, ASK_STAGE_SECONDS, OLLAMA_REQUEST_SECONDS
+
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+
+ASGI_DB_POOL_SIZE = int(os.getenv("ASGI_DB_POOL_SIZE", "10"))
+ASGI_OLLAMA_MAX_CONNECTIONS = int(os.getenv("ASGI_OLLAMA_MAX_CONNECTIONS", "256"))
+# Mismo secreto que Flask-JWT-Extended en app.py: los tokens de /login valen en ambos modos.
+JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY", "super-secret-jwt-key")
+ASK_JOB_POLL_INTERVAL = 0.25
+# asyncpg no entiende los sufijos de driver de SQLAlchemy (postgresql+psycopg2://).
+ASYNC_DATABASE_URL = make_url(DATABASE_URL).set(drivername="postgresql").render_as_string(hide_password=False)
+
+
+def _positional(sql: str, names: list[str]) -> str:
+    """Pasa los parámetros `:nombre` de una consulta de rag_service al formato `$n` de asyncpg."""
+    for position, name in enumerate(names, start=1):
+        sql = sql.replace(f":{name}", f"${position}")
+    return sql
+
+
+def _bind(sql: str, params: dict) -> tuple:
+    """`(sql, *args)` para asyncpg con los parámetros de `params` que usa la consulta."""
+    names = [name for name in params if f":{name}" in sql]
+    return (_positional(sql, names), *(params[name] for name in names))
+
+
+# La última versión de cada documento en la misma consulta (app.py hace una consulta por documento).
+LIST_DOCUMENTS_SQL = """
+    SELECT d.id, d.title, d.category, d.tags, d.created_at, d.last_modified_at,
+           lv.id AS version_id, lv.version_number, lv.original_filename, lv.processed_status, lv.upload_timestamp
+    FROM documents d
+    LEFT JOIN LATERAL (
+        SELECT dv.id, dv.version_number, dv.original_filename, dv.processed_status, dv.upload_timestamp
+        FROM document_versions dv
+        WHERE dv.document_id = d.id AND dv.is_latest_version = TRUE
+        LIMIT 1
+    ) lv ON TRUE
+    WHERE d.created_by = $1 AND d.deleted_at IS NULL
+      AND ($2::text IS NULL OR d.category = $2)
+      AND ($3::text IS NULL OR d.tags @> ARRAY[$3::text])
+      AND ($4::text IS NULL OR d.title ILIKE '%' || $4 || '%')
+    ORDER BY d.last_modified_at DESC
+"""
+
+LIST_VERSIONS_SQL = """
+    SELECT dv.id, dv.version_number, dv.original_filename, dv.is_latest_version, dv.processed_status,
+           dv.chunks_indexed, dv.chunks_total, dv.upload_timestamp, dv.ceph_path
+    FROM document_versions dv
+    JOIN documents d ON d.id = dv.document_id
+    WHERE dv.document_id = $1 AND d.created_by = $2 AND d.deleted_at IS NULL
+    ORDER BY dv.version_number ASC
+"""
+
+DOCUMENT_EXISTS_SQL = "SELECT 1 FROM documents WHERE id = $1 AND created_by = $2 AND deleted_at IS NULL"
+
+DOWNLOAD_SQL = """
+    SELECT dv.ceph_path, dv.encryption_key_encrypted, dv.original_filename, dv.mimetype, d.created_by
+    FROM document_versions dv
+    JOIN documents d ON d.id = dv.document_id
+    WHERE dv.id = $1 AND d.deleted_at IS NULL
+"""
+
+
+# --- Recursos compartidos por el proceso ---
+
+@asynccontextmanager
+async def lifespan(app):
+    app.state.db_pool = await asyncpg.create_pool(
+        ASYNC_DATABASE_URL,
+        min_size=1,
+        max_size=ASGI_DB_POOL_SIZE,
+        init=register_vector,
+        # PgBouncer en modo transacción no conserva las sentencias preparadas entre transacciones.
+        statement_cache_size=0 if DB_PGBOUNCER else 100,
+    )
+    metrics.DB_POOL_CAPACITY.labels(role=DB_PROCESS_ROLE, target="primary").set(ASGI_DB_POOL_SIZE)
+    app.state.ollama = httpx.AsyncClient(
+        base_url=OLLAMA_API_BASE_URL,
+        limits=httpx.Limits(max_connections=ASGI_OLLAMA_MAX_CONNECTIONS,
+                            max_keepalive_connections=ASGI_OLLAMA_MAX_CONNECTIONS),
+    )
+    logging.info(f"ASGI: pool asyncpg de {ASGI_DB_POOL_SIZE} conexiones y cliente Ollama "
+                 f"de {ASGI_OLLAMA_MAX_CONNECTIONS} conexiones listos.")
+    try:
+        yield
+    finally:
+        await app.state.ollama.aclose()
+        await app.state.db_pool.close()
+
+
+@asynccontextmanager
+async def acquire_connection(request: Request):
+    """Conexión del pool asyncpg, con las mismas métricas de espera y ocupación que el pool síncrono."""
+    started_at = time.perf_counter()
+    try:
+        connection = await request.app.state.db_pool.acquire(timeout=DB_POOL_TIMEOUT)
+    except asyncio.TimeoutError:
+        metrics.DB_POOL_TIMEOUTS.labels(role=DB_PROCESS_ROLE, target="primary").inc()
+        raise
+    finally:
+        metrics.DB_POOL_CHECKOUT_SECONDS.labels(role=DB_PROCESS_ROLE, target="primary").observe(
+            time.perf_counter() - started_at)
+    checked_out = metrics.DB_POOL_CHECKED_OUT.labels(role=DB_PROCESS_ROLE, target="primary")
+    checked_out.inc()
+    try:
+        yield connection
+    finally:
+        checked_out.dec()
+        await request.app.state.db_pool.release(connection)
+
+
+_file_processor = None
+
+def get_file_processor() -> FileProcessorService:
+    global _file_processor
+    if _file_processor is None:
+        # Misma configuración que app.py; los clientes de MinIO, Kafka y ClamAV se crean en el primer uso.
+        _file_processor = FileProcessorService(
+            s3_endpoint_url=os.getenv("CEPH_ENDPOINT_URL"),
+            s3_access_key=os.getenv("CEPH_ACCESS_KEY"),
+            s3_secret_key=os.getenv("CEPH_SECRET_KEY"),
+            s3_bucket_name=os.getenv("CEPH_BUCKET_NAME"),
+            master_key=os.getenv("SYSTEM_MASTER_KEY"),
+            kafka_bootstrap_servers=os.getenv("KAFKA_BOOTSTRAP_SERVERS"),
+            kafka_topic_uploaded=os.getenv("KAFKA_TOPIC_FILE_UPLOADED")
+        )
+    return _file_processor
+
+
+# --- Autenticación ---
+
+def jwt_required(handler):
+    """
+    Equivalente a `@jwt_required()` de Flask-JWT-Extended para tokens de acceso en la
+    cabecera Authorization. Deja el id del usuario en `request.state.user_id`.
+    """
+    @functools.wraps(handler)
+    async def wrapper(request: Request):
+        header = request.headers.get("Authorization")
+        if not header:
+            return JSONResponse({"msg": "Missing Authorization Header"}, status_code=401)
+        scheme, _, token = header.partition(" ")
+        if scheme != "Bearer" or not token:
+            return JSONResponse({"msg": "Bad Authorization header. Expected 'Authorization: Bearer <JWT>'"},
+                                status_code=422)
+        try:
+            claims = jwt.decode(token, JWT_SECRET_KEY, algorithms=["HS256"])
+        except jwt.ExpiredSignatureError:
+            return JSONResponse({"msg": "Token has expired"}, status_code=401)
+        except jwt.InvalidTokenError as e:
+            return JSONResponse({"msg": str(e)}, status_code=422)
+        if claims.get("type") != "access":
+            return JSONResponse({"msg": "Only non-refresh tokens are allowed"}, status_code=422)
+        request.state.user_id = claims["sub"]
+        return await handler(request)
+    return wrapper
+
+
+# --- RAG asíncrono ---
+
+async def embed_question(request: Request, question: str):
+    """Como `rag_service.embed_question`; con EMBEDDING_BACKEND=onnx la inferencia va a un hilo."""
+    with observe_stage(ASK_STAGE_SECONDS, stage='embedding', model=OLLAMA_EMBEDDING_MODEL):
+        if EMBEDDING_BACKEND != "ollama":
+            return await run_in_threadpool(get_ollama_embedding, question, OLLAMA_EMBEDDING_MODEL)
+        with observe_stage(OLLAMA_REQUEST_SECONDS, endpoint='embed', model=OLLAMA_EMBEDDING_MODEL):
+            response = await request.app.state.ollama.post(
+                "/api/embed", json={"model": OLLAMA_EMBEDDING_MODEL, "input": [question],
+                                    "keep_alive": model_residency.keep_alive_for(OLLAMA_EMBEDDING_MODEL)},
+                timeout=OLLAMA_EMBEDDING_TIMEOUT)
+        response.raise_for_status()
+        result = response.json()
+        model_residency.record_load(OLLAMA_EMBEDDING_MODEL, 'request', result)
+        return result["embeddings"][0]
+
+
+async def retrieve_chunks(request: Request, user_id: UUID, question_embedding, filters: dict = None) -> list[dict]:
+    """Como `rag_service.retrieve_chunks`: consulta vectorial con asyncpg y MMR sobre los candidatos."""
+    filters = filters or {}
+    queries = rag_service.retrieval_queries(filters)
+    limit = max(rag_service.RAG_CANDIDATE_CHUNKS, rag_service.RAG_TOP_K)
+    params = {"embedding": question_embedding, "user_id": user_id, "limit": limit, **filters}
+    filtered = str(bool(filters)).lower()
+    with observe_stage(ASK_STAGE_SECONDS, stage='vector_sql', model=OLLAMA_EMBEDDING_MODEL):
+        async with acquire_connection(request) as connection:
+            scope = await connection.fetchrow(*_bind(queries["scope"], params))
+            if not scope["scope_versions"]:
+                metrics.RETRIEVAL_SEARCHES.labels(plan='empty', filtered=filtered).inc()
+                return []
+            ef_search = rag_service.hnsw_ef_search(scope["scope_chunks"], scope["total_chunks"], limit)
+            candidate_documents = rag_service.two_stage_documents(scope["scope_versions"], scope["scope_chunks"], ef_search)
+            if candidate_documents:
+                plan = 'two_stage'
+                records = await connection.fetch(*_bind(queries["two_stage"],
+                                                        {**params, "candidate_documents": candidate_documents}))
+            else:
+                records = []
+                if ef_search:
+                    async with connection.transaction(): # SET LOCAL solo dura la transacción
+                        await connection.execute(f"SET LOCAL hnsw.ef_search = {int(ef_search)}")
+                        records = await connection.fetch(*_bind(queries["hnsw"], params))
+                plan = rag_service.search_plan(ef_search, records, limit, scope["scope_chunks"])
+                if plan != 'hnsw':
+                    records = await connection.fetch(*_bind(queries["exact"], params))
+        metrics.RETRIEVAL_SEARCHES.labels(plan=plan, filtered=filtered).inc()
+        rows = [dict(record) for record in records]
+    with observe_stage(ASK_STAGE_SECONDS, stage='mmr', model=OLLAMA_EMBEDDING_MODEL):
+        return rag_service.diversify(rows, question_embedding, rag_service.RAG_TOP_K, rag_service.RAG_MMR_LAMBDA)
+
+
+async def retrieve_chunks_batch(request: Request, user_id: UUID, question_embeddings: list,
+                                filters: dict = None) -> list[list[dict]]:
+    """Como `retrieve_chunks` para varias preguntas: una consulta con LATERAL (ver ask_batch.py)."""
+    filters = filters or {}
+    queries = ask_batch.batch_retrieval_queries(filters)
+    limit = max(rag_service.RAG_CANDIDATE_CHUNKS, rag_service.RAG_TOP_K)
+    params = {"user_id": user_id, "limit": limit, **filters}
+    filtered = str(bool(filters)).lower()
+    with observe_stage(ASK_STAGE_SECONDS, stage='vector_sql', model=OLLAMA_EMBEDDING_MODEL):
+        async with acquire_connection(request) as connection:
+            scope = await connection.fetchrow(*_bind(queries["scope"], params))
+            if not scope["scope_versions"]:
+                metrics.RETRIEVAL_SEARCHES.labels(plan='empty', filtered=filtered).inc(len(question_embeddings))
+                return [[] for _ in question_embeddings]
+            ef_search = rag_service.hnsw_ef_search(scope["scope_chunks"], scope["total_chunks"], limit)
+            candidate_documents = rag_service.two_stage_documents(scope["scope_versions"], scope["scope_chunks"], ef_search)
+            if candidate_documents:
+                records = await connection.fetch(*_bind(queries["two_stage"], {
+                    **params, "candidate_documents": candidate_documents,
+                    "question_vectors": ask_batch.vector_literals(question_embeddings)}))
+                results = ask_batch.group_rows(records, len(question_embeddings))
+                plans = ['two_stage'] * len(question_embeddings)
+            else:
+                results = [[] for _ in question_embeddings]
+                if ef_search:
+                    async with connection.transaction(): # SET LOCAL solo dura la transacción
+                        await connection.execute(f"SET LOCAL hnsw.ef_search = {int(ef_search)}")
+                        records = await connection.fetch(*_bind(queries["hnsw"], {
+                            **params, "question_vectors": ask_batch.vector_literals(question_embeddings)}))
+                    results = ask_batch.group_rows(records, len(question_embeddings))
+                plans = [rag_service.search_plan(ef_search, rows, limit, scope["scope_chunks"]) for rows in results]
+            pending = [i for i, plan in enumerate(plans) if plan not in ('hnsw', 'two_stage')]
+            if pending:
+                records = await connection.fetch(*_bind(queries["exact"], {
+                    **params, "question_vectors": ask_batch.vector_literals([question_embeddings[i] for i in pending])}))
+                for i, rows in zip(pending, ask_batch.group_rows(records, len(pending))):
+                    results[i] = rows
+        for plan in plans:
+            metrics.RETRIEVAL_SEARCHES.labels(plan=plan, filtered=filtered).inc()
+    with observe_stage(ASK_STAGE_SECONDS, stage='mmr', model=OLLAMA_EMBEDDING_MODEL):
+        return [rag_service.diversify(rows, embedding, rag_service.RAG_TOP_K, rag_service.RAG_MMR_LAMBDA)
+                for rows, embedding in zip(results, question_embeddings)]
+
+
+async def wait_until_loaded(model_name: str) -> float:
+    """Como `model_residency.wait_until_loaded`, sin bloquear el event loop."""
+    started_at = time.monotonic()
+    while (time.monotonic() - started_at < model_residency.MODEL_LOAD_WAIT_SECONDS
+           and await run_in_threadpool(model_residency.is_loading, model_name)):
+        await asyncio.sleep(model_residency.MODEL_LOAD_POLL_SECONDS)
+    return time.monotonic() - started_at
+
+
+async def acquire_model_slot(model_name: str, member: str) -> float:
+    """Espera un slot de `model_name` en el semáforo de ask_jobs (el de los jobs de /ask). Devuelve la espera."""
+    started_at = time.monotonic()
+    while not await run_in_threadpool(ask_jobs.acquire_model_slot, model_name, member):
+        await asyncio.sleep(ask_batch.ASK_BATCH_SLOT_POLL_SECONDS)
+    return time.monotonic() - started_at
+
+
+async def generate_answer(request: Request, prompt: str, model_name: str) -> str:
+    with observe_stage(ASK_STAGE_SECONDS, stage='generation', model=model_name):
+        waited = await wait_until_loaded(model_name)
+        if waited >= model_residency.MODEL_LOAD_POLL_SECONDS:
+            logging.info(f"Generación con '{model_name}' retrasada {waited:.1f}s mientras se cargaba el modelo.")
+        with observe_stage(OLLAMA_REQUEST_SECONDS, endpoint='generate', model=model_name):
+            response = await request.app.state.ollama.post(
+                "/api/generate",
+                json={"model": model_name, "prompt": prompt, "stream": False,
+                      "keep_alive": model_residency.keep_alive_for(model_name),
+                      "options": context_builder.generation_options(model_name)},
+                timeout=OLLAMA_GENERATION_TIMEOUT)
+        response.raise_for_status()
+        result = response.json()
+        model_residency.record_load(model_name, 'request', result)
+        return result["response"]
+
+
+# --- Rutas ---
+
+@jwt_required
+async def ask_question(request: Request):
+    body = await request.json()
+    user_question = body.get('question')
+    if not user_question:
+        return JSONResponse({"error": "No se proporcionó ninguna pregunta."}, status_code=400)
+    user_id = UUID(request.state.user_id)
+    try:
+        filters = rag_service.parse_filters(body.get('filters'))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    if body.get('mode', ask_jobs.ASK_DEFAULT_MODE) == 'job':
+        response = await enqueue_ask_job(request, user_id, user_question, body.get('filters'))
+        metrics.ASK_REQUESTS.labels(mode='job', outcome='queued' if response.status_code == 202 else str(response.status_code)).inc()
+        return response
+
+    model_name = rag_service.OLLAMA_GENERATION_MODEL
+    try:
+        question_embedding = await embed_question(request, user_question)
+    except Exception as e:
+        logging.error(f"Error al obtener el embedding de la pregunta: {e}", exc_info=True)
+        question_embedding = None
+    if question_embedding is None:
+        metrics.ASK_REQUESTS.labels(mode='sync', outcome='error').inc()
+        return JSONResponse({"error": "No se pudo generar el embedding de la pregunta."}, status_code=500)
+
+    try:
+        retrieved_chunks = await retrieve_chunks(request, user_id, question_embedding, filters)
+    except Exception as e:
+        logging.error(f"Error al buscar en la base de datos para usuario {user_id}: {e}", exc_info=True)
+        metrics.ASK_REQUESTS.labels(mode='sync', outcome='error').inc()
+        return JSONResponse({"error": "Error al buscar información relevante en los documentos del usuario."}, status_code=500)
+
+    if not retrieved_chunks:
+        metrics.ASK_REQUESTS.labels(mode='sync', outcome='no_context').inc()
+        return JSONResponse({"answer": rag_service.NO_CONTEXT_ANSWER})
+
+    prompt_for_llm, sources = rag_service.build_prompt(user_question, retrieved_chunks, model_name=model_name)
+    logging.info(f"Enviando prompt al LLM: {prompt_for_llm[:200]}...")
+    llm_response = await generate_answer(request, prompt_for_llm, model_name)
+    metrics.ASK_REQUESTS.labels(mode='sync', outcome='answered').inc()
+    return JSONResponse({"answer": llm_response, "sources": sources})
+
+
+@jwt_required
+async def ask_batch_questions(request: Request):
+    started_at = time.perf_counter()
+    body = await request.json()
+    try:
+        questions = ask_batch.parse_questions(body.get('questions'))
+        filters = rag_service.parse_filters(body.get('filters'))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    user_id = UUID(request.state.user_id)
+
+    try:
+        embeddings = await run_in_threadpool(ask_batch.embed_questions, questions)
+        retrieved = []
+        for start in range(0, len(embeddings), ask_batch.ASK_BATCH_LOOKUP_SIZE):
+            retrieved.extend(await retrieve_chunks_batch(
+                request, user_id, embeddings[start:start + ask_batch.ASK_BATCH_LOOKUP_SIZE], filters))
+    except Exception as e:
+        logging.error(f"Error en la búsqueda del batch de {len(questions)} preguntas del usuario {user_id}: {e}", exc_info=True)
+        metrics.ASK_REQUESTS.labels(mode='batch', outcome='error').inc(len(questions))
+        return JSONResponse({"error": "Error al buscar información relevante en los documentos del usuario."}, status_code=500)
+
+    model_name = rag_service.OLLAMA_GENERATION_MODEL
+    semaphore = asyncio.Semaphore(max(ask_batch.ASK_BATCH_CONCURRENCY, 1))
+    batch_id = uuid4()
+
+    async def answer(question, retrieved_chunks):
+        line = {"index": question["index"], "id": question["id"]}
+        if not retrieved_chunks:
+            return {**line, "answer": rag_service.NO_CONTEXT_ANSWER}
+        async with semaphore:
+            # Slot del límite global por modelo: lo comparten todas las suites y los jobs de /ask
+            slot = f"batch:{batch_id}:{question['index']}"
+            try:
+                ASK_STAGE_SECONDS.labels(stage='queue_wait', model=model_name).observe(
+                    await acquire_model_slot(model_name, slot))
+                prompt, sources = rag_service.build_prompt(question["question"], retrieved_chunks, model_name=model_name)
+                return {**line, "answer": await generate_answer(request, prompt, model_name), "sources": sources}
+            except Exception as e:
+                logging.error(f"Batch: error al generar la respuesta {question['index']}: {e}", exc_info=True)
+                return {**line, "error": "No se pudo generar la respuesta."}
+            finally:
+                # También si se canceló mientras lo pedía: el slot pudo quedar concedido sin llegar a saberlo
+                try:
+                    await run_in_threadpool(ask_jobs.release_model_slot, model_name, slot)
+                except Exception as e:
+                    logging.warning(f"Batch: no se pudo liberar el slot {slot} de '{model_name}': {e}")
+
+    async def stream():
+        pending = [asyncio.create_task(answer(question, chunks)) for question, chunks in zip(questions, retrieved)]
+        outcomes = []
+        try:
+            for next_done in asyncio.as_completed(pending):
+                line = await next_done
+                outcomes.append(ask_batch.line_outcome(line))
+                metrics.ASK_REQUESTS.labels(mode='batch', outcome=outcomes[-1]).inc()
+                yield json.dumps(line, ensure_ascii=False) + "\n"
+            yield json.dumps(ask_batch.summary_line(outcomes, started_at)) + "\n"
+        finally:
+            # Si el cliente corta la conexión, se cancelan las generaciones pendientes
+            for task in pending:
+                task.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+def _enqueue_ask_job_sync(user_id, user_question, raw_filters=None):
+    """Admisión y encolado del modo job (Valkey y broker bloqueantes), igual que `enqueue_ask_job` de app.py."""
+    model_name = rag_service.OLLAMA_GENERATION_MODEL
+    job_id = str(uuid4())
+    try:
+        ask_jobs.admit_job(job_id, user_id, model_name)
+    except ask_jobs.AdmissionDenied as e:
+        return JSONResponse({"error": str(e), "retry_after": e.retry_after}, status_code=429,
+                            headers={"Retry-After": str(e.retry_after)})
+
+    try:
+        ask_jobs.register_job(job_id, user_id, model_name)
+        celery_app.send_task(GENERATE_ANSWER_TASK, args=[str(user_id), user_question, model_name],
+                             kwargs={"filters": raw_filters or None}, task_id=job_id)
+    except Exception as e:
+        ask_jobs.release_user_slot(user_id, job_id)
+        logging.error(f"Error al encolar la pregunta del usuario {user_id}: {e}", exc_info=True)
+        return JSONResponse({"error": "No se pudo encolar la pregunta."}, status_code=500)
+
+    status_url = f"/ask/jobs/{job_id}"
+    return JSONResponse({"job_id": job_id, "status": "queued", "status_url": status_url}, status_code=202,
+                        headers={"Location": status_url})
+
+
+async def enqueue_ask_job(request: Request, user_id, user_question, raw_filters=None):
+    return await run_in_threadpool(_enqueue_ask_job_sync, user_id, user_question, raw_filters)
+
+
+@jwt_required
+async def get_ask_job(request: Request):
+    job_id = request.path_params['job_id']
+    job = await run_in_threadpool(ask_jobs.get_job, job_id)
+    if not job or job.get('user_id') != request.state.user_id:
+        return JSONResponse({"error": "Job not found"}, status_code=404)
+
+    try:
+        wait_seconds = min(float(request.query_params.get('wait', 0)), ask_jobs.ASK_LONG_POLL_MAX_SECONDS)
+    except ValueError:
+        return JSONResponse({"error": "Invalid wait value"}, status_code=400)
+
+    # Long-poll sin bloquear el bucle: se consulta el estado periódicamente en lugar de esperar en `result.get`.
+    result = AsyncResult(job_id, app=celery_app)
+    deadline = time.monotonic() + wait_seconds
+    while not await run_in_threadpool(result.ready) and time.monotonic() < deadline:
+        await asyncio.sleep(ASK_JOB_POLL_INTERVAL)
+
+    state, value = await run_in_threadpool(lambda: (result.state, result.result))
+    if state == 'SUCCESS':
+        return JSONResponse({"job_id": job_id, "status": "completed", **value})
+    if state == 'FAILURE':
+        logging.error(f"El job {job_id} falló: {value}")
+        return JSONResponse({"job_id": job_id, "status": "failed", "error": "No se pudo generar la respuesta."})
+    return JSONResponse({"job_id": job_id, "status": "running" if state == 'STARTED' else "queued"})
+
+
+@jwt_required
+async def list_documents(request: Request):
+    user_id = UUID(request.state.user_id)
+    params = request.query_params
+    try:
+        async with acquire_connection(request) as connection:
+            records = await connection.fetch(LIST_DOCUMENTS_SQL, user_id, params.get('category') or None,
+                                             params.get('tag') or None, params.get('search') or None)
+    except Exception as e:
+        logging.error(f"Error listing documents for user {user_id}: {e}", exc_info=True)
+        return JSONResponse({"error": "Internal server error while listing documents", "details": str(e)}, status_code=500)
+
+    return JSONResponse([{
+        "id": str(r["id"]),
+        "title": r["title"],
+        "category": r["category"],
+        "tags": r["tags"],
+        "created_at": r["created_at"].isoformat(),
+        "last_modified_at": r["last_modified_at"].isoformat(),
+        "latest_version_info": {
+            "id": str(r["version_id"]),
+            "version_number": r["version_number"],
+            "original_filename": r["original_filename"],
+            "processed_status": r["processed_status"],
+            "upload_timestamp": r["upload_timestamp"].isoformat()
+        } if r["version_id"] else None
+    } for r in records])
+
+
+@jwt_required
+async def list_document_versions(request: Request):
+    user_id = UUID(request.state.user_id)
+    document_id = request.path_params['document_id']
+    try:
+        async with acquire_connection(request) as connection:
+            if not await connection.fetchval(DOCUMENT_EXISTS_SQL, document_id, user_id):
+                return JSONResponse({"error": "Document not found or you don't have permission to view its versions."},
+                                    status_code=404)
+            records = await connection.fetch(LIST_VERSIONS_SQL, document_id, user_id)
+    except Exception as e:
+        logging.error(f"Error listing versions for document {document_id}: {e}", exc_info=True)
+        return JSONResponse({"error": "Internal server error while listing document versions", "details": str(e)},
+                            status_code=500)
+
+    return JSONResponse([{
+        "id": str(r["id"]),
+        "version_number": r["version_number"],
+        "original_filename": r["original_filename"],
+        "is_latest_version": r["is_latest_version"],
+        "processed_status": r["processed_status"],
+        "indexing_progress": indexing_progress(r["processed_status"], r["chunks_indexed"], r["chunks_total"]),
+        "upload_timestamp": r["upload_timestamp"].isoformat(),
+        "ceph_path": r["ceph_path"]
+    } for r in records])
+
+
+def _attachment_header(filename: str) -> str:
+    try:
+        filename.encode("ascii")
+        return f'attachment; filename="{filename}"'
+    except UnicodeEncodeError:
+        return f"attachment; filename*=UTF-8''{quote(filename)}"
+
+
+@jwt_required
+async def download_document_version(request: Request):
+    user_id = UUID(request.state.user_id)
+    version_id = request.path_params['version_id']
+    try:
+        async with acquire_connection(request) as connection:
+            record = await connection.fetchrow(DOWNLOAD_SQL, version_id)
+        if not record:
+            return JSONResponse({"error": "Document version not found"}, status_code=404)
+        if record["created_by"] != user_id:
+            logging.warning(f"Unauthorized download attempt for version {version_id} by user {user_id}. Document owner mismatch.")
+            return JSONResponse({"error": "Unauthorized access: You do not have permission to download this document version"},
+                                status_code=403)
+
+        # MinIO y el descifrado son bloqueantes: en un hilo, para no frenar al resto de peticiones.
+        decrypted_data = await run_in_threadpool(get_file_processor().retrieve_and_decrypt_file, SimpleNamespace(**record))
+        return Response(decrypted_data, media_type=record["mimetype"],
+                        headers={"Content-Disposition": _attachment_header(record["original_filename"])})
+    except Exception as e:
+        logging.error(f"Error downloading document version {version_id}: {e}", exc_info=True)
+        return JSONResponse({"error": "Internal server error during file download", "details": str(e)}, status_code=500)
+
+
+async def home(request: Request):
+    return PlainTextResponse("Digital Vault Project API (ASGI) is running!")
+
+
+async def metrics_endpoint(request: Request):
+    if not metrics.scrape_allowed(request.headers.get('Authorization'), request.client.host if request.client else None):
+        return JSONResponse({"error": "Forbidden"}, status_code=403)
+    payload, content_type = await run_in_threadpool(metrics.generate_metrics)
+    return Response(payload, media_type=content_type)
+
+
+app = Starlette(
+    routes=[
+        Route('/', home),
+        Route('/metrics', metrics_endpoint, methods=['GET']),
+        Route('/ask', ask_question, methods=['POST']),
+        Route('/ask/batch', ask_batch_questions, methods=['POST']),
+        Route('/ask/jobs/{job_id}', get_ask_job, methods=['GET']),
+        Route('/documents', list_documents, methods=['GET']),
+        Route('/documents/{document_id:uuid}/versions', list_document_versions, methods=['GET']),
+        Route('/documents/versions/{version_id:uuid}/download', download_document_version, methods=['GET']),
+    ],
+    lifespan=lifespan,
+)
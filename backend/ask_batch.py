@@ -0,0 +1,214 @@
+# backend/ask_batch.py
+"""
+Modo batch de /ask: una lista de preguntas en una sola petición (evaluación y
+regresión nocturna), con las respuestas devueltas como JSON lines a medida que
+terminan.
+
+Frente a N llamadas a /ask:
+
+* Los embeddings de todas las preguntas se piden juntos (`embed_texts`, en lotes
+  de EMBEDDING_BATCH_SIZE).
+* La búsqueda vectorial de ASK_BATCH_LOOKUP_SIZE preguntas va en una sola consulta:
+  un `LATERAL` sobre el array de vectores, con el alcance y el plan (exacto o HNSW)
+  calculados una vez para todas (ver rag_service).
+* Las generaciones corren con como mucho ASK_BATCH_CONCURRENCY en vuelo por petición,
+  y cada una ocupa un slot del semáforo por modelo de ask_jobs.py, el mismo de los
+  jobs de /ask: varias suites a la vez no pasan de ASK_MODEL_CONCURRENCY
+  generaciones en Ollama. Un slot ocupado se vuelve a pedir cada
+  ASK_BATCH_SLOT_POLL_SECONDS.
+
+Solo lo sirve la API asíncrona (asgi_app.py): una suite larga ocuparía durante
+todas sus generaciones uno de los workers síncronos de gunicorn de app.py. Este
+módulo reúne la validación, las consultas y el formato de las líneas.
+
+Cada línea es `{"index", "id", "answer", "sources"}` (o `"error"`) en orden de
+finalización; la última es `{"summary": {...}}`.
+"""
+import os
+import json
+import time
+
+import rag_service
+from embedding_providers import embed_texts
+from metrics import observe_stage, ASK_STAGE_SECONDS
+
+ASK_BATCH_MAX_QUESTIONS = int(os.getenv("ASK_BATCH_MAX_QUESTIONS", "1000"))
+ASK_BATCH_CONCURRENCY = int(os.getenv("ASK_BATCH_CONCURRENCY", "4"))
+ASK_BATCH_LOOKUP_SIZE = int(os.getenv("ASK_BATCH_LOOKUP_SIZE", "100"))
+ASK_BATCH_SLOT_POLL_SECONDS = float(os.getenv("ASK_BATCH_SLOT_POLL_SECONDS", "0.1"))
+
+# Vectores de las preguntas como text[] (`:question_vectors`, en formato '[...]' de pgvector) con su posición.
+_QUESTIONS_CTE = """
+    questions AS (
+        SELECT CAST(q.vector AS vector) AS embedding, q.position - 1 AS question_index
+        FROM unnest(CAST(:question_vectors AS text[])) WITH ORDINALITY AS q(vector, position)
+    )"""
+
+# Como rag_service.RETRIEVAL_SQL, una vez por pregunta: el índice HNSW se recorre con el vector de cada una.
+BATCH_RETRIEVAL_SQL = """
+    WITH {questions}
+    SELECT questions.question_index, hit.*
+    FROM questions
+    CROSS JOIN LATERAL (
+        SELECT
+            occurrence.*,
+            vector_send(cc.chunk_embedding) AS embedding,
+            cc.chunk_embedding <=> questions.embedding AS distance
+        FROM
+            chunk_contents cc
+        {occurrence}
+        ORDER BY
+            distance
+        LIMIT :limit
+    ) hit
+    ORDER BY questions.question_index, hit.distance;
+"""
+
+# Como rag_service.EXACT_RETRIEVAL_SQL: el alcance se resuelve una vez y cada pregunta lo recorre entero.
+BATCH_EXACT_RETRIEVAL_SQL = """
+    WITH {questions}, scoped AS MATERIALIZED (
+        SELECT cc.id, cc.chunk_embedding
+        FROM chunk_contents cc
+        WHERE cc.id IN (
+            SELECT dc.content_id
+            FROM document_chunks dc
+            JOIN document_versions dv ON dc.document_version_id = dv.id
+            JOIN documents d ON dv.document_id = d.id
+            WHERE {conditions})
+    ), nearest AS (
+        SELECT questions.question_index, hit.id, hit.distance
+        FROM questions
+        CROSS JOIN LATERAL (
+            SELECT scoped.id, scoped.chunk_embedding <=> questions.embedding AS distance
+            FROM scoped ORDER BY distance LIMIT :limit
+        ) hit
+    )
+    SELECT
+        nearest.question_index,
+        occurrence.*,
+        vector_send(cc.chunk_embedding) AS embedding,
+        nearest.distance
+    FROM
+        nearest
+    JOIN
+        chunk_contents cc ON cc.id = nearest.id
+    {occurrence}
+    ORDER BY
+        nearest.question_index, nearest.distance;
+"""
+
+# Como rag_service.TWO_STAGE_RETRIEVAL_SQL: las versiones candidatas de cada pregunta y, entre sus contenidos,
+# los `:limit` más cercanos. Solo se materializan ids y distancias, no los vectores.
+BATCH_TWO_STAGE_RETRIEVAL_SQL = """
+    WITH {questions}, scoped_versions AS MATERIALIZED (
+        SELECT dv.id, dv.summary_embedding
+        FROM document_versions dv
+        JOIN documents d ON dv.document_id = d.id
+        WHERE {conditions}
+    ), candidate_versions AS MATERIALIZED (
+        SELECT questions.question_index, candidate.id
+        FROM questions
+        CROSS JOIN LATERAL (
+            SELECT id FROM scoped_versions
+            WHERE summary_embedding IS NOT NULL
+            ORDER BY summary_embedding <=> questions.embedding
+            LIMIT :candidate_documents
+        ) candidate
+        UNION ALL
+        SELECT questions.question_index, scoped_versions.id
+        FROM questions
+        CROSS JOIN scoped_versions
+        WHERE scoped_versions.summary_embedding IS NULL
+    ), scoped AS MATERIALIZED (
+        SELECT candidate_contents.question_index, cc.id, cc.chunk_embedding <=> questions.embedding AS distance
+        FROM (
+            SELECT DISTINCT candidate_versions.question_index, dc.content_id
+            FROM candidate_versions
+            JOIN document_chunks dc ON dc.document_version_id = candidate_versions.id
+        ) candidate_contents
+        JOIN questions ON questions.question_index = candidate_contents.question_index
+        JOIN chunk_contents cc ON cc.id = candidate_contents.content_id
+    ), nearest AS (
+        SELECT question_index, id, distance
+        FROM (
+            SELECT scoped.*, ROW_NUMBER() OVER (PARTITION BY question_index ORDER BY distance) AS position
+            FROM scoped
+        ) ranked
+        WHERE position <= :limit
+    )
+    SELECT
+        nearest.question_index,
+        occurrence.*,
+        vector_send(cc.chunk_embedding) AS embedding,
+        nearest.distance
+    FROM
+        nearest
+    JOIN
+        chunk_contents cc ON cc.id = nearest.id
+    {occurrence}
+    ORDER BY
+        nearest.question_index, nearest.distance;
+"""
+
+
+def parse_questions(raw) -> list[dict]:
+    """
+    Valida la lista `questions`: textos u objetos `{"question", "id"}` (`id` opcional, se devuelve
+    tal cual en su línea). Devuelve `[{"index", "id", "question"}]`; lanza ValueError para el cliente.
+    """
+    if not isinstance(raw, list) or not raw:
+        raise ValueError("'questions' debe ser una lista no vacía de preguntas.")
+    if len(raw) > ASK_BATCH_MAX_QUESTIONS:
+        raise ValueError(f"Como mucho {ASK_BATCH_MAX_QUESTIONS} preguntas por petición (ASK_BATCH_MAX_QUESTIONS).")
+    questions = []
+    for index, item in enumerate(raw):
+        question, question_id = (item.get("question"), item.get("id")) if isinstance(item, dict) else (item, None)
+        if not isinstance(question, str) or not question.strip():
+            raise ValueError(f"La pregunta {index} está vacía o no es un texto.")
+        questions.append({"index": index, "id": question_id, "question": question})
+    return questions
+
+
+def batch_retrieval_queries(filters: dict) -> dict:
+    """Las consultas de la búsqueda en batch (`scope`, `hnsw`, `exact`, `two_stage`) con las condiciones de los filtros."""
+    conditions = rag_service.scope_conditions(filters)
+    occurrence = rag_service.OCCURRENCE_SQL.format(conditions=conditions)
+    return {
+        "scope": rag_service.SCOPE_SQL.format(conditions=conditions),
+        "hnsw": BATCH_RETRIEVAL_SQL.format(questions=_QUESTIONS_CTE, occurrence=occurrence),
+        "exact": BATCH_EXACT_RETRIEVAL_SQL.format(questions=_QUESTIONS_CTE, conditions=conditions, occurrence=occurrence),
+        "two_stage": BATCH_TWO_STAGE_RETRIEVAL_SQL.format(questions=_QUESTIONS_CTE, conditions=conditions,
+                                                          occurrence=occurrence),
+    }
+
+
+def vector_literals(embeddings) -> list[str]:
+    return [json.dumps([float(value) for value in embedding]) for embedding in embeddings]
+
+
+def group_rows(rows, count: int) -> list[list[dict]]:
+    """Reparte las filas de la consulta en batch por `question_index`."""
+    grouped = [[] for _ in range(count)]
+    for row in rows:
+        row = dict(row)
+        grouped[row.pop("question_index")].append(row)
+    return grouped
+
+
+def embed_questions(questions: list[dict]) -> list:
+    with observe_stage(ASK_STAGE_SECONDS, stage='embedding', model=rag_service.OLLAMA_EMBEDDING_MODEL):
+        return embed_texts([q["question"] for q in questions], rag_service.OLLAMA_EMBEDDING_MODEL)
+
+
+def line_outcome(line: dict) -> str:
+    if "error" in line:
+        return 'error'
+    return 'answered' if "sources" in line else 'no_context'
+
+
+def summary_line(outcomes: list[str], started_at: float) -> dict:
+    return {"summary": {
+        "questions": len(outcomes),
+        **{outcome: outcomes.count(outcome) for outcome in ('answered', 'no_context', 'error')},
+        "seconds": round(time.perf_counter() - started_at, 3),
+    }}
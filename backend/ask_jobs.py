@@ -0,0 +1,122 @@
+# backend/ask_jobs.py
+"""
+Modo "job" de /ask: control de admisión, cuotas por usuario y límite de
+concurrencia por modelo de Ollama. Todo el estado compartido vive en Valkey
+para que lo vean por igual los workers de gunicorn y los de Celery.
+"""
+import os
+import json
+import math
+import time
+import logging
+
+from valkey_client import get_valkey
+
+ASK_JOB_QUEUE = os.getenv("ASK_JOB_QUEUE", "generation")
+ASK_DEFAULT_MODE = os.getenv("ASK_DEFAULT_MODE", "sync").lower() # 'sync' o 'job'
+ASK_MAX_QUEUE_DEPTH = int(os.getenv("ASK_MAX_QUEUE_DEPTH", "50"))
+ASK_MAX_JOBS_PER_USER = int(os.getenv("ASK_MAX_JOBS_PER_USER", "3"))
+ASK_MODEL_CONCURRENCY = int(os.getenv("ASK_MODEL_CONCURRENCY", "1"))
+# Límites específicos por modelo, ej. '{"llama3": 2}'. Los modelos no listados usan ASK_MODEL_CONCURRENCY.
+ASK_MODEL_CONCURRENCY_OVERRIDES = json.loads(os.getenv("ASK_MODEL_CONCURRENCY_OVERRIDES", "{}"))
+ASK_ESTIMATED_JOB_SECONDS = int(os.getenv("ASK_ESTIMATED_JOB_SECONDS", "60"))
+ASK_MODEL_SLOT_RETRY_SECONDS = int(os.getenv("ASK_MODEL_SLOT_RETRY_SECONDS", "5"))
+ASK_JOB_TTL_SECONDS = int(os.getenv("ASK_JOB_TTL_SECONDS", "3600"))
+ASK_LONG_POLL_MAX_SECONDS = int(os.getenv("ASK_LONG_POLL_MAX_SECONDS", "25"))
+# Un slot sin liberar (worker muerto) se considera abandonado pasado este tiempo.
+ASK_SLOT_STALE_SECONDS = int(os.getenv("ASK_SLOT_STALE_SECONDS", os.getenv("OLLAMA_GENERATION_TIMEOUT", "1200")))
+
+# Semáforo sobre un ZSET: purga los miembros caducados y añade el nuevo solo si queda hueco.
+_ACQUIRE_SLOT_LUA = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1] - ARGV[4])
+if redis.call('ZSCORE', KEYS[1], ARGV[2]) then
+    return 1
+end
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+
+class AdmissionDenied(Exception):
+    """La petición no se admite ahora; el cliente debe reintentar tras `retry_after` segundos."""
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _job_key(job_id):
+    return f"ask:job:{job_id}"
+
+def _user_slots_key(user_id):
+    return f"ask:user_jobs:{user_id}"
+
+def _model_slots_key(model_name):
+    return f"ask:model_slots:{model_name}"
+
+
+def _acquire_slot(key, member, limit, stale_after):
+    valkey = get_valkey()
+    return bool(valkey.eval(_ACQUIRE_SLOT_LUA, 1, key, time.time(), member, limit, stale_after))
+
+def _release_slot(key, member):
+    get_valkey().zrem(key, member)
+
+
+def get_model_concurrency(model_name: str) -> int:
+    return int(ASK_MODEL_CONCURRENCY_OVERRIDES.get(model_name, ASK_MODEL_CONCURRENCY))
+
+
+def get_queue_depth() -> int:
+    """Número de mensajes pendientes en la cola de generación del broker."""
+    return get_valkey().llen(ASK_JOB_QUEUE)
+
+
+def estimate_retry_after(queue_depth: int, model_name: str) -> int:
+    """Estimación conservadora del tiempo hasta que se drene la cola actual."""
+    concurrency = max(get_model_concurrency(model_name), 1)
+    return max(1, math.ceil((queue_depth + 1) * ASK_ESTIMATED_JOB_SECONDS / concurrency))
+
+
+def admit_job(job_id: str, user_id, model_name: str):
+    """
+    Aplica el control de admisión y reserva la cuota del usuario para `job_id`.
+    Lanza AdmissionDenied si la cola está llena o el usuario ya agotó su cuota.
+    """
+    queue_depth = get_queue_depth()
+    if queue_depth >= ASK_MAX_QUEUE_DEPTH:
+        logging.warning(f"Cola de generación llena ({queue_depth} >= {ASK_MAX_QUEUE_DEPTH}). Rechazando job de {user_id}.")
+        raise AdmissionDenied("El servicio de generación está saturado. Inténtalo más tarde.",
+                              estimate_retry_after(queue_depth, model_name))
+
+    if not _acquire_slot(_user_slots_key(user_id), job_id, ASK_MAX_JOBS_PER_USER, ASK_JOB_TTL_SECONDS):
+        raise AdmissionDenied(f"Ya tienes {ASK_MAX_JOBS_PER_USER} preguntas en curso. Espera a que terminen.",
+                              ASK_ESTIMATED_JOB_SECONDS)
+
+
+def register_job(job_id: str, user_id, model_name: str):
+    """Guarda el dueño del job para validar las consultas de estado."""
+    valkey = get_valkey()
+    key = _job_key(job_id)
+    valkey.hset(key, mapping={"user_id": str(user_id), "model": model_name, "created_at": time.time()})
+    valkey.expire(key, ASK_JOB_TTL_SECONDS)
+
+
+def get_job(job_id: str):
+    """Devuelve los metadatos del job o None si no existe o ya caducó."""
+    return get_valkey().hgetall(_job_key(job_id)) or None
+
+
+def release_user_slot(user_id, job_id: str):
+    _release_slot(_user_slots_key(user_id), job_id)
+
+
+def acquire_model_slot(model_name: str, job_id: str) -> bool:
+    return _acquire_slot(_model_slots_key(model_name), job_id, get_model_concurrency(model_name), ASK_SLOT_STALE_SECONDS)
+
+
+def release_model_slot(model_name: str, job_id: str):
+    _release_slot(_model_slots_key(model_name), job_id)
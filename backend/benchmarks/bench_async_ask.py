@@ -0,0 +1,157 @@
+# backend/benchmarks/bench_async_ask.py
+"""
+Preguntas concurrentes a /ask: un proceso ASGI (asgi_app.py) frente a un worker
+síncrono de gunicorn (app.py).
+
+Indexa un corpus pequeño con el pipeline real (Ollama y MinIO simulados, como en
+`benchmarks.run_benchmark`) y arranca cada API en su propio proceso de gunicorn
+con un solo worker (`-k uvicorn_worker.UvicornWorker` para la ASGI). Las
+preguntas se lanzan con `--concurrency` en vuelo desde este proceso, y el Ollama
+simulado corre en otro para no competir por el GIL con la API medida.
+
+Con la generación dominando la latencia (`--generate-latency-ms`), el throughput
+de la ASGI debe crecer con la concurrencia y el de Flask quedarse en
+`1 / latencia`.
+
+Uso (desde backend/, con la base de datos de testcompose.yml levantada):
+    python -m benchmarks.bench_async_ask --questions 400 --concurrency 200 --generate-latency-ms 1000
+"""
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import asyncio
+import argparse
+import subprocess
+from types import SimpleNamespace
+
+import httpx
+
+from benchmarks.corpus import generate_corpus, generate_questions
+from benchmarks.fake_s3 import start_fake_s3
+from benchmarks.run_benchmark import (
+    DEFAULT_DATABASE_URL, EMBEDDING_DIM, configure_environment, _percentiles
+)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_process(args, url, log_path=None, timeout=60):
+    """Arranca un servidor (hereda el entorno ya configurado) y espera a que responda en `url`."""
+    log = open(log_path, "ab") if log_path else subprocess.DEVNULL
+    process = subprocess.Popen(args, stdout=log, stderr=log)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=1)
+            return process
+        except httpx.TransportError:
+            if process.poll() is not None:
+                raise SystemExit(f"El proceso {' '.join(args)} terminó al arrancar.")
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit(f"{url} no respondió en {timeout}s.")
+
+
+async def _ask_concurrently(base_url, headers, questions, concurrency):
+    latencies_ms, errors = [], {}
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=None, limits=limits) as client:
+        async def ask(question):
+            async with semaphore:
+                started_at = time.perf_counter()
+                try:
+                    response = await client.post("/ask", headers=headers, json={"question": question, "mode": "sync"})
+                    outcome = str(response.status_code)
+                except httpx.HTTPError as e:
+                    outcome = type(e).__name__
+                latencies_ms.append((time.perf_counter() - started_at) * 1000)
+                if outcome != "200":
+                    errors[outcome] = errors.get(outcome, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(ask(q) for q in questions))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "questions": len(questions),
+        "concurrency": concurrency,
+        "errors": errors,
+        "questions_per_second": round(len(questions) / elapsed, 2),
+        "latency_ms": _percentiles(latencies_ms),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=DEFAULT_DATABASE_URL)
+    parser.add_argument("--documents", type=int, default=6)
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--sync-questions", type=int, default=20,
+                        help="Preguntas para Flask: a una por latencia de generación, más tardaría demasiado.")
+    parser.add_argument("--generate-latency-ms", type=float, default=500.0)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--server-log", help="Fichero donde volcar la salida de los procesos de la API.")
+    args = parser.parse_args()
+
+    ollama_port = _free_port()
+    ollama_url = f"http://127.0.0.1:{ollama_port}"
+    ollama = _start_process([sys.executable, "-m", "benchmarks.fake_ollama", "--port", str(ollama_port),
+                             "--dim", str(EMBEDDING_DIM), "--embed-latency-ms", "5",
+                             "--generate-latency-ms", str(args.generate_latency_ms)], f"{ollama_url}/api/tags")
+    s3_server, _, s3_endpoint = start_fake_s3()
+    configure_environment(SimpleNamespace(database_url=args.database_url), ollama_url, s3_endpoint)
+    os.environ["JWT_SECRET_KEY"] = f"bench-{uuid.uuid4().hex}" # Compartido con los procesos de la API
+
+    import app as app_module
+    from tasks import index_document_for_rag
+
+    servers = [ollama]
+    try:
+        if not app_module.create_tables():
+            raise SystemExit("No se pudo crear el esquema en la base de datos de benchmark.")
+        client = app_module.app.test_client()
+        username = f"bench_{uuid.uuid4().hex[:10]}"
+        client.post("/register", json={"username": username, "password": "bench-password"})
+        login = client.post("/login", json={"username": username, "password": "bench-password"})
+        headers = {"Authorization": f"Bearer {login.get_json()['access_token']}"}
+
+        corpus = generate_corpus(args.documents, formats=("txt",), paragraphs_per_doc=20, seed=args.seed)
+        for document in corpus:
+            response = client.post("/documents", headers=headers, content_type="multipart/form-data", data={
+                "file": (io.BytesIO(document["content"]), document["filename"], document["mimetype"]),
+            })
+            index_document_for_rag.apply(args=[response.get_json()["document_version_id"]])
+        questions = generate_questions(corpus, args.questions, seed=args.seed + 1)
+
+        results = {"benchmark": "async_ask", "config": vars(args)}
+        for name, target, concurrency, count in (
+            ("asgi", ["-k", "uvicorn_worker.UvicornWorker", "asgi_app:app"], args.concurrency, args.questions),
+            ("flask", ["app:app"], args.concurrency, args.sync_questions),
+        ):
+            port = _free_port()
+            base_url = f"http://127.0.0.1:{port}"
+            server = _start_process([sys.executable, "-m", "gunicorn", "--workers", "1", "--timeout", "1200",
+                                     "--bind", f"127.0.0.1:{port}", *target], f"{base_url}/", args.server_log)
+            servers.append(server)
+            results[name] = asyncio.run(_ask_concurrently(base_url, headers, questions[:count], concurrency))
+    finally:
+        for server in servers:
+            server.terminate()
+        s3_server.shutdown()
+
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
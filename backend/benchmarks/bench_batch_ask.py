@@ -0,0 +1,101 @@
+# backend/benchmarks/bench_batch_ask.py
+"""
+Suite de regresión de `--questions` preguntas: una llamada a /ask por pregunta
+frente a una sola llamada a /ask/batch.
+
+Indexa un corpus pequeño con el pipeline real (Ollama y MinIO simulados, como en
+`benchmarks.run_benchmark`) y lanza las mismas preguntas de las dos formas: a
+/ask con el cliente de pruebas de Flask y a /ask/batch, que solo sirve la API
+asíncrona, con el de Starlette sobre asgi_app. Con la latencia simulada de Ollama
+(`--embed-latency-ms` por llamada, `--generate-latency-ms` por generación), la
+suite secuencial cuesta `N * (embedding + búsqueda + generación)`; el batch, un
+embedding por lote, una consulta por ASK_BATCH_LOOKUP_SIZE preguntas y
+`N / ASK_BATCH_CONCURRENCY` generaciones. Informa también de las llamadas a
+Ollama de cada modo y de si las respuestas coinciden.
+
+Uso (desde backend/, con la base de datos de testcompose.yml levantada):
+    python -m benchmarks.bench_batch_ask --questions 500 --generate-latency-ms 100 --concurrency 4
+"""
+import io
+import os
+import json
+import time
+import uuid
+import argparse
+
+from benchmarks.corpus import generate_corpus, generate_questions
+from benchmarks.fake_ollama import start_fake_ollama
+from benchmarks.fake_s3 import start_fake_s3
+from benchmarks.run_benchmark import DEFAULT_DATABASE_URL, EMBEDDING_DIM, configure_environment
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=DEFAULT_DATABASE_URL)
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--questions", type=int, default=500)
+    parser.add_argument("--embed-latency-ms", type=float, default=20.0)
+    parser.add_argument("--generate-latency-ms", type=float, default=100.0)
+    parser.add_argument("--concurrency", type=int, default=4, help="ASK_BATCH_CONCURRENCY")
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    ollama_server, ollama_config, ollama_url = start_fake_ollama(dim=EMBEDDING_DIM)
+    s3_server, _, s3_endpoint = start_fake_s3()
+    configure_environment(args, ollama_url, s3_endpoint)
+    os.environ["ASK_BATCH_CONCURRENCY"] = str(args.concurrency)
+    os.environ["ASK_MODEL_CONCURRENCY"] = str(args.concurrency) # El batch también respeta el límite por modelo
+
+    from starlette.testclient import TestClient
+
+    import app as app_module
+    import asgi_app
+    from tasks import index_document_for_rag
+
+    if not app_module.create_tables():
+        raise SystemExit("No se pudo crear el esquema en la base de datos de benchmark.")
+    client = app_module.app.test_client()
+    username = f"bench_{uuid.uuid4().hex[:10]}"
+    client.post("/register", json={"username": username, "password": "bench-password"})
+    token = client.post("/login", json={"username": username, "password": "bench-password"}).get_json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    corpus = generate_corpus(args.documents, seed=args.seed)
+    for document in corpus:
+        response = client.post("/documents", headers=headers, content_type="multipart/form-data", data={
+            "file": (io.BytesIO(document["content"]), document["filename"], document["mimetype"]),
+        })
+        index_document_for_rag.apply(args=[response.get_json()["document_version_id"]])
+    questions = generate_questions(corpus, args.questions, seed=args.seed + 1)
+
+    # La latencia simulada solo se aplica a las preguntas, no a la indexación.
+    ollama_config.embed_latency_ms = args.embed_latency_ms
+    ollama_config.generate_latency_ms = args.generate_latency_ms
+    results = {"benchmark": "batch_ask", "config": vars(args)}
+
+    ollama_config.requests.update({endpoint: 0 for endpoint in ollama_config.requests})
+    started_at = time.perf_counter()
+    sequential = [client.post("/ask", headers=headers, json={"question": question, "mode": "sync"}).get_json()
+                  for question in questions]
+    results["sequential"] = {"seconds": round(time.perf_counter() - started_at, 2),
+                             "ollama_requests": dict(ollama_config.requests)}
+
+    ollama_config.requests.update({endpoint: 0 for endpoint in ollama_config.requests})
+    started_at = time.perf_counter()
+    with TestClient(asgi_app.app) as asgi_client: # Arranca el lifespan: pool asyncpg y cliente de Ollama
+        response = asgi_client.post("/ask/batch", headers=headers, json={"questions": questions}, timeout=None)
+    lines = [json.loads(line) for line in response.text.splitlines() if line.strip()]
+    results["batch"] = {"seconds": round(time.perf_counter() - started_at, 2),
+                        "ollama_requests": dict(ollama_config.requests), **lines[-1]}
+
+    by_index = {line["index"]: line for line in lines[:-1]}
+    results["same_answers"] = all(by_index[i].get("sources") == sequential[i].get("sources")
+                                  for i in range(len(questions)))
+    results["speedup"] = round(results["sequential"]["seconds"] / results["batch"]["seconds"], 1)
+    ollama_server.shutdown()
+    s3_server.shutdown()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
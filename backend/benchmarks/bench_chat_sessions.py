@@ -0,0 +1,100 @@
+# backend/benchmarks/bench_chat_sessions.py
+"""
+Conversaciones de `--turns` preguntas sobre un mismo documento: preguntas
+independientes a /ask frente a una sesión de /chat/sessions.
+
+Indexa un corpus pequeño con el pipeline real (Ollama y MinIO simulados, como en
+`benchmarks.run_benchmark`) y repite las mismas conversaciones de las dos formas.
+El Ollama simulado cobra `--generate-ms-per-prompt-token` por token de prompt
+procesado, y en la sesión solo procesa el prompt nuevo de cada turno (el resto ya
+está en el `context` que se le reenvía), como Ollama con el KV cache caliente.
+Informa de los tokens de prefill por turno, del tiempo total y de cuántos turnos
+reiniciaron el contexto por no caber en la ventana. Necesita Valkey (VALKEY_URL).
+
+Uso (desde backend/, con la base de datos de testcompose.yml levantada):
+    python -m benchmarks.bench_chat_sessions --conversations 10 --turns 6 --generate-ms-per-prompt-token 1
+"""
+import io
+import json
+import time
+import uuid
+import argparse
+
+from benchmarks.corpus import generate_corpus, generate_questions
+from benchmarks.fake_ollama import start_fake_ollama
+from benchmarks.fake_s3 import start_fake_s3
+from benchmarks.run_benchmark import DEFAULT_DATABASE_URL, EMBEDDING_DIM, configure_environment, _percentiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=DEFAULT_DATABASE_URL)
+    parser.add_argument("--documents", type=int, default=10)
+    parser.add_argument("--conversations", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=6)
+    parser.add_argument("--generate-latency-ms", type=float, default=50.0)
+    parser.add_argument("--generate-ms-per-prompt-token", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    ollama_server, ollama_config, ollama_url = start_fake_ollama(dim=EMBEDDING_DIM)
+    s3_server, _, s3_endpoint = start_fake_s3()
+    configure_environment(args, ollama_url, s3_endpoint)
+
+    import app as app_module
+    from tasks import index_document_for_rag
+
+    if not app_module.create_tables():
+        raise SystemExit("No se pudo crear el esquema en la base de datos de benchmark.")
+    client = app_module.app.test_client()
+    username = f"bench_{uuid.uuid4().hex[:10]}"
+    client.post("/register", json={"username": username, "password": "bench-password"})
+    token = client.post("/login", json={"username": username, "password": "bench-password"}).get_json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    corpus = generate_corpus(args.documents, seed=args.seed)
+    for document in corpus:
+        response = client.post("/documents", headers=headers, content_type="multipart/form-data", data={
+            "file": (io.BytesIO(document["content"]), document["filename"], document["mimetype"]),
+        })
+        index_document_for_rag.apply(args=[response.get_json()["document_version_id"]])
+    # Cada conversación pregunta varias veces por el mismo documento, como un seguimiento
+    conversations = [generate_questions([corpus[i % len(corpus)]], args.turns, seed=args.seed + i)
+                     for i in range(args.conversations)]
+
+    ollama_config.generate_latency_ms = args.generate_latency_ms
+    ollama_config.generate_ms_per_prompt_token = args.generate_ms_per_prompt_token
+    results = {"benchmark": "chat_sessions", "config": vars(args)}
+
+    ollama_config.prompt_eval_tokens = 0
+    started_at = time.perf_counter()
+    for questions in conversations:
+        for question in questions:
+            client.post("/ask", headers=headers, json={"question": question, "mode": "sync"})
+    results["stateless"] = {"seconds": round(time.perf_counter() - started_at, 2),
+                            "prefill_tokens": ollama_config.prompt_eval_tokens,
+                            "prefill_tokens_per_turn": round(ollama_config.prompt_eval_tokens / (args.conversations * args.turns))}
+
+    per_turn = {"first": [], "follow_up": []}
+    resets = 0
+    ollama_config.prompt_eval_tokens = 0
+    started_at = time.perf_counter()
+    for questions in conversations:
+        session_id = client.post("/chat/sessions", headers=headers, json={}).get_json()["session_id"]
+        for turn, question in enumerate(questions):
+            reply = client.post(f"/chat/sessions/{session_id}/messages", headers=headers, json={"question": question}).get_json()
+            per_turn["first" if turn == 0 else "follow_up"].append(reply["prefill_tokens"])
+            resets += reply["context_reset"]
+        client.delete(f"/chat/sessions/{session_id}", headers=headers)
+    results["session"] = {"seconds": round(time.perf_counter() - started_at, 2),
+                          "prefill_tokens": ollama_config.prompt_eval_tokens,
+                          "prefill_tokens_per_turn": {kind: _percentiles(values) for kind, values in per_turn.items()},
+                          "context_resets": resets}
+    results["prefill_reduction"] = round(1 - results["session"]["prefill_tokens"] / results["stateless"]["prefill_tokens"], 2)
+    ollama_server.shutdown()
+    s3_server.shutdown()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
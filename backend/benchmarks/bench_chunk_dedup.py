@@ -0,0 +1,153 @@
+# backend/benchmarks/bench_chunk_dedup.py
+"""
+Deduplicación de chunks en la indexación con un corpus de contratos hechos con
+la misma plantilla.
+
+Cada documento repite las mismas cláusulas de cabecera (duplicados exactos: mismos
+chunks al principio del texto), los datos de las partes (nombres de longitud
+variable que desplazan unas palabras las ventanas siguientes: casi duplicados), las
+cláusulas de la plantilla y unas notas propias. Una fracción `--reuploads` de los
+documentos se sube dos veces.
+
+Indexa el corpus con el pipeline real (Ollama y MinIO simulados, como en
+`benchmarks.run_benchmark`) en dos modos, cada uno con su propio modelo de
+embeddings para no reutilizar los contenidos del otro:
+
+* `exact`: solo duplicados exactos (CHUNK_DEDUP_NEAR_THRESHOLD > 1),
+* `near`: exactos y casi duplicados con el umbral por defecto.
+
+Informa de los chunks, los textos embebidos por Ollama (sin deduplicación serían
+tantos como chunks), las filas de chunk_contents, el ratio de deduplicación y el
+tiempo de indexación; y, con una pregunta sobre la cabecera, de cuántos resultados
+de la búsqueda repiten texto.
+
+Uso (desde backend/, con la base de datos de testcompose.yml levantada):
+    python -m benchmarks.bench_chunk_dedup --documents 200 --embed-latency-ms 20
+"""
+import io
+import json
+import time
+import uuid
+import random
+import argparse
+
+from benchmarks.corpus import VOCABULARY, BOILERPLATE
+from benchmarks.fake_ollama import start_fake_ollama
+from benchmarks.fake_s3 import start_fake_s3
+from benchmarks.run_benchmark import DEFAULT_DATABASE_URL, EMBEDDING_DIM, configure_environment
+
+FIRST_NAMES = ["Ana", "Luis", "María José", "Juan", "Francisco Javier", "Lucía", "José Antonio", "Eva"]
+LAST_NAMES = ["García", "Pérez", "Fernández de la Torre", "Ruiz", "Martínez Sánchez", "Gil", "López"]
+
+
+def _clauses(rng: random.Random, count: int) -> str:
+    return "\n\n".join(
+        f"Cláusula {number}. " + " ".join(" ".join(rng.choices(VOCABULARY, k=rng.randint(8, 18))).capitalize() + "."
+                                         for _ in range(rng.randint(4, 7)))
+        for number in range(1, count + 1))
+
+
+def _name(rng: random.Random) -> str:
+    return f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+
+
+def generate_contracts(documents: int, reuploads: float, seed: int) -> list[bytes]:
+    template_rng = random.Random(seed)
+    header = "\n\n".join(BOILERPLATE * 3) + "\n\n" + _clauses(template_rng, 4)
+    template = _clauses(template_rng, 8)
+    rng = random.Random(seed + 1)
+    contracts = []
+    for _ in range(documents):
+        parties = (f"Reunidos {_name(rng)}, con domicilio en calle {rng.choice(VOCABULARY)} {rng.randint(1, 300)}, "
+                   f"y {_name(rng)}, en representación de {rng.choice(VOCABULARY).capitalize()} S.L.")
+        notes = _clauses(rng, rng.randint(2, 5))
+        contract = f"{header}\n\n{parties}\n\n{template}\n\nNotas.\n\n{notes}".encode("utf-8")
+        contracts.append(contract)
+        if rng.random() < reuploads:
+            contracts.append(contract)
+    return contracts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=DEFAULT_DATABASE_URL)
+    parser.add_argument("--documents", type=int, default=200)
+    parser.add_argument("--reuploads", type=float, default=0.1)
+    parser.add_argument("--embed-latency-ms", type=float, default=20.0)
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    ollama_server, ollama_config, ollama_url = start_fake_ollama(dim=EMBEDDING_DIM)
+    s3_server, _, s3_endpoint = start_fake_s3()
+    configure_environment(args, ollama_url, s3_endpoint)
+
+    from sqlalchemy import text
+    import app as app_module
+    import chunk_dedup
+    import rag_service
+    import tasks
+    from database import SessionLocal
+
+    if not app_module.create_tables():
+        raise SystemExit("No se pudo crear el esquema en la base de datos de benchmark.")
+    client = app_module.app.test_client()
+    contracts = generate_contracts(args.documents, args.reuploads, args.seed)
+    ollama_config.embed_latency_ms = args.embed_latency_ms
+    near_threshold = chunk_dedup.CHUNK_DEDUP_NEAR_THRESHOLD
+    results = {"benchmark": "chunk_dedup", "config": vars(args), "uploads": len(contracts), "modes": {}}
+
+    session = SessionLocal()
+    for mode, threshold in (("exact", 2.0), ("near", near_threshold)):
+        chunk_dedup.CHUNK_DEDUP_NEAR_THRESHOLD = threshold
+        tasks.EMBEDDING_MODEL_KEY = f"bench-dedup-{mode}-{uuid.uuid4().hex[:8]}"
+        username = f"bench_{uuid.uuid4().hex[:10]}"
+        client.post("/register", json={"username": username, "password": "bench-password"})
+        token = client.post("/login", json={"username": username, "password": "bench-password"}).get_json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        user_id = session.execute(text("SELECT id FROM users WHERE username = :username"), {"username": username}).scalar()
+        try:
+            version_ids = [client.post("/documents", headers=headers, content_type="multipart/form-data", data={
+                "file": (io.BytesIO(contract), f"contrato_{index:05d}.txt", "text/plain"),
+            }).get_json()["document_version_id"] for index, contract in enumerate(contracts)]
+
+            ollama_config.embedded_texts = 0
+            outcomes = {"new": 0, "exact": 0, "near": 0}
+            started_at = time.perf_counter()
+            for version_id in version_ids:
+                report = tasks.index_document_for_rag.apply(args=[version_id]).get()
+                for outcome, count in report["dedup"].items():
+                    outcomes[outcome] += count
+            seconds = time.perf_counter() - started_at
+            chunks, embedded_texts = sum(outcomes.values()), ollama_config.embedded_texts
+
+            contents = session.execute(text("SELECT COUNT(*) FROM chunk_contents WHERE embedding_model = :model"),
+                                       {"model": tasks.EMBEDDING_MODEL_KEY}).scalar()
+            question = rag_service.embed_question(BOILERPLATE[0])
+            rows = rag_service.retrieve_chunks(session, user_id, question, limit=10, lambda_mult=1.0)
+            session.rollback()
+            texts = [chunk_dedup.normalize(row["chunk_text"]) for row in rows]
+            results["modes"][mode] = {
+                "chunks": chunks,
+                "embedded_texts": embedded_texts,
+                "chunk_contents": contents,
+                "outcomes": outcomes,
+                "dedup_ratio": round((outcomes["exact"] + outcomes["near"]) / max(chunks, 1), 3),
+                "index_seconds": round(seconds, 2),
+                "top_k_repeated_texts": len(texts) - len(set(texts)),
+            }
+            print(json.dumps({mode: results["modes"][mode]}), flush=True)
+        finally:
+            session.rollback()
+            session.execute(text("DELETE FROM documents WHERE created_by = :user_id"), {"user_id": user_id})
+            session.execute(text("DELETE FROM chunk_contents WHERE embedding_model = :model"),
+                            {"model": tasks.EMBEDDING_MODEL_KEY})
+            session.execute(text("DELETE FROM users WHERE id = :user_id"), {"user_id": user_id})
+            session.commit()
+    session.close()
+    ollama_server.shutdown()
+    s3_server.shutdown()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
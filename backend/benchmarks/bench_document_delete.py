@@ -0,0 +1,146 @@
+# backend/benchmarks/bench_document_delete.py
+"""
+Borrado de documentos grandes: síncrono (como antes) frente a tombstone y purga.
+
+Crea documentos sintéticos con `--versions` versiones, cada una con su fichero en
+MinIO (simulado, como en `benchmarks.run_benchmark`) y `--chunks` chunks con
+contenidos propios, y los borra de dos formas:
+
+* `sync`: lo que hacía DELETE /documents/<id>: un `remove_object` por versión y
+  el borrado del documento, con todos sus chunks en cascada, en una transacción.
+  Sus contenidos de chunk_contents quedan huérfanos hasta la compactación.
+* `tombstone`: DELETE /documents/<id> (solo marca el documento) y después la
+  tarea `tasks.purge_document` (borrado múltiple de S3 y chunks por lotes de
+  PURGE_CHUNK_BATCH, con los contenidos que dejan de usarse).
+
+Informa del tiempo de respuesta del borrado, del tiempo total hasta quedar purgado
+y, en `tombstone`, de lo que purgó la tarea.
+
+Uso (desde backend/, con la base de datos de testcompose.yml levantada):
+    python -m benchmarks.bench_document_delete --versions 50 --chunks 2000
+"""
+import io
+import json
+import time
+import uuid
+import argparse
+
+import numpy as np
+
+from benchmarks.fake_ollama import start_fake_ollama
+from benchmarks.fake_s3 import start_fake_s3
+from benchmarks.run_benchmark import DEFAULT_DATABASE_URL, EMBEDDING_DIM, configure_environment
+
+BENCH_VERSION_SQL = """
+    INSERT INTO document_versions (document_id, ceph_path, encryption_key_encrypted, original_filename, size_bytes,
+                                   version_number, is_latest_version, processed_status, uploaded_by)
+    VALUES (:document_id, :ceph_path, '\\x00', 'bench.txt', 1, :version_number, :latest, 'indexed', :user_id)
+    RETURNING id
+"""
+BENCH_CHUNKS_SQL = """
+    WITH content AS (
+        INSERT INTO chunk_contents (embedding_model, content_hash, chunk_text, chunk_embedding)
+        SELECT 'bench-delete', md5(random()::text || g), 'chunk ' || g, CAST(:embedding AS vector)
+        FROM generate_series(1, :chunks) g
+        RETURNING id
+    )
+    INSERT INTO document_chunks (document_version_id, content_id, chunk_order)
+    SELECT :version_id, id, row_number() OVER () - 1 FROM content
+"""
+
+
+def _create_document(session, s3_client, bucket, user_id, args) -> str:
+    from sqlalchemy import text
+
+    document_id = session.execute(text(
+        "INSERT INTO documents (title, created_by) VALUES ('bench-delete', :user_id) RETURNING id"),
+        {"user_id": user_id}).scalar()
+    embedding = str(np.random.default_rng(0).standard_normal(EMBEDDING_DIM).astype(np.float32).tolist())
+    for number in range(1, args.versions + 1):
+        ceph_path = f"{user_id}/{uuid.uuid4()}-bench.txt"
+        s3_client.put_object(bucket, ceph_path, io.BytesIO(b"x" * 1024), 1024)
+        version_id = session.execute(text(BENCH_VERSION_SQL), {
+            "document_id": document_id, "ceph_path": ceph_path, "version_number": number,
+            "latest": number == args.versions, "user_id": user_id}).scalar()
+        session.execute(text(BENCH_CHUNKS_SQL), {"version_id": version_id, "chunks": args.chunks, "embedding": embedding})
+    session.commit()
+    return str(document_id)
+
+
+def _delete_sync(session, s3_client, bucket, document_id):
+    from sqlalchemy import text
+
+    for row in session.execute(text("SELECT ceph_path FROM document_versions WHERE document_id = :document_id"),
+                               {"document_id": document_id}).all():
+        s3_client.remove_object(bucket, row.ceph_path)
+    session.execute(text("DELETE FROM documents WHERE id = :document_id"), {"document_id": document_id})
+    session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=DEFAULT_DATABASE_URL)
+    parser.add_argument("--versions", type=int, default=50)
+    parser.add_argument("--chunks", type=int, default=2000, help="Chunks por versión.")
+    args = parser.parse_args()
+
+    ollama_server, _, ollama_url = start_fake_ollama(dim=EMBEDDING_DIM)
+    s3_server, _, s3_endpoint = start_fake_s3()
+    configure_environment(args, ollama_url, s3_endpoint)
+
+    from sqlalchemy import text
+    import app as app_module
+    import tasks
+    from database import SessionLocal
+
+    if not app_module.create_tables():
+        raise SystemExit("No se pudo crear el esquema en la base de datos de benchmark.")
+    client = app_module.app.test_client()
+    purges = []
+    app_module.celery_app.send_task = lambda name, args=None, **kwargs: purges.append(args[0]) # Sin worker: se ejecuta aquí
+    s3_client, bucket = tasks.get_s3_client(), tasks.CEPH_BUCKET_NAME
+    if not s3_client.bucket_exists(bucket):
+        s3_client.make_bucket(bucket)
+    username = f"bench_{uuid.uuid4().hex[:10]}"
+    client.post("/register", json={"username": username, "password": "bench-password"})
+    token = client.post("/login", json={"username": username, "password": "bench-password"}).get_json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    results = {"benchmark": "document_delete", "config": vars(args), "cases": {}}
+
+    session = SessionLocal()
+    user_id = session.execute(text("SELECT id FROM users WHERE username = :username"), {"username": username}).scalar()
+    try:
+        document_id = _create_document(session, s3_client, bucket, user_id, args)
+        started_at = time.perf_counter()
+        _delete_sync(session, s3_client, bucket, document_id)
+        seconds = time.perf_counter() - started_at
+        results["cases"]["sync"] = {"response_ms": round(seconds * 1000, 1), "purged_seconds": round(seconds, 2)}
+        print(json.dumps({"sync": results["cases"]["sync"]}), flush=True)
+
+        document_id = _create_document(session, s3_client, bucket, user_id, args)
+        started_at = time.perf_counter()
+        response = client.delete(f"/documents/{document_id}", headers=headers)
+        response_ms = (time.perf_counter() - started_at) * 1000
+        report = tasks.purge_document.apply(args=[purges.pop()]).get()
+        results["cases"]["tombstone"] = {
+            "status": response.status_code,
+            "response_ms": round(response_ms, 1),
+            "purged_seconds": round(time.perf_counter() - started_at, 2),
+            "purge": report,
+        }
+        print(json.dumps({"tombstone": results["cases"]["tombstone"]}), flush=True)
+    finally:
+        session.rollback()
+        session.execute(text("DELETE FROM documents WHERE created_by = :user_id"), {"user_id": user_id})
+        session.execute(text("DELETE FROM chunk_contents cc WHERE cc.embedding_model = 'bench-delete' "
+                             "AND NOT EXISTS (SELECT 1 FROM document_chunks dc WHERE dc.content_id = cc.id)"))
+        session.execute(text("DELETE FROM users WHERE id = :user_id"), {"user_id": user_id})
+        session.commit()
+        session.close()
+    ollama_server.shutdown()
+    s3_server.shutdown()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
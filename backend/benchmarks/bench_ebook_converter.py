@@ -0,0 +1,97 @@
+# backend/benchmarks/bench_ebook_converter.py
+"""
+Conversiones por minuto: `ebook-convert` por libro frente al pool de ebook_converter.py.
+
+Genera libros pequeños del corpus sintético, los pasa al formato pedido con
+`ebook-convert` (preparación, no se mide) y convierte cada uno a texto de las dos
+formas: un proceso `ebook-convert` por libro, como hacía la rama `.azw3`, y el
+pool de conversores de larga duración con `--concurrency` conversiones en vuelo.
+Necesita Calibre (`ebook-convert` y `calibre-debug`) en el PATH.
+
+Uso (desde backend/, en el contenedor del worker):
+    python -m benchmarks.bench_ebook_converter --books 40 --format azw3 --pool-size 2 --concurrency 4
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.corpus import generate_corpus
+from benchmarks.run_benchmark import _percentiles
+
+
+def _prepare_books(count, fmt, paragraphs, seed, workdir):
+    books = []
+    for i, document in enumerate(generate_corpus(count, formats=("txt",), paragraphs_per_doc=paragraphs, seed=seed)):
+        source = os.path.join(workdir, f"book{i}.txt")
+        target = os.path.join(workdir, f"book{i}.{fmt}")
+        with open(source, "wb") as f:
+            f.write(document["content"])
+        subprocess.run(["ebook-convert", source, target], check=True, capture_output=True)
+        with open(target, "rb") as f:
+            books.append(f.read())
+    return books
+
+
+def _run(convert_one, books, concurrency):
+    latencies_ms = []
+
+    def timed(book):
+        started_at = time.perf_counter()
+        convert_one(book)
+        latencies_ms.append((time.perf_counter() - started_at) * 1000)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, books))
+    elapsed = time.perf_counter() - started
+    return {
+        "books": len(books),
+        "conversions_per_minute": round(len(books) / elapsed * 60, 1),
+        "latency_ms": _percentiles(latencies_ms),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--books", type=int, default=40)
+    parser.add_argument("--format", default="azw3")
+    parser.add_argument("--paragraphs", type=int, default=10)
+    parser.add_argument("--pool-size", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    from ebook_converter import EbookConverterPool
+
+    workdir = tempfile.mkdtemp(prefix="bench-ebook-")
+    pool = EbookConverterPool(size=args.pool_size)
+    try:
+        books = _prepare_books(args.books, args.format, args.paragraphs, args.seed, workdir)
+        extension = f".{args.format}"
+
+        def spawn_per_book(book):
+            with tempfile.TemporaryDirectory(dir=workdir) as job_dir:
+                source, target = os.path.join(job_dir, f"in{extension}"), os.path.join(job_dir, "out.txt")
+                with open(source, "wb") as f:
+                    f.write(book)
+                subprocess.run(["ebook-convert", source, target], check=True, capture_output=True)
+
+        results = {"benchmark": "ebook_converter", "config": vars(args)}
+        # El proceso por libro se limita a --pool-size procesos simultáneos para comparar con los mismos recursos.
+        results["spawn_per_book"] = _run(spawn_per_book, books, args.pool_size)
+        pool.convert_to_text(books[0], extension) # Arranque del primer conversor fuera de la medición
+        results["pool"] = _run(lambda book: pool.convert_to_text(book, extension), books, args.concurrency)
+    finally:
+        pool.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# backend/benchmarks/bench_fair_scheduler.py
+"""
+Espera de las subidas sueltas con un usuario que sube miles de ficheros: cola FIFO
+de Celery frente al scheduler justo (ingest_scheduler.py).
+
+Simula el worker con `--workers` hilos que "indexan" cada documento en
+`--service-ms` (los pequeños en `--small-service-ms`) y, al terminar, llaman a
+`ingest_scheduler.finish` como la tarea real. El usuario masivo encola
+`--bulk-documents` documentos grandes de golpe; después, cada `--arrival-ms`, otro
+usuario sube un documento suelto (uno de cada dos pequeño, al carril rápido). Se
+mide cuánto tarda cada subida suelta en quedar indexada. Usa las claves `ingest:*`
+de la base de Valkey indicada, que se vacían al empezar.
+
+Uso (desde backend/):
+    python -m benchmarks.bench_fair_scheduler --valkey-url redis://localhost:6379/15 --bulk-documents 2000
+"""
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+
+from benchmarks.run_benchmark import _percentiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--valkey-url", default="redis://localhost:6379/15")
+    parser.add_argument("--bulk-documents", type=int, default=2000)
+    parser.add_argument("--single-users", type=int, default=20)
+    parser.add_argument("--arrival-ms", type=float, default=50.0)
+    parser.add_argument("--workers", type=int, default=10)
+    parser.add_argument("--fast-slots", type=int, default=2, help="Parte de --workers reservada al carril rápido.")
+    parser.add_argument("--tenant-max-in-flight", type=int, default=4)
+    parser.add_argument("--service-ms", type=float, default=20.0)
+    parser.add_argument("--small-service-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    os.environ.update({
+        "VALKEY_URL": args.valkey_url,
+        "INGEST_MAX_IN_FLIGHT": str(args.workers - args.fast_slots),
+        "INGEST_FAST_MAX_IN_FLIGHT": str(args.fast_slots),
+        "INGEST_TENANT_MAX_IN_FLIGHT": str(args.tenant_max_in_flight),
+        "INGEST_FAST_LANE_MAX_BYTES": "1000",
+    })
+    import ingest_scheduler
+    from valkey_client import get_valkey
+
+    def run(mode):
+        valkey = get_valkey()
+        for key in valkey.scan_iter("ingest:*"):
+            valkey.delete(key)
+        ingest_scheduler.INGEST_SCHEDULER_ENABLED = mode == "fair"
+        celery_queue = queue.Queue() # Una sola cola de Celery en modo FIFO; en modo justo, la suma de ambos carriles
+        owners, sizes, submitted_at, done_at = {}, {}, {}, {}
+        finished = threading.Event()
+
+        def send(document_version_id, lane):
+            celery_queue.put(document_version_id)
+
+        def worker():
+            while not finished.is_set():
+                try:
+                    version_id = celery_queue.get(timeout=0.05)
+                except queue.Empty:
+                    continue
+                time.sleep((args.small_service_ms if sizes[version_id] <= 1000 else args.service_ms) / 1000)
+                done_at[version_id] = time.perf_counter()
+                if mode == "fair":
+                    ingest_scheduler.finish(owners[version_id], version_id, send=send)
+
+        def submit(user, version_id, size):
+            owners[version_id], sizes[version_id] = user, size
+            submitted_at[version_id] = time.perf_counter()
+            ingest_scheduler.submit(user, version_id, size, send=send)
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(args.workers)]
+        for thread in threads:
+            thread.start()
+        started = time.perf_counter()
+        for i in range(args.bulk_documents):
+            submit("bulk-user", f"bulk-{i}", 50_000)
+        singles = []
+        for i in range(args.single_users):
+            time.sleep(args.arrival_ms / 1000)
+            version_id = f"single-{i}"
+            submit(f"user-{i}", version_id, 500 if i % 2 else 50_000)
+            singles.append(version_id)
+        while len(done_at) < args.bulk_documents + args.single_users:
+            time.sleep(0.05)
+        finished.set()
+
+        waits = {"small": [], "large": []}
+        for version_id in singles:
+            waits["small" if sizes[version_id] <= 1000 else "large"].append((done_at[version_id] - submitted_at[version_id]) * 1000)
+        return {
+            "total_seconds": round(time.perf_counter() - started, 2),
+            "single_upload_latency_ms": {kind: _percentiles(values) for kind, values in waits.items()},
+        }
+
+    results = {"benchmark": "fair_scheduler", "config": vars(args)}
+    for mode in ("fifo", "fair"):
+        results[mode] = run(mode)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# backend/benchmarks/bench_mmr.py
+"""
+Latencia añadida por la etapa MMR de /ask.
+
+Uso (desde backend/):
+    python -m benchmarks.bench_mmr --candidates 100 --k 5
+
+Mide por separado la decodificación de los embeddings tal como llegan de
+pgvector (binario de `vector_send()`, y texto '[...]' como referencia) y la
+selección MMR, e imprime los percentiles en JSON.
+"""
+import argparse
+import json
+import struct
+import time
+
+import numpy as np
+
+from mmr import mmr_select, to_matrix
+
+
+def _percentiles(samples_ms):
+    return {f"p{p}": round(float(np.percentile(samples_ms, p)), 4) for p in (50, 95, 99)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--candidates", type=int, default=100)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--lambda-mult", type=float, default=0.7)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    query = rng.standard_normal(args.dim).astype(np.float32)
+    # Candidatos con grupos de casi-duplicados, como el boilerplate repetido entre versiones.
+    base = rng.standard_normal((max(args.candidates // 4, 1), args.dim)).astype(np.float32)
+    candidates = base[rng.integers(0, len(base), args.candidates)] + 0.05 * rng.standard_normal((args.candidates, args.dim)).astype(np.float32)
+    as_binary = [struct.pack(">hh", args.dim, 0) + row.astype(">f4").tobytes() for row in candidates]
+    as_text = ["[" + ",".join(f"{x:.6f}" for x in row) + "]" for row in candidates]
+
+    decode_ms, decode_text_ms, select_ms = [], [], []
+    for _ in range(args.iterations):
+        start = time.perf_counter()
+        vectors = to_matrix(as_binary)
+        decoded = time.perf_counter()
+        mmr_select(query, vectors, args.k, args.lambda_mult)
+        done = time.perf_counter()
+        to_matrix(as_text)
+        decoded_text = time.perf_counter()
+        decode_ms.append((decoded - start) * 1000)
+        select_ms.append((done - decoded) * 1000)
+        decode_text_ms.append((decoded_text - done) * 1000)
+
+    print(json.dumps({
+        "benchmark": "mmr",
+        "candidates": args.candidates,
+        "dim": args.dim,
+        "k": args.k,
+        "iterations": args.iterations,
+        "decode_binary_ms": _percentiles(decode_ms),
+        "decode_text_ms": _percentiles(decode_text_ms),
+        "mmr_select_ms": _percentiles(select_ms),
+        "added_latency_ms": _percentiles([d + s for d, s in zip(decode_ms, select_ms)]),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
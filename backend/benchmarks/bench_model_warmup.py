@@ -0,0 +1,85 @@
+# backend/benchmarks/bench_model_warmup.py
+"""
+Arranque en frío de los modelos de Ollama con y sin el gestor de residencia.
+
+Con un Ollama simulado cuya primera petición a cada modelo paga `--load-latency-ms`
+(la carga en memoria), mide la latencia de la primera pregunta (embedding de la
+pregunta y generación) y de las `--questions` siguientes en dos casos:
+
+* `cold`: sin precarga, como tras un despliegue o cuando expira el keep_alive,
+* `preloaded`: después de `model_residency.warm_all('preload')`, lo que hace el
+  servicio model_manager al arrancar y en cada calentamiento.
+
+Informa además de las cargas registradas en `dv_ollama_model_loads_total` por
+modelo y origen ('request' si la pagó una pregunta).
+
+Uso (desde backend/):
+    python -m benchmarks.bench_model_warmup --load-latency-ms 3000 --generate-latency-ms 200
+"""
+import json
+import time
+import argparse
+
+from benchmarks.fake_ollama import start_fake_ollama
+from benchmarks.run_benchmark import DEFAULT_DATABASE_URL, EMBEDDING_DIM, configure_environment, _percentiles
+
+
+def _loads(metrics):
+    """Cargas registradas hasta ahora: `{"modelo/origen": n}`."""
+    return {f"{sample.labels['model']}/{sample.labels['trigger']}": int(sample.value)
+            for metric in metrics.OLLAMA_MODEL_LOADS.collect() for sample in metric.samples
+            if sample.name.endswith("_total")}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=DEFAULT_DATABASE_URL)
+    parser.add_argument("--load-latency-ms", type=float, default=3000.0)
+    parser.add_argument("--embed-latency-ms", type=float, default=20.0)
+    parser.add_argument("--generate-latency-ms", type=float, default=200.0)
+    parser.add_argument("--questions", type=int, default=5)
+    args = parser.parse_args()
+
+    ollama_server, ollama_config, ollama_url = start_fake_ollama(
+        dim=EMBEDDING_DIM, load_latency_ms=args.load_latency_ms,
+        embed_latency_ms=args.embed_latency_ms, generate_latency_ms=args.generate_latency_ms)
+    configure_environment(args, ollama_url, "http://127.0.0.1:9")
+    import metrics
+    import model_residency
+    import rag_service
+    from ollama_client import generate_with_context
+    from model_residency import OLLAMA_GENERATION_MODEL
+
+    # Las cargas de menos de un segundo cuentan si el benchmark simula cargas cortas.
+    model_residency.MODEL_COLD_LOAD_SECONDS = min(model_residency.MODEL_COLD_LOAD_SECONDS, args.load_latency_ms / 2000)
+    results = {"benchmark": "model_warmup", "config": vars(args), "cases": {}}
+    for case in ("cold", "preloaded"):
+        ollama_config.loaded.clear() # Ollama recién arrancado (o keep_alive expirado)
+        loads_before = _loads(metrics)
+        preload_seconds = 0.0
+        if case == "preloaded":
+            started_at = time.perf_counter()
+            model_residency.warm_all('preload')
+            preload_seconds = time.perf_counter() - started_at
+        latencies_ms = []
+        for q in range(args.questions + 1):
+            started_at = time.perf_counter()
+            rag_service.embed_question(f"pregunta {q} sobre el contrato")
+            generate_with_context(f"Contexto sintético. Pregunta {q}.", OLLAMA_GENERATION_MODEL)
+            latencies_ms.append((time.perf_counter() - started_at) * 1000)
+        loads = {key: value - loads_before.get(key, 0) for key, value in _loads(metrics).items()
+                 if value > loads_before.get(key, 0)}
+        results["cases"][case] = {
+            "preload_seconds": round(preload_seconds, 2),
+            "first_question_ms": round(latencies_ms[0], 1),
+            "next_questions_ms": _percentiles(latencies_ms[1:]),
+            "loads": loads,
+        }
+        print(json.dumps({case: results["cases"][case]}), flush=True)
+
+    ollama_server.shutdown()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# backend/benchmarks/bench_office_extraction.py
+"""
+Memoria pico de la extracción de XLSX: `load_workbook` completo frente a la lectura
+en streaming de office_extraction.py.
+
+Genera libros de tamaño creciente (con el modo `write_only` de openpyxl, sin
+cargarlos en memoria) y extrae cada uno en un proceso hijo limpio, que informa
+de su RSS máximo (`ru_maxrss`) y del tiempo de extracción. Con el streaming, el
+pico de memoria no debe crecer con el número de filas más allá del propio texto.
+
+Uso (desde backend/):
+    python -m benchmarks.bench_office_extraction --rows 10000,50000,200000 --columns 12
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from benchmarks.corpus import VOCABULARY
+
+
+def build_large_xlsx(path, rows, columns, seed=1234):
+    from openpyxl import Workbook
+    rng = random.Random(seed)
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Movimientos")
+    sheet.append([f"columna_{c}" for c in range(columns)])
+    for i in range(rows):
+        sheet.append([i, *(rng.choice(VOCABULARY) if c % 2 else round(rng.random() * 1000, 2)
+                           for c in range(columns - 1))])
+    workbook.save(path)
+
+
+def _legacy_extract(content):
+    # La rama .xlsx anterior de tasks.py: modo completo y un único join.
+    from openpyxl import load_workbook
+    workbook = load_workbook(io.BytesIO(content))
+    text = []
+    for sheet_name in workbook.sheetnames:
+        sheet = workbook[sheet_name]
+        text.append(f"--- Hoja: {sheet_name} ---")
+        for row in sheet.iter_rows():
+            text.append('\t'.join(str(cell.value) if cell.value is not None else "" for cell in row))
+    return '\n'.join(text)
+
+
+def _child(mode, path):
+    with open(path, "rb") as f:
+        content = f.read()
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started_at = time.perf_counter()
+    if mode == "legacy":
+        text = _legacy_extract(content)
+    else:
+        from office_extraction import UNIT_SEPARATOR, iter_xlsx_units
+        text = UNIT_SEPARATOR.join(iter_xlsx_units(content, path))
+    print(json.dumps({
+        "seconds": round(time.perf_counter() - started_at, 2),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "peak_rss_over_baseline_mb": round((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_kb) / 1024, 1),
+        "text_mb": round(len(text) / 1024 / 1024, 1),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", default="10000,50000,200000")
+    parser.add_argument("--columns", type=int, default=12)
+    parser.add_argument("--child", nargs=2, metavar=("MODE", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return _child(*args.child)
+
+    results = {"benchmark": "office_extraction", "config": vars(args), "workbooks": []}
+    with tempfile.TemporaryDirectory() as workdir:
+        for rows in (int(r) for r in args.rows.split(",")):
+            path = os.path.join(workdir, f"{rows}.xlsx")
+            build_large_xlsx(path, rows, args.columns)
+            entry = {"rows": rows, "file_mb": round(os.path.getsize(path) / 1024 / 1024, 1)}
+            for mode in ("legacy", "streaming"):
+                output = subprocess.run([sys.executable, "-m", "benchmarks.bench_office_extraction", "--child", mode, path],
+                                        check=True, capture_output=True, text=True).stdout
+                entry[mode] = json.loads(output.strip().splitlines()[-1])
+            results["workbooks"].append(entry)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+# backend/benchmarks/bench_scoped_retrieval.py
+"""
+Latencia de la búsqueda vectorial de /ask con y sin filtros de alcance.
+
+Crea un usuario con `--documents` documentos de `--chunks-per-document` chunks
+(embeddings aleatorios, repartidos en `--categories` categorías y unas pocas
+etiquetas) y mide `rag_service.retrieve_chunks` sin filtros, por categoría, por
+etiqueta y sobre tres documentos concretos. Para cada caso informa de cuántos
+chunks entran en el alcance, del plan elegido (exacto o HNSW con su
+hnsw.ef_search) y de los percentiles de latencia. Al terminar borra el usuario y
+sus documentos.
+
+Uso (desde backend/, con la base de datos de testcompose.yml levantada):
+    python -m benchmarks.bench_scoped_retrieval --documents 400 --chunks-per-document 50 --queries 50
+"""
+import json
+import time
+import uuid
+import argparse
+from types import SimpleNamespace
+
+import numpy as np
+
+from benchmarks.run_benchmark import DEFAULT_DATABASE_URL, EMBEDDING_DIM, configure_environment, _percentiles
+
+# Cada chunk con su propio contenido (sin duplicados), bajo un modelo de embeddings ficticio.
+BENCH_CHUNK_SQL = """
+    WITH content AS (
+        INSERT INTO chunk_contents (embedding_model, content_hash, chunk_text, chunk_embedding)
+        VALUES ('bench', :content_hash, :chunk_text, CAST(:embedding AS vector))
+        RETURNING id
+    )
+    INSERT INTO document_chunks (document_version_id, content_id, chunk_order)
+    SELECT :version_id, id, :chunk_order FROM content
+"""
+BENCH_CONTENTS_CLEANUP_SQL = """
+    DELETE FROM chunk_contents cc
+    WHERE cc.embedding_model = 'bench' AND NOT EXISTS (SELECT 1 FROM document_chunks dc WHERE dc.content_id = cc.id)
+"""
+
+
+def _populate(session, user_id, args, rng):
+    from sqlalchemy import text
+
+    documents = []
+    for i in range(args.documents):
+        document_id = session.execute(text(
+            "INSERT INTO documents (title, category, tags, created_by) VALUES (:title, :category, :tags, :user_id) RETURNING id"),
+            {"title": f"bench-{i}", "category": f"categoria-{i % args.categories}", "tags": [f"etiqueta-{i % 7}"],
+             "user_id": user_id}).scalar()
+        version_id = session.execute(text(
+            "INSERT INTO document_versions (document_id, ceph_path, encryption_key_encrypted, original_filename, "
+            "version_number, is_latest_version, processed_status, chunks_total, chunks_indexed) "
+            "VALUES (:document_id, 'bench', 'bench', 'bench.txt', 1, TRUE, 'indexed', :chunks, :chunks) RETURNING id"),
+            {"document_id": document_id, "chunks": args.chunks_per_document}).scalar()
+        embeddings = rng.random((args.chunks_per_document, EMBEDDING_DIM), dtype=np.float32)
+        session.execute(text(BENCH_CHUNK_SQL),
+            [{"version_id": version_id, "chunk_text": f"chunk {order} de bench-{i}", "content_hash": uuid.uuid4().hex,
+              "embedding": str(embedding.tolist()), "chunk_order": order}
+             for order, embedding in enumerate(embeddings)])
+        documents.append(str(document_id))
+        session.commit()
+    session.execute(text("ANALYZE documents, document_versions, document_chunks, chunk_contents"))
+    session.commit()
+    return documents
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=DEFAULT_DATABASE_URL)
+    parser.add_argument("--documents", type=int, default=400)
+    parser.add_argument("--chunks-per-document", type=int, default=50)
+    parser.add_argument("--categories", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    # Sin Ollama ni MinIO: los embeddings de las preguntas son aleatorios.
+    configure_environment(args, "http://127.0.0.1:9", "http://127.0.0.1:9")
+    from sqlalchemy import text
+    import app
+    import rag_service
+    from database import SessionLocal
+
+    assert app.create_tables(), "No se pudieron crear las tablas."
+    rng = np.random.default_rng(args.seed)
+    session = SessionLocal()
+    user_id = session.execute(text("INSERT INTO users (username, password_hash) VALUES (:username, 'bench') RETURNING id"),
+                              {"username": f"bench-scoped-{uuid.uuid4().hex[:8]}"}).scalar()
+    session.commit()
+    try:
+        documents = _populate(session, user_id, args, rng)
+        cases = {
+            "sin_filtros": None,
+            "categoria": {"category": "categoria-0"},
+            "etiqueta": {"tags": ["etiqueta-0"]},
+            "tres_documentos": {"document_ids": documents[:3]},
+        }
+        results = {"benchmark": "scoped_retrieval", "config": vars(args), "cases": {}}
+        for name, raw_filters in cases.items():
+            filters = rag_service.parse_filters(raw_filters)
+            params = {"user_id": user_id, **filters}
+            scope = session.execute(text(rag_service.retrieval_queries(filters)["scope"]), params).one()
+            session.rollback()
+            ef_search = rag_service.hnsw_ef_search(scope.scope_chunks, scope.total_chunks, rag_service.RAG_CANDIDATE_CHUNKS)
+            latencies_ms = []
+            for _ in range(args.queries):
+                question_embedding = rng.random(EMBEDDING_DIM, dtype=np.float32).tolist()
+                started_at = time.perf_counter()
+                rag_service.retrieve_chunks(session, user_id, question_embedding, filters=filters)
+                latencies_ms.append((time.perf_counter() - started_at) * 1000)
+                session.rollback()
+            results["cases"][name] = {
+                "scope_chunks": scope.scope_chunks,
+                "plan": f"hnsw (ef_search={ef_search})" if ef_search else "exact",
+                "latency_ms": _percentiles(latencies_ms),
+            }
+    finally:
+        session.rollback()
+        session.execute(text("DELETE FROM documents WHERE created_by = :user_id"), {"user_id": user_id})
+        session.execute(text(BENCH_CONTENTS_CLEANUP_SQL))
+        session.execute(text("DELETE FROM users WHERE id = :user_id"), {"user_id": user_id})
+        session.commit()
+        session.close()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
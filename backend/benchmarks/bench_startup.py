@@ -0,0 +1,95 @@
+# backend/benchmarks/bench_startup.py
+"""
+Tiempo de arranque de la API: cuánto tarda `import app` en un proceso nuevo.
+
+Uso (desde backend/):
+    python -m benchmarks.bench_startup --runs 10
+
+Cada ejecución es un intérprete limpio (como un worker de gunicorn recién creado)
+con los servicios externos apuntando a direcciones inalcanzables: el import no
+debe depender de ellos. Además de los percentiles, informa de los módulos más
+costosos según `-X importtime` y de si se han cargado librerías que no deberían
+estar en el proceso de la API (tasks, extracción de texto, Kafka, ClamAV).
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+import numpy as np
+
+# Módulos que la API no necesita: si aparecen, algo ha vuelto a importar tasks.py o un cliente eagerly.
+UNWANTED_MODULES = ["tasks", "pypdf", "pytesseract", "PIL", "docx", "openpyxl", "pptx", "ebooklib", "kafka", "pyclamd"]
+
+PROBE = """
+import sys, time, json
+started_at = time.perf_counter()
+import app
+elapsed = time.perf_counter() - started_at
+print(json.dumps({"seconds": elapsed, "modules": sorted(m for m in %r if m in sys.modules)}))
+""" % (UNWANTED_MODULES,)
+
+
+def _environment():
+    from cryptography.fernet import Fernet
+    env = dict(os.environ)
+    env.update({
+        # Puertos cerrados: cualquier conexión en el import fallaría o tardaría en agotar el timeout.
+        "POSTGRES_HOST": "127.0.0.1", "POSTGRES_PORT": "1", "POSTGRES_DB": "none",
+        "POSTGRES_USER": "none", "POSTGRES_PASSWORD": "none",
+        "CEPH_ENDPOINT_URL": "http://127.0.0.1:1", "CEPH_BUCKET_NAME": "none",
+        "CELERY_BROKER_URL": "redis://127.0.0.1:1/0", "CELERY_RESULT_BACKEND": "redis://127.0.0.1:1/0",
+        "SYSTEM_MASTER_KEY": Fernet.generate_key().decode("utf-8"),
+        "ENABLE_KAFKA": "true", "KAFKA_BOOTSTRAP_SERVERS": "127.0.0.1:1",
+        "CLAMAV_ENABLED": "true", "CLAMAV_HOST": "127.0.0.1", "CLAMAV_PORT": "1",
+        "LOG_LEVEL": "ERROR",
+    })
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    env.pop("DATABASE_URL", None)
+    return env
+
+
+def _slowest_imports(env, top):
+    """Imports directos de app.py con mayor tiempo acumulado (incluidas sus dependencias) según -X importtime."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"],
+                            env=env, capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        # La columna del nombre se sangra dos espacios por nivel; solo interesan los imports directos de app.
+        if name.startswith("   ") and not name.startswith("     "):
+            rows.append((name.strip(), int(cumulative_us)))
+    rows.sort(key=lambda row: row[1], reverse=True)
+    return [{"module": name, "cumulative_ms": round(us / 1000, 1)} for name, us in rows[:top]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=15, help="Imports directos de app.py más lentos a listar.")
+    args = parser.parse_args()
+
+    env = _environment()
+    samples_ms, loaded = [], set()
+    for _ in range(args.runs):
+        result = subprocess.run([sys.executable, "-c", PROBE], env=env, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise SystemExit(f"`import app` ha fallado:\n{result.stderr[-2000:]}")
+        probe = json.loads(result.stdout.strip().splitlines()[-1])
+        samples_ms.append(probe["seconds"] * 1000)
+        loaded.update(probe["modules"])
+
+    print(json.dumps({
+        "benchmark": "api_startup",
+        "runs": args.runs,
+        "import_app_ms": {f"p{p}": round(float(np.percentile(samples_ms, p)), 1) for p in (50, 95, 99)},
+        "unwanted_modules_loaded": sorted(loaded),
+        "slowest_app_imports": _slowest_imports(env, args.top),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# backend/benchmarks/bench_storage_envelope.py
+"""
+Tamaño y coste de CPU del sobre de almacenamiento (storage_envelope.py) frente a Fernet.
+
+Para cada formato del corpus sintético mide los bytes guardados y el tiempo de
+cifrado y descifrado con Fernet (formato antiguo) y con el sobre binario
+(zstd según el tipo MIME + AES-256-GCM). No necesita servicios externos.
+
+Uso (desde backend/):
+    python -m benchmarks.bench_storage_envelope --documents 40 --repeat 5
+"""
+import json
+import time
+import argparse
+
+from cryptography.fernet import Fernet
+
+import storage_envelope
+from benchmarks.corpus import generate_corpus
+
+
+def _timed(function, repeat):
+    started_at = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return result, (time.perf_counter() - started_at) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=40)
+    parser.add_argument("--formats", default="txt,pdf,docx,xlsx")
+    parser.add_argument("--paragraphs", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    corpus = generate_corpus(args.documents, formats=tuple(args.formats.split(",")),
+                             paragraphs_per_doc=args.paragraphs, seed=args.seed)
+    key = Fernet.generate_key()
+    fernet = Fernet(key)
+    totals = {}
+    for document in corpus:
+        content, mimetype = document["content"], document["mimetype"]
+        legacy, legacy_seal_s = _timed(lambda: fernet.encrypt(content), args.repeat)
+        sealed, seal_s = _timed(lambda: storage_envelope.seal(content, key, mimetype), args.repeat)
+        _, legacy_open_s = _timed(lambda: storage_envelope.open_envelope(legacy, key), args.repeat)
+        opened, open_s = _timed(lambda: storage_envelope.open_envelope(sealed, key), args.repeat)
+        assert opened == content
+
+        row = totals.setdefault(document["filename"].rsplit(".", 1)[-1], {
+            "documents": 0, "plaintext_bytes": 0, "fernet_bytes": 0, "envelope_bytes": 0,
+            "fernet_encrypt_ms": 0.0, "envelope_encrypt_ms": 0.0, "fernet_decrypt_ms": 0.0, "envelope_decrypt_ms": 0.0,
+        })
+        row["documents"] += 1
+        row["plaintext_bytes"] += len(content)
+        row["fernet_bytes"] += len(legacy)
+        row["envelope_bytes"] += len(sealed)
+        row["fernet_encrypt_ms"] += legacy_seal_s * 1000
+        row["envelope_encrypt_ms"] += seal_s * 1000
+        row["fernet_decrypt_ms"] += legacy_open_s * 1000
+        row["envelope_decrypt_ms"] += open_s * 1000
+
+    for row in totals.values():
+        row["envelope_vs_fernet_bytes"] = round(row["envelope_bytes"] / row["fernet_bytes"], 3)
+        for field in ("fernet_encrypt_ms", "envelope_encrypt_ms", "fernet_decrypt_ms", "envelope_decrypt_ms"):
+            row[field] = round(row[field], 2)
+    print(json.dumps({"benchmark": "storage_envelope", "config": vars(args), "formats": totals}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+# backend/benchmarks/bench_two_stage_retrieval.py
+"""
+Búsqueda plana (un solo nivel, exacta o HNSW según el alcance) frente a la búsqueda
+en dos etapas (versiones por su summary_embedding y después sus chunks) a medida
+que crece el corpus de un usuario.
+
+Genera documentos de `--chunks-per-document` chunks con embeddings agrupados por
+temas (`--topics` temas; cada documento es una variación de uno y cada chunk, una
+variación de su documento), calcula el summary_embedding como la indexación y, para
+cada tamaño de `--sizes`, mide `rag_service.retrieve_chunks` con:
+
+* `exact`: búsqueda exacta sobre todos los chunks (referencia para el recall). Es
+  el plan plano de un usuario cuyo alcance es grande pero una parte pequeña de la
+  tabla, en la que el índice HNSW necesitaría un ef_search mayor que el máximo,
+* `flat`: el plan sin dos etapas tal como lo elige rag_service (aquí el usuario es
+  casi toda la tabla, así que por encima de RAG_EXACT_SEARCH_MAX_CHUNKS usa HNSW),
+* `two_stage_<N>`: dos etapas con N versiones candidatas para cada N de `--candidate-documents`
+  (forzadas: en producción sustituyen solo a la búsqueda exacta de alcances grandes).
+
+El recall es la fracción de los chunks devueltos por `exact` que devuelve cada
+plan. Las preguntas son variaciones de chunks al azar. Al terminar borra el usuario
+y sus documentos.
+
+Uso (desde backend/, con la base de datos de testcompose.yml levantada):
+    python -m benchmarks.bench_two_stage_retrieval --sizes 500,2000,5000 --chunks-per-document 40
+"""
+import json
+import time
+import uuid
+import argparse
+
+import numpy as np
+
+from benchmarks.run_benchmark import DEFAULT_DATABASE_URL, EMBEDDING_DIM, configure_environment, _percentiles
+from benchmarks.bench_scoped_retrieval import BENCH_CHUNK_SQL, BENCH_CONTENTS_CLEANUP_SQL
+
+
+def _normalize(matrix):
+    return matrix / np.linalg.norm(matrix, axis=-1, keepdims=True)
+
+
+def _noise(rng, spread, shape):
+    """Ruido de norma ~`spread` (independiente de la dimensión)."""
+    return spread * rng.standard_normal(shape) / np.sqrt(EMBEDDING_DIM)
+
+
+def _populate(session, user_id, start, end, args, topics, rng, chunk_bank):
+    from sqlalchemy import text
+    from tasks import SUMMARY_EMBEDDING_SQL
+
+    for i in range(start, end):
+        document_id = session.execute(text(
+            "INSERT INTO documents (title, category, created_by) VALUES (:title, 'bench', :user_id) RETURNING id"),
+            {"title": f"bench-{i}", "user_id": user_id}).scalar()
+        version_id = session.execute(text(
+            "INSERT INTO document_versions (document_id, ceph_path, encryption_key_encrypted, original_filename, "
+            "version_number, is_latest_version, processed_status, chunks_total, chunks_indexed) "
+            "VALUES (:document_id, 'bench', 'bench', 'bench.txt', 1, TRUE, 'indexed', :chunks, :chunks) RETURNING id"),
+            {"document_id": document_id, "chunks": args.chunks_per_document}).scalar()
+        document_vector = _normalize(topics[rng.integers(len(topics))] + _noise(rng, args.document_spread, EMBEDDING_DIM))
+        embeddings = _normalize(document_vector + _noise(rng, args.chunk_spread, (args.chunks_per_document, EMBEDDING_DIM)))
+        session.execute(text(BENCH_CHUNK_SQL),
+            [{"version_id": version_id, "chunk_text": f"chunk {order} de bench-{i}", "content_hash": uuid.uuid4().hex,
+              "embedding": str(embedding.tolist()), "chunk_order": order}
+             for order, embedding in enumerate(embeddings)])
+        session.execute(text(SUMMARY_EMBEDDING_SQL), {"version_id": version_id})
+        chunk_bank.append(embeddings[rng.integers(len(embeddings))])
+        session.commit()
+    session.execute(text("ANALYZE documents, document_versions, document_chunks, chunk_contents"))
+    session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=DEFAULT_DATABASE_URL)
+    parser.add_argument("--sizes", default="500,2000,5000", help="Documentos del usuario en cada medición.")
+    parser.add_argument("--chunks-per-document", type=int, default=40)
+    parser.add_argument("--topics", type=int, default=50)
+    parser.add_argument("--document-spread", type=float, default=0.8)
+    parser.add_argument("--chunk-spread", type=float, default=0.6)
+    parser.add_argument("--candidate-documents", default="10,20,50")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    # Sin Ollama ni MinIO: las preguntas son vectores cerca de chunks del corpus.
+    configure_environment(args, "http://127.0.0.1:9", "http://127.0.0.1:9")
+    from sqlalchemy import text
+    import app
+    import rag_service
+    from database import SessionLocal
+
+    assert app.create_tables(), "No se pudieron crear las tablas."
+    rng = np.random.default_rng(args.seed)
+    topics = _normalize(rng.standard_normal((args.topics, EMBEDDING_DIM)))
+    exact_max_chunks, ef_search_max = rag_service.RAG_EXACT_SEARCH_MAX_CHUNKS, rag_service.RAG_HNSW_EF_SEARCH_MAX
+    cases = {"exact": {"exact_max_chunks": 10 ** 12, "ef_search_max": ef_search_max, "candidate_documents": 0},
+             "flat": {"exact_max_chunks": exact_max_chunks, "ef_search_max": ef_search_max, "candidate_documents": 0}}
+    for n in (int(value) for value in args.candidate_documents.split(",")):
+        cases[f"two_stage_{n}"] = {"exact_max_chunks": 0, "ef_search_max": 0, "candidate_documents": n}
+    rag_service.RAG_TWO_STAGE_MIN_VERSIONS = 0
+
+    session = SessionLocal()
+    user_id = session.execute(text("INSERT INTO users (username, password_hash) VALUES (:username, 'bench') RETURNING id"),
+                              {"username": f"bench-two-stage-{uuid.uuid4().hex[:8]}"}).scalar()
+    session.commit()
+    results = {"benchmark": "two_stage_retrieval", "config": vars(args), "sizes": {}}
+    chunk_bank, populated = [], 0
+    try:
+        for size in sorted(int(value) for value in args.sizes.split(",")):
+            _populate(session, user_id, populated, size, args, topics, rng, chunk_bank)
+            populated = size
+            questions = [_normalize(chunk_bank[rng.integers(len(chunk_bank))]
+                                    + _noise(rng, 0.5 * args.chunk_spread, EMBEDDING_DIM)).tolist() for _ in range(args.queries)]
+            expected, measured = [], {}
+            for name, case in cases.items():
+                rag_service.RAG_EXACT_SEARCH_MAX_CHUNKS = case["exact_max_chunks"]
+                rag_service.RAG_HNSW_EF_SEARCH_MAX = case["ef_search_max"]
+                latencies_ms, recalls = [], []
+                for q, question_embedding in enumerate(questions):
+                    started_at = time.perf_counter()
+                    rows = rag_service.retrieve_chunks(session, user_id, question_embedding,
+                                                       candidate_documents=case["candidate_documents"])
+                    latencies_ms.append((time.perf_counter() - started_at) * 1000)
+                    session.rollback()
+                    found = {(str(row["document_version_id"]), row["chunk_order"]) for row in rows}
+                    if name == "exact":
+                        expected.append(found)
+                    recalls.append(len(found & expected[q]) / max(len(expected[q]), 1))
+                measured[name] = {"latency_ms": _percentiles(latencies_ms), "recall": round(float(np.mean(recalls)), 3)}
+            results["sizes"][size] = {"chunks": size * args.chunks_per_document, **measured}
+            print(json.dumps({size: results["sizes"][size]}), flush=True)
+    finally:
+        rag_service.RAG_EXACT_SEARCH_MAX_CHUNKS, rag_service.RAG_HNSW_EF_SEARCH_MAX = exact_max_chunks, ef_search_max
+        session.rollback()
+        session.execute(text("DELETE FROM documents WHERE created_by = :user_id"), {"user_id": user_id})
+        session.execute(text(BENCH_CONTENTS_CLEANUP_SQL))
+        session.execute(text("DELETE FROM users WHERE id = :user_id"), {"user_id": user_id})
+        session.commit()
+        session.close()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# backend/benchmarks/bench_version_retention.py
+"""
+Retención de versiones: tamaño de las tablas de vectores y latencia de la
+búsqueda antes y después de archivar las versiones superadas.
+
+Sube `--documents` documentos con `--versions` versiones cada uno (cada versión
+reescribe una parte de las cláusulas de la anterior) y los indexa con el pipeline
+real (Ollama y MinIO simulados, como en `benchmarks.run_benchmark`) sin retención,
+como se indexaba antes. Después aplica la política con `--keep` versiones y una
+pasada de compactación (`version_retention.compact`).
+
+Informa, en cada fase, de las filas de document_chunks y chunk_contents, del tamaño
+de sus tablas e índices (VACUUM no devuelve el espacio al sistema de ficheros, pero
+lo deja libre para las inserciones siguientes), de las filas de archived_chunks y de
+la latencia de `/ask` (búsqueda y MMR) sobre las últimas versiones.
+
+Uso (desde backend/, con la base de datos de testcompose.yml levantada):
+    python -m benchmarks.bench_version_retention --documents 40 --versions 6 --keep 2
+"""
+import io
+import json
+import time
+import uuid
+import random
+import argparse
+
+from benchmarks.corpus import VOCABULARY
+from benchmarks.bench_chunk_dedup import _clauses
+from benchmarks.fake_ollama import start_fake_ollama
+from benchmarks.fake_s3 import start_fake_s3
+from benchmarks.run_benchmark import DEFAULT_DATABASE_URL, EMBEDDING_DIM, configure_environment, _percentiles
+
+SIZES_SQL = """
+    SELECT pg_total_relation_size('document_chunks'), pg_total_relation_size('chunk_contents'),
+           pg_relation_size('ix_chunk_contents_embedding_hnsw'), pg_total_relation_size('archived_chunks')
+"""
+
+
+def _snapshot(session, user_id, model_key, questions, rag_service):
+    from sqlalchemy import text
+
+    counts = session.execute(text("""
+        SELECT (SELECT COUNT(*) FROM document_chunks dc JOIN document_versions dv ON dv.id = dc.document_version_id
+                WHERE dv.uploaded_by = :user_id),
+               (SELECT COUNT(*) FROM chunk_contents WHERE embedding_model = :model),
+               (SELECT COUNT(*) FROM archived_chunks ac JOIN document_versions dv ON dv.id = ac.document_version_id
+                WHERE dv.uploaded_by = :user_id)
+    """), {"user_id": user_id, "model": model_key}).one()
+    sizes = session.execute(text(SIZES_SQL)).one()
+    session.rollback()
+    latencies_ms = []
+    for question in questions:
+        started_at = time.perf_counter()
+        rag_service.retrieve_chunks(session, user_id, question)
+        latencies_ms.append((time.perf_counter() - started_at) * 1000)
+        session.rollback()
+    return {
+        "document_chunks": counts[0],
+        "chunk_contents": counts[1],
+        "archived_chunks": counts[2],
+        "bytes": {"document_chunks": sizes[0], "chunk_contents": sizes[1], "chunk_contents_hnsw": sizes[2],
+                  "archived_chunks": sizes[3]},
+        "retrieve_ms": _percentiles(latencies_ms),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=DEFAULT_DATABASE_URL)
+    parser.add_argument("--documents", type=int, default=40)
+    parser.add_argument("--versions", type=int, default=6)
+    parser.add_argument("--keep", type=int, default=2)
+    parser.add_argument("--rewrite", type=float, default=0.3, help="Fracción de cláusulas que cambia cada versión.")
+    parser.add_argument("--questions", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    ollama_server, _, ollama_url = start_fake_ollama(dim=EMBEDDING_DIM)
+    s3_server, _, s3_endpoint = start_fake_s3()
+    configure_environment(args, ollama_url, s3_endpoint)
+
+    from sqlalchemy import text
+    import app as app_module
+    import rag_service
+    import tasks
+    import version_retention
+    from database import SessionLocal, engine
+
+    if not app_module.create_tables():
+        raise SystemExit("No se pudo crear el esquema en la base de datos de benchmark.")
+    client = app_module.app.test_client()
+    rng = random.Random(args.seed)
+    tasks.EMBEDDING_MODEL_KEY = f"bench-retention-{uuid.uuid4().hex[:8]}"
+    username = f"bench_{uuid.uuid4().hex[:10]}"
+    client.post("/register", json={"username": username, "password": "bench-password"})
+    token = client.post("/login", json={"username": username, "password": "bench-password"}).get_json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    results = {"benchmark": "version_retention", "config": vars(args), "phases": {}}
+
+    session = SessionLocal()
+    user_id = session.execute(text("SELECT id FROM users WHERE username = :username"), {"username": username}).scalar()
+    try:
+        # Indexación sin retención: todas las versiones se quedan en las tablas calientes.
+        version_retention.RETENTION_KEEP_VERSIONS = 0
+        started_at = time.perf_counter()
+        for index in range(args.documents):
+            clauses = _clauses(rng, 12).split("\n\n")
+            document_id = None
+            for _ in range(args.versions):
+                for position in rng.sample(range(len(clauses)), max(1, int(len(clauses) * args.rewrite))):
+                    clauses[position] = _clauses(rng, 1)
+                data = {"file": (io.BytesIO("\n\n".join(clauses).encode("utf-8")), f"contrato_{index:05d}.txt", "text/plain")}
+                if document_id:
+                    data["document_id"] = document_id
+                response = client.post("/documents", headers=headers, content_type="multipart/form-data", data=data).get_json()
+                document_id = response["document_id"]
+                tasks.index_document_for_rag.apply(args=[response["document_version_id"]]).get()
+        results["index_seconds"] = round(time.perf_counter() - started_at, 2)
+        session.execute(text("ANALYZE document_chunks, chunk_contents"))
+        session.commit()
+
+        questions = [rag_service.embed_question(" ".join(rng.choices(VOCABULARY, k=8))) for _ in range(args.questions)]
+        results["phases"]["all_versions"] = _snapshot(session, user_id, tasks.EMBEDDING_MODEL_KEY, questions, rag_service)
+        print(json.dumps({"all_versions": results["phases"]["all_versions"]}), flush=True)
+
+        version_retention.RETENTION_KEEP_VERSIONS = args.keep
+        results["compaction"] = version_retention.compact(session, engine, version_retention.RETENTION_COMPACTION_MAX_SECONDS)
+        results["phases"]["retained"] = _snapshot(session, user_id, tasks.EMBEDDING_MODEL_KEY, questions, rag_service)
+        print(json.dumps({"retained": results["phases"]["retained"]}), flush=True)
+    finally:
+        session.rollback()
+        session.execute(text("DELETE FROM documents WHERE created_by = :user_id"), {"user_id": user_id})
+        session.execute(text("DELETE FROM chunk_contents WHERE embedding_model = :model"), {"model": tasks.EMBEDDING_MODEL_KEY})
+        session.execute(text("DELETE FROM users WHERE id = :user_id"), {"user_id": user_id})
+        session.commit()
+        session.close()
+    ollama_server.shutdown()
+    s3_server.shutdown()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# backend/benchmarks/compare.py
+"""
+Compara dos ficheros de resultados de `benchmarks.run_benchmark`.
+
+Uso (desde backend/):
+    python -m benchmarks.compare results/base.json results/candidato.json
+
+Imprime cada métrica numérica común con su valor base, el nuevo y la variación
+relativa. Avisa si las configuraciones de ambas ejecuciones no coinciden, porque
+entonces la comparación no es directa.
+"""
+import json
+import argparse
+
+
+def _flatten(data, prefix=""):
+    values = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            values.update(_flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[name] = value
+    return values
+
+
+def compare(base: dict, candidate: dict) -> list[tuple]:
+    """Lista de `(métrica, base, candidato, variación %)` de las métricas presentes en ambos."""
+    base_values = _flatten({k: v for k, v in base.items() if k != "metadata"})
+    candidate_values = _flatten({k: v for k, v in candidate.items() if k != "metadata"})
+    rows = []
+    for name in sorted(base_values.keys() & candidate_values.keys()):
+        old, new = base_values[name], candidate_values[name]
+        change = ((new - old) / old * 100) if old else None
+        rows.append((name, old, new, change))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("base")
+    parser.add_argument("candidate")
+    args = parser.parse_args()
+
+    with open(args.base, encoding="utf-8") as handle:
+        base = json.load(handle)
+    with open(args.candidate, encoding="utf-8") as handle:
+        candidate = json.load(handle)
+
+    base_config = dict(base.get("metadata", {}).get("config", {}))
+    candidate_config = dict(candidate.get("metadata", {}).get("config", {}))
+    base_config.pop("output", None)
+    candidate_config.pop("output", None)
+    if base_config != candidate_config:
+        print("AVISO: las ejecuciones usan configuraciones distintas.")
+
+    print(f"base: {base.get('metadata', {}).get('git_commit')}  candidato: {candidate.get('metadata', {}).get('git_commit')}")
+    width = max((len(row[0]) for row in compare(base, candidate)), default=10)
+    for name, old, new, change in compare(base, candidate):
+        change_str = f"{change:+.1f}%" if change is not None else "n/a"
+        print(f"{name:<{width}}  {old:>12}  {new:>12}  {change_str:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+# backend/benchmarks/corpus.py
+"""
+Generador determinista de un corpus sintético (PDF, DOCX, XLSX y TXT).
+
+El texto combina un vocabulario fijo con párrafos de "boilerplate" repetidos
+(avisos legales, cabeceras) como los del corpus real. El PDF se escribe a mano
+(una fuente estándar, sin dependencias); DOCX y XLSX usan python-docx y openpyxl,
+las mismas librerías que la extracción.
+"""
+import io
+import random
+
+VOCABULARY = (
+    "contrato arrendamiento propiedad factura informe anual proyecto cliente proveedor pago plazo "
+    "cláusula garantía entrega servicio mantenimiento auditoría presupuesto riesgo seguro póliza "
+    "empleado nómina vacaciones política seguridad acceso datos personales confidencial firma "
+    "anexo vigencia renovación penalización rescisión importe impuesto moneda banco cuenta "
+    "inventario almacén pedido envío devolución calidad norma certificado licencia software "
+    "servidor red copia respaldo incidente soporte usuario contraseña reunión acta acuerdo"
+).split()
+
+BOILERPLATE = [
+    "Este documento es confidencial y está destinado exclusivamente a su destinatario. "
+    "Queda prohibida su reproducción total o parcial sin autorización previa por escrito.",
+    "Las partes se someten a la jurisdicción de los tribunales competentes, renunciando a "
+    "cualquier otro fuero que pudiera corresponderles por razón de su domicilio presente o futuro.",
+]
+
+FORMATS = {
+    "txt": "text/plain",
+    "pdf": "application/pdf",
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+
+def _sentence(rng: random.Random) -> str:
+    words = rng.choices(VOCABULARY, k=rng.randint(8, 18))
+    return " ".join(words).capitalize() + "."
+
+
+def _paragraphs(rng: random.Random, count: int, boilerplate_ratio: float) -> list[str]:
+    paragraphs = []
+    for _ in range(count):
+        if rng.random() < boilerplate_ratio:
+            paragraphs.append(rng.choice(BOILERPLATE))
+        else:
+            paragraphs.append(" ".join(_sentence(rng) for _ in range(rng.randint(3, 7))))
+    return paragraphs
+
+
+def _pdf_escape(line: str) -> str:
+    # La fuente estándar no cubre todo Unicode: se reduce a Latin-1 y se escapan los delimitadores.
+    line = line.encode("latin-1", "replace").decode("latin-1")
+    return line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def build_pdf(paragraphs: list[str], lines_per_page: int = 45, width: int = 90) -> bytes:
+    lines = []
+    for paragraph in paragraphs:
+        words, current = paragraph.split(), ""
+        for word in words:
+            if len(current) + len(word) + 1 > width:
+                lines.append(current)
+                current = word
+            else:
+                current = f"{current} {word}".strip()
+        lines.extend([current, ""])
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)] or [[""]]
+
+    objects = []  # cuerpo de cada objeto, el número es índice + 1
+    font_id = 3
+    page_ids = []
+    objects.append(None) # 1: catálogo
+    objects.append(None) # 2: árbol de páginas
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+    for page_lines in pages:
+        text_ops = "".join(f"({_pdf_escape(line)}) Tj T* " for line in page_lines)
+        stream = f"BT /F1 10 Tf 12 TL 50 780 Td {text_ops}ET".encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_id = len(objects)
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents {content_id} 0 R "
+                       f"/Resources << /Font << /F1 {font_id} 0 R >> >> >>".encode("latin-1"))
+        page_ids.append(len(objects))
+    objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    kids = " ".join(f"{pid} 0 R" for pid in page_ids)
+    objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode("latin-1")
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+    xref_at = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_at))
+    return out.getvalue()
+
+
+def build_docx(paragraphs: list[str]) -> bytes:
+    from docx import Document
+    document = Document()
+    for paragraph in paragraphs:
+        document.add_paragraph(paragraph)
+    out = io.BytesIO()
+    document.save(out)
+    return out.getvalue()
+
+
+def build_xlsx(rows: list[list]) -> bytes:
+    from openpyxl import Workbook
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.title = "Movimientos"
+    sheet.append(["id", "concepto", "cliente", "importe", "descripcion"])
+    for row in rows:
+        sheet.append(row)
+    out = io.BytesIO()
+    workbook.save(out)
+    return out.getvalue()
+
+
+def generate_corpus(documents: int, formats=("txt", "pdf", "docx", "xlsx"), paragraphs_per_doc: int = 20,
+                    boilerplate_ratio: float = 0.15, seed: int = 1234) -> list[dict]:
+    """
+    Devuelve `documents` documentos en rotación de formatos. Cada elemento tiene
+    `filename`, `mimetype`, `content` (bytes) y `text` (texto de referencia para las preguntas).
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for index in range(documents):
+        extension = formats[index % len(formats)]
+        paragraphs = _paragraphs(rng, paragraphs_per_doc, boilerplate_ratio)
+        if extension == "txt":
+            content = "\n\n".join(paragraphs).encode("utf-8")
+        elif extension == "pdf":
+            content = build_pdf(paragraphs)
+        elif extension == "docx":
+            content = build_docx(paragraphs)
+        elif extension == "xlsx":
+            rows = [[row_id, rng.choice(VOCABULARY), rng.choice(VOCABULARY), round(rng.uniform(10, 10000), 2),
+                     _sentence(rng)] for row_id in range(paragraphs_per_doc * 5)]
+            paragraphs = [row[-1] for row in rows]
+            content = build_xlsx(rows)
+        else:
+            raise ValueError(f"Formato no soportado por el generador: {extension}")
+        corpus.append({
+            "filename": f"bench_{index:05d}.{extension}",
+            "mimetype": FORMATS[extension],
+            "content": content,
+            "text": " ".join(paragraphs),
+        })
+    return corpus
+
+
+def generate_questions(corpus: list[dict], count: int, seed: int = 4321) -> list[str]:
+    """Preguntas construidas con fragmentos reales del corpus, para que la búsqueda encuentre contexto."""
+    rng = random.Random(seed)
+    questions = []
+    for _ in range(count):
+        words = rng.choice(corpus)["text"].split()
+        start = rng.randrange(max(len(words) - 8, 1))
+        questions.append("¿Qué dice el documento sobre " + " ".join(words[start:start + 6]).strip(".,") + "?")
+    return questions
@@ -0,0 +1,179 @@
+# backend/benchmarks/fake_ollama.py
+"""
+Servidor HTTP que imita la API de Ollama para benchmarks sin modelos reales.
+
+Los embeddings son deterministas (hashing de palabras sobre `dim` dimensiones), de
+modo que textos que comparten vocabulario quedan cerca y la búsqueda vectorial se
+comporta de forma realista. La latencia de cada endpoint es configurable, y la de
+generación puede crecer con el tamaño del prompt para modelar el coste del prefill.
+La primera petición a cada modelo paga además `load_latency_ms` (carga en memoria)
+y lo devuelve en `load_duration`, como Ollama; /api/ps lista los modelos cargados.
+
+Uso independiente (desde backend/):
+    python -m benchmarks.fake_ollama --port 11434 --embed-latency-ms 20 --generate-latency-ms 500
+"""
+import argparse
+import json
+import math
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def deterministic_embedding(text: str, dim: int = 768) -> list[float]:
+    """Vector normalizado por hashing de palabras: mismo texto, mismo embedding."""
+    vector = [0.0] * dim
+    for word in _WORD_RE.findall(text.lower()):
+        digest = zlib.crc32(word.encode("utf-8"))
+        vector[digest % dim] += 1.0 if (digest >> 16) & 1 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+class FakeOllamaConfig:
+    def __init__(self, dim=768, embed_latency_ms=0.0, generate_latency_ms=0.0,
+                 generate_ms_per_prompt_token=0.0, chars_per_token=4.0, load_latency_ms=0.0):
+        self.dim = dim
+        self.embed_latency_ms = embed_latency_ms
+        self.generate_latency_ms = generate_latency_ms
+        self.generate_ms_per_prompt_token = generate_ms_per_prompt_token
+        self.chars_per_token = chars_per_token
+        self.load_latency_ms = load_latency_ms # Carga de un modelo que no está en memoria (la primera petición)
+        self.loaded = set() # Modelos en memoria, como /api/ps
+        self.requests = {"embeddings": 0, "embed": 0, "generate": 0}
+        self.prompt_eval_tokens = 0 # Suma de prompt_eval_count devueltos por /api/generate
+        self.embedded_texts = 0 # Textos embebidos por /api/embeddings y /api/embed
+        self.lock = threading.Lock()
+
+    def count(self, endpoint, texts=0):
+        with self.lock:
+            self.requests[endpoint] += 1
+            self.embedded_texts += texts
+
+    def load(self, model):
+        """Simula la carga de `model` si no estaba en memoria. Devuelve `load_duration` en nanosegundos."""
+        with self.lock:
+            if model in self.loaded:
+                return 0
+            self.loaded.add(model)
+        time.sleep(self.load_latency_ms / 1000)
+        return int(self.load_latency_ms * 1e6)
+
+    def count_prompt_tokens(self, tokens):
+        with self.lock:
+            self.prompt_eval_tokens += tokens
+
+
+def _make_handler(config: FakeOllamaConfig):
+    class FakeOllamaHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass # Silencioso: el ruido de logs distorsiona las mediciones
+
+        def _send_json(self, payload, status=200):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/api/tags":
+                return self._send_json({"models": []})
+            if self.path == "/api/ps":
+                return self._send_json({"models": [{"name": name if ":" in name else f"{name}:latest"}
+                                                   for name in sorted(config.loaded)]})
+            return self._send_json({"error": "not found"}, 404)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+
+            if self.path == "/api/embeddings":
+                config.count("embeddings", texts=1)
+                time.sleep(config.embed_latency_ms / 1000)
+                return self._send_json({"embedding": deterministic_embedding(payload.get("prompt", ""), config.dim)})
+
+            if self.path == "/api/embed":
+                inputs = payload.get("input", [])
+                inputs = [inputs] if isinstance(inputs, str) else inputs
+                config.count("embed", texts=len(inputs))
+                load_duration = config.load(payload.get("model"))
+                time.sleep(config.embed_latency_ms * max(len(inputs), 1) / 1000)
+                return self._send_json({
+                    "model": payload.get("model"),
+                    "embeddings": [deterministic_embedding(text, config.dim) for text in inputs],
+                    "load_duration": load_duration,
+                })
+
+            if self.path == "/api/generate":
+                config.count("generate")
+                load_duration = config.load(payload.get("model"))
+                prompt = payload.get("prompt", "")
+                prompt_tokens = math.ceil(len(prompt) / config.chars_per_token)
+                config.count_prompt_tokens(prompt_tokens)
+                prefill_ms = config.generate_ms_per_prompt_token * prompt_tokens
+                time.sleep((config.generate_latency_ms + prefill_ms) / 1000)
+                answer = f"Respuesta sintética basada en {prompt_tokens} tokens de prompt."
+                return self._send_json({
+                    "model": payload.get("model"),
+                    "response": answer,
+                    "done": True,
+                    # Como Ollama: los tokens de la conversación recibida más los del prompt y la respuesta.
+                    # Con el KV cache caliente solo se procesa el prompt nuevo (prompt_eval_count).
+                    "context": (payload.get("context") or [])
+                               + [zlib.crc32(prompt.encode("utf-8")) % 32000] * (prompt_tokens + len(answer.split())),
+                    "prompt_eval_count": prompt_tokens,
+                    "eval_count": len(answer.split()),
+                    "load_duration": load_duration,
+                    "total_duration": int((config.generate_latency_ms + prefill_ms) * 1e6),
+                })
+
+            return self._send_json({"error": "not found"}, 404)
+
+    return FakeOllamaHandler
+
+
+class _FakeOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024 # Cientos de conexiones simultáneas en los benchmarks de concurrencia
+
+
+def start_fake_ollama(host="127.0.0.1", port=0, **config_kwargs):
+    """Arranca el servidor en un hilo. Devuelve `(server, config, base_url)`."""
+    config = FakeOllamaConfig(**config_kwargs)
+    server = _FakeOllamaServer((host, port), _make_handler(config))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, config, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--embed-latency-ms", type=float, default=0.0)
+    parser.add_argument("--generate-latency-ms", type=float, default=0.0)
+    parser.add_argument("--generate-ms-per-prompt-token", type=float, default=0.0)
+    parser.add_argument("--load-latency-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server, _, base_url = start_fake_ollama(
+        args.host, args.port, dim=args.dim, embed_latency_ms=args.embed_latency_ms,
+        generate_latency_ms=args.generate_latency_ms, generate_ms_per_prompt_token=args.generate_ms_per_prompt_token,
+        load_latency_ms=args.load_latency_ms)
+    print(f"Fake Ollama escuchando en {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+# backend/benchmarks/fake_s3.py
+"""
+Sustituto local y en memoria de MinIO para benchmarks.
+
+Implementa el subconjunto de la API S3 que usa el cliente `minio` del proyecto:
+buckets (HEAD/PUT/location), objetos (PUT/GET/HEAD/DELETE), subida multipart,
+borrado múltiple (POST ?delete) y listado v2. No valida firmas: cualquier
+credencial es aceptada.
+
+Uso independiente (desde backend/):
+    python -m benchmarks.fake_s3 --port 9000
+"""
+import argparse
+import hashlib
+import threading
+import uuid
+from datetime import datetime, timezone
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+S3_NS = "http://s3.amazonaws.com/doc/2006-03-01/"
+
+
+class ObjectStore:
+    def __init__(self):
+        self.buckets = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def stored_bytes(self) -> int:
+        with self.lock:
+            return sum(len(obj["data"]) for objects in self.buckets.values() for obj in objects.values())
+
+    def object_count(self) -> int:
+        with self.lock:
+            return sum(len(objects) for objects in self.buckets.values())
+
+
+def _iso(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def _make_handler(store: ObjectStore):
+    class FakeS3Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        # --- helpers ---
+        def _parse(self):
+            parts = urlsplit(self.path)
+            path = unquote(parts.path).lstrip("/")
+            bucket, _, key = path.partition("/")
+            return bucket, key, {k: v[0] for k, v in parse_qs(parts.query, keep_blank_values=True).items()}
+
+        def _body(self) -> bytes:
+            length = int(self.headers.get("Content-Length", 0))
+            return self.rfile.read(length) if length else b""
+
+        def _send(self, status=200, body=b"", headers=None, content_type="application/xml", content_length=None):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body) if content_length is None else content_length))
+            self.end_headers()
+            if body and self.command != "HEAD":
+                self.wfile.write(body)
+
+        def _xml(self, root_tag, inner, status=200):
+            body = f'<?xml version="1.0" encoding="UTF-8"?><{root_tag} xmlns="{S3_NS}">{inner}</{root_tag}>'
+            self._send(status, body.encode("utf-8"))
+
+        def _error(self, status, code, resource=""):
+            body = (f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code><Message>{code}</Message>'
+                    f'<Resource>{escape(resource)}</Resource><RequestId>fake</RequestId><HostId>fake</HostId></Error>')
+            self._send(status, body.encode("utf-8"))
+
+        def _bucket(self, bucket):
+            return store.buckets.get(bucket)
+
+        # --- verbs ---
+        def do_HEAD(self):
+            bucket, key, _ = self._parse()
+            with store.lock:
+                objects = self._bucket(bucket)
+                if objects is None:
+                    return self._send(404)
+                if not key:
+                    return self._send(200)
+                obj = objects.get(key)
+            if obj is None:
+                return self._send(404)
+            self._send(200, headers={"ETag": f'"{obj["etag"]}"', "Last-Modified": formatdate(obj["mtime"], usegmt=True)},
+                       content_type="application/octet-stream", content_length=len(obj["data"]))
+
+        def do_GET(self):
+            bucket, key, query = self._parse()
+            with store.lock:
+                objects = self._bucket(bucket)
+                if objects is None:
+                    return self._error(404, "NoSuchBucket", bucket)
+                if "location" in query:
+                    return self._xml("LocationConstraint", "")
+                if not key:
+                    return self._list(bucket, objects, query)
+                obj = objects.get(key)
+            if obj is None:
+                return self._error(404, "NoSuchKey", key)
+            self._send(200, obj["data"], headers={"ETag": f'"{obj["etag"]}"',
+                                                  "Last-Modified": formatdate(obj["mtime"], usegmt=True)},
+                       content_type="application/octet-stream")
+
+        def _list(self, bucket, objects, query):
+            prefix = query.get("prefix", "")
+            delimiter = query.get("delimiter", "")
+            max_keys = int(query.get("max-keys", 1000) or 1000)
+            start_after = query.get("continuation-token") or query.get("start-after", "")
+            keys = sorted(k for k in objects if k.startswith(prefix) and k > start_after)
+            contents, prefixes = [], []
+            for k in keys:
+                if delimiter and delimiter in k[len(prefix):]:
+                    common = prefix + k[len(prefix):].split(delimiter, 1)[0] + delimiter
+                    if common not in prefixes:
+                        prefixes.append(common)
+                    continue
+                contents.append(k)
+            truncated = len(contents) > max_keys
+            contents = contents[:max_keys]
+            inner = [f"<Name>{escape(bucket)}</Name><Prefix>{escape(prefix)}</Prefix><KeyCount>{len(contents)}</KeyCount>",
+                     f"<MaxKeys>{max_keys}</MaxKeys><IsTruncated>{'true' if truncated else 'false'}</IsTruncated>"]
+            if truncated:
+                inner.append(f"<NextContinuationToken>{escape(contents[-1])}</NextContinuationToken>")
+            for k in contents:
+                obj = objects[k]
+                inner.append(f"<Contents><Key>{escape(k)}</Key><LastModified>{_iso(obj['mtime'])}</LastModified>"
+                             f"<ETag>\"{obj['etag']}\"</ETag><Size>{len(obj['data'])}</Size>"
+                             f"<StorageClass>STANDARD</StorageClass></Contents>")
+            for common in prefixes:
+                inner.append(f"<CommonPrefixes><Prefix>{escape(common)}</Prefix></CommonPrefixes>")
+            self._xml("ListBucketResult", "".join(inner))
+
+        def do_PUT(self):
+            bucket, key, query = self._parse()
+            body = self._body()
+            with store.lock:
+                if not key:
+                    store.buckets.setdefault(bucket, {})
+                    return self._send(200)
+                objects = self._bucket(bucket)
+                if objects is None:
+                    return self._error(404, "NoSuchBucket", bucket)
+                etag = hashlib.md5(body).hexdigest()
+                if "uploadId" in query:
+                    upload = store.uploads.get(query["uploadId"])
+                    if upload is None:
+                        return self._error(404, "NoSuchUpload", key)
+                    upload["parts"][int(query["partNumber"])] = body
+                else:
+                    objects[key] = {"data": body, "etag": etag, "mtime": datetime.now(timezone.utc).timestamp()}
+            self._send(200, headers={"ETag": f'"{etag}"'})
+
+        def do_POST(self):
+            bucket, key, query = self._parse()
+            body = self._body()
+            with store.lock:
+                objects = self._bucket(bucket)
+                if objects is None:
+                    return self._error(404, "NoSuchBucket", bucket)
+                if "delete" in query:
+                    root = ElementTree.fromstring(body)
+                    deleted = []
+                    for element in root.iter():
+                        if element.tag.endswith("Key"):
+                            objects.pop(element.text, None)
+                            deleted.append(element.text)
+                    quiet = any(e.tag.endswith("Quiet") and (e.text or "").lower() == "true" for e in root.iter())
+                    inner = "" if quiet else "".join(f"<Deleted><Key>{escape(k)}</Key></Deleted>" for k in deleted)
+                    return self._xml("DeleteResult", inner)
+                if "uploads" in query:
+                    upload_id = uuid.uuid4().hex
+                    store.uploads[upload_id] = {"bucket": bucket, "key": key, "parts": {}}
+                    return self._xml("InitiateMultipartUploadResult",
+                                     f"<Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key><UploadId>{upload_id}</UploadId>")
+                if "uploadId" in query:
+                    upload = store.uploads.pop(query["uploadId"], None)
+                    if upload is None:
+                        return self._error(404, "NoSuchUpload", key)
+                    data = b"".join(upload["parts"][n] for n in sorted(upload["parts"]))
+                    etag = hashlib.md5(data).hexdigest()
+                    objects[key] = {"data": data, "etag": etag, "mtime": datetime.now(timezone.utc).timestamp()}
+                    return self._xml("CompleteMultipartUploadResult",
+                                     f"<Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key><ETag>\"{etag}\"</ETag>")
+            self._error(400, "InvalidRequest", key)
+
+        def do_DELETE(self):
+            bucket, key, query = self._parse()
+            with store.lock:
+                objects = self._bucket(bucket)
+                if objects is None:
+                    return self._error(404, "NoSuchBucket", bucket)
+                if "uploadId" in query:
+                    store.uploads.pop(query["uploadId"], None)
+                elif key:
+                    objects.pop(key, None)
+                else:
+                    store.buckets.pop(bucket, None)
+            self._send(204)
+
+    return FakeS3Handler
+
+
+def start_fake_s3(host="127.0.0.1", port=0):
+    """Arranca el servidor en un hilo. Devuelve `(server, store, endpoint_url)`."""
+    store = ObjectStore()
+    server = ThreadingHTTPServer((host, port), _make_handler(store))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, store, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    args = parser.parse_args()
+    server, _, endpoint = start_fake_s3(args.host, args.port)
+    print(f"Fake S3 escuchando en {endpoint}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
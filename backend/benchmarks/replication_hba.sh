@@ -0,0 +1,4 @@
+#!/bin/sh
+# Script de inicialización de bench_postgres (testcompose.yml): permite la conexión de replicación de bench_postgres_replica.
+set -e
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
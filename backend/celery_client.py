@@ -0,0 +1,23 @@
+# backend/celery_client.py
+"""
+Aplicación Celery sin tareas registradas, para quien solo necesita encolar o
+consultar resultados (la API). Los workers arrancan con `celery -A tasks`, que
+importa esta misma aplicación y registra las tareas sobre ella.
+"""
+import os
+
+from celery import Celery
+
+CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', 'redis://localhost:6379/0')
+CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', 'redis://localhost:6379/0')
+celery_app = Celery('tasks', broker=CELERY_BROKER_URL, backend=CELERY_RESULT_BACKEND)
+# /ask generations go to their own queue so they never wait behind (or block) document indexing.
+celery_app.conf.task_routes = {
+    'tasks.generate_answer_for_job': {'queue': os.getenv('ASK_JOB_QUEUE', 'generation')},
+}
+celery_app.conf.result_expires = int(os.getenv('ASK_JOB_TTL_SECONDS', '3600'))
+
+# Nombres de las tareas definidas en tasks.py, para encolarlas con `send_task` sin importar ese módulo.
+INDEX_DOCUMENT_TASK = 'tasks.index_document_for_rag'
+GENERATE_ANSWER_TASK = 'tasks.generate_answer_for_job'
+PURGE_DOCUMENT_TASK = 'tasks.purge_document'
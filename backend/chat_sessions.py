@@ -0,0 +1,277 @@
+# backend/chat_sessions.py
+"""
+Conversaciones sobre los documentos del usuario (/chat/sessions).
+
+Cada pregunta de /ask es independiente: reenvía todo el contexto recuperado y
+Ollama vuelve a procesar (prefill) el prompt entero. En una sesión de chat se
+guarda en Valkey el estado de la conversación:
+
+* los turnos anteriores (pregunta, respuesta y fuentes),
+* los chunks que ya están en la conversación (`version_id:chunk_order`),
+* el `context` que devuelve /api/generate: los tokens de la conversación, que se
+  envían en el turno siguiente para que Ollama continúe sobre ellos (y reutilice
+  su KV cache si el modelo sigue cargado, de ahí el `keep_alive`).
+
+El primer turno lleva el prompt completo. En los siguientes solo viajan los
+chunks recuperados que aún no estaban en la conversación, con referencias `[n]`
+que siguen a las anteriores, y la pregunta nueva. Cuando la conversación ya no
+deja sitio en la ventana (CHAT_MIN_TURN_TOKENS), se empieza un contexto nuevo
+con el prompt completo y los últimos CHAT_HISTORY_TURNS turnos como texto.
+
+Cada turno informa de `prefill_tokens` (`prompt_eval_count` de Ollama: tokens de
+prompt procesados en ese turno). Las sesiones caducan tras CHAT_SESSION_TTL_SECONDS
+sin uso y cada usuario conserva como mucho CHAT_MAX_SESSIONS_PER_USER: al crear
+una más se descartan las usadas hace más tiempo.
+"""
+import os
+import json
+import time
+import logging
+from uuid import UUID, uuid4
+
+import rag_service
+import context_builder
+from valkey_client import get_valkey
+from ollama_client import generate_with_context
+from metrics import observe_stage, ASK_STAGE_SECONDS, ASK_REQUESTS, CHAT_PREFILL_TOKENS
+
+CHAT_SESSION_TTL_SECONDS = int(os.getenv("CHAT_SESSION_TTL_SECONDS", "1800"))
+CHAT_MAX_SESSIONS_PER_USER = int(os.getenv("CHAT_MAX_SESSIONS_PER_USER", "20"))
+CHAT_MAX_TURNS = int(os.getenv("CHAT_MAX_TURNS", "50")) # Turnos que se conservan para GET /chat/sessions/<id>
+CHAT_HISTORY_TURNS = int(os.getenv("CHAT_HISTORY_TURNS", "3")) # Turnos reenviados como texto al reiniciar el contexto
+CHAT_MIN_TURN_TOKENS = int(os.getenv("CHAT_MIN_TURN_TOKENS", "512"))
+# Mantiene el modelo (y su KV cache) cargado entre turnos; Ollama lo descarga a los 5 minutos por defecto.
+CHAT_KEEP_ALIVE = os.getenv("CHAT_KEEP_ALIVE", "30m")
+CHAT_TURN_LOCK_SECONDS = int(os.getenv("CHAT_TURN_LOCK_SECONDS", os.getenv("OLLAMA_GENERATION_TIMEOUT", "1200")))
+
+# Borra el cerrojo del turno solo si sigue siendo nuestro (no caducó y lo tomó otra petición).
+_RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class SessionBusy(Exception):
+    """La sesión ya está respondiendo otro turno."""
+
+
+def _session_key(session_id):
+    return f"chat:session:{session_id}"
+
+def _lock_key(session_id):
+    return f"chat:session:{session_id}:lock"
+
+def _user_sessions_key(user_id):
+    return f"chat:user_sessions:{user_id}"
+
+
+def _chunk_key(chunk) -> str:
+    return f"{chunk['document_version_id']}:{chunk['chunk_order']}"
+
+
+def _first_turn_template(question: str, context: str, history: str = "") -> str:
+    return (
+        f"Vas a mantener una conversación sobre los documentos del usuario. Responde a cada pregunta "
+        f"basándote en el contexto. Si la respuesta no se encuentra directamente en el contexto, indica que no tienes "
+        f"suficiente información y no intentes inventar la respuesta. Cita las fuentes con su número entre corchetes.\n\n"
+        + (f"Conversación anterior:\n{history}\n\n" if history else "")
+        + f"Contexto:\n{context}\n\n"
+        f"Pregunta: {question}\n"
+        f"Respuesta:"
+    )
+
+
+def _follow_up_template(question: str, context: str) -> str:
+    return (
+        (f"Nuevo contexto:\n{context}\n\n" if context else "")
+        + f"Pregunta: {question}\n"
+        f"Respuesta:"
+    )
+
+
+def _history_text(turns: list[dict]) -> str:
+    return "\n".join(f"Pregunta: {turn['question']}\nRespuesta: {turn['answer']}"
+                     for turn in turns[-CHAT_HISTORY_TURNS:]) if CHAT_HISTORY_TURNS > 0 else ""
+
+
+def create_session(user_id, raw_filters=None, model_name: str = None) -> dict:
+    """
+    Crea una sesión vacía (los filtros de alcance se validan aquí y valen para toda la
+    conversación) y descarta las más antiguas del usuario si supera CHAT_MAX_SESSIONS_PER_USER.
+    """
+    rag_service.parse_filters(raw_filters)
+    now = time.time()
+    session = {
+        "session_id": str(uuid4()),
+        "user_id": str(user_id),
+        "model": model_name or rag_service.OLLAMA_GENERATION_MODEL,
+        "filters": raw_filters or None,
+        "created_at": now,
+        "updated_at": now,
+        "turns": [],
+        "turn_count": 0,
+        "included": [],
+        "context": [],
+        "refs": 0,
+        "prefill_tokens": 0,
+    }
+    save_session(session)
+
+    valkey = get_valkey()
+    index_key = _user_sessions_key(user_id)
+    valkey.zremrangebyscore(index_key, "-inf", now - CHAT_SESSION_TTL_SECONDS)
+    evicted = valkey.zcard(index_key) - CHAT_MAX_SESSIONS_PER_USER
+    if evicted > 0:
+        for session_id, _ in valkey.zpopmin(index_key, evicted):
+            valkey.delete(_session_key(session_id))
+            logging.info(f"Sesión de chat {session_id} del usuario {user_id} descartada (CHAT_MAX_SESSIONS_PER_USER).")
+    return session
+
+
+def save_session(session: dict):
+    """Guarda la sesión y renueva su caducidad y su posición entre las del usuario."""
+    session["updated_at"] = time.time()
+    valkey = get_valkey()
+    pipe = valkey.pipeline()
+    pipe.set(_session_key(session["session_id"]), json.dumps(session), ex=CHAT_SESSION_TTL_SECONDS)
+    pipe.zadd(_user_sessions_key(session["user_id"]), {session["session_id"]: session["updated_at"]})
+    pipe.expire(_user_sessions_key(session["user_id"]), CHAT_SESSION_TTL_SECONDS)
+    pipe.execute()
+
+
+def get_session(session_id: str, user_id) -> dict | None:
+    """Devuelve la sesión o None si no existe, caducó o es de otro usuario."""
+    raw = get_valkey().get(_session_key(session_id))
+    if not raw:
+        return None
+    session = json.loads(raw)
+    return session if session["user_id"] == str(user_id) else None
+
+
+def delete_session(session_id: str, user_id) -> bool:
+    if not get_session(session_id, user_id):
+        return False
+    valkey = get_valkey()
+    valkey.delete(_session_key(session_id))
+    valkey.zrem(_user_sessions_key(user_id), session_id)
+    return True
+
+
+def describe_session(session: dict) -> dict:
+    """Cuerpo JSON de GET /chat/sessions/<id>: los turnos sin el estado interno de Ollama."""
+    return {
+        "session_id": session["session_id"],
+        "model": session["model"],
+        "filters": session["filters"],
+        "created_at": session["created_at"],
+        "updated_at": session["updated_at"],
+        "turns": session["turns"],
+        "turn_count": session["turn_count"],
+        "context_tokens": len(session["context"]),
+        "prefill_tokens": session["prefill_tokens"],
+        "expires_in": get_valkey().ttl(_session_key(session["session_id"])),
+    }
+
+
+def _acquire_turn(session_id: str) -> str:
+    token = str(uuid4())
+    if not get_valkey().set(_lock_key(session_id), token, nx=True, ex=CHAT_TURN_LOCK_SECONDS):
+        raise SessionBusy("La sesión ya está respondiendo otra pregunta.")
+    return token
+
+
+def _release_turn(session_id: str, token: str):
+    try:
+        get_valkey().eval(_RELEASE_LOCK_LUA, 1, _lock_key(session_id), token)
+    except Exception as e:
+        logging.warning(f"No se pudo liberar el turno de la sesión de chat {session_id}: {e}")
+
+
+def answer_turn(db_session, session_id: str, user_id, question: str) -> dict | None:
+    """
+    Responde una pregunta dentro de la sesión y devuelve el cuerpo JSON del turno, o None si la
+    sesión no existe. Lanza SessionBusy si la sesión está respondiendo otro turno; el resto de
+    excepciones se propagan al llamador y la sesión queda como estaba.
+    """
+    token = _acquire_turn(session_id)
+    try:
+        session = get_session(session_id, user_id)
+        if session is None:
+            return None
+        result = _run_turn(db_session, session, question)
+        save_session(session)
+        return result
+    finally:
+        _release_turn(session_id, token)
+
+
+def _append_turn(session: dict, turn: dict) -> dict:
+    session["turn_count"] += 1
+    session["turns"].append(turn)
+    del session["turns"][:-CHAT_MAX_TURNS]
+    return {"session_id": session["session_id"], "turn": session["turn_count"], **turn}
+
+
+def _run_turn(db_session, session: dict, question: str) -> dict:
+    model_name = session["model"]
+    turns = session["turns"]
+    filters = rag_service.parse_filters(session["filters"])
+
+    # Las preguntas de seguimiento suelen ser elípticas ("¿y en la versión 2?"): se busca con la anterior delante.
+    search_text = f"{turns[-1]['question']}\n{question}" if turns else question
+    question_embedding = rag_service.embed_question(search_text)
+    if question_embedding is None:
+        raise ValueError("No se pudo generar el embedding de la pregunta.")
+    retrieved_chunks = rag_service.retrieve_chunks(db_session, UUID(session["user_id"]), question_embedding, filters=filters)
+
+    conversation = session["context"]
+    window = context_builder.get_context_window(model_name)
+    follow_up = bool(conversation) and (
+        window - context_builder.RAG_ANSWER_TOKENS - len(conversation)
+        - context_builder.estimate_tokens(_follow_up_template(question, "")) >= CHAT_MIN_TURN_TOKENS)
+
+    if not follow_up and not retrieved_chunks:
+        ASK_REQUESTS.labels(mode='chat', outcome='no_context').inc()
+        turn = {"question": question, "answer": rag_service.NO_CONTEXT_ANSWER, "sources": [], "prefill_tokens": 0,
+                "context_reset": False}
+        return {**_append_turn(session, turn), "context_tokens": len(conversation)}
+
+    with observe_stage(ASK_STAGE_SECONDS, stage='context', model=model_name):
+        if follow_up:
+            kind = 'follow_up'
+            included = set(session["included"])
+            new_chunks = [chunk for chunk in retrieved_chunks if _chunk_key(chunk) not in included]
+            context, sources = context_builder.build_context(
+                new_chunks, model_name, prompt_overhead=_follow_up_template(question, ""), overlap=context_builder.CHUNK_OVERLAP,
+                ref_offset=session["refs"], reserved_tokens=len(conversation))
+            prompt = _follow_up_template(question, context)
+        else:
+            # Primer turno, o la conversación ya no cabe: contexto nuevo con los últimos turnos como texto,
+            # dejando sitio en la ventana para al menos un turno de seguimiento
+            kind = 'reset' if conversation else 'first'
+            history = _history_text(turns) if conversation else ""
+            session["included"], conversation = [], []
+            context, sources = context_builder.build_context(
+                retrieved_chunks, model_name, prompt_overhead=_first_turn_template(question, "", history),
+                overlap=context_builder.CHUNK_OVERLAP, ref_offset=session["refs"], reserved_tokens=CHAT_MIN_TURN_TOKENS)
+            prompt = _first_turn_template(question, context, history)
+
+    logging.info(f"Turno {session['turn_count'] + 1} ({kind}) de la sesión de chat {session['session_id']}: {prompt[:200]}...")
+    with observe_stage(ASK_STAGE_SECONDS, stage='generation', model=model_name):
+        generation = generate_with_context(prompt, model_name, options=context_builder.generation_options(model_name),
+                                           context=conversation or None, keep_alive=CHAT_KEEP_ALIVE)
+
+    prefill_tokens = int(generation.get("prompt_eval_count") or 0)
+    CHAT_PREFILL_TOKENS.labels(kind=kind).observe(prefill_tokens)
+    ASK_REQUESTS.labels(mode='chat', outcome='answered').inc()
+    session["context"] = generation.get("context") or []
+    session["included"].extend(f"{source['document_version_id']}:{order}"
+                               for source in sources for order in source["chunk_orders"])
+    session["refs"] += len(sources)
+    session["prefill_tokens"] += prefill_tokens
+
+    turn = {"question": question, "answer": generation.get("response", ""), "sources": sources,
+            "prefill_tokens": prefill_tokens, "context_reset": kind == 'reset'}
+    return {**_append_turn(session, turn), "context_tokens": len(session["context"])}
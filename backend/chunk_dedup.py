@@ -0,0 +1,200 @@
+# backend/chunk_dedup.py
+"""
+Deduplicación de chunks en la indexación: el boilerplate repetido (avisos legales,
+cabeceras, cláusulas de contrato) no se vuelve a embeber ni a guardar.
+
+Cada chunk apunta a una fila de `chunk_contents` con el texto y el embedding:
+
+* Duplicado exacto: mismo SHA-256 del texto normalizado (`normalize`: minúsculas y
+  espacios colapsados) para el mismo modelo de embeddings. Comparte texto y embedding.
+* Casi duplicado: firma MinHash de shingles de CHUNK_DEDUP_SHINGLE_WORDS palabras con
+  similitud de Jaccard estimada >= CHUNK_DEDUP_NEAR_THRESHOLD frente a un contenido ya
+  guardado o anterior del mismo lote. Los candidatos salen del índice LSH
+  (`chunk_content_bands`, CHUNK_DEDUP_BANDS bandas de la firma). Comparte el embedding
+  pero conserva su propio texto en document_chunks, para no citar el de otro documento.
+
+Solo los contenidos nuevos se embeben. Uso por lote de la indexación:
+`plan_batch` -> embeber los textos con outcome 'new' -> `store_contents`.
+"""
+import os
+import re
+import zlib
+import hashlib
+
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+
+from models import ChunkContent, ChunkContentBand
+
+# Similitud de Jaccard estimada a partir de la que un chunk reutiliza el embedding de otro (> 1 la desactiva).
+CHUNK_DEDUP_NEAR_THRESHOLD = float(os.getenv("CHUNK_DEDUP_NEAR_THRESHOLD", "0.9"))
+# Los chunks más cortos solo se deduplican de forma exacta: unos pocos shingles no dan una estimación fiable.
+CHUNK_DEDUP_MIN_WORDS = int(os.getenv("CHUNK_DEDUP_MIN_WORDS", "20"))
+CHUNK_DEDUP_SHINGLE_WORDS = 3
+# 16 bandas de 4 valores: un par con Jaccard 0.9 es candidato con probabilidad ~1 y uno con 0.5, ~0.64
+# (después se descarta comparando las firmas completas).
+CHUNK_DEDUP_PERMUTATIONS = 64
+CHUNK_DEDUP_BANDS = 16
+
+# Permutaciones (a * x + b) mod p fijas: las firmas guardadas deben seguir siendo comparables entre workers
+# y despliegues. Con p = 2^31 - 1 el producto cabe en uint64 y cada valor de la firma, en uint32.
+_PRIME = np.uint64((1 << 31) - 1)
+_rng = np.random.default_rng(20240531)
+_PERM_A = _rng.integers(1, int(_PRIME), CHUNK_DEDUP_PERMUTATIONS, dtype=np.uint64)
+_PERM_B = _rng.integers(0, int(_PRIME), CHUNK_DEDUP_PERMUTATIONS, dtype=np.uint64)
+
+_WORD_RE = re.compile(r"\w+")
+
+# Contenidos ya guardados con el mismo texto normalizado.
+EXISTING_CONTENTS_SQL = """
+    SELECT id, content_hash, chunk_text
+    FROM chunk_contents
+    WHERE embedding_model = :embedding_model AND content_hash = ANY(CAST(:hashes AS text[]))
+"""
+
+# Contenidos que comparten alguna banda con las firmas del lote (las claves ya incluyen el modelo).
+BAND_CANDIDATES_SQL = """
+    SELECT DISTINCT cc.id, cc.minhash
+    FROM chunk_content_bands b
+    JOIN chunk_contents cc ON cc.id = b.content_id
+    WHERE b.band_key = ANY(CAST(:band_keys AS bigint[]))
+"""
+
+
+def normalize(chunk: str) -> str:
+    return " ".join(chunk.split()).lower()
+
+
+def content_hash(chunk: str) -> str:
+    return hashlib.sha256(normalize(chunk).encode('utf-8')).hexdigest()
+
+
+def minhash_signature(chunk: str):
+    """Firma MinHash (uint32) de los shingles de palabras del chunk, o None si es demasiado corto."""
+    words = _WORD_RE.findall(normalize(chunk))
+    if len(words) < max(CHUNK_DEDUP_MIN_WORDS, CHUNK_DEDUP_SHINGLE_WORDS):
+        return None
+    shingles = {" ".join(words[i:i + CHUNK_DEDUP_SHINGLE_WORDS])
+                for i in range(len(words) - CHUNK_DEDUP_SHINGLE_WORDS + 1)}
+    hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles),
+                         dtype=np.uint64, count=len(shingles)) % _PRIME
+    return ((hashes[:, None] * _PERM_A + _PERM_B) % _PRIME).min(axis=0).astype(np.uint32)
+
+
+def band_keys(embedding_model: str, signature) -> list[int]:
+    """Claves LSH (bigint con signo) de cada banda de la firma, separadas por modelo de embeddings."""
+    rows = CHUNK_DEDUP_PERMUTATIONS // CHUNK_DEDUP_BANDS
+    keys = []
+    for band in range(CHUNK_DEDUP_BANDS):
+        digest = hashlib.blake2b(f"{embedding_model}:{band}:".encode('utf-8'), digest_size=8)
+        digest.update(signature[band * rows:(band + 1) * rows].astype("<u4").tobytes())
+        keys.append(int.from_bytes(digest.digest(), 'big', signed=True))
+    return keys
+
+
+def similarity(signature, signatures) -> np.ndarray:
+    """Jaccard estimada frente a cada fila de `signatures`: fracción de posiciones en las que coinciden."""
+    return (np.asarray(signatures).reshape(-1, CHUNK_DEDUP_PERMUTATIONS) == signature).mean(axis=1)
+
+
+def _signature_from_bytes(value):
+    return np.frombuffer(bytes(value), dtype="<u4") if value is not None else None
+
+
+def plan_batch(db_session, embedding_model: str, chunks: list[str]) -> list[dict]:
+    """
+    Decide qué chunks del lote reutilizan un contenido. Devuelve una entrada por chunk con `outcome`
+    ('new', 'exact' o 'near') y, si lo reutiliza, `content_id` (contenido ya guardado) o `source`
+    (índice del chunk nuevo del lote del que toma el contenido).
+    """
+    entries = [{"text": chunk, "hash": content_hash(chunk), "outcome": 'new', "content_id": None,
+                "content_text": None, "source": None, "signature": None} for chunk in chunks]
+    existing = {row.content_hash: row for row in db_session.execute(text(EXISTING_CONTENTS_SQL), {
+        "embedding_model": embedding_model, "hashes": sorted({entry["hash"] for entry in entries})})}
+    first_by_hash = {}
+    for index, entry in enumerate(entries):
+        if entry["hash"] in existing:
+            row = existing[entry["hash"]]
+            entry.update(outcome='exact', content_id=row.id, content_text=row.chunk_text)
+        elif entry["hash"] in first_by_hash:
+            entry.update(outcome='exact', source=first_by_hash[entry["hash"]])
+        else:
+            first_by_hash[entry["hash"]] = index
+
+    if CHUNK_DEDUP_NEAR_THRESHOLD > 1:
+        return entries
+    pending = [entry for entry in entries if entry["outcome"] == 'new']
+    for entry in pending:
+        entry["signature"] = minhash_signature(entry["text"])
+        if entry["signature"] is not None:
+            entry["bands"] = band_keys(embedding_model, entry["signature"])
+    all_keys = sorted({key for entry in pending for key in entry.get("bands", ())})
+    candidate_ids, candidate_signatures = [], np.empty((0, CHUNK_DEDUP_PERMUTATIONS), dtype=np.uint32)
+    if all_keys:
+        rows = [row for row in db_session.execute(text(BAND_CANDIDATES_SQL), {"band_keys": all_keys})
+                if row.minhash is not None]
+        if rows:
+            candidate_ids = [row.id for row in rows]
+            candidate_signatures = np.stack([_signature_from_bytes(row.minhash) for row in rows])
+
+    batch_bands = {} # clave de banda -> índices de los chunks nuevos del lote con esa banda
+    for index, entry in enumerate(entries):
+        if entry["outcome"] != 'new' or entry["signature"] is None:
+            continue
+        best_score, best = CHUNK_DEDUP_NEAR_THRESHOLD, None
+        if candidate_ids:
+            scores = similarity(entry["signature"], candidate_signatures)
+            position = int(scores.argmax())
+            if scores[position] >= best_score:
+                best_score, best = scores[position], ("content_id", candidate_ids[position])
+        others = sorted({i for key in entry["bands"] for i in batch_bands.get(key, ())})
+        if others:
+            scores = similarity(entry["signature"], [entries[i]["signature"] for i in others])
+            position = int(scores.argmax())
+            if scores[position] >= best_score:
+                best = ("source", others[position])
+        if best:
+            entry.update(outcome='near', **{best[0]: best[1]})
+        else:
+            for key in entry["bands"]:
+                batch_bands.setdefault(key, []).append(index)
+    return entries
+
+
+def store_contents(db_session, embedding_model: str, entries: list[dict], embeddings) -> None:
+    """
+    Guarda los contenidos nuevos con sus embeddings (en el orden de los outcome 'new') y sus bandas LSH,
+    y completa `content_id` y `content_text` de todas las entradas. Si otro worker guardó antes el mismo
+    contenido, se usa el suyo. No hace commit.
+    """
+    new_entries = [entry for entry in entries if entry["outcome"] == 'new']
+    if new_entries:
+        statement = insert(ChunkContent).values([
+            {
+                "embedding_model": embedding_model,
+                "content_hash": entry["hash"],
+                "chunk_text": entry["text"],
+                "chunk_embedding": embedding,
+                "minhash": entry["signature"].astype("<u4").tobytes() if entry["signature"] is not None else None,
+            }
+            for entry, embedding in zip(new_entries, embeddings)
+        ])
+        inserted = {row.content_hash: row.id for row in db_session.execute(
+            statement.on_conflict_do_nothing(index_elements=['embedding_model', 'content_hash'])
+            .returning(ChunkContent.id, ChunkContent.content_hash))}
+        stored = {row.content_hash: row for row in db_session.execute(text(EXISTING_CONTENTS_SQL), {
+            "embedding_model": embedding_model, "hashes": sorted({entry["hash"] for entry in new_entries})})}
+        bands = []
+        for entry in new_entries:
+            row = stored[entry["hash"]]
+            entry.update(content_id=row.id, content_text=row.chunk_text)
+            if entry["hash"] in inserted and entry.get("bands"):
+                bands.extend({"band_key": key, "content_id": row.id} for key in set(entry["bands"]))
+        if bands:
+            db_session.execute(insert(ChunkContentBand).values(bands).on_conflict_do_nothing())
+
+    for entry in entries:
+        if entry["source"] is not None:
+            source = entries[entry["source"]]
+            entry.update(content_id=source["content_id"], content_text=source["content_text"])
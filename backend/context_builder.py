@@ -0,0 +1,139 @@
+# backend/context_builder.py
+"""
+Construcción del contexto RAG con presupuesto de tokens.
+
+Los chunks recuperados se agrupan por versión, los que tienen `chunk_order`
+consecutivo se fusionan eliminando el solapamiento de `chunk_text`, y los
+segmentos resultantes se empaquetan por relevancia hasta llenar la ventana de
+contexto del modelo de generación, dejando hueco para la pregunta y la respuesta.
+"""
+import os
+import json
+import math
+
+# Ollama usa num_ctx=2048 si no se indica otra cosa, aunque el modelo admita más.
+OLLAMA_DEFAULT_CONTEXT_WINDOW = int(os.getenv("OLLAMA_DEFAULT_CONTEXT_WINDOW", "2048"))
+# Ventanas conocidas por prefijo de nombre de modelo; OLLAMA_CONTEXT_WINDOWS ('{"modelo": tokens}') las sobrescribe.
+DEFAULT_CONTEXT_WINDOWS = {
+    "phi3:3.8b-mini-4k": 4096,
+    "phi3:3.8b-mini-128k": 131072,
+    "phi3": 4096,
+    "llama3": 8192,
+    "mistral": 8192,
+}
+CONTEXT_WINDOWS = {**DEFAULT_CONTEXT_WINDOWS, **json.loads(os.getenv("OLLAMA_CONTEXT_WINDOWS", "{}"))}
+# Límite superior para num_ctx: ventanas enormes (128k) disparan la memoria del KV cache en CPU.
+RAG_MAX_CONTEXT_WINDOW = int(os.getenv("RAG_MAX_CONTEXT_WINDOW", "8192"))
+# Tokens reservados para la respuesta del modelo (se envía también como num_predict).
+RAG_ANSWER_TOKENS = int(os.getenv("RAG_ANSWER_TOKENS", "512"))
+# Estimación sin tokenizer: caracteres por token (conservadora para español).
+RAG_CHARS_PER_TOKEN = float(os.getenv("RAG_CHARS_PER_TOKEN", "3.5"))
+# Parámetros del chunking de la indexación. El solapamiento se usa aquí para volver a unir chunks contiguos.
+CHUNK_SIZE = int(os.getenv("RAG_CHUNK_SIZE", "1000"))
+CHUNK_OVERLAP = int(os.getenv("RAG_CHUNK_OVERLAP", "100"))
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / RAG_CHARS_PER_TOKEN)
+
+
+def get_context_window(model_name: str) -> int:
+    """Ventana de contexto del modelo: coincidencia exacta o por el prefijo más largo."""
+    if model_name in CONTEXT_WINDOWS:
+        window = CONTEXT_WINDOWS[model_name]
+    else:
+        prefixes = [prefix for prefix in CONTEXT_WINDOWS if model_name.startswith(prefix)]
+        window = CONTEXT_WINDOWS[max(prefixes, key=len)] if prefixes else OLLAMA_DEFAULT_CONTEXT_WINDOW
+    return min(window, RAG_MAX_CONTEXT_WINDOW)
+
+
+def generation_options(model_name: str) -> dict:
+    """Opciones de Ollama coherentes con el presupuesto usado para empaquetar el contexto."""
+    return {"num_ctx": get_context_window(model_name), "num_predict": RAG_ANSWER_TOKENS}
+
+
+def _strip_overlap(previous: str, following: str, max_overlap: int) -> str:
+    """Quita del inicio de `following` el texto que ya aparece al final de `previous`."""
+    for size in range(min(max_overlap, len(previous), len(following)), 0, -1):
+        if previous.endswith(following[:size]):
+            return following[size:]
+    return following
+
+
+def merge_adjacent_chunks(chunks: list[dict], overlap: int) -> list[dict]:
+    """
+    Fusiona los chunks consecutivos (mismo `document_version_id`, `chunk_order` contiguo).
+    Cada segmento conserva la mejor distancia de sus chunks y la lista de órdenes incluidos.
+    """
+    by_version = {}
+    for chunk in chunks:
+        by_version.setdefault(chunk["document_version_id"], []).append(chunk)
+
+    segments = []
+    for version_chunks in by_version.values():
+        version_chunks.sort(key=lambda c: c["chunk_order"])
+        current = None
+        for chunk in version_chunks:
+            if current and chunk["chunk_order"] == current["chunk_orders"][-1] + 1:
+                current["text"] += _strip_overlap(current["text"], chunk["chunk_text"], overlap)
+                current["chunk_orders"].append(chunk["chunk_order"])
+                current["distance"] = min(current["distance"], chunk["distance"])
+                continue
+            if current and chunk["chunk_order"] == current["chunk_orders"][-1]:
+                continue # duplicado exacto
+            current = {
+                "text": chunk["chunk_text"],
+                "chunk_orders": [chunk["chunk_order"]],
+                "distance": chunk["distance"],
+                "document_id": chunk["document_id"],
+                "document_version_id": chunk["document_version_id"],
+                "title": chunk["title"],
+                "version_number": chunk["version_number"],
+            }
+            segments.append(current)
+    return segments
+
+
+def _format_source(ref: int, segment: dict) -> str:
+    orders = segment["chunk_orders"]
+    span = f"{orders[0]}" if len(orders) == 1 else f"{orders[0]}-{orders[-1]}"
+    return f"[{ref}] {segment['title']} (v{segment['version_number']}, frag. {span})"
+
+
+def build_context(chunks: list[dict], model_name: str, prompt_overhead: str, overlap: int,
+                  ref_offset: int = 0, reserved_tokens: int = 0):
+    """
+    Devuelve `(context, sources)`: el texto de contexto con referencias compactas `[n]`
+    y la lista de fuentes incluidas. `prompt_overhead` es el resto del prompt (instrucciones
+    y pregunta) y se descuenta del presupuesto junto con los tokens reservados a la respuesta.
+    En una conversación, las referencias siguen tras `ref_offset` y `reserved_tokens` son
+    los tokens que ya ocupan los turnos anteriores en la ventana.
+    """
+    budget = get_context_window(model_name) - RAG_ANSWER_TOKENS - estimate_tokens(prompt_overhead) - reserved_tokens
+    segments = sorted(merge_adjacent_chunks(chunks, overlap), key=lambda s: s["distance"])
+
+    parts, sources = [], []
+    for segment in segments:
+        header = _format_source(ref_offset + len(sources) + 1, segment)
+        cost = estimate_tokens(header) + estimate_tokens(segment["text"]) + 1
+        body = segment["text"]
+        if cost > budget:
+            if sources:
+                continue # probar con un segmento más corto
+            # El mejor segmento no cabe entero: se recorta para no quedarnos sin contexto.
+            body = body[:max(int((budget - estimate_tokens(header) - 1) * RAG_CHARS_PER_TOKEN), 0)]
+            if not body:
+                break
+            cost = budget
+        parts.append(f"{header}\n{body}")
+        sources.append({
+            "ref": ref_offset + len(sources) + 1,
+            "document_id": str(segment["document_id"]),
+            "document_version_id": str(segment["document_version_id"]),
+            "title": segment["title"],
+            "version_number": segment["version_number"],
+            "chunk_orders": segment["chunk_orders"],
+        })
+        budget -= cost
+
+    return "\n\n".join(parts), sources
@@ -1,9 +1,27 @@
 # backend/database.py
+"""
+Capa única de acceso a PostgreSQL para la API, los workers y los comandos.
+
+Cada proceso crea un solo engine, con el pool dimensionado según su rol
+(DB_PROCESS_ROLE): un worker de gunicorn atiende pocas peticiones a la vez, un
+worker de Celery con gevent puede tener cientos de tareas y no debe abrir una
+conexión por greenlet. Con DB_PGBOUNCER=true se asume PgBouncer en modo
+transacción delante de PostgreSQL. El tiempo de espera por una conexión y la
+ocupación del pool se publican como métricas (ver metrics.py).
+"""
 import os
-from sqlalchemy import create_engine
+import sys
+import time
+import logging
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import QueuePool, NullPool
 from dotenv import load_dotenv
 
+from metrics import DB_POOL_CHECKOUT_SECONDS, DB_POOL_TIMEOUTS, DB_POOL_CHECKED_OUT, DB_POOL_CAPACITY
+
 load_dotenv() # Load environment variables from .env
 
 # Get database connection details from environment variables
@@ -18,19 +36,99 @@ if not DATABASE_URL:
     DB_PORT = os.getenv("POSTGRES_PORT", "5432")
     DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
+# api: worker de gunicorn; worker: Celery de indexación; generation: Celery de /ask; cli: comandos puntuales;
+# asgi: asgi_app.py, que usa su propio pool asyncpg (ASGI_DB_POOL_SIZE) y apenas este engine.
+DB_PROCESS_ROLE = os.getenv("DB_PROCESS_ROLE", "api")
+# (pool_size, max_overflow) por rol cuando no se fijan DB_POOL_SIZE / DB_MAX_OVERFLOW.
+ROLE_POOL_DEFAULTS = {
+    "api": (4, 4),
+    "worker": (4, 4),
+    "generation": (2, 0),
+    "cli": (1, 0),
+    "asgi": (1, 0),
+}
+# Con gevent todas las tareas del proceso comparten el pool: se acota y las demás esperan turno (DB_POOL_TIMEOUT).
+DB_GEVENT_POOL_SIZE = int(os.getenv("DB_GEVENT_POOL_SIZE", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600"))
+# PgBouncer en modo transacción: no admite parámetros de arranque como `options` ni estado de sesión.
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "false").lower() == "true"
+# Con PgBouncer el pooling lo hace él; un pool local pequeño solo ahorra el handshake con PgBouncer.
+DB_PGBOUNCER_CLIENT_POOL = os.getenv("DB_PGBOUNCER_CLIENT_POOL", "false").lower() == "true"
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+
+
+def _gevent_active() -> bool:
+    if "gevent.monkey" not in sys.modules:
+        return False
+    return sys.modules["gevent.monkey"].is_module_patched("socket")
+
+
+def pool_settings(role: str = DB_PROCESS_ROLE) -> dict:
+    """Tamaño del pool para el rol del proceso; DB_POOL_SIZE / DB_MAX_OVERFLOW tienen prioridad."""
+    pool_size, max_overflow = ROLE_POOL_DEFAULTS.get(role, ROLE_POOL_DEFAULTS["api"])
+    if _gevent_active():
+        pool_size, max_overflow = DB_GEVENT_POOL_SIZE, 0
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", pool_size)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", max_overflow)),
+    }
+
+
+class _TimedPoolMixin:
+    """Mide cuánto espera cada checkout (en NullPool, lo que tarda en conectar) y cuenta los timeouts."""
+    metrics_target = "primary" # Se fija por engine en create_db_engine (primary, replica0, ...)
+
+    def _do_get(self):
+        started_at = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            DB_POOL_TIMEOUTS.labels(role=DB_PROCESS_ROLE, target=self.metrics_target).inc()
+            raise
+        finally:
+            DB_POOL_CHECKOUT_SECONDS.labels(role=DB_PROCESS_ROLE, target=self.metrics_target).observe(
+                time.perf_counter() - started_at)
+
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedNullPool(_TimedPoolMixin, NullPool):
+    pass
+
+
+def create_db_engine(url: str = DATABASE_URL, role: str = DB_PROCESS_ROLE, target: str = "primary"):
+    connect_args = {}
+    if DB_STATEMENT_TIMEOUT_MS and not DB_PGBOUNCER:
+        connect_args["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+
+    if DB_PGBOUNCER and not DB_PGBOUNCER_CLIENT_POOL:
+        pool_kwargs = {"poolclass": TimedNullPool}
+        capacity = 0
+    else:
+        settings = pool_settings(role)
+        # pool_pre_ping: descarta conexiones cortadas (reinicios de PostgreSQL/PgBouncer) antes de usarlas.
+        # pool_recycle: recicla conexiones viejas para que no las corte un timeout intermedio.
+        pool_kwargs = {"poolclass": TimedQueuePool, "pool_pre_ping": True, "pool_timeout": DB_POOL_TIMEOUT,
+                       "pool_recycle": DB_POOL_RECYCLE, **settings}
+        capacity = settings["pool_size"] + settings["max_overflow"]
+
+    # Subclase por engine para que las métricas del pool lleven su destino (sobrevive a engine.dispose()).
+    base_pool = pool_kwargs["poolclass"]
+    pool_kwargs["poolclass"] = type(base_pool.__name__, (base_pool,), {"metrics_target": target})
+    db_engine = create_engine(url, connect_args=connect_args, **pool_kwargs)
+    DB_POOL_CAPACITY.labels(role=role, target=target).set(capacity)
+    checked_out = DB_POOL_CHECKED_OUT.labels(role=role, target=target)
+    event.listen(db_engine, "checkout", lambda *args: checked_out.inc())
+    event.listen(db_engine, "checkin", lambda *args: checked_out.dec())
+    logging.info(f"Engine de base de datos creado (rol={role}, destino={target}, pgbouncer={DB_PGBOUNCER}, "
+                 f"{', '.join(f'{k}={v}' for k, v in pool_kwargs.items() if k != 'poolclass')}).")
+    return db_engine
+
 
-# Create the SQLAlchemy engine with connection pooling options
-# pool_pre_ping=True: Helps with connection stability by testing connections before use.
-# pool_size: Number of connections to keep open in the pool.
-# max_overflow: Max number of connections to open beyond pool_size when needed.
-# pool_recycle: Recycles connections after a specified time to prevent stale connections.
-engine = create_engine(
-    DATABASE_URL,
-    pool_pre_ping=True,
-    pool_size=10,        # Número de conexiones a mantener en el pool (ajustar según carga)
-    max_overflow=20,     # Número extra de conexiones que se pueden abrir en picos
-    pool_recycle=3600    # Recicla conexiones cada 1 hora (3600 segundos)
-)
+engine = create_db_engine()
 
 # Create a SessionLocal class (a sessionmaker factory)
 # Each instance of SessionLocal will be a database session
@@ -40,13 +138,17 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 # Define Base here, and import it into models.py
 Base = declarative_base()
 
+@contextmanager
 def get_db():
     """Dependency for getting a database session.
     Use with: `with get_db() as db_session:`
-    This context manager ensures the session is closed, releasing the connection.
+    Rolls back on error and always closes the session, releasing the connection.
     """
     db = SessionLocal()
     try:
         yield db
+    except Exception:
+        db.rollback()
+        raise
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
@@ -0,0 +1,161 @@
+# backend/db_routing.py
+"""
+Enrutado de lecturas a réplicas de PostgreSQL (DATABASE_REPLICA_URLS, separadas por comas).
+
+Las consultas de solo lectura (listados, búsqueda vectorial de /ask) abren su
+sesión con `read_session(user_id)`. Una réplica se usa solo si:
+
+* su retraso es menor que DB_REPLICA_MAX_LAG_SECONDS (frescura acotada), y
+* ya ha reproducido la última escritura del usuario (read-your-writes): tras cada
+  commit propio se guarda en Valkey la LSN del primario (`record_write`) y la
+  réplica debe haberla alcanzado. La marca caduca a los DB_READ_YOUR_WRITES_SECONDS.
+
+En cualquier otro caso (sin réplicas, réplica caída o atrasada, Valkey no
+disponible) la lectura va al primario. Sin réplicas configuradas no se hace
+ninguna consulta ni llamada a Valkey adicional.
+"""
+import os
+import time
+import logging
+import itertools
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+
+import database
+from metrics import DB_READ_ROUTES
+
+DATABASE_REPLICA_URLS = [u.strip() for u in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if u.strip()]
+DB_REPLICA_MAX_LAG_SECONDS = float(os.getenv("DB_REPLICA_MAX_LAG_SECONDS", "5"))
+# Cada cuánto se vuelve a consultar el estado (LSN reproducida y retraso) de cada réplica.
+DB_REPLICA_STATUS_TTL = float(os.getenv("DB_REPLICA_STATUS_TTL", "1"))
+DB_READ_YOUR_WRITES_SECONDS = int(os.getenv("DB_READ_YOUR_WRITES_SECONDS", "300"))
+
+# Si la réplica ya ha reproducido todo lo recibido, su retraso es 0 aunque el primario lleve tiempo sin escribir.
+REPLICA_STATUS_SQL = text("""
+    SELECT pg_is_in_recovery() AS in_recovery,
+           pg_last_wal_replay_lsn()::text AS replay_lsn,
+           CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+           END AS lag_seconds
+""")
+
+
+def parse_lsn(lsn: str) -> int:
+    """'16/B374D848' -> entero comparable."""
+    high, low = lsn.split("/")
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+class Replica:
+    def __init__(self, index: int, url: str):
+        self.name = f"replica{index}"
+        self.engine = database.create_db_engine(url, target=self.name)
+        self.sessionmaker = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        self.replay_lsn = 0
+        self.lag_seconds = None # None: desconocido o réplica no disponible
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+    def status(self):
+        """`(replay_lsn, lag_seconds)` cacheado DB_REPLICA_STATUS_TTL segundos."""
+        with self.lock:
+            if time.monotonic() - self.checked_at >= DB_REPLICA_STATUS_TTL:
+                try:
+                    with self.engine.connect() as connection:
+                        row = connection.execute(REPLICA_STATUS_SQL).mappings().one()
+                    # Un servidor fuera de recuperación (p. ej. promocionado) no es una réplica fiable.
+                    if row["in_recovery"] and row["replay_lsn"]:
+                        self.replay_lsn, self.lag_seconds = parse_lsn(row["replay_lsn"]), float(row["lag_seconds"])
+                    else:
+                        self.lag_seconds = None
+                except Exception as e:
+                    logging.warning(f"No se pudo consultar el estado de {self.name}: {e}")
+                    self.lag_seconds = None
+                self.checked_at = time.monotonic()
+            return self.replay_lsn, self.lag_seconds
+
+
+_replicas = None
+_replicas_lock = threading.Lock()
+_round_robin = itertools.count()
+
+
+def get_replicas() -> list[Replica]:
+    global _replicas
+    if _replicas is None:
+        with _replicas_lock:
+            if _replicas is None:
+                _replicas = [Replica(i, url) for i, url in enumerate(DATABASE_REPLICA_URLS)]
+    return _replicas
+
+
+def _write_key(user_id) -> str:
+    return f"db:write_lsn:{user_id}"
+
+
+def record_write(session, user_id):
+    """
+    Llamar justo después del commit de una escritura del usuario: guarda la LSN actual
+    del primario para que sus lecturas no vayan a una réplica que aún no la tenga.
+    """
+    if not DATABASE_REPLICA_URLS or user_id is None:
+        return
+    from valkey_client import get_valkey
+    try:
+        lsn = session.execute(text("SELECT pg_current_wal_lsn()::text")).scalar()
+        session.commit() # Cierra la transacción de la consulta y devuelve la conexión
+        get_valkey().set(_write_key(user_id), parse_lsn(lsn), ex=DB_READ_YOUR_WRITES_SECONDS)
+    except Exception as e:
+        # Sin la marca, una lectura inmediata podría no ver la escritura: se registra y se sigue.
+        logging.warning(f"No se pudo registrar la LSN de escritura del usuario {user_id}: {e}")
+
+
+def choose_read_target(user_id=None):
+    """Devuelve `(Replica | None, motivo)`; None significa leer del primario."""
+    replicas = get_replicas()
+    if not replicas:
+        return None, "no_replicas"
+
+    required_lsn = 0
+    if user_id is not None:
+        from valkey_client import get_valkey
+        try:
+            required_lsn = int(get_valkey().get(_write_key(user_id)) or 0)
+        except Exception as e:
+            logging.warning(f"No se pudo leer la LSN de escritura del usuario {user_id}: {e}")
+            return None, "valkey_unavailable"
+
+    start = next(_round_robin)
+    reason = "replicas_unavailable"
+    for offset in range(len(replicas)):
+        replica = replicas[(start + offset) % len(replicas)]
+        replay_lsn, lag_seconds = replica.status()
+        if lag_seconds is None:
+            continue
+        if lag_seconds > DB_REPLICA_MAX_LAG_SECONDS:
+            reason = "replica_lagging"
+        elif replay_lsn < required_lsn:
+            reason = "read_your_writes"
+        else:
+            return replica, "fresh"
+    return None, reason
+
+
+def read_session(user_id=None):
+    """Sesión para consultas de solo lectura (réplica si es segura, si no el primario). El llamador la cierra."""
+    replica, reason = choose_read_target(user_id)
+    DB_READ_ROUTES.labels(target=replica.name if replica else "primary", reason=reason).inc()
+    return replica.sessionmaker() if replica else database.SessionLocal()
+
+
+@contextmanager
+def get_read_db(user_id=None):
+    """Como `database.get_db`, pero enrutada con `read_session`."""
+    db = read_session(user_id)
+    try:
+        yield db
+    finally:
+        db.close()
@@ -0,0 +1,355 @@
+# backend/document_purge.py
+"""
+Borrado asíncrono de documentos y recolección de los objetos huérfanos de MinIO.
+
+DELETE /documents/<id> borraba en la petición el fichero de cada versión, uno a
+uno, y después todos sus chunks en la misma transacción: con muchas versiones y
+muchos chunks la petición agotaba el timeout y bloqueaba las tablas mientras tanto.
+
+* Tombstone (`tombstone`): la petición solo marca `documents.deleted_at` y pasa
+  sus versiones a 'deleted' (fuera de /ask, de la indexación y de la admisión), y
+  encola la tarea `tasks.purge_document`.
+* Purga (`purge_document`): quita las versiones del scheduler de indexación
+  (`ingest_scheduler.forget`: colas virtuales y slots en curso), borra los ficheros de MinIO en lotes de
+  PURGE_OBJECT_BATCH con el borrado múltiple de S3, los chunks (y los archivados
+  por la retención) en lotes de PURGE_CHUNK_BATCH, cada uno en su transacción,
+  junto con los contenidos de chunk_contents que dejan de usarse, después el
+  documento con sus versiones y, por último, los artefactos de texto
+  (text_artifacts.py) de los contenidos que ya no tiene ninguna versión.
+* GC (`python document_purge.py`, servicio `storage_gc`): cada
+  STORAGE_GC_INTERVAL_SECONDS, y como mucho durante STORAGE_GC_MAX_SECONDS, purga
+  los tombstones de más de PURGE_STALE_SECONDS (la tarea se perdió o falló) y
+  concilia los objetos bajo `{user_id}/` con `document_versions.ceph_path`: los
+  que no tienen versión y tienen más de STORAGE_GC_GRACE_SECONDS (una subida en
+  curso guarda el fichero antes que la versión) se borran. Lo mismo con los de
+  `text-artifacts/` sin fila en text_artifacts o cuyo contenido ya no tiene
+  ninguna versión (la purga no pudo borrarlos), junto con esas filas.
+
+Lo purgado se cuenta en `dv_document_purge_total` y la duración de cada paso en
+`dv_document_purge_seconds`.
+"""
+import os
+import time
+import logging
+import argparse
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import text
+from minio.deleteobjects import DeleteObject
+
+import metrics
+import ingest_scheduler
+from text_artifacts import ARTIFACT_PREFIX
+from metrics import observe_stage, DOCUMENT_PURGE_ITEMS, DOCUMENT_PURGE_SECONDS
+
+PURGE_CHUNK_BATCH = int(os.getenv("PURGE_CHUNK_BATCH", "5000")) # Chunks por transacción
+PURGE_OBJECT_BATCH = 1000 # Máximo de claves por petición de borrado múltiple de S3
+PURGE_STALE_SECONDS = int(os.getenv("PURGE_STALE_SECONDS", "3600"))
+STORAGE_GC_INTERVAL_SECONDS = int(os.getenv("STORAGE_GC_INTERVAL_SECONDS", "86400"))
+STORAGE_GC_MAX_SECONDS = int(os.getenv("STORAGE_GC_MAX_SECONDS", "1800"))
+STORAGE_GC_GRACE_SECONDS = int(os.getenv("STORAGE_GC_GRACE_SECONDS", "86400"))
+
+TOMBSTONE_DOCUMENT_SQL = "UPDATE documents SET deleted_at = now() WHERE id = :document_id AND deleted_at IS NULL"
+
+TOMBSTONE_VERSIONS_SQL = """
+    UPDATE document_versions SET processed_status = 'deleted', last_processed_at = now()
+    WHERE document_id = :document_id
+"""
+
+# Los contenidos de los chunks borrados que ya no usa ningún otro chunk se borran en el mismo lote. Como en
+# version_retention.delete_orphan_contents, un worker que iba a reutilizar uno falla la inserción y reintenta.
+DELETE_CHUNKS_SQL = """
+    WITH deleted AS (
+        DELETE FROM document_chunks
+        WHERE id IN (
+            SELECT dc.id FROM document_chunks dc
+            WHERE dc.document_version_id = ANY(CAST(:version_ids AS uuid[]))
+            LIMIT :limit)
+        RETURNING content_id
+    )
+    SELECT COUNT(*) AS chunks, COALESCE(array_agg(DISTINCT content_id), '{}') AS content_ids FROM deleted
+"""
+
+DELETE_UNUSED_CONTENTS_SQL = """
+    DELETE FROM chunk_contents
+    WHERE id IN (
+        SELECT cc.id FROM unnest(CAST(:content_ids AS uuid[])) AS freed(id)
+        JOIN chunk_contents cc ON cc.id = freed.id
+        WHERE NOT EXISTS (SELECT 1 FROM document_chunks dc WHERE dc.content_id = cc.id)
+        FOR UPDATE OF cc SKIP LOCKED)
+"""
+
+DELETE_ARCHIVED_CHUNKS_SQL = """
+    DELETE FROM archived_chunks
+    WHERE (document_version_id, chunk_order) IN (
+        SELECT document_version_id, chunk_order FROM archived_chunks
+        WHERE document_version_id = ANY(CAST(:version_ids AS uuid[]))
+        LIMIT :limit)
+"""
+
+# Artefactos de texto de `shas` (y, si se da, de `paths`) sin ninguna versión con ese contenido. Se borra la fila
+# antes que el objeto: un objeto sin fila lo recoge reconcile_objects, una fila sin objeto haría fallar la indexación.
+DELETE_UNUSED_ARTIFACTS_SQL = """
+    DELETE FROM text_artifacts ta
+    WHERE ta.content_sha256 = ANY(CAST(:shas AS text[]))
+      AND (CAST(:paths AS text[]) IS NULL OR ta.ceph_path = ANY(CAST(:paths AS text[])))
+      AND NOT EXISTS (SELECT 1 FROM document_versions dv WHERE dv.file_metadata->>'sha256' = ta.content_sha256)
+    RETURNING ta.ceph_path
+"""
+
+# De los objetos candidatos de `text-artifacts/{sha256}/...`, los de un artefacto cuyo contenido aún tiene versión.
+USED_ARTIFACT_PATHS_SQL = """
+    SELECT ta.ceph_path FROM unnest(CAST(:paths AS text[])) AS candidate(path)
+    JOIN text_artifacts ta ON ta.content_sha256 = split_part(candidate.path, '/', 2) AND ta.ceph_path = candidate.path
+    WHERE EXISTS (SELECT 1 FROM document_versions dv WHERE dv.file_metadata->>'sha256' = ta.content_sha256)
+"""
+
+STALE_TOMBSTONES_SQL = """
+    SELECT id FROM documents
+    WHERE deleted_at < now() - make_interval(secs => :stale_seconds)
+    ORDER BY deleted_at
+"""
+
+
+def tombstone(db_session, document_id) -> bool:
+    """Marca el documento como borrado y saca sus versiones de la búsqueda. No hace commit."""
+    params = {"document_id": str(document_id)}
+    if not db_session.execute(text(TOMBSTONE_DOCUMENT_SQL), params).rowcount:
+        return False
+    db_session.execute(text(TOMBSTONE_VERSIONS_SQL), params)
+    return True
+
+
+def remove_objects(s3_client, bucket, paths) -> list:
+    """Borra `paths` de MinIO con el borrado múltiple, por lotes. Devuelve los que no se pudieron borrar."""
+    failed = []
+    paths = list(paths)
+    for start in range(0, len(paths), PURGE_OBJECT_BATCH):
+        batch = [DeleteObject(path) for path in paths[start:start + PURGE_OBJECT_BATCH]]
+        for error in s3_client.remove_objects(bucket, batch): # El iterador hace las peticiones: hay que recorrerlo
+            if error.code != 'NoSuchKey':
+                logging.error(f"No se pudo borrar '{error.name}' de MinIO: {error.code} {error.message}")
+                failed.append(error.name)
+    return failed
+
+
+def delete_chunks(db_session, version_ids, deadline=None) -> tuple[int, int]:
+    """
+    Borra los chunks de `version_ids` en lotes de PURGE_CHUNK_BATCH, cada uno en su transacción, con los
+    contenidos que dejan de usarse. Devuelve `(chunks, contenidos)` borrados.
+    """
+    chunks = contents = 0
+    while deadline is None or time.monotonic() < deadline:
+        batch = db_session.execute(text(DELETE_CHUNKS_SQL), {"version_ids": version_ids, "limit": PURGE_CHUNK_BATCH}).one()
+        if batch.content_ids:
+            contents += db_session.execute(text(DELETE_UNUSED_CONTENTS_SQL),
+                                           {"content_ids": [str(c) for c in batch.content_ids]}).rowcount
+        db_session.commit()
+        chunks += batch.chunks
+        if batch.chunks < PURGE_CHUNK_BATCH:
+            break
+    return chunks, contents
+
+
+def delete_archived_chunks(db_session, version_ids, deadline=None) -> int:
+    """Borra los chunks archivados por la retención (version_retention.py) de `version_ids`, por lotes."""
+    deleted = 0
+    while deadline is None or time.monotonic() < deadline:
+        batch = db_session.execute(text(DELETE_ARCHIVED_CHUNKS_SQL),
+                                   {"version_ids": version_ids, "limit": PURGE_CHUNK_BATCH}).rowcount
+        db_session.commit()
+        deleted += batch
+        if batch < PURGE_CHUNK_BATCH:
+            break
+    return deleted
+
+
+def purge_document(db_session, s3_client, bucket, document_id, deadline=None) -> dict:
+    """
+    Purga un documento con tombstone: ficheros, chunks y, al final, el documento y sus versiones. Se puede
+    repetir: una purga interrumpida (o sin tiempo, con `deadline`) sigue donde se quedó.
+    """
+    report = {"document_id": str(document_id), "objects": 0, "object_errors": 0, "chunks": 0,
+              "archived_chunks": 0, "contents": 0, "text_artifacts": 0, "purged": False}
+    versions = db_session.execute(text("""
+        SELECT dv.id, dv.ceph_path, dv.uploaded_by, dv.file_metadata->>'sha256' AS sha256 FROM document_versions dv
+        JOIN documents d ON d.id = dv.document_id
+        WHERE d.id = :document_id AND d.deleted_at IS NOT NULL
+    """), {"document_id": str(document_id)}).all()
+    db_session.rollback()
+    version_ids = [str(version.id) for version in versions]
+
+    # Las versiones en cola o en curso dejan el scheduler antes que la base de datos: si no, su slot
+    # ocuparía capacidad hasta caducar y la tarea ya despachada no encontraría la versión.
+    for version in versions:
+        ingest_scheduler.forget(version.uploaded_by, version.id)
+
+    # Un fichero que no se pudo borrar ya no tendrá versión: lo recoge la conciliación de reconcile_objects.
+    with observe_stage(DOCUMENT_PURGE_SECONDS, step='objects'):
+        failed = remove_objects(s3_client, bucket, [version.ceph_path for version in versions])
+    report["objects"], report["object_errors"] = len(versions) - len(failed), len(failed)
+
+    with observe_stage(DOCUMENT_PURGE_SECONDS, step='chunks'):
+        report["chunks"], report["contents"] = delete_chunks(db_session, version_ids, deadline)
+        report["archived_chunks"] = delete_archived_chunks(db_session, version_ids, deadline)
+
+    if deadline is None or time.monotonic() < deadline:
+        # Las versiones ya no tienen chunks: el ON DELETE CASCADE solo borra filas de document_versions.
+        report["purged"] = bool(db_session.execute(
+            text("DELETE FROM documents WHERE id = :document_id AND deleted_at IS NOT NULL"),
+            {"document_id": str(document_id)}).rowcount)
+        db_session.commit()
+    if report["purged"]:
+        with observe_stage(DOCUMENT_PURGE_SECONDS, step='text_artifacts'):
+            report["text_artifacts"] = delete_unused_artifacts(
+                db_session, s3_client, bucket, {version.sha256 for version in versions if version.sha256})
+    for kind in ("objects", "object_errors", "chunks", "archived_chunks", "contents", "text_artifacts"):
+        if report[kind]:
+            DOCUMENT_PURGE_ITEMS.labels(kind=kind).inc(report[kind])
+    if report["purged"]:
+        DOCUMENT_PURGE_ITEMS.labels(kind='documents').inc()
+    logging.info(f"Purga del documento {document_id}: {report}")
+    return report
+
+
+def delete_unused_artifacts(db_session, s3_client, bucket, shas) -> int:
+    """Borra los artefactos de texto de `shas` que ya no tiene ninguna versión, con sus objetos. Devuelve cuántos."""
+    if not shas:
+        return 0
+    paths = [row.ceph_path for row in db_session.execute(text(DELETE_UNUSED_ARTIFACTS_SQL),
+                                                                    {"shas": sorted(shas), "paths": None})]
+    db_session.commit()
+    return len(paths) - len(remove_objects(s3_client, bucket, paths))
+
+
+def purge_stale_tombstones(db_session, s3_client, bucket, deadline=None) -> int:
+    """Purga los documentos con tombstone de más de PURGE_STALE_SECONDS. Devuelve cuántos terminó."""
+    stale = [row.id for row in db_session.execute(text(STALE_TOMBSTONES_SQL), {"stale_seconds": PURGE_STALE_SECONDS})]
+    db_session.rollback()
+    purged = 0
+    for document_id in stale:
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        purged += purge_document(db_session, s3_client, bucket, document_id, deadline)["purged"]
+    return purged
+
+
+def reconcile_objects(db_session, s3_client, bucket, deadline=None, dry_run: bool = False) -> int:
+    """
+    Borra los objetos de más de STORAGE_GC_GRACE_SECONDS que no usa nada: los de `{user_id}/` sin versión en
+    document_versions y los artefactos de texto (`text-artifacts/`) sin fila o cuyo contenido ya no tiene
+    ninguna versión, junto con esas filas. Devuelve los huérfanos.
+    """
+    user_ids = [str(row.id) for row in db_session.execute(text("SELECT id FROM users ORDER BY id"))]
+    db_session.rollback()
+    orphans = 0
+    for prefix in [f"{user_id}/" for user_id in user_ids] + [f"{ARTIFACT_PREFIX}/"]:
+        remove = _remove_orphan_artifacts if prefix == f"{ARTIFACT_PREFIX}/" else _remove_orphans
+        orphans += _reconcile_prefix(db_session, s3_client, bucket, prefix, remove, deadline, dry_run)
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+    return orphans
+
+
+def _reconcile_prefix(db_session, s3_client, bucket, prefix, remove, deadline, dry_run) -> int:
+    older_than = datetime.now(timezone.utc) - timedelta(seconds=STORAGE_GC_GRACE_SECONDS)
+    orphans = 0
+    candidates = []
+    for obj in s3_client.list_objects(bucket, prefix=prefix, recursive=True):
+        if obj.last_modified and obj.last_modified < older_than:
+            candidates.append(obj.object_name)
+        if len(candidates) == PURGE_OBJECT_BATCH:
+            orphans += remove(db_session, s3_client, bucket, candidates, dry_run)
+            candidates = []
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+    return orphans + remove(db_session, s3_client, bucket, candidates, dry_run)
+
+
+def _remove_orphans(db_session, s3_client, bucket, candidates, dry_run) -> int:
+    if not candidates:
+        return 0
+    known = {row.ceph_path for row in db_session.execute(
+        text("SELECT ceph_path FROM document_versions WHERE ceph_path = ANY(:paths)"), {"paths": candidates})}
+    db_session.rollback()
+    return _remove_orphan_paths(s3_client, bucket, [path for path in candidates if path not in known], dry_run)
+
+
+def _remove_orphan_artifacts(db_session, s3_client, bucket, candidates, dry_run) -> int:
+    if not candidates:
+        return 0
+    used = {row.ceph_path for row in db_session.execute(text(USED_ARTIFACT_PATHS_SQL), {"paths": candidates})}
+    orphans = [path for path in candidates if path not in used]
+    if orphans and not dry_run:
+        # Las filas se borran con la misma condición: si entretanto se subió una versión con ese contenido,
+        # la fila sigue y su objeto no se toca.
+        params = {"shas": sorted({path.split('/')[1] for path in orphans}), "paths": orphans}
+        db_session.execute(text(DELETE_UNUSED_ARTIFACTS_SQL), params)
+        kept = {row.ceph_path for row in db_session.execute(text(
+            "SELECT ceph_path FROM text_artifacts WHERE content_sha256 = ANY(:shas) AND ceph_path = ANY(:paths)"), params)}
+        db_session.commit()
+        orphans = [path for path in orphans if path not in kept]
+    db_session.rollback()
+    return _remove_orphan_paths(s3_client, bucket, orphans, dry_run)
+
+
+def _remove_orphan_paths(s3_client, bucket, orphans, dry_run) -> int:
+    if not orphans:
+        return 0
+    if dry_run:
+        logging.info(f"GC de MinIO (simulación): {len(orphans)} objetos huérfanos, ej. '{orphans[0]}'.")
+        return len(orphans)
+    removed = len(orphans) - len(remove_objects(s3_client, bucket, orphans))
+    DOCUMENT_PURGE_ITEMS.labels(kind='orphan_objects').inc(removed)
+    logging.info(f"GC de MinIO: {removed} objetos huérfanos borrados, ej. '{orphans[0]}'.")
+    return removed
+
+
+def collect(db_session, s3_client, bucket, max_seconds: float = STORAGE_GC_MAX_SECONDS, dry_run: bool = False) -> dict:
+    """Una pasada del GC acotada a `max_seconds`: tombstones atrasados y objetos huérfanos."""
+    deadline = time.monotonic() + max_seconds
+    report = {"stale_documents": 0, "orphan_objects": 0}
+    if not dry_run:
+        with observe_stage(DOCUMENT_PURGE_SECONDS, step='stale'):
+            report["stale_documents"] = purge_stale_tombstones(db_session, s3_client, bucket, deadline)
+    with observe_stage(DOCUMENT_PURGE_SECONDS, step='reconcile'):
+        report["orphan_objects"] = reconcile_objects(db_session, s3_client, bucket, deadline, dry_run)
+    logging.info(f"GC de almacenamiento: {report}")
+    return report
+
+
+def get_s3_client():
+    from minio import Minio
+
+    endpoint = os.getenv("CEPH_ENDPOINT_URL", "http://minio:9000")
+    return Minio(endpoint.replace("http://", "").replace("https://", ""), access_key=os.getenv("CEPH_ACCESS_KEY"),
+                 secret_key=os.getenv("CEPH_SECRET_KEY"), secure=endpoint.startswith("https://"))
+
+
+def run(max_seconds: float = STORAGE_GC_MAX_SECONDS, once: bool = False, dry_run: bool = False):
+    """Bucle del GC: una pasada acotada cada STORAGE_GC_INTERVAL_SECONDS."""
+    from database import SessionLocal
+
+    s3_client, bucket = get_s3_client(), os.getenv("CEPH_BUCKET_NAME")
+    logging.info(f"GC de almacenamiento: pasada de hasta {max_seconds}s cada {STORAGE_GC_INTERVAL_SECONDS}s "
+                 f"(huérfanos de más de {STORAGE_GC_GRACE_SECONDS}s{', simulación' if dry_run else ''}).")
+    while True:
+        try:
+            with SessionLocal() as db_session:
+                collect(db_session, s3_client, bucket, max_seconds, dry_run)
+        except Exception as e:
+            logging.error(f"Error en el GC de almacenamiento: {e}", exc_info=True)
+        if once:
+            return
+        time.sleep(STORAGE_GC_INTERVAL_SECONDS)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Purga los documentos borrados y los objetos huérfanos de MinIO.")
+    parser.add_argument("--once", action="store_true", help="Una sola pasada (para cron) en lugar del bucle.")
+    parser.add_argument("--max-seconds", type=float, default=STORAGE_GC_MAX_SECONDS)
+    parser.add_argument("--dry-run", action="store_true", help="Solo informa de los objetos huérfanos.")
+    args = parser.parse_args()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+    metrics.reset_multiprocess_dir()
+    run(args.max_seconds, args.once, args.dry_run)
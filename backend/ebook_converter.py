@@ -0,0 +1,202 @@
+# backend/ebook_converter.py
+"""
+Conversión de ebooks (AZW3, MOBI, FB2...) a texto con un pool de conversores de Calibre.
+
+Lanzar `ebook-convert` por libro paga el arranque de Calibre en cada conversión,
+que en libros pequeños es casi todo el tiempo. Aquí cada conversor es un proceso
+de larga duración (ebook_converter_worker.py bajo `calibre-debug`) que importa el
+pipeline una vez y atiende trabajos por stdin/stdout. El pool:
+
+* acota los procesos vivos a EBOOK_CONVERTER_POOL_SIZE por proceso del worker; con
+  el pool gevent, los 100 greenlets de indexación esperan turno sin bloquear el hilo;
+* mata el grupo de procesos del conversor si una conversión supera
+  EBOOK_CONVERT_TIMEOUT, y lo sustituye por uno nuevo en el siguiente trabajo;
+* limita la memoria de cada conversor (RLIMIT_AS, EBOOK_CONVERTER_MEMORY_MB) y lo
+  recicla tras EBOOK_CONVERTER_MAX_JOBS conversiones;
+* escribe la entrada y la salida en EBOOK_CONVERT_TMPDIR, pensado para un tmpfs
+  (Calibre elige el formato por la extensión, así que necesita rutas con nombre).
+"""
+import os
+import json
+import time
+import shutil
+import signal
+import select
+import logging
+import tempfile
+import threading
+import subprocess
+
+from metrics import EBOOK_CONVERSIONS, EBOOK_CONVERSION_SECONDS, EBOOK_CONVERTER_STARTS
+
+logger = logging.getLogger(__name__)
+
+EBOOK_CONVERTER_COMMAND = os.getenv("EBOOK_CONVERTER_COMMAND", "calibre-debug")
+EBOOK_CONVERTER_POOL_SIZE = int(os.getenv("EBOOK_CONVERTER_POOL_SIZE", "2"))
+EBOOK_CONVERT_TIMEOUT = float(os.getenv("EBOOK_CONVERT_TIMEOUT", "300"))
+EBOOK_CONVERTER_START_TIMEOUT = float(os.getenv("EBOOK_CONVERTER_START_TIMEOUT", "60"))
+EBOOK_CONVERTER_MEMORY_MB = int(os.getenv("EBOOK_CONVERTER_MEMORY_MB", "2048")) # 0 = sin límite
+EBOOK_CONVERTER_MAX_JOBS = int(os.getenv("EBOOK_CONVERTER_MAX_JOBS", "100"))
+EBOOK_CONVERT_TMPDIR = os.getenv("EBOOK_CONVERT_TMPDIR") or None # None = directorio temporal del sistema
+
+# Formatos que se convierten con Calibre (MOBI incluido: la librería `mobi` falla con muchos ficheros).
+EBOOK_EXTENSIONS = ('.azw3', '.azw', '.mobi', '.prc', '.fb2', '.lit', '.pdb')
+
+_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ebook_converter_worker.py")
+
+
+class EbookConversionError(Exception):
+    """La conversión falló, agotó el tiempo o el conversor murió."""
+
+
+class EbookConversionTimeout(EbookConversionError):
+    pass
+
+
+def _limit_memory():
+    import resource
+    limit = EBOOK_CONVERTER_MEMORY_MB * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+class _Converter:
+    """Un proceso `calibre-debug` con el worker de conversión cargado."""
+
+    def __init__(self):
+        self.jobs = 0
+        self._buffer = b""
+        self.process = subprocess.Popen(
+            [EBOOK_CONVERTER_COMMAND, "-e", _WORKER_SCRIPT],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0,
+            start_new_session=True, # Grupo propio: al matarlo caen también los hijos de Calibre
+            preexec_fn=_limit_memory if EBOOK_CONVERTER_MEMORY_MB > 0 else None,
+        )
+        EBOOK_CONVERTER_STARTS.inc()
+        try:
+            self._read_reply(EBOOK_CONVERTER_START_TIMEOUT)
+        except EbookConversionError:
+            self.kill()
+            raise
+        logger.info(f"Conversor de ebooks iniciado (pid {self.process.pid}).")
+
+    def _read_reply(self, timeout):
+        deadline = time.monotonic() + timeout
+        fd = self.process.stdout.fileno()
+        while b"\n" not in self._buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise EbookConversionTimeout(f"El conversor no respondió en {timeout:.0f}s.")
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if readable:
+                data = os.read(fd, 65536)
+                if not data:
+                    raise EbookConversionError(f"El conversor terminó inesperadamente (código {self.process.poll()}).")
+                self._buffer += data
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return json.loads(line)
+
+    def convert(self, input_path, output_path, timeout):
+        self.jobs += 1
+        try:
+            self.process.stdin.write((json.dumps({"input": input_path, "output": output_path}) + "\n").encode("utf-8"))
+        except (BrokenPipeError, OSError) as e:
+            raise EbookConversionError(f"El conversor no acepta trabajos: {e}") from e
+        reply = self._read_reply(timeout)
+        if not reply.get("ok"):
+            logger.debug(reply.get("traceback", ""))
+            raise EbookConversionError(reply.get("error", "error desconocido"))
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+
+
+class EbookConverterPool:
+    """Pool acotado de conversores; los procesos se crean al primer uso y se reutilizan."""
+
+    def __init__(self, size=EBOOK_CONVERTER_POOL_SIZE):
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _checkout(self):
+        with self._lock:
+            while self._idle:
+                converter = self._idle.pop()
+                if converter.alive():
+                    return converter
+        return _Converter()
+
+    def _checkin(self, converter, healthy):
+        if healthy and converter.alive() and converter.jobs < EBOOK_CONVERTER_MAX_JOBS:
+            with self._lock:
+                self._idle.append(converter)
+        else:
+            converter.kill()
+
+    def convert_to_text(self, content: bytes, extension: str, timeout: float = EBOOK_CONVERT_TIMEOUT) -> str:
+        """Convierte el ebook (`extension` con punto, p. ej. '.azw3') a texto plano."""
+        fmt = extension.lstrip('.').lower()
+        workdir = tempfile.mkdtemp(prefix="ebook-", dir=EBOOK_CONVERT_TMPDIR)
+        started_at = time.perf_counter()
+        outcome = 'error'
+        try:
+            input_path = os.path.join(workdir, f"input.{fmt}")
+            output_path = os.path.join(workdir, "output.txt")
+            with open(input_path, "wb") as f:
+                f.write(content)
+
+            with self._slots:
+                converter = self._checkout()
+                healthy = False
+                try:
+                    converter.convert(input_path, output_path, timeout)
+                    healthy = True
+                except EbookConversionTimeout:
+                    outcome = 'timeout'
+                    raise
+                except EbookConversionError:
+                    # Un error de conversión deja el proceso usable; si murió (p. ej. por el límite de memoria) se descarta.
+                    healthy = converter.alive()
+                    raise
+                finally:
+                    self._checkin(converter, healthy)
+
+            with open(output_path, "r", encoding="utf-8", errors="replace") as f:
+                text = f.read()
+            outcome = 'ok'
+            return text
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+            EBOOK_CONVERSIONS.labels(format=fmt, outcome=outcome).inc()
+            EBOOK_CONVERSION_SECONDS.labels(format=fmt).observe(time.perf_counter() - started_at)
+
+    def shutdown(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for converter in idle:
+            converter.kill()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_converter_pool() -> EbookConverterPool:
+    """Pool compartido por el proceso (se crea al primer uso, igual que el cliente Valkey)."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = EbookConverterPool()
+    return _pool
+
+
+def reset_converter_pool():
+    """Tras un fork, el hijo no debe reutilizar los conversores del padre."""
+    global _pool
+    _pool = None
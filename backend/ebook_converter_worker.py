@@ -0,0 +1,43 @@
+# backend/ebook_converter_worker.py
+"""
+Proceso conversor de larga duración. Se ejecuta dentro del intérprete de Calibre:
+
+    calibre-debug -e ebook_converter_worker.py
+
+Importa el pipeline de conversión una sola vez y atiende trabajos por stdin, uno
+por línea en JSON (`{"input": ruta, "output": ruta}`), respondiendo con otra línea
+JSON por stdout. Lo arranca y vigila ebook_converter.py; no depende de nada del
+backend porque corre con el Python de Calibre.
+"""
+import os
+import sys
+import json
+import traceback
+
+
+def main():
+    # Las respuestas van por una copia del stdout original; lo que Calibre escriba en
+    # stdout (su log de conversión) acaba en stderr y no rompe el protocolo.
+    replies = os.fdopen(os.dup(1), "w", buffering=1)
+    os.dup2(2, 1)
+
+    from calibre.ebooks.conversion.plumber import Plumber
+    from calibre.utils.logging import Log
+
+    def reply(**payload):
+        replies.write(json.dumps(payload) + "\n")
+
+    reply(ready=True, pid=os.getpid())
+    for line in sys.stdin:
+        try:
+            job = json.loads(line)
+            plumber = Plumber(job["input"], job["output"], Log())
+            plumber.merge_ui_recommendations([])
+            plumber.run()
+            reply(ok=True)
+        except Exception as e:
+            reply(ok=False, error=f"{type(e).__name__}: {e}", traceback=traceback.format_exc())
+
+
+if __name__ == "__main__":
+    main()
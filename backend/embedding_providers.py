@@ -0,0 +1,152 @@
+# backend/embedding_providers.py
+"""
+Backends de embeddings intercambiables, seleccionados con EMBEDDING_BACKEND.
+
+* `ollama` (por defecto): HTTP contra el contenedor de Ollama, usando el endpoint
+  por lotes `/api/embed` para enviar varios textos en una sola petición.
+* `onnx`: inferencia en CPU dentro del propio proceso con ONNX Runtime, a partir de
+  una exportación del mismo modelo (`model.onnx` + `tokenizer.json` en
+  EMBEDDING_ONNX_MODEL_DIR). Evita la serialización y el salto de red, que para
+  modelos pequeños cuestan más que la propia inferencia.
+
+Los vectores ya guardados solo son comparables con los de la pregunta si ambos
+salen del mismo modelo: cambiar de backend exige que la exportación ONNX sea del
+modelo configurado en OLLAMA_EMBEDDING_MODEL (o reindexar).
+"""
+import os
+import time
+import logging
+import threading
+
+import numpy as np
+import requests
+
+import model_residency
+from metrics import observe_stage, OLLAMA_REQUEST_SECONDS, EMBEDDING_BATCH_SECONDS
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "ollama").lower()
+# Textos por lote (por petición HTTP en Ollama, por llamada a `session.run` en ONNX).
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+
+OLLAMA_API_BASE_URL = os.getenv("OLLAMA_API_BASE_URL", "http://ollama:11434")
+OLLAMA_EMBEDDING_TIMEOUT = int(os.getenv("OLLAMA_EMBEDDING_TIMEOUT", os.getenv("OLLAMA_GENERATION_TIMEOUT", "1200")))
+
+EMBEDDING_ONNX_MODEL_DIR = os.getenv("EMBEDDING_ONNX_MODEL_DIR", "/models/embedding")
+# Hilos intra-op de ONNX Runtime. Con varios procesos por contenedor conviene repartir los núcleos entre ellos.
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "2"))
+EMBEDDING_MAX_TOKENS = int(os.getenv("EMBEDDING_MAX_TOKENS", "512"))
+
+
+class EmbeddingProvider:
+    """Interfaz común: `embed` recibe una lista de textos y devuelve un vector (lista de floats) por texto."""
+    backend = None
+
+    def __init__(self, model_name: str, batch_size: int = EMBEDDING_BATCH_SIZE):
+        self.model_name = model_name
+        self.batch_size = max(batch_size, 1)
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        embeddings = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            with observe_stage(EMBEDDING_BATCH_SECONDS, backend=self.backend, model=self.model_name):
+                embeddings.extend(self._embed_batch(batch))
+        return embeddings
+
+    def _embed_batch(self, texts: list[str]) -> list[list[float]]:
+        raise NotImplementedError
+
+
+class OllamaEmbeddingProvider(EmbeddingProvider):
+    backend = "ollama"
+
+    def __init__(self, model_name: str, base_url: str = OLLAMA_API_BASE_URL,
+                 timeout: int = OLLAMA_EMBEDDING_TIMEOUT, batch_size: int = EMBEDDING_BATCH_SIZE):
+        super().__init__(model_name, batch_size)
+        self.base_url = base_url
+        self.timeout = timeout
+        self.http = requests.Session() # Reutiliza la conexión entre lotes
+
+    def _embed_batch(self, texts: list[str]) -> list[list[float]]:
+        url = f"{self.base_url}/api/embed"
+        try:
+            with observe_stage(OLLAMA_REQUEST_SECONDS, endpoint='embed', model=self.model_name):
+                response = self.http.post(url, json={"model": self.model_name, "input": texts,
+                                                     "keep_alive": model_residency.keep_alive_for(self.model_name)},
+                                          timeout=self.timeout)
+            response.raise_for_status()
+            result = response.json()
+            model_residency.record_load(self.model_name, 'request', result)
+            return result['embeddings']
+        except requests.exceptions.Timeout as e:
+            logger.error(f"Tiempo de espera agotado al obtener embeddings de Ollama en {url}: {e}")
+            raise
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error al comunicarse con Ollama para embeddings en {url}: {e}")
+            raise
+
+
+class OnnxEmbeddingProvider(EmbeddingProvider):
+    backend = "onnx"
+
+    def __init__(self, model_name: str, model_dir: str = EMBEDDING_ONNX_MODEL_DIR, threads: int = EMBEDDING_THREADS,
+                 max_tokens: int = EMBEDDING_MAX_TOKENS, batch_size: int = EMBEDDING_BATCH_SIZE):
+        super().__init__(model_name, batch_size)
+        # Dependencias opcionales: solo se necesitan con EMBEDDING_BACKEND=onnx.
+        try:
+            import onnxruntime
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise RuntimeError("EMBEDDING_BACKEND=onnx requiere los paquetes 'onnxruntime' y 'tokenizers'.") from e
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        started_at = time.perf_counter()
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, "model.onnx"), sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_tokens)
+        self.tokenizer.enable_padding()
+        logger.info(f"Modelo ONNX de embeddings cargado desde {model_dir} en {time.perf_counter() - started_at:.2f}s "
+                    f"({threads} hilos, lotes de {self.batch_size}).")
+
+    def _embed_batch(self, texts: list[str]) -> list[list[float]]:
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        feed = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feed["token_type_ids"] = np.zeros_like(input_ids)
+        output = self.session.run(None, {k: v for k, v in feed.items() if k in self.input_names})[0]
+
+        if output.ndim == 3:
+            # Mean pooling sobre los tokens reales (sin padding), como hace Ollama con los modelos BERT.
+            mask = attention_mask[..., None].astype(np.float32)
+            output = (output * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        output = output / np.maximum(np.linalg.norm(output, axis=1, keepdims=True), 1e-12)
+        return output.astype(np.float32).tolist()
+
+
+_PROVIDERS = {"ollama": OllamaEmbeddingProvider, "onnx": OnnxEmbeddingProvider}
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+def get_embedding_provider(model_name: str, backend: str = None) -> EmbeddingProvider:
+    """Devuelve el proveedor (uno por proceso, backend y modelo); el modelo ONNX se carga en el primer uso."""
+    backend = (backend or EMBEDDING_BACKEND).lower()
+    if backend not in _PROVIDERS:
+        raise ValueError(f"EMBEDDING_BACKEND desconocido: '{backend}'. Opciones: {', '.join(_PROVIDERS)}.")
+    with _instances_lock:
+        provider = _instances.get((backend, model_name))
+        if provider is None:
+            provider = _instances[(backend, model_name)] = _PROVIDERS[backend](model_name)
+        return provider
+
+
+def embed_texts(texts: list[str], model_name: str) -> list[list[float]]:
+    return get_embedding_provider(model_name).embed(texts) if texts else []
@@ -1,12 +1,14 @@
 import os
 import io
 import uuid
+import hashlib
 import logging
+import threading
 from minio import Minio
 from minio.error import S3Error
 from cryptography.fernet import Fernet
-import clamd # Para el escaneo de virus
-from kafka import KafkaProducer # Para enviar mensajes a Kafka
+from metrics import observe_stage, file_extension, STORAGE_STAGE_SECONDS, STORAGE_OBJECT_BYTES
+import storage_envelope
 
 # No importes EncryptedFile ni User aquí si los estás reemplazando por Document y DocumentVersion
 # Los modelos se manejan en app.py, FileProcessorService solo devuelve los datos.
@@ -17,31 +19,14 @@ class FileProcessorService:
         logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format='%(asctime)s - %(levelname)s - %(message)s')
         self.logger = logging.getLogger(__name__)
 
-        # --- Configuración de MinIO ---
-        minio_host = s3_endpoint_url.replace("http://", "").replace("https://", "")
-        secure_connection = s3_endpoint_url.startswith("https://")
-        
-        try:
-            self.s3_client = Minio(
-                minio_host,
-                access_key=s3_access_key,
-                secret_key=s3_secret_key,
-                secure=secure_connection
-            )
-            self.s3_bucket_name = s3_bucket_name
-            self.logger.info(f"Cliente MinIO inicializado para {s3_endpoint_url}.")
-        except Exception as e:
-            self.logger.error(f"Error al inicializar el cliente MinIO: {e}")
-            raise
-
-        # Verificar existencia del bucket
-        try:
-            if not self.s3_client.bucket_exists(self.s3_bucket_name):
-                self.s3_client.make_bucket(self.s3_bucket_name)
-                self.logger.info(f"Bucket '{self.s3_bucket_name}' creado en MinIO/Ceph.")
-        except S3Error as e:
-            self.logger.error(f"Error al verificar/crear bucket en MinIO/Ceph: {e}")
-            raise
+        # Los clientes externos (MinIO, Kafka, ClamAV) se crean en el primer uso, no al importar app.py:
+        # así arrancar un worker de gunicorn no hace llamadas de red ni falla si alguno está caído.
+        self._lock = threading.Lock()
+        self.s3_endpoint_url = s3_endpoint_url
+        self.s3_access_key = s3_access_key
+        self.s3_secret_key = s3_secret_key
+        self.s3_bucket_name = s3_bucket_name
+        self._s3_client = None
 
         # --- Configuración de Fernet (encriptación simétrica) ---
         try:
@@ -52,56 +37,87 @@ class FileProcessorService:
             raise
 
         # --- Configuración de Kafka ---
-        self.kafka_producer = None
+        self.kafka_bootstrap_servers = kafka_bootstrap_servers
         self.kafka_topic_uploaded = kafka_topic_uploaded
-        self.kafka_enabled = os.getenv("ENABLE_KAFKA", "False").lower() == "true" # Usar variable de entorno para habilitar/deshabilitar
-
-        if self.kafka_enabled and kafka_bootstrap_servers:
-            try:
-                self.kafka_producer = KafkaProducer(
-                    bootstrap_servers=kafka_bootstrap_servers.split(','),
-                    value_serializer=lambda v: v.encode('utf-8') # Cambio a encode directo para enviar el ID de la versión
-                )
-                self.logger.info(f"Kafka Producer inicializado para {kafka_bootstrap_servers}")
-            except Exception as e:
-                self.logger.error(f"Error al inicializar Kafka Producer: {e}", exc_info=True)
-                self.kafka_producer = None
-                self.kafka_enabled = False # Deshabilitar Kafka si falla la inicialización
-        else:
+        self.kafka_enabled = os.getenv("ENABLE_KAFKA", "False").lower() == "true" and bool(kafka_bootstrap_servers) # Usar variable de entorno para habilitar/deshabilitar
+        self._kafka_producer = None
+        if not self.kafka_enabled:
             self.logger.info("Kafka deshabilitado por configuración o parámetros.")
 
-
         # --- Configuración de ClamAV ---
         self.clamav_enabled = os.getenv("CLAMAV_ENABLED", "false").lower() == "true"
-        if self.clamav_enabled:
-            clamav_host = os.getenv("CLAMAV_HOST", "clamav") # <--- CAMBIADO DE "localhost" A "clamav"
-            clamav_port = int(os.getenv("CLAMAV_PORT", "3310"))
-            try:
-                # Intenta conectarte a ClamAV
-                self.clamav_client = pyclamd.ClamdNetworkSocket(clamav_host, clamav_port)
-                self.clamav_client.ping() # Verifica la conexión
-                self.logger.info(f"Conexión a ClamAV establecida en {clamav_host}:{clamav_port}.")
-            except clamd.ConnectionError as e: # <--- CORREGIDO: ERA pyclamd.clamd.ConnectionError
-                self.logger.error(f"No se pudo conectar a ClamAV en {clamav_host}:{clamav_port}: {e}")
-                self.clamav_enabled = False # Deshabilita la funcionalidad si no se puede conectar
-            except Exception as e:
-                self.logger.error(f"Error inesperado al inicializar ClamAV: {e}", exc_info=True)
-                self.clamav_enabled = False # Deshabilita la funcionalidad
-
-            
+        self.clamav_host = os.getenv("CLAMAV_HOST", "clamav") # <--- CAMBIADO DE "localhost" A "clamav"
+        self.clamav_port = int(os.getenv("CLAMAV_PORT", "3310"))
+        self._clamav_client = None
+
+    @property
+    def s3_client(self):
+        """Cliente MinIO; la primera vez comprueba (y crea si falta) el bucket."""
+        if self._s3_client is None:
+            with self._lock:
+                if self._s3_client is None:
+                    minio_host = self.s3_endpoint_url.replace("http://", "").replace("https://", "")
+                    client = Minio(
+                        minio_host,
+                        access_key=self.s3_access_key,
+                        secret_key=self.s3_secret_key,
+                        secure=self.s3_endpoint_url.startswith("https://")
+                    )
+                    try:
+                        if not client.bucket_exists(self.s3_bucket_name):
+                            client.make_bucket(self.s3_bucket_name)
+                            self.logger.info(f"Bucket '{self.s3_bucket_name}' creado en MinIO/Ceph.")
+                    except S3Error as e:
+                        self.logger.error(f"Error al verificar/crear bucket en MinIO/Ceph: {e}")
+                        raise
+                    self._s3_client = client
+                    self.logger.info(f"Cliente MinIO inicializado para {self.s3_endpoint_url}.")
+        return self._s3_client
+
+    @property
+    def kafka_producer(self):
+        if self.kafka_enabled and self._kafka_producer is None:
+            with self._lock:
+                if self.kafka_enabled and self._kafka_producer is None:
+                    try:
+                        from kafka import KafkaProducer
+                        self._kafka_producer = KafkaProducer(
+                            bootstrap_servers=self.kafka_bootstrap_servers.split(','),
+                            value_serializer=lambda v: v.encode('utf-8') # Cambio a encode directo para enviar el ID de la versión
+                        )
+                        self.logger.info(f"Kafka Producer inicializado para {self.kafka_bootstrap_servers}")
+                    except Exception as e:
+                        self.logger.error(f"Error al inicializar Kafka Producer: {e}", exc_info=True)
+                        self.kafka_enabled = False # Deshabilitar Kafka si falla la inicialización
+        return self._kafka_producer
+
+    @property
+    def clamav_client(self):
+        if self.clamav_enabled and self._clamav_client is None:
+            with self._lock:
+                if self.clamav_enabled and self._clamav_client is None:
+                    try:
+                        import pyclamd
+                        client = pyclamd.ClamdNetworkSocket(self.clamav_host, self.clamav_port)
+                        client.ping() # Verifica la conexión
+                        self._clamav_client = client
+                        self.logger.info(f"Conexión a ClamAV establecida en {self.clamav_host}:{self.clamav_port}.")
+                    except Exception as e:
+                        # Se reintenta en el siguiente escaneo: ClamAV puede tardar en cargar sus firmas.
+                        self.logger.error(f"No se pudo conectar a ClamAV en {self.clamav_host}:{self.clamav_port}: {e}")
+        return self._clamav_client
+
     def _generate_file_key(self):
         """Genera una clave de encriptación aleatoria para un archivo."""
         return Fernet.generate_key()
 
-    def _encrypt_data(self, data: bytes, file_key: bytes) -> bytes:
-        """Encripta datos usando una clave de archivo."""
-        f = Fernet(file_key)
-        return f.encrypt(data)
+    def _encrypt_data(self, data: bytes, file_key: bytes, mimetype: str = None) -> bytes:
+        """Comprime (según el tipo MIME) y encripta datos usando una clave de archivo (ver storage_envelope.py)."""
+        return storage_envelope.seal(data, file_key, mimetype)
 
     def _decrypt_data(self, encrypted_data: bytes, file_key: bytes) -> bytes:
-        """Desencripta datos usando una clave de archivo."""
-        f = Fernet(file_key)
-        return f.decrypt(encrypted_data)
+        """Desencripta datos usando una clave de archivo; acepta también el formato Fernet antiguo."""
+        return storage_envelope.open_envelope(encrypted_data, file_key)
 
     def _scan_for_viruses(self, data: bytes) -> str:
         """Escanea los datos en busca de virus usando ClamAV."""
@@ -134,8 +150,11 @@ class FileProcessorService:
 
         self.logger.info(f"Procesando archivo: '{original_filename}' (Tamaño: {file_size} bytes, Tipo: {mimetype}) para usuario: {user_id}")
 
+        extension = file_extension(original_filename)
+
         # Escanear el archivo en busca de virus
-        scan_status = self._scan_for_viruses(file_content)
+        with observe_stage(STORAGE_STAGE_SECONDS, operation='upload', stage='virus_scan', extension=extension):
+            scan_status = self._scan_for_viruses(file_content)
         if scan_status == "infected":
             self.logger.error(f"Archivo '{original_filename}' infectado, no se almacenará.")
             raise ValueError(f"Virus detectado: {scan_status}. No se pudo procesar el archivo.")
@@ -145,11 +164,12 @@ class FileProcessorService:
              # Por ahora, permitimos el almacenamiento pero registramos la advertencia.
 
         # Generar clave de archivo y encriptar datos
-        file_key = self._generate_file_key()
-        encrypted_data = self._encrypt_data(file_content, file_key)
+        with observe_stage(STORAGE_STAGE_SECONDS, operation='upload', stage='encryption', extension=extension):
+            file_key = self._generate_file_key()
+            encrypted_data = self._encrypt_data(file_content, file_key, mimetype)
 
-        # Encriptar la clave del archivo con la master key del sistema
-        encryption_key_encrypted = self.fernet_master.encrypt(file_key)
+            # Encriptar la clave del archivo con la master key del sistema
+            encryption_key_encrypted = self.fernet_master.encrypt(file_key)
 
         # Generar un nombre único para el objeto en MinIO/Ceph
         # Se incluye el user_id para organizar los objetos en MinIO por usuario (opcional pero bueno)
@@ -157,23 +177,28 @@ class FileProcessorService:
 
         try:
             # Subir el archivo encriptado a MinIO/Ceph
-            self.s3_client.put_object(
-                self.s3_bucket_name,
-                ceph_path,
-                io.BytesIO(encrypted_data),
-                len(encrypted_data),
-                content_type="application/octet-stream" # Siempre como octet-stream porque está encriptado
-            )
-            self.logger.info(f"Archivo encriptado '{original_filename}' subido a MinIO/Ceph como '{ceph_path}'.")
+            with observe_stage(STORAGE_STAGE_SECONDS, operation='upload', stage='storage', extension=extension):
+                self.s3_client.put_object(
+                    self.s3_bucket_name,
+                    ceph_path,
+                    io.BytesIO(encrypted_data),
+                    len(encrypted_data),
+                    content_type="application/octet-stream" # Siempre como octet-stream porque está encriptado
+                )
+            self.logger.info(f"Archivo encriptado '{original_filename}' subido a MinIO/Ceph como '{ceph_path}' "
+                             f"({len(file_content)} -> {len(encrypted_data)} bytes).")
+            STORAGE_OBJECT_BYTES.labels(kind='plaintext', extension=extension).inc(len(file_content))
+            STORAGE_OBJECT_BYTES.labels(kind='stored', extension=extension).inc(len(encrypted_data))
 
             # Retornar la información necesaria para el modelo DocumentVersion
             return {
                 "ceph_path": ceph_path,
-                "encryption_key_encrypted": encryption_key_encrypted.decode('utf-8'), # Decodificar a string para guardar en DB
-                "file_size": file_size,
+                "encryption_key_encrypted": encryption_key_encrypted, # Bytes: la columna es LargeBinary
+                "file_size": len(file_content), # content_length de la parte multipart suele venir vacío
                 "mimetype": mimetype,
                 "original_filename": original_filename,
-                "virus_scan_status": scan_status # Devolver el estado del escaneo de virus
+                "virus_scan_status": scan_status, # Devolver el estado del escaneo de virus
+                "sha256": hashlib.sha256(file_content).hexdigest() # Clave de los artefactos de texto (text_artifacts.py)
             }
         except S3Error as e:
             self.logger.error(f"Error al subir el archivo a MinIO/Ceph: {e}")
@@ -189,6 +214,7 @@ class FileProcessorService:
         y la master key del sistema.
         """
         self.logger.info(f"Recuperando y desencriptando archivo: '{document_version_entry.original_filename}' (MinIO path: {document_version_entry.ceph_path})")
+        extension = file_extension(document_version_entry.original_filename)
         try:
             # 1. Obtener la clave de encriptación del archivo (encriptada con la master key)
             encryption_key_encrypted = document_version_entry.encryption_key_encrypted
@@ -200,14 +226,16 @@ class FileProcessorService:
             file_key = self.fernet_master.decrypt(encryption_key_encrypted)
 
             # 3. Descargar el archivo encriptado de MinIO/Ceph
-            response = self.s3_client.get_object(self.s3_bucket_name, document_version_entry.ceph_path)
-            encrypted_data = response.read()
-            response.close()
-            response.release_conn()
+            with observe_stage(STORAGE_STAGE_SECONDS, operation='download', stage='storage', extension=extension):
+                response = self.s3_client.get_object(self.s3_bucket_name, document_version_entry.ceph_path)
+                encrypted_data = response.read()
+                response.close()
+                response.release_conn()
             self.logger.info(f"Archivo '{document_version_entry.ceph_path}' descargado de MinIO/Ceph.")
 
             # 4. Desencriptar los datos del archivo
-            decrypted_data = self._decrypt_data(encrypted_data, file_key)
+            with observe_stage(STORAGE_STAGE_SECONDS, operation='download', stage='decryption', extension=extension):
+                decrypted_data = self._decrypt_data(encrypted_data, file_key)
             self.logger.info(f"Archivo '{document_version_entry.original_filename}' desencriptado exitosamente.")
             return decrypted_data
 
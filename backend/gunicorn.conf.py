@@ -0,0 +1,12 @@
+# backend/gunicorn.conf.py
+# Gunicorn carga este fichero automáticamente desde el directorio de trabajo.
+import metrics
+
+
+def on_starting(server):
+    # Valores de ejecuciones anteriores no deben sumarse a los nuevos contadores.
+    metrics.reset_multiprocess_dir()
+
+
+def child_exit(server, worker):
+    metrics.mark_process_dead(worker.pid)
@@ -0,0 +1,220 @@
+# backend/ingest_admission.py
+"""
+Control de admisión de las subidas según la presión de la indexación.
+
+Sin él, POST /documents guarda en MinIO y encola todo lo que llega aunque la
+indexación lleve horas de retraso: el almacenamiento y la cola crecen más deprisa
+de lo que los workers los vacían. Antes de leer el fichero se comprueba:
+
+* Espacio: con INGEST_STORAGE_CAPACITY_BYTES (capacidad de MinIO; 0 desactiva la
+  comprobación), la subida debe dejar al menos INGEST_STORAGE_MIN_HEADROOM_BYTES
+  libres. Lo ocupado es la suma de `size_bytes` de las versiones (tamaño sin
+  comprimir: una cota superior), cacheada INGEST_ADMISSION_CACHE_SECONDS. 503.
+* Usuario: como mucho INGEST_MAX_PENDING_PER_USER versiones sin indexar
+  ('pending', 'processing' o 'deferred'). 429.
+* Backlog: versiones esperando en las colas de Celery de la indexación y en las
+  colas virtuales de ingest_scheduler. A partir de INGEST_DEFER_BACKLOG la subida
+  se acepta y se guarda, pero la versión queda 'deferred' sin encolar; los workers
+  (al terminar un documento) y el servicio `ingest_dispatcher` (en cada barrido)
+  las pasan a 'pending' y las encolan (`promote_deferred`, las más antiguas
+  primero) cuando el backlog baja del umbral. Si las encoladas más las diferidas
+  llegan a INGEST_MAX_BACKLOG, 503.
+
+Los rechazos llevan Retry-After (ver `estimate_retry_after`). Las decisiones se
+cuentan en `dv_ingest_admissions_total` y la presión de cada recurso (uso / límite)
+se publica en `dv_ingest_pressure`. Si Valkey no responde, el backlog no se comprueba.
+"""
+import os
+import math
+import logging
+
+from sqlalchemy import text
+
+import ingest_scheduler
+from valkey_client import get_valkey
+from metrics import INGEST_ADMISSIONS
+
+INGEST_ADMISSION_ENABLED = os.getenv("INGEST_ADMISSION_ENABLED", "true").lower() == "true"
+INGEST_DEFER_BACKLOG = int(os.getenv("INGEST_DEFER_BACKLOG", "2000"))
+INGEST_MAX_BACKLOG = int(os.getenv("INGEST_MAX_BACKLOG", "10000"))
+INGEST_MAX_PENDING_PER_USER = int(os.getenv("INGEST_MAX_PENDING_PER_USER", "5000"))
+INGEST_STORAGE_CAPACITY_BYTES = int(os.getenv("INGEST_STORAGE_CAPACITY_BYTES", "0"))
+INGEST_STORAGE_MIN_HEADROOM_BYTES = int(os.getenv("INGEST_STORAGE_MIN_HEADROOM_BYTES", str(1024 ** 3)))
+INGEST_ADMISSION_CACHE_SECONDS = int(os.getenv("INGEST_ADMISSION_CACHE_SECONDS", "30"))
+# Tiempo medio de indexación de un documento, para estimar Retry-After.
+INGEST_ESTIMATED_DOCUMENT_SECONDS = float(os.getenv("INGEST_ESTIMATED_DOCUMENT_SECONDS", "30"))
+INGEST_STORAGE_RETRY_AFTER_SECONDS = int(os.getenv("INGEST_STORAGE_RETRY_AFTER_SECONDS", "3600"))
+INGEST_MAX_RETRY_AFTER_SECONDS = int(os.getenv("INGEST_MAX_RETRY_AFTER_SECONDS", "3600"))
+# Versiones diferidas que un worker encola de una vez al terminar un documento.
+INGEST_PROMOTE_BATCH = int(os.getenv("INGEST_PROMOTE_BATCH", "20"))
+
+_STORAGE_USED_KEY = "ingest:storage_used_bytes"
+
+# Suma la subida a la caché solo si existe: sin ella la próxima admisión vuelve a sumar la tabla.
+_ADD_STORAGE_USED_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+return nil
+"""
+
+# Versiones sin indexar del usuario (índice parcial ix_document_versions_unindexed).
+USER_PENDING_SQL = """
+    SELECT COUNT(*) FROM document_versions
+    WHERE uploaded_by = :user_id AND processed_status IN ('pending', 'processing', 'deferred')
+"""
+
+DEFERRED_COUNT_SQL = "SELECT COUNT(*) FROM document_versions WHERE processed_status = 'deferred'"
+
+STORAGE_USED_SQL = "SELECT COALESCE(SUM(size_bytes), 0) FROM document_versions"
+
+# Las diferidas más antiguas; SKIP LOCKED evita que dos workers encolen la misma.
+DEFERRED_SQL = """
+    SELECT id, uploaded_by, size_bytes FROM document_versions
+    WHERE processed_status = 'deferred'
+    ORDER BY upload_timestamp
+    LIMIT :limit
+    FOR UPDATE SKIP LOCKED
+"""
+
+
+class AdmissionDenied(Exception):
+    """La subida no se admite ahora (429 o 503 según `status`); el cliente debe reintentar tras `retry_after` segundos."""
+    def __init__(self, message, status, reason, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def backlog_depth(valkey=None) -> int:
+    """Versiones esperando indexación: mensajes en las colas de Celery de los carriles más las colas virtuales."""
+    valkey = valkey or get_valkey()
+    depth = sum(valkey.llen(lane["queue"]) for lane in ingest_scheduler.LANES.values())
+    return depth + sum(queued for _, _, queued, _, _ in ingest_scheduler.backlog_snapshot())
+
+
+def storage_used_bytes(db_session) -> int:
+    """Bytes ocupados según las versiones guardadas, cacheados en Valkey para no sumar la tabla en cada subida."""
+    valkey = get_valkey()
+    try:
+        cached = valkey.get(_STORAGE_USED_KEY)
+        if cached is not None:
+            return int(cached)
+    except Exception as e:
+        logging.warning(f"No se pudo leer el almacenamiento ocupado de Valkey: {e}")
+    used = int(db_session.execute(text(STORAGE_USED_SQL)).scalar())
+    try:
+        valkey.set(_STORAGE_USED_KEY, used, ex=INGEST_ADMISSION_CACHE_SECONDS)
+    except Exception:
+        pass
+    return used
+
+
+def _add_storage_used(size_bytes: int):
+    # Las subidas aceptadas cuentan ya, sin esperar a que caduque la caché.
+    try:
+        get_valkey().eval(_ADD_STORAGE_USED_LUA, 1, _STORAGE_USED_KEY, int(size_bytes or 0))
+    except Exception:
+        pass
+
+
+def estimate_retry_after(waiting: int, capacity: int) -> int:
+    """Tiempo hasta que se drenen `waiting` documentos con `capacity` en paralelo, acotado."""
+    seconds = math.ceil((waiting + 1) * INGEST_ESTIMATED_DOCUMENT_SECONDS / max(capacity, 1))
+    return min(max(1, seconds), INGEST_MAX_RETRY_AFTER_SECONDS)
+
+
+def _lanes_capacity() -> int:
+    return sum(lane["max_in_flight"] for lane in ingest_scheduler.LANES.values())
+
+
+def admit_upload(db_session, user_id, size_bytes) -> str:
+    """
+    Decide si se admite una subida de `size_bytes` (Content-Length de la petición) antes de leerla.
+    Devuelve 'accepted' o 'deferred' (guardar, pero sin encolar la indexación); lanza AdmissionDenied si no.
+    """
+    if not INGEST_ADMISSION_ENABLED:
+        return 'accepted'
+
+    if INGEST_STORAGE_CAPACITY_BYTES:
+        headroom = INGEST_STORAGE_CAPACITY_BYTES - storage_used_bytes(db_session) - (size_bytes or 0)
+        if headroom < INGEST_STORAGE_MIN_HEADROOM_BYTES:
+            INGEST_ADMISSIONS.labels(decision='rejected', reason='storage').inc()
+            logging.warning(f"Almacenamiento casi lleno ({headroom} bytes libres tras la subida). Rechazando subida de {user_id}.")
+            raise AdmissionDenied("El almacenamiento está casi lleno. Inténtalo más tarde.",
+                                  503, 'storage', INGEST_STORAGE_RETRY_AFTER_SECONDS)
+
+    pending = db_session.execute(text(USER_PENDING_SQL), {"user_id": user_id}).scalar()
+    if pending >= INGEST_MAX_PENDING_PER_USER:
+        INGEST_ADMISSIONS.labels(decision='rejected', reason='user_pending').inc()
+        raise AdmissionDenied(f"Ya tienes {pending} documentos pendientes de indexar. Espera a que avancen.", 429,
+                              'user_pending', estimate_retry_after(pending - INGEST_MAX_PENDING_PER_USER,
+                                                                   ingest_scheduler.tenant_settings(user_id)["max_in_flight"]))
+
+    try:
+        queued = backlog_depth()
+    except Exception as e:
+        logging.warning(f"No se pudo medir el backlog de indexación ({e}); se admite la subida de {user_id}.")
+        queued = 0
+    if queued >= INGEST_DEFER_BACKLOG:
+        backlog = queued + db_session.execute(text(DEFERRED_COUNT_SQL)).scalar()
+        if backlog >= INGEST_MAX_BACKLOG:
+            INGEST_ADMISSIONS.labels(decision='rejected', reason='backlog').inc()
+            logging.warning(f"Backlog de indexación lleno ({backlog} >= {INGEST_MAX_BACKLOG}). Rechazando subida de {user_id}.")
+            raise AdmissionDenied("La indexación está saturada. Inténtalo más tarde.", 503, 'backlog',
+                                  estimate_retry_after(backlog, _lanes_capacity()))
+        INGEST_ADMISSIONS.labels(decision='deferred', reason='backlog').inc()
+        return 'deferred'
+    INGEST_ADMISSIONS.labels(decision='accepted', reason='none').inc()
+    return 'accepted'
+
+
+def record_upload(size_bytes):
+    """La subida admitida ya está en MinIO."""
+    if INGEST_STORAGE_CAPACITY_BYTES:
+        _add_storage_used(size_bytes)
+
+
+def promote_deferred(db_session) -> int:
+    """
+    Encola versiones 'deferred' mientras el backlog esté por debajo de INGEST_DEFER_BACKLOG (como mucho
+    INGEST_PROMOTE_BATCH). La llaman los workers al terminar un documento y el barrido periódico de
+    ingest_scheduler.run. Devuelve cuántas encoló.
+    """
+    try:
+        room = min(INGEST_DEFER_BACKLOG - backlog_depth(), INGEST_PROMOTE_BATCH)
+    except Exception as e:
+        logging.warning(f"No se pudo medir el backlog de indexación para encolar las diferidas: {e}")
+        return 0
+    if room <= 0:
+        return 0
+    rows = db_session.execute(text(DEFERRED_SQL), {"limit": room}).all()
+    if not rows:
+        db_session.rollback()
+        return 0
+    db_session.execute(text("UPDATE document_versions SET processed_status = 'pending' WHERE id = ANY(:ids)"),
+                       {"ids": [row.id for row in rows]})
+    db_session.commit()
+    for row in rows:
+        ingest_scheduler.submit(row.uploaded_by, row.id, row.size_bytes)
+    logging.info(f"Encoladas {len(rows)} versiones diferidas (backlog por debajo de {INGEST_DEFER_BACKLOG}).")
+    return len(rows)
+
+
+def pressure_snapshot(db_session) -> dict:
+    """
+    `{recurso: uso / límite}` para /metrics: a partir de 1 las subidas se difieren ('deferral') o se
+    rechazan ('backlog', 'storage').
+    """
+    valkey = get_valkey()
+    queued = backlog_depth(valkey)
+    deferred = db_session.execute(text(DEFERRED_COUNT_SQL)).scalar()
+    pressure = {"deferral": queued / max(INGEST_DEFER_BACKLOG, 1),
+                "backlog": (queued + deferred) / max(INGEST_MAX_BACKLOG, 1)}
+    if INGEST_STORAGE_CAPACITY_BYTES:
+        used = valkey.get(_STORAGE_USED_KEY)
+        if used is not None:
+            usable = max(INGEST_STORAGE_CAPACITY_BYTES - INGEST_STORAGE_MIN_HEADROOM_BYTES, 1)
+            pressure["storage"] = int(used) / usable
+    return pressure
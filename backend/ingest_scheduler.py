@@ -0,0 +1,360 @@
+# backend/ingest_scheduler.py
+"""
+Reparto justo de la indexación entre usuarios.
+
+Encolar cada subida directamente en Celery hace que quien sube 20.000 ficheros
+deje detrás, durante horas, las subidas sueltas de todos los demás. Aquí cada
+usuario tiene su cola virtual en Valkey y el scheduler solo pasa a Celery lo que
+los workers pueden atender ya:
+
+* Dos carriles: los documentos de hasta INGEST_FAST_LANE_MAX_BYTES van al carril
+  rápido (cola de Celery INGEST_FAST_QUEUE, con su propia capacidad), para que un
+  fichero pequeño no espere detrás de libros escaneados.
+* En cada carril, round-robin ponderado entre los usuarios con cola: cada turno
+  despacha hasta `weight` documentos del usuario antes de pasar al siguiente.
+* Como mucho INGEST_MAX_IN_FLIGHT / INGEST_FAST_MAX_IN_FLIGHT documentos en
+  Celery por carril, y max_in_flight por usuario (INGEST_TENANT_MAX_IN_FLIGHT;
+  pesos y límites propios en INGEST_TENANT_OVERRIDES).
+
+Los documentos en curso son un ZSET con la hora de inicio, como los slots de
+ask_jobs.py: la tarea renueva el suyo al empezar, lo libera al terminar (o al
+agotar los reintentos) y despacha lo siguiente. Un slot de un worker muerto
+caduca tras INGEST_LEASE_SECONDS. Si Valkey no responde, la subida se encola
+directamente en Celery como antes.
+
+Despachar solo al subir o al terminar una tarea no basta: si se pierden las
+tareas en curso (reinicio del broker, un worker muerto), sus slots caducan pero
+nadie vuelve a despachar hasta la siguiente subida. El servicio
+`ingest_dispatcher` (`python ingest_scheduler.py`) hace cada
+INGEST_SWEEP_INTERVAL_SECONDS una pasada (`sweep`) que recorta los slots
+caducados y despacha los dos carriles. Después encola las versiones diferidas
+por la admisión (`ingest_admission.promote_deferred`) para las que haya sitio:
+los workers solo lo hacen al terminar un documento, y sin tareas que terminen
+se quedarían 'deferred' para siempre.
+"""
+import os
+import json
+import time
+import logging
+import argparse
+
+import metrics
+from valkey_client import get_valkey
+from celery_client import celery_app, INDEX_DOCUMENT_TASK
+from metrics import INGEST_QUEUE_WAIT_SECONDS
+
+INGEST_SCHEDULER_ENABLED = os.getenv("INGEST_SCHEDULER_ENABLED", "true").lower() == "true"
+INGEST_QUEUE = os.getenv("INGEST_QUEUE", "celery") # Cola por defecto de Celery, la que ya consumía el worker
+INGEST_FAST_QUEUE = os.getenv("INGEST_FAST_QUEUE", "ingest_fast")
+INGEST_FAST_LANE_MAX_BYTES = int(os.getenv("INGEST_FAST_LANE_MAX_BYTES", str(1024 * 1024)))
+INGEST_MAX_IN_FLIGHT = int(os.getenv("INGEST_MAX_IN_FLIGHT", "80"))
+INGEST_FAST_MAX_IN_FLIGHT = int(os.getenv("INGEST_FAST_MAX_IN_FLIGHT", "20"))
+INGEST_TENANT_MAX_IN_FLIGHT = int(os.getenv("INGEST_TENANT_MAX_IN_FLIGHT", "8"))
+INGEST_TENANT_WEIGHT = int(os.getenv("INGEST_TENANT_WEIGHT", "1"))
+# Pesos y límites por usuario, ej. '{"<user_id>": {"weight": 4, "max_in_flight": 20}}'.
+INGEST_TENANT_OVERRIDES = json.loads(os.getenv("INGEST_TENANT_OVERRIDES") or "{}")
+INGEST_LEASE_SECONDS = int(os.getenv("INGEST_LEASE_SECONDS", "3600"))
+INGEST_SWEEP_INTERVAL_SECONDS = int(os.getenv("INGEST_SWEEP_INTERVAL_SECONDS", "60"))
+
+LANES = {
+    "fast": {"queue": INGEST_FAST_QUEUE, "max_in_flight": INGEST_FAST_MAX_IN_FLIGHT},
+    "normal": {"queue": INGEST_QUEUE, "max_in_flight": INGEST_MAX_IN_FLIGHT},
+}
+
+# Añade el documento a la cola del usuario y al usuario a la rotación del carril si no estaba.
+_ENQUEUE_LUA = """
+redis.call('RPUSH', KEYS[2], ARGV[2])
+redis.call('HSET', KEYS[3], 'weight', ARGV[3], 'max_in_flight', ARGV[4])
+if not redis.call('LPOS', KEYS[1], ARGV[1]) then
+    redis.call('RPUSH', KEYS[1], ARGV[1])
+end
+return redis.call('LLEN', KEYS[2])
+"""
+
+# Saca el siguiente documento del carril: round-robin ponderado sobre la rotación (KEYS[1]),
+# respetando la capacidad del carril (KEYS[2]) y la del usuario. Devuelve {usuario, elemento} o nil.
+_DISPATCH_LUA = """
+local now, stale, lane_cap = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local queue_prefix, in_flight_prefix, tenant_prefix, credit_field = ARGV[4], ARGV[5], ARGV[6], ARGV[7]
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now - stale)
+if redis.call('ZCARD', KEYS[2]) >= lane_cap then
+    return nil
+end
+for _ = 1, redis.call('LLEN', KEYS[1]) do
+    local user = redis.call('LINDEX', KEYS[1], 0)
+    if not user then
+        return nil
+    end
+    local queue, in_flight, tenant = queue_prefix .. user, in_flight_prefix .. user, tenant_prefix .. user
+    if redis.call('LLEN', queue) == 0 then
+        redis.call('LPOP', KEYS[1])
+        redis.call('HDEL', tenant, credit_field)
+    else
+        redis.call('ZREMRANGEBYSCORE', in_flight, '-inf', now - stale)
+        if redis.call('ZCARD', in_flight) < tonumber(redis.call('HGET', tenant, 'max_in_flight') or '1') then
+            local item = redis.call('LPOP', queue)
+            local version_id = string.match(item, '^[^|]+')
+            redis.call('ZADD', in_flight, now, version_id)
+            redis.call('ZADD', KEYS[2], now, version_id)
+            local weight = tonumber(redis.call('HGET', tenant, 'weight') or '1')
+            local credit = tonumber(redis.call('HGET', tenant, credit_field) or weight) - 1
+            if redis.call('LLEN', queue) == 0 then
+                redis.call('LPOP', KEYS[1])
+                redis.call('HDEL', tenant, credit_field)
+            elseif credit <= 0 then
+                redis.call('RPUSH', KEYS[1], redis.call('LPOP', KEYS[1]))
+                redis.call('HDEL', tenant, credit_field)
+            else
+                redis.call('HSET', tenant, credit_field, credit)
+            end
+            return {user, item}
+        end
+        -- Usuario en su límite: cede el turno sin perder su sitio en la rotación
+        redis.call('RPUSH', KEYS[1], redis.call('LPOP', KEYS[1]))
+    end
+end
+return nil
+"""
+
+# Quita de una cola virtual (KEYS[1]) los elementos de la versión ARGV[1]. Devuelve cuántos quitó.
+_FORGET_LUA = """
+local prefix, removed = ARGV[1] .. '|', 0
+for _, item in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+    if string.sub(item, 1, string.len(prefix)) == prefix then
+        removed = removed + redis.call('LREM', KEYS[1], 0, item)
+    end
+end
+return removed
+"""
+
+
+def _rotation_key(lane):
+    return f"ingest:{lane}:rotation"
+
+def _queue_key(lane, user_id):
+    return f"ingest:{lane}:queue:{user_id}"
+
+def _lane_in_flight_key(lane):
+    return f"ingest:{lane}:in_flight"
+
+def _user_in_flight_key(lane, user_id):
+    return f"ingest:{lane}:in_flight:{user_id}"
+
+def _tenant_key(user_id):
+    return f"ingest:tenant:{user_id}"
+
+
+def tenant_settings(user_id) -> dict:
+    override = INGEST_TENANT_OVERRIDES.get(str(user_id), {})
+    return {
+        "weight": max(int(override.get("weight", INGEST_TENANT_WEIGHT)), 1),
+        "max_in_flight": max(int(override.get("max_in_flight", INGEST_TENANT_MAX_IN_FLIGHT)), 1),
+    }
+
+
+def lane_for(size_bytes) -> str:
+    return "fast" if size_bytes is not None and size_bytes <= INGEST_FAST_LANE_MAX_BYTES else "normal"
+
+
+def _send_to_celery(document_version_id: str, lane: str):
+    celery_app.send_task(INDEX_DOCUMENT_TASK, args=[document_version_id], queue=LANES[lane]["queue"])
+
+
+def submit(user_id, document_version_id, size_bytes, send=_send_to_celery) -> str:
+    """Pone la versión en la cola virtual de su usuario y despacha lo que quepa. Devuelve el carril."""
+    lane = lane_for(size_bytes)
+    if not INGEST_SCHEDULER_ENABLED:
+        send(str(document_version_id), lane)
+        return lane
+    try:
+        settings = tenant_settings(user_id)
+        get_valkey().eval(_ENQUEUE_LUA, 3, _rotation_key(lane), _queue_key(lane, user_id), _tenant_key(user_id),
+                          str(user_id), f"{document_version_id}|{time.time()}",
+                          settings["weight"], settings["max_in_flight"])
+    except Exception as e:
+        logging.warning(f"Scheduler de indexación no disponible ({e}); se encola {document_version_id} directamente.")
+        send(str(document_version_id), lane)
+        return lane
+    dispatch(lane, send=send)
+    return lane
+
+
+def dispatch(lane: str, send=_send_to_celery) -> int:
+    """Pasa a Celery documentos del carril mientras haya capacidad. Devuelve cuántos despachó."""
+    valkey = get_valkey()
+    dispatched = 0
+    while True:
+        picked = valkey.eval(
+            _DISPATCH_LUA, 2, _rotation_key(lane), _lane_in_flight_key(lane),
+            time.time(), INGEST_LEASE_SECONDS, LANES[lane]["max_in_flight"],
+            f"ingest:{lane}:queue:", f"ingest:{lane}:in_flight:", "ingest:tenant:", f"credit:{lane}")
+        if not picked:
+            return dispatched
+        user_id, item = picked
+        document_version_id, enqueued_at = item.split("|", 1)
+        try:
+            send(document_version_id, lane)
+        except Exception:
+            # Sin mensaje en Celery no hay tarea que libere el slot: se devuelve a la cabeza de su cola.
+            valkey.lpush(_queue_key(lane, user_id), item)
+            _release(valkey, lane, user_id, document_version_id)
+            raise
+        INGEST_QUEUE_WAIT_SECONDS.labels(lane=lane).observe(max(time.time() - float(enqueued_at), 0))
+        dispatched += 1
+
+
+def _release(valkey, lane, user_id, document_version_id):
+    valkey.zrem(_user_in_flight_key(lane, user_id), document_version_id)
+    valkey.zrem(_lane_in_flight_key(lane), document_version_id)
+
+
+def renew(user_id, document_version_id):
+    """La tarea empieza (o reintenta): renueva su slot para que no caduque mientras trabaja."""
+    try:
+        valkey = get_valkey()
+        now = time.time()
+        pipe = valkey.pipeline()
+        for lane in LANES:
+            pipe.zadd(_user_in_flight_key(lane, user_id), {str(document_version_id): now}, xx=True)
+            pipe.zadd(_lane_in_flight_key(lane), {str(document_version_id): now}, xx=True)
+        pipe.execute()
+    except Exception as e:
+        logging.warning(f"No se pudo renovar el slot de indexación de {document_version_id}: {e}")
+
+
+def finish(user_id, document_version_id, send=_send_to_celery):
+    """La tarea terminó (indexada o sin más reintentos): libera su slot y despacha lo siguiente."""
+    try:
+        valkey = get_valkey()
+        for lane in LANES:
+            _release(valkey, lane, user_id, str(document_version_id))
+        for lane in LANES:
+            dispatch(lane, send=send)
+    except Exception as e:
+        logging.warning(f"No se pudo liberar el slot de indexación de {document_version_id}: {e}")
+
+
+def forget(user_id, document_version_id, send=_send_to_celery):
+    """
+    La versión se purga: la quita de las colas virtuales de su usuario y libera su slot si estaba en curso,
+    para que no ocupe capacidad hasta que caduque. Despacha lo siguiente.
+    """
+    try:
+        valkey = get_valkey()
+        for lane in LANES:
+            valkey.eval(_FORGET_LUA, 1, _queue_key(lane, user_id), str(document_version_id))
+            _release(valkey, lane, user_id, str(document_version_id))
+        for lane in LANES:
+            dispatch(lane, send=send)
+    except Exception as e:
+        logging.warning(f"No se pudo quitar {document_version_id} del scheduler de indexación: {e}")
+
+
+def release_version(document_version_id, send=_send_to_celery):
+    """
+    Como `finish` para una versión que ya no existe en la base de datos (se purgó con la tarea en cola):
+    sin su usuario, busca el slot en los conjuntos en curso de todos los usuarios del carril.
+    """
+    try:
+        valkey = get_valkey()
+        for lane in LANES:
+            valkey.zrem(_lane_in_flight_key(lane), str(document_version_id))
+            for key in valkey.scan_iter(match=f"{_user_in_flight_key(lane, '')}*", count=500):
+                valkey.zrem(key, str(document_version_id))
+        for lane in LANES:
+            dispatch(lane, send=send)
+    except Exception as e:
+        logging.warning(f"No se pudo liberar el slot de indexación de {document_version_id}: {e}")
+
+
+def sweep(send=_send_to_celery) -> dict:
+    """
+    Recorta los slots caducados de los carriles y de todos los usuarios (también los que ya no están en la
+    rotación) y despacha cada carril. Devuelve `{lane: {"expired": n, "dispatched": n}}`.
+    """
+    valkey = get_valkey()
+    stale_before = time.time() - INGEST_LEASE_SECONDS
+    report = {}
+    for lane in LANES:
+        expired = valkey.zremrangebyscore(_lane_in_flight_key(lane), '-inf', stale_before)
+        for key in valkey.scan_iter(match=f"{_user_in_flight_key(lane, '')}*", count=500):
+            valkey.zremrangebyscore(key, '-inf', stale_before)
+        report[lane] = {"expired": expired, "dispatched": dispatch(lane, send=send)}
+    if any(lane_report["expired"] or lane_report["dispatched"] for lane_report in report.values()):
+        logging.info(f"Barrido del scheduler de indexación: {report}")
+    return report
+
+
+def promote_deferred() -> int:
+    """Encola las versiones diferidas que quepan en el backlog, por tandas de INGEST_PROMOTE_BATCH."""
+    import ingest_admission # ingest_admission importa este módulo
+    from database import SessionLocal
+
+    promoted = 0
+    with SessionLocal() as db_session:
+        while True:
+            batch = ingest_admission.promote_deferred(db_session)
+            promoted += batch
+            if batch < ingest_admission.INGEST_PROMOTE_BATCH:
+                return promoted
+
+
+def run(once: bool = False):
+    """Bucle del despachador: un barrido y las diferidas cada INGEST_SWEEP_INTERVAL_SECONDS."""
+    logging.info(f"Despachador de indexación: barrido cada {INGEST_SWEEP_INTERVAL_SECONDS}s "
+                 f"(slots caducados tras {INGEST_LEASE_SECONDS}s).")
+    while True:
+        try:
+            sweep()
+        except Exception as e:
+            # Valkey o el broker caídos: se reintenta en el siguiente barrido.
+            logging.error(f"Error en el barrido del scheduler de indexación: {e}", exc_info=True)
+        try:
+            promote_deferred()
+        except Exception as e:
+            logging.error(f"Error al encolar las versiones diferidas: {e}", exc_info=True)
+        if once:
+            return
+        time.sleep(INGEST_SWEEP_INTERVAL_SECONDS)
+
+
+def backlog_snapshot():
+    """`[(lane, user_id, queued, in_flight, oldest_wait_seconds)]` de los usuarios en rotación."""
+    valkey = get_valkey()
+    now = time.time()
+    rows = []
+    for lane in LANES:
+        users = valkey.lrange(_rotation_key(lane), 0, -1)
+        pipe = valkey.pipeline(transaction=False)
+        for user_id in users:
+            pipe.lindex(_queue_key(lane, user_id), 0)
+            pipe.llen(_queue_key(lane, user_id))
+            pipe.zcard(_user_in_flight_key(lane, user_id))
+        replies = pipe.execute()
+        for i, user_id in enumerate(users):
+            head, queued, running = replies[3 * i:3 * i + 3]
+            oldest_wait = now - float(head.split("|", 1)[1]) if head else 0.0
+            rows.append((lane, user_id, queued, running, oldest_wait))
+    return rows
+
+
+def lane_snapshot(rows=None):
+    """`[(lane, queued, in_flight, oldest_wait_seconds)]` agregado por carril, para /metrics sin etiquetas por usuario.
+
+    `in_flight` sale del ZSET del carril, así cuenta también a los usuarios que ya no tienen cola virtual."""
+    valkey = get_valkey()
+    rows = backlog_snapshot() if rows is None else rows
+    result = []
+    for lane in LANES:
+        lane_rows = [row for row in rows if row[0] == lane]
+        result.append((lane, sum(row[2] for row in lane_rows), valkey.zcard(_lane_in_flight_key(lane)),
+                       max((row[4] for row in lane_rows), default=0.0)))
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Despacha periódicamente las colas virtuales de indexación.")
+    parser.add_argument("--once", action="store_true", help="Un solo barrido (para cron) en lugar del bucle.")
+    args = parser.parse_args()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+    metrics.reset_multiprocess_dir()
+    run(args.once)
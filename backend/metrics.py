@@ -0,0 +1,285 @@
+# backend/metrics.py
+"""
+Métricas Prometheus de la API y de los workers de Celery.
+
+En producción cada proceso (workers de gunicorn e hijos de Celery) escribe sus
+valores en PROMETHEUS_MULTIPROC_DIR, que debe definirse antes de arrancar el
+proceso. Si varios contenedores comparten un volumen con un subdirectorio por
+servicio, `/metrics` de la API agrega todos los que cuelguen de METRICS_AGGREGATE_DIR.
+
+`/metrics` está en el puerto público de la API y cada scrape consulta PostgreSQL y
+Valkey: solo responde con `Authorization: Bearer <METRICS_TOKEN>` o, si no hay
+token configurado, a peticiones desde la propia máquina (loopback).
+"""
+import os
+import glob
+import hmac
+import time
+import shutil
+import logging
+from contextlib import contextmanager
+
+from prometheus_client import (
+    Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, multiprocess, CONTENT_TYPE_LATEST
+)
+from prometheus_client.core import GaugeMetricFamily
+
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRICS_AGGREGATE_DIR = os.getenv("METRICS_AGGREGATE_DIR", PROMETHEUS_MULTIPROC_DIR or "")
+# Usuarios con más cola de indexación que se publican con su id por carril; 0 (por defecto) no publica ninguno.
+METRICS_INGEST_TOP_TENANTS = int(os.getenv("METRICS_INGEST_TOP_TENANTS", "0"))
+# Colas del broker cuya profundidad se publica (la de generación de /ask se añade a la de Celery por defecto).
+METRICS_QUEUES = [q for q in os.getenv(
+    "METRICS_QUEUES", f"celery,{os.getenv('INGEST_FAST_QUEUE', 'ingest_fast')},{os.getenv('ASK_JOB_QUEUE', 'generation')}").split(",") if q]
+
+# Extensiones con etiqueta propia; el resto se agrupa en 'other' para acotar la cardinalidad.
+KNOWN_EXTENSIONS = {
+    '.pdf', '.txt', '.mobi', '.docx', '.xlsx', '.pptx', '.epub', '.azw3', '.azw', '.prc', '.fb2', '.lit', '.pdb',
+    '.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff',
+}
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200)
+
+ASK_STAGE_SECONDS = Histogram(
+    'dv_ask_stage_seconds', 'Duración de cada etapa de /ask (embedding, SQL vectorial, contexto, generación).',
+    ['stage', 'model'], buckets=STAGE_BUCKETS)
+ASK_REQUESTS = Counter(
+    'dv_ask_requests_total', 'Preguntas recibidas en /ask por modo y resultado.', ['mode', 'outcome'])
+RETRIEVAL_SEARCHES = Counter(
+    'dv_retrieval_searches_total', 'Búsquedas vectoriales de /ask por plan (exact, hnsw, hnsw_short, two_stage, empty) y si llevan filtros.',
+    ['plan', 'filtered'])
+CHAT_PREFILL_TOKENS = Histogram(
+    'dv_chat_prefill_tokens', 'Tokens de prompt procesados por Ollama en cada turno de chat (first, follow_up, reset).',
+    ['kind'], buckets=(16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384))
+OLLAMA_MODEL_LOADS = Counter(
+    'dv_ollama_model_loads_total', 'Cargas de un modelo en Ollama por origen (preload, warmup o request si una petición lo encontró fuera de memoria).',
+    ['model', 'trigger'])
+OLLAMA_MODEL_LOAD_SECONDS = Histogram(
+    'dv_ollama_model_load_seconds', 'Latencia de arranque en frío: duración de cada carga de un modelo en Ollama.',
+    ['model', 'trigger'], buckets=STAGE_BUCKETS)
+OLLAMA_MODEL_RESIDENT = Gauge(
+    'dv_ollama_model_resident', 'Modelos gestionados en memoria de Ollama (1) o no (0) según el gestor de residencia.',
+    ['model'], multiprocess_mode='livemax')
+INGEST_STAGE_SECONDS = Histogram(
+    'dv_ingest_stage_seconds', 'Duración de cada etapa de la indexación RAG.',
+    ['stage', 'extension'], buckets=STAGE_BUCKETS)
+INGEST_DOCUMENTS = Counter(
+    'dv_ingest_documents_total', 'Versiones de documento indexadas por resultado.', ['extension', 'outcome'])
+INGEST_CHUNKS = Counter(
+    'dv_ingest_chunks_total', 'Chunks generados e insertados durante la indexación.', ['extension'])
+# Ratio de deduplicación: sum(rate(dv_ingest_chunk_dedup_total{outcome!="new"}[1h])) / sum(rate(dv_ingest_chunk_dedup_total[1h]))
+INGEST_CHUNK_DEDUP = Counter(
+    'dv_ingest_chunk_dedup_total', 'Chunks indexados con contenido nuevo (new) o reutilizado de un duplicado exacto (exact) o casi duplicado (near).',
+    ['extension', 'outcome'])
+INGEST_QUEUE_WAIT_SECONDS = Histogram(
+    'dv_ingest_queue_wait_seconds', 'Espera de cada versión en su cola virtual hasta pasar a Celery, por carril.',
+    ['lane'], buckets=STAGE_BUCKETS + (1800, 3600, 7200, 14400))
+INGEST_ADMISSIONS = Counter(
+    'dv_ingest_admissions_total', 'Subidas admitidas (accepted), diferidas (deferred) o rechazadas (rejected) y el motivo.',
+    ['decision', 'reason'])
+RETENTION_ROWS = Counter(
+    'dv_retention_rows_total', 'Filas movidas por la retención de versiones: versiones y chunks archivados, contenidos podados.',
+    ['kind'])
+RETENTION_COMPACTION_SECONDS = Histogram(
+    'dv_retention_compaction_seconds', 'Duración de cada paso de la compactación de vectores (archive, gc, vacuum).',
+    ['step'], buckets=STAGE_BUCKETS + (1800, 3600))
+DOCUMENT_PURGE_ITEMS = Counter(
+    'dv_document_purge_total', 'Elementos purgados de los documentos borrados: documentos, objetos, chunks, artefactos de texto y huérfanos.',
+    ['kind'])
+DOCUMENT_PURGE_SECONDS = Histogram(
+    'dv_document_purge_seconds', 'Duración de cada paso de la purga de documentos y de la conciliación de MinIO.',
+    ['step'], buckets=STAGE_BUCKETS + (1800, 3600))
+TEXT_ARTIFACT_LOOKUPS = Counter(
+    'dv_text_artifact_lookups_total', 'Indexaciones que reutilizan (hit) o regeneran (miss) el texto extraído.',
+    ['extension', 'outcome'])
+# Conversiones por minuto: rate(dv_ebook_conversions_total[5m]) * 60
+EBOOK_CONVERSIONS = Counter(
+    'dv_ebook_conversions_total', 'Conversiones de ebooks con el pool de Calibre por formato y resultado.',
+    ['format', 'outcome'])
+EBOOK_CONVERSION_SECONDS = Histogram(
+    'dv_ebook_conversion_seconds', 'Duración de cada conversión de ebook (incluida la espera por un conversor libre).',
+    ['format'], buckets=STAGE_BUCKETS)
+EBOOK_CONVERTER_STARTS = Counter(
+    'dv_ebook_converter_starts_total', 'Procesos conversores de Calibre arrancados (primer uso, reciclado o tras un fallo).')
+STORAGE_STAGE_SECONDS = Histogram(
+    'dv_storage_stage_seconds', 'Duración de las etapas de FileProcessorService (escaneo, cifrado, MinIO).',
+    ['operation', 'stage', 'extension'], buckets=STAGE_BUCKETS)
+STORAGE_OBJECT_BYTES = Counter(
+    'dv_storage_object_bytes_total', 'Bytes de los ficheros subidos: originales (plaintext) y guardados en MinIO (stored).',
+    ['kind', 'extension'])
+OLLAMA_REQUEST_SECONDS = Histogram(
+    'dv_ollama_request_seconds', 'Duración de las llamadas HTTP a Ollama.',
+    ['endpoint', 'model'], buckets=STAGE_BUCKETS)
+EMBEDDING_BATCH_SECONDS = Histogram(
+    'dv_embedding_batch_seconds', 'Duración de cada lote de embeddings por backend (ollama, onnx).',
+    ['backend', 'model'], buckets=STAGE_BUCKETS)
+CELERY_TASK_SECONDS = Histogram(
+    'dv_celery_task_seconds', 'Duración de las tareas de Celery por nombre y estado final.',
+    ['task', 'state'], buckets=STAGE_BUCKETS)
+
+DB_POOL_CHECKOUT_SECONDS = Histogram(
+    'dv_db_pool_checkout_seconds', 'Espera para obtener una conexión del pool de SQLAlchemy.',
+    ['role', 'target'], buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+DB_POOL_TIMEOUTS = Counter(
+    'dv_db_pool_timeouts_total', 'Checkouts que agotaron DB_POOL_TIMEOUT esperando conexión.', ['role', 'target'])
+# Gauges sumados entre procesos vivos: saturación = checked_out / capacity.
+DB_POOL_CHECKED_OUT = Gauge(
+    'dv_db_pool_checked_out', 'Conexiones del pool en uso.', ['role', 'target'], multiprocess_mode='livesum')
+DB_POOL_CAPACITY = Gauge(
+    'dv_db_pool_capacity', 'Conexiones máximas del pool (pool_size + max_overflow; 0 con PgBouncer sin pool local).',
+    ['role', 'target'], multiprocess_mode='livesum')
+DB_READ_ROUTES = Counter(
+    'dv_db_read_routes_total', 'Sesiones de solo lectura por destino (primary/replica) y motivo.', ['target', 'reason'])
+
+
+def file_extension(filename: str) -> str:
+    extension = os.path.splitext(filename or "")[1].lower()
+    return extension if extension in KNOWN_EXTENSIONS else 'other'
+
+
+@contextmanager
+def observe_stage(histogram, **labels):
+    """Mide la duración del bloque y la registra en `histogram` con las etiquetas dadas."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(**labels).observe(time.perf_counter() - start)
+
+
+class QueueDepthCollector:
+    """Profundidad de las colas de Celery en Valkey, leída en cada scrape."""
+    def collect(self):
+        from valkey_client import get_valkey
+        gauge = GaugeMetricFamily('dv_celery_queue_depth', 'Mensajes pendientes en cada cola de Celery.', labels=['queue'])
+        try:
+            valkey = get_valkey()
+            for queue in METRICS_QUEUES:
+                gauge.add_metric([queue], valkey.llen(queue))
+        except Exception as e:
+            logging.warning(f"No se pudo leer la profundidad de las colas de Celery: {e}")
+        yield gauge
+
+
+class IngestBacklogCollector:
+    """Colas virtuales de indexación (ingest_scheduler.py) agregadas por carril, leídas en cada scrape.
+
+    Los ids de usuario no se publican salvo los METRICS_INGEST_TOP_TENANTS con más cola de cada carril,
+    para acotar la cardinalidad."""
+    def collect(self):
+        backlog = GaugeMetricFamily('dv_ingest_backlog', 'Versiones esperando en las colas virtuales del carril.',
+                                    labels=['lane'])
+        in_flight = GaugeMetricFamily('dv_ingest_in_flight', 'Versiones del carril despachadas a Celery y sin terminar.',
+                                      labels=['lane'])
+        oldest_wait = GaugeMetricFamily('dv_ingest_oldest_wait_seconds',
+                                        'Antigüedad de la versión más antigua en las colas virtuales del carril.',
+                                        labels=['lane'])
+        tenant_backlog = GaugeMetricFamily('dv_ingest_tenant_backlog',
+                                           'Versiones en la cola virtual de los usuarios con más cola del carril.',
+                                           labels=['lane', 'user'])
+        try:
+            from ingest_scheduler import backlog_snapshot, lane_snapshot
+            rows = backlog_snapshot()
+            for lane, queued, running, wait_seconds in lane_snapshot(rows):
+                backlog.add_metric([lane], queued)
+                in_flight.add_metric([lane], running)
+                oldest_wait.add_metric([lane], wait_seconds)
+                if METRICS_INGEST_TOP_TENANTS > 0:
+                    top = sorted((row for row in rows if row[0] == lane), key=lambda row: row[2], reverse=True)
+                    for _, user, user_queued, _, _ in top[:METRICS_INGEST_TOP_TENANTS]:
+                        tenant_backlog.add_metric([lane, user], user_queued)
+        except Exception as e:
+            logging.warning(f"No se pudo leer el backlog de indexación: {e}")
+        yield backlog
+        yield in_flight
+        yield oldest_wait
+        if METRICS_INGEST_TOP_TENANTS > 0:
+            yield tenant_backlog
+
+
+class IngestPressureCollector:
+    """Presión de la indexación sobre los límites de admisión de subidas (ingest_admission.py), leída en cada scrape."""
+    def collect(self):
+        gauge = GaugeMetricFamily('dv_ingest_pressure',
+                                  'Uso / límite de cada recurso de la admisión de subidas (>= 1: se rechaza o se difiere).',
+                                  labels=['resource'])
+        try:
+            from ingest_admission import pressure_snapshot
+            from database import SessionLocal
+            with SessionLocal() as session:
+                for resource, value in pressure_snapshot(session).items():
+                    gauge.add_metric([resource], value)
+        except Exception as e:
+            logging.warning(f"No se pudo calcular la presión de la indexación: {e}")
+        yield gauge
+
+
+class AggregateMultiProcessCollector:
+    """Como MultiProcessCollector, pero fusiona también los subdirectorios (uno por servicio)."""
+    def __init__(self, path):
+        self.path = path
+
+    def collect(self):
+        files = glob.glob(os.path.join(self.path, '**', '*.db'), recursive=True)
+        return multiprocess.MultiProcessCollector.merge(files, accumulate=True)
+
+
+_queue_registry = CollectorRegistry()
+_queue_registry.register(QueueDepthCollector())
+_queue_registry.register(IngestBacklogCollector())
+_queue_registry.register(IngestPressureCollector())
+
+
+def scrape_allowed(authorization, remote_addr) -> bool:
+    """¿Puede esta petición leer /metrics? Con METRICS_TOKEN, el token Bearer; sin él, solo loopback."""
+    if METRICS_TOKEN:
+        return hmac.compare_digest((authorization or "").encode(), f"Bearer {METRICS_TOKEN}".encode())
+    return remote_addr in ("127.0.0.1", "::1")
+
+
+def generate_metrics():
+    """Devuelve `(payload, content_type)` para el endpoint /metrics."""
+    if METRICS_AGGREGATE_DIR:
+        registry = CollectorRegistry()
+        registry.register(AggregateMultiProcessCollector(METRICS_AGGREGATE_DIR))
+    else:
+        registry = REGISTRY
+    return generate_latest(registry) + generate_latest(_queue_registry), CONTENT_TYPE_LATEST
+
+
+def reset_multiprocess_dir():
+    """Vacía el directorio de este servicio al arrancar, para no arrastrar valores de ejecuciones previas."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+        os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+
+def mark_process_dead(pid):
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
+
+
+_task_started_at = {}
+
+def connect_celery_signals():
+    """Registra la duración de cada tarea y limpia los ficheros de los hijos que terminan."""
+    from celery.signals import task_prerun, task_postrun, worker_init, worker_process_shutdown
+
+    @task_prerun.connect(weak=False)
+    def _task_prerun(task_id=None, **kwargs):
+        _task_started_at[task_id] = time.perf_counter()
+
+    @task_postrun.connect(weak=False)
+    def _task_postrun(task_id=None, task=None, state=None, **kwargs):
+        started_at = _task_started_at.pop(task_id, None)
+        if started_at is not None and task is not None:
+            CELERY_TASK_SECONDS.labels(task=task.name, state=state or 'UNKNOWN').observe(time.perf_counter() - started_at)
+
+    @worker_init.connect(weak=False)
+    def _worker_init(**kwargs):
+        reset_multiprocess_dir()
+
+    @worker_process_shutdown.connect(weak=False)
+    def _worker_process_shutdown(pid=None, **kwargs):
+        mark_process_dead(pid or os.getpid())
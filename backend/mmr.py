@@ -0,0 +1,70 @@
+# backend/mmr.py
+"""
+Diversificación MMR (Maximal Marginal Relevance) vectorizada con NumPy.
+
+Sobre los candidatos que devuelve la búsqueda vectorial se elige iterativamente
+el que maximiza `lambda * relevancia - (1 - lambda) * máxima similitud con los ya
+elegidos`, de modo que los chunks casi idénticos (boilerplate repetido entre
+versiones o páginas) no ocupen varias plazas del contexto.
+"""
+import numpy as np
+
+
+def to_vector(value) -> np.ndarray:
+    """
+    Convierte un embedding de pgvector en un array float32. Acepta el formato binario
+    de `vector_send()` (int16 dim, int16 sin uso y float32 big-endian), que es mucho más
+    barato de decodificar que el texto '[x,y,...]', además del texto o una secuencia.
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return np.frombuffer(value, dtype=">f4", offset=4).astype(np.float32)
+    if isinstance(value, str):
+        return np.fromstring(value.strip("[]"), sep=",", dtype=np.float32)
+    return np.asarray(value, dtype=np.float32)
+
+
+def to_matrix(values) -> np.ndarray:
+    """
+    Decodifica una lista de embeddings en una matriz (n, dim). Si todos vienen en binario
+    se decodifican de una sola vez, sin crear un array intermedio por fila.
+    """
+    if values and all(isinstance(v, (bytes, bytearray, memoryview)) for v in values):
+        raw = np.frombuffer(b"".join(values), dtype=np.uint8).reshape(len(values), -1)
+        return np.ascontiguousarray(raw[:, 4:]).view(">f4").astype(np.float32)
+    return np.stack([to_vector(v) for v in values]) if values else np.empty((0, 0), dtype=np.float32)
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def mmr_select(query_embedding, candidate_embeddings, k: int, lambda_mult: float) -> list[int]:
+    """
+    Devuelve los índices (en orden de selección) de hasta `k` candidatos.
+    `lambda_mult=1` equivale al top-k por similitud; valores menores favorecen la diversidad.
+    """
+    candidates = _normalize(np.asarray(candidate_embeddings, dtype=np.float32))
+    n_candidates = candidates.shape[0]
+    if n_candidates == 0 or k <= 0:
+        return []
+
+    query = _normalize(np.asarray(query_embedding, dtype=np.float32))
+    relevance = candidates @ query
+    first = int(np.argmax(relevance))
+    selected = [first]
+    # Similitud máxima de cada candidato con el conjunto ya seleccionado; se actualiza
+    # con un único producto matriz-vector por iteración en lugar de la matriz n x n completa.
+    max_similarity = candidates @ candidates[first]
+    available = np.ones(n_candidates, dtype=bool)
+    available[first] = False
+
+    for _ in range(min(k, n_candidates) - 1):
+        scores = lambda_mult * relevance - (1.0 - lambda_mult) * max_similarity
+        scores[~available] = -np.inf
+        chosen = int(np.argmax(scores))
+        selected.append(chosen)
+        available[chosen] = False
+        np.maximum(max_similarity, candidates @ candidates[chosen], out=max_similarity)
+
+    return selected
@@ -0,0 +1,224 @@
+# backend/model_residency.py
+"""
+Residencia de los modelos de Ollama: qué modelos se mantienen cargados y durante
+cuánto tiempo.
+
+Sin gestión, la primera pregunta tras un rato de inactividad y la primera
+indexación tras un despliegue pagan la carga del modelo, y en un host con poca
+memoria el modelo de embeddings y el de generación se expulsan el uno al otro.
+
+* `keep_alive_for`: keep_alive de cada modelo (OLLAMA_EMBEDDING_KEEP_ALIVE,
+  OLLAMA_GENERATION_KEEP_ALIVE u OLLAMA_KEEP_ALIVE_OVERRIDES), que envían todas
+  las peticiones a Ollama.
+* Gestor (`python model_residency.py`, servicio `model_manager`): precarga
+  OLLAMA_EMBEDDING_MODEL y OLLAMA_GENERATION_MODEL al arrancar y, en horario
+  laboral (MODEL_WARMUP_HOURS, MODEL_WARMUP_WEEKDAYS), repite cada
+  MODEL_WARMUP_INTERVAL_SECONDS una petición de calentamiento sin coste
+  (generación con prompt vacío, embedding de una palabra) que además renueva el
+  keep_alive.
+* Mientras el gestor carga un modelo que no estaba en memoria publica
+  `ollama:model_loading:<modelo>` en Valkey: las generaciones esperan
+  (`wait_until_loaded`) o, en modo job, se reintentan más tarde.
+* Las cargas (precarga, calentamiento o una petición normal que encontró el modelo
+  fuera de memoria, según su `load_duration`) y su duración se registran en
+  `dv_ollama_model_loads_total` y `dv_ollama_model_load_seconds`.
+"""
+import os
+import json
+import time
+import logging
+from datetime import datetime
+
+import requests
+
+import metrics
+from metrics import OLLAMA_MODEL_LOADS, OLLAMA_MODEL_LOAD_SECONDS, OLLAMA_MODEL_RESIDENT
+from valkey_client import get_valkey
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_API_BASE_URL = os.getenv("OLLAMA_API_BASE_URL", "http://ollama:11434")
+OLLAMA_EMBEDDING_MODEL = os.getenv("OLLAMA_EMBEDDING_MODEL", "nomic-embed-text")
+OLLAMA_GENERATION_MODEL = os.getenv("OLLAMA_GENERATION_MODEL", "phi3:3.8b-mini-4k-instruct-q4_K_M")
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "ollama").lower()
+
+OLLAMA_EMBEDDING_KEEP_ALIVE = os.getenv("OLLAMA_EMBEDDING_KEEP_ALIVE", "24h")
+OLLAMA_GENERATION_KEEP_ALIVE = os.getenv("OLLAMA_GENERATION_KEEP_ALIVE", "1h")
+# keep_alive específicos por modelo, ej. '{"llama3": "4h"}' (formato de Ollama: "30m", "2h", -1 para siempre).
+OLLAMA_KEEP_ALIVE_OVERRIDES = json.loads(os.getenv("OLLAMA_KEEP_ALIVE_OVERRIDES", "{}"))
+
+MODEL_WARMUP_INTERVAL_SECONDS = int(os.getenv("MODEL_WARMUP_INTERVAL_SECONDS", "240"))
+# Horas locales (TZ del contenedor) con calentamiento, [inicio, fin), y días ISO (1 = lunes). Vacío: siempre.
+MODEL_WARMUP_HOURS = os.getenv("MODEL_WARMUP_HOURS", "8-20")
+MODEL_WARMUP_WEEKDAYS = os.getenv("MODEL_WARMUP_WEEKDAYS", "1-5")
+# Tope de una carga: timeout de la precarga y caducidad de la marca de carga si el gestor muere a medias.
+MODEL_LOAD_TIMEOUT_SECONDS = int(os.getenv("MODEL_LOAD_TIMEOUT_SECONDS", "300"))
+# Espera máxima de una generación síncrona a que termine la carga; después se envía igualmente.
+MODEL_LOAD_WAIT_SECONDS = float(os.getenv("MODEL_LOAD_WAIT_SECONDS", "60"))
+MODEL_LOAD_POLL_SECONDS = 0.5
+# load_duration a partir del cual una petición normal cuenta como arranque en frío.
+MODEL_COLD_LOAD_SECONDS = float(os.getenv("MODEL_COLD_LOAD_SECONDS", "1.0"))
+
+
+def _loading_key(model_name):
+    return f"ollama:model_loading:{model_name}"
+
+
+def _tagged(model_name: str) -> str:
+    # /api/ps devuelve los nombres con etiqueta ('llama3:latest')
+    return model_name if ":" in model_name else f"{model_name}:latest"
+
+
+def keep_alive_for(model_name: str) -> str:
+    if model_name in OLLAMA_KEEP_ALIVE_OVERRIDES:
+        return OLLAMA_KEEP_ALIVE_OVERRIDES[model_name]
+    return OLLAMA_EMBEDDING_KEEP_ALIVE if model_name == OLLAMA_EMBEDDING_MODEL else OLLAMA_GENERATION_KEEP_ALIVE
+
+
+def managed_models() -> list[tuple[str, str]]:
+    """`(modelo, tipo)` que el gestor mantiene cargados; el de embeddings solo si lo sirve Ollama."""
+    models = [(OLLAMA_EMBEDDING_MODEL, 'embedding')] if EMBEDDING_BACKEND == 'ollama' else []
+    return models + [(OLLAMA_GENERATION_MODEL, 'generation')]
+
+
+def _parse_range(value: str):
+    start, _, end = value.partition("-")
+    return int(start), int(end or start)
+
+
+def in_business_hours(now: datetime = None) -> bool:
+    now = now or datetime.now()
+    if MODEL_WARMUP_WEEKDAYS:
+        first, last = _parse_range(MODEL_WARMUP_WEEKDAYS)
+        if not first <= now.isoweekday() <= last:
+            return False
+    if MODEL_WARMUP_HOURS:
+        start, end = _parse_range(MODEL_WARMUP_HOURS)
+        if not start <= now.hour < end:
+            return False
+    return True
+
+
+def record_load(model_name: str, trigger: str, response: dict):
+    """
+    Registra la carga si la respuesta de Ollama indica que el modelo no estaba en memoria
+    (`load_duration`, en nanosegundos, de al menos MODEL_COLD_LOAD_SECONDS). Devuelve los segundos o None.
+    """
+    load_seconds = (response or {}).get("load_duration", 0) / 1e9
+    if load_seconds < MODEL_COLD_LOAD_SECONDS:
+        return None
+    OLLAMA_MODEL_LOADS.labels(model=model_name, trigger=trigger).inc()
+    OLLAMA_MODEL_LOAD_SECONDS.labels(model=model_name, trigger=trigger).observe(load_seconds)
+    logger.info(f"Ollama cargó el modelo '{model_name}' en {load_seconds:.1f}s ({trigger}).")
+    return load_seconds
+
+
+def is_loading(model_name: str) -> bool:
+    try:
+        return bool(get_valkey().exists(_loading_key(model_name)))
+    except Exception as e:
+        # Sin Valkey no se retrasa ninguna generación.
+        logger.warning(f"No se pudo consultar si '{model_name}' se está cargando: {e}")
+        return False
+
+
+def wait_until_loaded(model_name: str, timeout: float = MODEL_LOAD_WAIT_SECONDS) -> float:
+    """Espera mientras el gestor carga `model_name`, como mucho `timeout` segundos. Devuelve lo esperado."""
+    started_at = time.monotonic()
+    while is_loading(model_name) and time.monotonic() - started_at < timeout:
+        time.sleep(MODEL_LOAD_POLL_SECONDS)
+    return time.monotonic() - started_at
+
+
+def loaded_models(http=requests) -> set:
+    """Modelos en memoria según /api/ps."""
+    response = http.get(f"{OLLAMA_API_BASE_URL}/api/ps", timeout=10)
+    response.raise_for_status()
+    return {model.get("name") for model in response.json().get("models", [])}
+
+
+def warm_model(model_name: str, kind: str, trigger: str, resident: bool, http=requests):
+    """
+    Petición mínima que carga el modelo (si no lo estaba) y renueva su keep_alive. Si no estaba en memoria,
+    marca la carga en Valkey mientras dura y registra el tiempo como arranque en frío.
+    """
+    payload = {"model": model_name, "keep_alive": keep_alive_for(model_name)}
+    if kind == 'embedding':
+        url, payload["input"] = f"{OLLAMA_API_BASE_URL}/api/embed", ["warmup"]
+    else:
+        url, payload["prompt"], payload["stream"] = f"{OLLAMA_API_BASE_URL}/api/generate", "", False # Solo carga
+    marked = False
+    if not resident:
+        try:
+            marked = bool(get_valkey().set(_loading_key(model_name), trigger, nx=True, ex=MODEL_LOAD_TIMEOUT_SECONDS))
+        except Exception as e:
+            logger.warning(f"No se pudo marcar la carga de '{model_name}' en Valkey: {e}")
+    started_at = time.perf_counter()
+    try:
+        response = http.post(url, json=payload, timeout=MODEL_LOAD_TIMEOUT_SECONDS)
+        response.raise_for_status()
+    finally:
+        if marked:
+            get_valkey().delete(_loading_key(model_name))
+    elapsed = time.perf_counter() - started_at
+    if not resident:
+        OLLAMA_MODEL_LOADS.labels(model=model_name, trigger=trigger).inc()
+        OLLAMA_MODEL_LOAD_SECONDS.labels(model=model_name, trigger=trigger).observe(elapsed)
+        logger.info(f"Modelo '{model_name}' cargado en {elapsed:.1f}s ({trigger}, keep_alive={payload['keep_alive']}).")
+    return elapsed
+
+
+def warm_all(trigger: str, http=requests) -> dict:
+    """Calienta los modelos gestionados y actualiza `dv_ollama_model_resident`. Devuelve `{modelo: residente antes}`."""
+    try:
+        resident = loaded_models(http)
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"No se pudo consultar /api/ps de Ollama: {e}")
+        resident = set()
+    before = {}
+    for model_name, kind in managed_models():
+        before[model_name] = _tagged(model_name) in resident
+        try:
+            warm_model(model_name, kind, trigger, before[model_name], http)
+            OLLAMA_MODEL_RESIDENT.labels(model=model_name).set(1)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"No se pudo cargar el modelo '{model_name}' en Ollama: {e}")
+            OLLAMA_MODEL_RESIDENT.labels(model=model_name).set(0)
+    return before
+
+
+def refresh_residency(http=requests):
+    """Fuera del horario de calentamiento solo se publica qué modelos siguen en memoria."""
+    try:
+        resident = loaded_models(http)
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"No se pudo consultar /api/ps de Ollama: {e}")
+        return
+    for model_name, _ in managed_models():
+        OLLAMA_MODEL_RESIDENT.labels(model=model_name).set(int(_tagged(model_name) in resident))
+
+
+def run():
+    """Bucle del gestor: precarga al arrancar y calentamientos periódicos en horario laboral."""
+    http = requests.Session()
+    logger.info(f"Gestor de modelos: {', '.join(m for m, _ in managed_models())}; calentamiento cada "
+                f"{MODEL_WARMUP_INTERVAL_SECONDS}s (horas {MODEL_WARMUP_HOURS or 'todas'}, "
+                f"días {MODEL_WARMUP_WEEKDAYS or 'todos'}).")
+    trigger = 'preload'
+    while True:
+        try:
+            if trigger == 'preload' or in_business_hours():
+                warm_all(trigger, http)
+            else:
+                refresh_residency(http)
+        except Exception as e:
+            # Un fallo de Valkey u Ollama no detiene el gestor: se reintenta en el siguiente ciclo.
+            logger.error(f"Error en el ciclo del gestor de modelos: {e}", exc_info=True)
+        trigger = 'warmup'
+        time.sleep(MODEL_WARMUP_INTERVAL_SECONDS)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+    metrics.reset_multiprocess_dir()
+    run()
@@ -1,13 +1,13 @@
 from sqlalchemy import Column, String, LargeBinary, Integer, DateTime, Text, BigInteger, Boolean
-from sqlalchemy.dialects.postgresql import JSONB, UUID
+from sqlalchemy.dialects.postgresql import JSONB, UUID, ARRAY
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, UniqueConstraint, Index, text
 from pgvector.sqlalchemy import Vector
 
-# IMPORTE BASE DESDE backend.database
-from backend.database import Base
+# IMPORTE BASE DESDE database (el directorio backend/ es el raíz de la app en los contenedores)
+from database import Base
 # <-- ¡CAMBIA ESTA LÍNEA!
 # Define la Base declarativa para tus modelos SQLAlchemy
 # Base = declarative_base()
@@ -45,13 +45,15 @@ class Document(Base):
     # Metadatos generales del documento
     title = Column(String(255), nullable=False) # Título lógico del documento (ej. "Contrato de Arrendamiento - Propiedad X")
     category = Column(String(255), nullable=True) # Ej. "Contratos", "Informes", "Facturas"
-    tags = Column(TEXT().as_array(String()), nullable=True, default=[]) # Array de etiquetas (ej. ["legal", "2024", "proyecto-alfa"])
+    tags = Column(ARRAY(Text), nullable=True, default=[]) # Array de etiquetas (ej. ["legal", "2024", "proyecto-alfa"])
     
     # Información de auditoría
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     created_by = Column(UUID(as_uuid=True), ForeignKey('users.id'), nullable=True) # Quién creó el documento (primera versión)
     last_modified_at = Column(DateTime(timezone=True), default=func.now(), onupdate=func.now())
     last_modified_by = Column(UUID(as_uuid=True), ForeignKey('users.id'), nullable=True) # Quién modificó por última vez los metadatos o subió una nueva versión
+    # Tombstone: el documento está borrado y pendiente de purga (document_purge.py); la API ya no lo muestra
+    deleted_at = Column(DateTime(timezone=True), nullable=True)
 
     # Relaciones
     versions = relationship("DocumentVersion", back_populates="document", order_by="DocumentVersion.version_number")
@@ -61,11 +63,26 @@ class Document(Base):
     # Relación con usuario que modificó por última vez
     last_modified_by_user = relationship("User", back_populates="modified_documents", foreign_keys=[last_modified_by])
 
+    # Filtros de /ask (rag_service.scope_conditions): categoría por usuario y etiquetas (GIN, operador @>)
+    __table_args__ = (
+        Index('ix_documents_created_by_category', 'created_by', 'category'),
+        Index('ix_documents_tags', 'tags', postgresql_using='gin'),
+        Index('ix_documents_tombstoned', 'deleted_at', postgresql_where=text('deleted_at IS NOT NULL')),
+    )
 
     def __repr__(self):
         return f"<Document(id='{self.id}', title='{self.title}', category='{self.category}')>"
 
 
+def indexing_progress(processed_status, chunks_indexed, chunks_total) -> float:
+    """Porcentaje de chunks indexados de una versión (100 si ya está indexada, aunque sea anterior al checkpoint)."""
+    if processed_status == 'indexed':
+        return 100.0
+    if not chunks_total:
+        return 0.0
+    return round(100 * (chunks_indexed or 0) / chunks_total, 1)
+
+
 #### `DocumentVersion` (La antigua `EncryptedFile`, ahora representa una versión específica)
 
 class DocumentVersion(Base):
@@ -99,6 +116,16 @@ class DocumentVersion(Base):
     # Si quieres registrar quién subió esta versión específica
     uploaded_by = Column(UUID(as_uuid=True), ForeignKey('users.id'), nullable=True) 
 
+    # Checkpoint de la indexación: chunks ya embebidos y guardados de `chunks_total`. Un reintento continúa
+    # desde `chunks_indexed` si `index_fingerprint` (hash de los chunks y del modelo de embeddings) coincide.
+    chunks_total = Column(Integer, nullable=True)
+    chunks_indexed = Column(Integer, nullable=False, default=0, server_default='0')
+    index_fingerprint = Column(Text, nullable=True)
+    # Centroide de los embeddings de sus chunks: primera etapa de la búsqueda en dos etapas de /ask (rag_service)
+    summary_embedding = Column(Vector(768), nullable=True)
+    # Versión restaurada a mano: la retención (version_retention.py) no vuelve a archivar sus vectores
+    retention_pinned = Column(Boolean, nullable=False, default=False, server_default='false')
+
     # Relaciones
     document = relationship("Document", back_populates="versions")
     chunks = relationship("DocumentChunk", back_populates="document_version", cascade="all, delete-orphan")
@@ -115,8 +142,22 @@ class DocumentVersion(Base):
         # UniqueConstraint('document_id', 'version_number'), # Ya lo definí en la DB SQL
         # UniqueConstraint('document_id', 'is_latest_version', postgresql_where=is_latest_version), # Esto es más complejo en SQLAlchemy
         # Mejor manejar 'is_latest_version' lógicamente en el código
+        # Versiones en alcance de /ask: por documento y por fecha de subida (filtros date_from/date_to)
+        Index('ix_document_versions_document_latest', 'document_id', 'is_latest_version'),
+        Index('ix_document_versions_upload_timestamp', 'upload_timestamp'),
+        # Versiones sin indexar: pendientes por usuario y diferidas más antiguas (ingest_admission)
+        Index('ix_document_versions_unindexed', 'uploaded_by', 'upload_timestamp',
+              postgresql_where=text("processed_status IN ('pending', 'processing', 'deferred')")),
+        # Conciliación de los objetos de MinIO con sus versiones (document_purge.reconcile_objects)
+        Index('ix_document_versions_ceph_path', 'ceph_path'),
+        # Artefactos de texto que ya no usa ninguna versión (document_purge): versiones por contenido
+        Index('ix_document_versions_sha256', text("(file_metadata->>'sha256')")),
     )
 
+    @property
+    def indexing_progress(self) -> float:
+        return indexing_progress(self.processed_status, self.chunks_indexed, self.chunks_total)
+
     def __repr__(self):
         return (f"<DocumentVersion(id='{self.id}', document_id='{self.document_id}', "
                 f"version_number={self.version_number}, is_latest={self.is_latest_version})>")
@@ -128,14 +169,109 @@ class DocumentChunk(Base):
     # Cambiado de file_id a document_version_id
     document_version_id = Column(UUID(as_uuid=True), ForeignKey('document_versions.id', ondelete='CASCADE'), nullable=False) 
     
-    chunk_text = Column(Text, nullable=False)
-    chunk_embedding = Column(Vector(768)) # Asegúrate de que la dimensión (ej. 768) coincida
+    # Texto y embedding compartidos con los chunks duplicados (chunk_dedup.py). chunk_text solo se guarda
+    # aquí si difiere del de chunk_contents (casi duplicados, o mayúsculas y espacios distintos).
+    content_id = Column(UUID(as_uuid=True), ForeignKey('chunk_contents.id'), nullable=False)
+    chunk_text = Column(Text, nullable=True)
     chunk_order = Column(Integer, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     # Relación inversa a DocumentVersion
     document_version = relationship("DocumentVersion", back_populates="chunks")
+    content = relationship("ChunkContent")
+
+    # Los reintentos de la indexación hacen upsert sobre esta clave
+    __table_args__ = (
+        UniqueConstraint('document_version_id', 'chunk_order', name='uq_document_chunks_version_order'),
+        # Apariciones de cada contenido en la búsqueda de /ask
+        Index('ix_document_chunks_content', 'content_id'),
+    )
 
     def __repr__(self):
         return (f"<DocumentChunk(id='{self.id}', document_version_id='{self.document_version_id}', "
                 f"order={self.chunk_order})>")
+
+
+#### `ChunkContent` (Texto y embedding de un chunk, compartido por sus duplicados)
+
+class ChunkContent(Base):
+    __tablename__ = 'chunk_contents'
+
+    id = Column(UUID(as_uuid=True), primary_key=True, server_default=func.gen_random_uuid())
+
+    # Clave del contenido: SHA-256 del texto normalizado, por modelo de embeddings ('legacy' para los
+    # chunks indexados antes de la deduplicación, que no se reutilizan).
+    embedding_model = Column(Text, nullable=False)
+    content_hash = Column(String(64), nullable=False)
+    chunk_text = Column(Text, nullable=False)
+    chunk_embedding = Column(Vector(768)) # Asegúrate de que la dimensión (ej. 768) coincida
+    minhash = Column(LargeBinary, nullable=True) # Firma MinHash para detectar casi duplicados (None si es corto)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        UniqueConstraint('embedding_model', 'content_hash', name='uq_chunk_contents_model_hash'),
+        # Búsqueda aproximada por distancia coseno (<=>) para los alcances grandes de /ask
+        Index('ix_chunk_contents_embedding_hnsw', 'chunk_embedding', postgresql_using='hnsw',
+              postgresql_ops={'chunk_embedding': 'vector_cosine_ops'}),
+    )
+
+    def __repr__(self):
+        return f"<ChunkContent(id='{self.id}', embedding_model='{self.embedding_model}')>"
+
+
+class ChunkContentBand(Base):
+    # Índice LSH de las firmas MinHash: una fila por banda de cada contenido (ver chunk_dedup.band_keys)
+    __tablename__ = 'chunk_content_bands'
+
+    band_key = Column(BigInteger, primary_key=True)
+    content_id = Column(UUID(as_uuid=True), ForeignKey('chunk_contents.id', ondelete='CASCADE'), primary_key=True)
+
+    # El ON DELETE CASCADE busca las bandas por contenido al borrar contenidos (document_purge, version_retention)
+    __table_args__ = (
+        Index('ix_chunk_content_bands_content', 'content_id'),
+    )
+
+
+#### `ArchivedChunk` (Chunks de versiones antiguas fuera de la búsqueda, ver version_retention.py)
+
+class ArchivedChunk(Base):
+    # Tabla fría: sin índice vectorial. Guarda lo necesario para restaurar la versión sin volver a embeber.
+    __tablename__ = 'archived_chunks'
+
+    document_version_id = Column(UUID(as_uuid=True), ForeignKey('document_versions.id', ondelete='CASCADE'),
+                                 primary_key=True)
+    chunk_order = Column(Integer, primary_key=True)
+    chunk_text = Column(Text, nullable=False)
+    embedding_model = Column(Text, nullable=False)
+    chunk_embedding = Column(Vector(768))
+    archived_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    def __repr__(self):
+        return f"<ArchivedChunk(document_version_id='{self.document_version_id}', order={self.chunk_order})>"
+
+
+#### `TextArtifact` (Texto extraído y normalizado, reutilizable entre reintentos y re-indexaciones)
+
+class TextArtifact(Base):
+    __tablename__ = 'text_artifacts'
+
+    id = Column(UUID(as_uuid=True), primary_key=True, server_default=func.gen_random_uuid())
+
+    # Clave del artefacto: el mismo contenido extraído con la misma versión de extractor da el mismo texto.
+    # Subir la versión de un extractor (tasks.EXTRACTOR_VERSIONS) invalida solo los artefactos de ese formato.
+    content_sha256 = Column(String(64), nullable=False) # SHA-256 del fichero original (file_metadata['sha256'])
+    extractor_version = Column(Text, nullable=False)
+
+    # El texto se guarda cifrado en MinIO con su propia clave, igual que los ficheros originales
+    ceph_path = Column(Text, nullable=False)
+    encryption_key_encrypted = Column(LargeBinary, nullable=False)
+    text_length = Column(Integer, nullable=False) # Caracteres del texto normalizado
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        UniqueConstraint('content_sha256', 'extractor_version', name='uq_text_artifacts_content_extractor'),
+    )
+
+    def __repr__(self):
+        return (f"<TextArtifact(id='{self.id}', content_sha256='{self.content_sha256}', "
+                f"extractor_version='{self.extractor_version}')>")
@@ -0,0 +1,110 @@
+# backend/office_extraction.py
+"""
+Extracción de hojas de cálculo (XLSX) y presentaciones (PPTX) en unidades de texto.
+
+`load_workbook` en modo completo crea un objeto por celda: un export grande de
+cientos de miles de filas agota la memoria del worker. Aquí el libro se abre en
+modo `read_only` y cada hoja se recorre fila a fila; la memoria no crece con el
+número de filas, solo con el texto producido, que se acota con
+XLSX_MAX_ROWS_PER_SHEET y XLSX_MAX_CELLS.
+
+Las filas se agrupan en ventanas de hasta XLSX_ROW_WINDOW filas y CHUNK_SIZE
+caracteres, y cada ventana repite la fila de cabecera de su hoja: un chunk de la
+fila 40.000 sigue diciendo qué es cada columna. En PPTX cada diapositiva es una
+unidad con sus cuadros de texto, tablas (también dentro de grupos) y notas.
+
+Las unidades se separan con una línea en blanco (UNIT_SEPARATOR), que sobrevive a
+`normalize_text` y al artefacto de texto; `tasks.chunk_units` las vuelve a empaquetar
+sin partirlas.
+"""
+import io
+import os
+import re
+import logging
+
+from context_builder import CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+UNIT_SEPARATOR = "\n\n"
+_BLANK_LINES_RE = re.compile(r"\n\s*\n")
+
+XLSX_ROW_WINDOW = int(os.getenv("XLSX_ROW_WINDOW", "50"))
+XLSX_MAX_ROWS_PER_SHEET = int(os.getenv("XLSX_MAX_ROWS_PER_SHEET", "200000"))
+XLSX_MAX_CELLS = int(os.getenv("XLSX_MAX_CELLS", "5000000"))
+
+
+def _row_text(values) -> str:
+    cells = ["" if value is None else str(value).replace("\n", " ") for value in values]
+    while cells and not cells[-1]:
+        cells.pop()
+    return "\t".join(cells)
+
+
+def iter_xlsx_units(content: bytes, filename: str = ""):
+    """Genera ventanas de filas por hoja, cada una con el título de la hoja y su cabecera."""
+    from openpyxl import load_workbook # Requires 'openpyxl' package
+
+    workbook = load_workbook(io.BytesIO(content), read_only=True, data_only=True)
+    cells_left = XLSX_MAX_CELLS
+    try:
+        for sheet in workbook.worksheets: # Sin las hojas de gráfico, que no tienen filas
+            # La dimensión guardada en el fichero puede ser falsa y recortaría columnas en modo read_only.
+            sheet.reset_dimensions()
+            title, header, window, window_chars, rows = f"--- Hoja: {sheet.title} ---", None, [], 0, 0
+            for values in sheet.iter_rows(values_only=True):
+                if rows >= XLSX_MAX_ROWS_PER_SHEET or cells_left <= 0:
+                    logger.warning(f"XLSX {filename}: hoja '{sheet.title}' truncada tras {rows} filas "
+                                   f"(XLSX_MAX_ROWS_PER_SHEET={XLSX_MAX_ROWS_PER_SHEET}, XLSX_MAX_CELLS={XLSX_MAX_CELLS}).")
+                    window.append(f"[Hoja truncada tras {rows} filas]")
+                    break
+                cells_left -= len(values)
+                line = _row_text(values)
+                if not line:
+                    continue
+                rows += 1
+                if header is None:
+                    header = line
+                    continue
+                # El presupuesto de la ventana incluye el título y la cabecera que se repiten en cada una
+                if window and (len(window) >= XLSX_ROW_WINDOW
+                               or len(title) + len(header) + window_chars + len(line) + 2 > CHUNK_SIZE):
+                    yield "\n".join((title, header, *window))
+                    window, window_chars = [], 0
+                window.append(line)
+                window_chars += len(line) + 1
+            if window or header:
+                yield "\n".join((title, header or "", *window)).rstrip()
+            if cells_left <= 0:
+                break
+    finally:
+        workbook.close() # En read_only el fichero ZIP queda abierto hasta cerrarlo
+
+
+def _shape_texts(shapes):
+    from pptx.enum.shapes import MSO_SHAPE_TYPE # Requires 'python-pptx' package
+
+    for shape in shapes:
+        if shape.shape_type == MSO_SHAPE_TYPE.GROUP:
+            yield from _shape_texts(shape.shapes)
+        elif getattr(shape, "has_table", False) and shape.has_table:
+            rows = [_row_text(cell.text for cell in row.cells) for row in shape.table.rows]
+            yield "\n".join(row for row in rows if row)
+        elif getattr(shape, "has_text_frame", False) and shape.has_text_frame:
+            yield shape.text_frame.text
+
+
+def iter_pptx_units(content: bytes, filename: str = ""):
+    """Genera una unidad por diapositiva: texto de las formas, tablas y notas del orador."""
+    from pptx import Presentation # Requires 'python-pptx' package
+
+    presentation = Presentation(io.BytesIO(content))
+    for number, slide in enumerate(presentation.slides, start=1):
+        parts = [text.strip() for text in _shape_texts(slide.shapes) if text and text.strip()]
+        if slide.has_notes_slide:
+            notes = slide.notes_slide.notes_text_frame.text.strip() if slide.notes_slide.notes_text_frame else ""
+            if notes:
+                parts.append(f"Notas: {notes}")
+        if parts:
+            # Sin líneas en blanco dentro de la unidad: separarían la diapositiva en varias unidades.
+            yield _BLANK_LINES_RE.sub("\n", "\n".join([f"--- Diapositiva {number} ---", *parts]))
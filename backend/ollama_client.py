@@ -0,0 +1,71 @@
+# backend/ollama_client.py
+"""
+Llamadas HTTP a Ollama compartidas por la API (/ask síncrono) y los workers.
+
+Vive fuera de tasks.py para que la API no tenga que importar el módulo de tareas
+(y con él pypdf, pytesseract, PIL y el resto de librerías de extracción).
+"""
+import os
+import logging
+
+import requests
+
+import model_residency
+from embedding_providers import embed_texts
+from metrics import observe_stage, OLLAMA_REQUEST_SECONDS
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_API_BASE_URL = os.getenv("OLLAMA_API_BASE_URL", "http://ollama:11434")
+OLLAMA_GENERATION_TIMEOUT = int(os.getenv("OLLAMA_GENERATION_TIMEOUT", "1200"))
+
+
+def get_ollama_embedding(text: str, model_name: str):
+    """
+    Embedding de un único texto con el backend configurado en EMBEDDING_BACKEND
+    (Ollama por HTTP o ONNX Runtime en proceso). Para muchos textos usar `embed_texts`.
+    """
+    return embed_texts([text], model_name)[0]
+
+def get_ollama_generation(prompt: str, model_name: str, options: dict = None):
+    return generate_with_context(prompt, model_name, options=options)['response']
+
+def generate_with_context(prompt: str, model_name: str, options: dict = None, context: list = None,
+                          keep_alive: str = None) -> dict:
+    """
+    /api/generate devolviendo el JSON completo: `response`, el `context` (tokens de la conversación,
+    para continuarla en la siguiente llamada sin volver a enviar lo anterior) y `prompt_eval_count`
+    (tokens de prompt procesados en esta llamada). `keep_alive` mantiene el modelo cargado entre turnos
+    (por defecto, el del modelo en model_residency). Si el gestor de modelos lo está cargando, espera antes.
+    """
+    headers = {'Content-Type': 'application/json'}
+    data = {
+        "model": model_name,
+        "prompt": prompt,
+        "stream": False
+    }
+    if options:
+        data["options"] = options # e.g. num_ctx / num_predict
+    if context:
+        data["context"] = context
+    data["keep_alive"] = keep_alive or model_residency.keep_alive_for(model_name)
+    waited = model_residency.wait_until_loaded(model_name)
+    if waited >= model_residency.MODEL_LOAD_POLL_SECONDS:
+        logger.info(f"Generación con '{model_name}' retrasada {waited:.1f}s mientras se cargaba el modelo.")
+    try:
+        logger.info(f"Solicitando generación para el modelo '{model_name}' (prompt: {prompt[:100]}...) con timeout {OLLAMA_GENERATION_TIMEOUT}s")
+        with observe_stage(OLLAMA_REQUEST_SECONDS, endpoint='generate', model=model_name):
+            response = requests.post(f"{OLLAMA_API_BASE_URL}/api/generate", headers=headers, json=data, timeout=OLLAMA_GENERATION_TIMEOUT)
+        response.raise_for_status()
+        result = response.json()
+        model_residency.record_load(model_name, 'request', result)
+        return result
+    except requests.exceptions.Timeout as e:
+        logger.error(f"Tiempo de espera agotado al generar respuesta de Ollama en {OLLAMA_API_BASE_URL}/api/generate: {e}")
+        raise
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Error al comunicarse con Ollama en {OLLAMA_API_BASE_URL}/api/generate: {e}")
+        raise
+    except Exception as e:
+        logger.error(f"Error inesperado al obtener generación de Ollama: {e}")
+        raise
@@ -0,0 +1,405 @@
+# backend/rag_service.py
+import os
+import math
+import logging
+from uuid import UUID
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import text
+
+from ollama_client import get_ollama_embedding, get_ollama_generation
+import context_builder
+from context_builder import CHUNK_OVERLAP
+from mmr import mmr_select, to_matrix
+from metrics import observe_stage, ASK_STAGE_SECONDS, RETRIEVAL_SEARCHES
+
+OLLAMA_EMBEDDING_MODEL = os.getenv("OLLAMA_EMBEDDING_MODEL", "nomic-embed-text")
+OLLAMA_GENERATION_MODEL = os.getenv("OLLAMA_GENERATION_MODEL", "phi3:3.8b-mini-4k-instruct-q4_K_M")
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "5"))
+# Candidatos que se traen de la base de datos para que MMR elija los RAG_TOP_K finales.
+RAG_CANDIDATE_CHUNKS = int(os.getenv("RAG_CANDIDATE_CHUNKS", "40"))
+# 1.0 = solo relevancia (top-k clásico); valores menores penalizan los chunks redundantes.
+RAG_MMR_LAMBDA = float(os.getenv("RAG_MMR_LAMBDA", "0.7"))
+
+NO_CONTEXT_ANSWER = "No pude encontrar información relevante en los documentos indexados disponibles para ti."
+
+# Búsqueda exacta (sin índice HNSW) si el alcance de la pregunta tiene hasta estos chunks.
+RAG_EXACT_SEARCH_MAX_CHUNKS = int(os.getenv("RAG_EXACT_SEARCH_MAX_CHUNKS", "20000"))
+# Límites de hnsw.ef_search (pgvector no admite más de 1000); por encima del máximo se busca de forma exacta.
+RAG_HNSW_EF_SEARCH_MIN = int(os.getenv("RAG_HNSW_EF_SEARCH_MIN", "40"))
+RAG_HNSW_EF_SEARCH_MAX = min(int(os.getenv("RAG_HNSW_EF_SEARCH_MAX", "1000")), 1000)
+
+# Búsqueda en dos etapas cuando el alcance es grande y el índice HNSW no sirve (la búsqueda plana sería exacta
+# sobre todos sus chunks): primero las RAG_TWO_STAGE_DOCUMENTS versiones cuyo summary_embedding (centroide de
+# sus chunks) está más cerca de la pregunta y después solo sus chunks. 0 la desactiva.
+RAG_TWO_STAGE_DOCUMENTS = int(os.getenv("RAG_TWO_STAGE_DOCUMENTS", "50"))
+RAG_TWO_STAGE_MIN_VERSIONS = int(os.getenv("RAG_TWO_STAGE_MIN_VERSIONS", "200"))
+
+FILTER_KEYS = ("category", "tags", "document_ids", "version_ids", "date_from", "date_to")
+
+# Versiones indexadas del usuario dentro del alcance de la pregunta ({conditions}, ver `scope_conditions`).
+# La suma de chunks_total y el número aproximado de contenidos (los que recorre el índice HNSW) dan la
+# selectividad de los filtros.
+SCOPE_SQL = """
+    SELECT
+        COUNT(*) AS scope_versions,
+        COALESCE(SUM(dv.chunks_total), 0) AS scope_chunks,
+        (SELECT GREATEST(reltuples, 0)::bigint FROM pg_class WHERE oid = 'chunk_contents'::regclass) AS total_chunks
+    FROM
+        document_versions dv
+    JOIN
+        documents d ON dv.document_id = d.id
+    WHERE
+        {conditions};
+"""
+
+# Los chunks duplicados comparten contenido (chunk_contents, ver chunk_dedup.py): la búsqueda ordena contenidos
+# y de cada uno devuelve una sola aparición dentro del alcance, la de la versión subida primero. Un casi
+# duplicado conserva su propio texto en document_chunks.
+OCCURRENCE_SQL = """
+    CROSS JOIN LATERAL (
+        SELECT
+            COALESCE(dc.chunk_text, cc.chunk_text) AS chunk_text,
+            dc.chunk_order,
+            dc.document_version_id,
+            dv.version_number,
+            d.id AS document_id,
+            d.title
+        FROM
+            document_chunks dc
+        JOIN
+            document_versions dv ON dc.document_version_id = dv.id
+        JOIN
+            documents d ON dv.document_id = d.id
+        WHERE
+            dc.content_id = cc.id AND {conditions}
+        ORDER BY
+            dv.upload_timestamp, dc.document_version_id, dc.chunk_order
+        LIMIT 1
+    ) occurrence"""
+
+# Filtra por los documentos del usuario y las versiones en alcance (por defecto,
+# document_versions.is_latest_version = TRUE: la versión más reciente de cada documento).
+# Con el índice HNSW de chunk_embedding, PostgreSQL puede resolver el ORDER BY ... LIMIT con el índice
+# y descartar después los contenidos sin aparición en el alcance; hnsw.ef_search se ajusta antes según
+# la selectividad (ver `hnsw_ef_search`).
+RETRIEVAL_SQL = """
+    SELECT
+        occurrence.*,
+        vector_send(cc.chunk_embedding) AS embedding,
+        cc.chunk_embedding <=> CAST(:embedding AS vector) AS distance
+    FROM
+        chunk_contents cc
+    {occurrence}
+    ORDER BY
+        distance
+    LIMIT :limit;
+"""
+
+# Búsqueda exacta sobre los contenidos del alcance: la CTE materializada impide usar el índice HNSW,
+# que con filtros muy selectivos devolvería menos candidatos de los pedidos.
+EXACT_RETRIEVAL_SQL = """
+    WITH scoped AS MATERIALIZED (
+        SELECT cc.id, cc.chunk_embedding <=> CAST(:embedding AS vector) AS distance
+        FROM chunk_contents cc
+        WHERE cc.id IN (
+            SELECT dc.content_id
+            FROM document_chunks dc
+            JOIN document_versions dv ON dc.document_version_id = dv.id
+            JOIN documents d ON dv.document_id = d.id
+            WHERE {conditions})
+    ), nearest AS (
+        SELECT id, distance FROM scoped ORDER BY distance LIMIT :limit
+    )
+    SELECT
+        occurrence.*,
+        vector_send(cc.chunk_embedding) AS embedding,
+        nearest.distance
+    FROM
+        nearest
+    JOIN
+        chunk_contents cc ON cc.id = nearest.id
+    {occurrence}
+    ORDER BY
+        nearest.distance;
+"""
+
+# Dos etapas: las `:candidate_documents` versiones del alcance con el summary_embedding más cercano (más las que
+# aún no lo tienen, que siempre entran) y búsqueda exacta solo entre sus contenidos, como en EXACT_RETRIEVAL_SQL.
+TWO_STAGE_RETRIEVAL_SQL = """
+    WITH candidate_versions AS MATERIALIZED (
+        (SELECT dv.id
+         FROM document_versions dv
+         JOIN documents d ON dv.document_id = d.id
+         WHERE {conditions} AND dv.summary_embedding IS NOT NULL
+         ORDER BY dv.summary_embedding <=> CAST(:embedding AS vector)
+         LIMIT :candidate_documents)
+        UNION ALL
+        SELECT dv.id
+        FROM document_versions dv
+        JOIN documents d ON dv.document_id = d.id
+        WHERE {conditions} AND dv.summary_embedding IS NULL
+    ), scoped AS MATERIALIZED (
+        SELECT cc.id, cc.chunk_embedding <=> CAST(:embedding AS vector) AS distance
+        FROM chunk_contents cc
+        WHERE cc.id IN (
+            SELECT dc.content_id
+            FROM document_chunks dc
+            WHERE dc.document_version_id IN (SELECT id FROM candidate_versions))
+    ), nearest AS (
+        SELECT id, distance FROM scoped ORDER BY distance LIMIT :limit
+    )
+    SELECT
+        occurrence.*,
+        vector_send(cc.chunk_embedding) AS embedding,
+        nearest.distance
+    FROM
+        nearest
+    JOIN
+        chunk_contents cc ON cc.id = nearest.id
+    {occurrence}
+    ORDER BY
+        nearest.distance;
+"""
+
+
+def _string_list(value, key: str) -> list[str]:
+    values = [value] if isinstance(value, str) else value
+    if not isinstance(values, list) or not all(isinstance(v, str) and v for v in values):
+        raise ValueError(f"El filtro '{key}' debe ser un texto o una lista de textos.")
+    return values
+
+
+def _uuid_list(value, key: str) -> list[UUID]:
+    try:
+        return [UUID(str(v)) for v in ([value] if isinstance(value, str) else value)]
+    except (TypeError, ValueError):
+        raise ValueError(f"El filtro '{key}' debe ser una lista de UUID.")
+
+
+def _timestamp(value, key: str, end_of_day: bool = False) -> datetime:
+    try:
+        parsed = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"El filtro '{key}' debe ser una fecha ISO 8601 (ej. 2024-05-31 o 2024-05-31T18:00:00+02:00).")
+    if end_of_day and len(value) == 10: # Una fecha sin hora incluye el día completo
+        parsed += timedelta(days=1)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def parse_filters(raw) -> dict:
+    """
+    Valida el objeto `filters` de /ask y lo pasa a los parámetros de la consulta.
+    Los filtros se combinan con AND; lanza ValueError con un mensaje para el cliente.
+
+    * `category`: una categoría o una lista (cualquiera de ellas).
+    * `tags`: lista de etiquetas (el documento debe tenerlas todas).
+    * `document_ids`: solo esos documentos.
+    * `version_ids`: versiones fijadas; se busca en ellas en lugar de en la última versión de su documento
+      (sin `document_ids`, solo en ellas).
+    * `date_from` / `date_to`: fecha de subida de la versión, ISO 8601; `date_to` excluida
+      salvo si es una fecha sin hora, que incluye ese día.
+    """
+    if not raw:
+        return {}
+    if not isinstance(raw, dict):
+        raise ValueError("'filters' debe ser un objeto JSON.")
+    unknown = set(raw) - set(FILTER_KEYS)
+    if unknown:
+        raise ValueError(f"Filtros desconocidos: {', '.join(sorted(unknown))}. Válidos: {', '.join(FILTER_KEYS)}.")
+
+    filters = {}
+    if raw.get("category"):
+        filters["categories"] = _string_list(raw["category"], "category")
+    if raw.get("tags"):
+        filters["tags"] = _string_list(raw["tags"], "tags")
+    for key in ("document_ids", "version_ids"):
+        if raw.get(key):
+            filters[key] = _uuid_list(raw[key], key)
+    if raw.get("date_from"):
+        filters["date_from"] = _timestamp(raw["date_from"], "date_from")
+    if raw.get("date_to"):
+        filters["date_to"] = _timestamp(raw["date_to"], "date_to", end_of_day=True)
+    return filters
+
+
+def scope_conditions(filters: dict) -> str:
+    """Condiciones del WHERE sobre `d` (documents) y `dv` (document_versions) para los filtros de `parse_filters`."""
+    conditions = ["d.created_by = :user_id", "d.deleted_at IS NULL", "dv.processed_status = 'indexed'"]
+    latest = "dv.is_latest_version = TRUE"
+    if "document_ids" in filters:
+        latest += " AND d.id = ANY(CAST(:document_ids AS uuid[]))"
+    if "version_ids" not in filters:
+        conditions.append(latest)
+    elif "document_ids" not in filters:
+        conditions.append("dv.id = ANY(CAST(:version_ids AS uuid[]))")
+    else:
+        conditions.append(
+            "(dv.id = ANY(CAST(:version_ids AS uuid[])) OR "
+            f"({latest} AND d.id NOT IN (SELECT document_id FROM document_versions WHERE id = ANY(CAST(:version_ids AS uuid[])))))")
+    if "categories" in filters:
+        conditions.append("d.category = ANY(CAST(:categories AS text[]))")
+    if "tags" in filters:
+        conditions.append("d.tags @> CAST(:tags AS text[])")
+    if "date_from" in filters:
+        conditions.append("dv.upload_timestamp >= :date_from")
+    if "date_to" in filters:
+        conditions.append("dv.upload_timestamp < :date_to")
+    return " AND ".join(conditions)
+
+
+def retrieval_queries(filters: dict) -> dict:
+    """Las consultas de la búsqueda (`scope`, `hnsw`, `exact`, `two_stage`) con las condiciones de los filtros."""
+    conditions = scope_conditions(filters)
+    occurrence = OCCURRENCE_SQL.format(conditions=conditions)
+    return {
+        "scope": SCOPE_SQL.format(conditions=conditions),
+        "hnsw": RETRIEVAL_SQL.format(occurrence=occurrence),
+        "exact": EXACT_RETRIEVAL_SQL.format(conditions=conditions, occurrence=occurrence),
+        "two_stage": TWO_STAGE_RETRIEVAL_SQL.format(conditions=conditions, occurrence=occurrence),
+    }
+
+
+def hnsw_ef_search(scope_chunks: int, total_chunks: int, candidates: int):
+    """
+    hnsw.ef_search para traer `candidates` chunks del alcance con el índice HNSW, o None si conviene la
+    búsqueda exacta. El índice recorre ef_search vecinos de toda la tabla y los filtros se aplican
+    después, así que hacen falta unos candidates / selectividad; si eso supera RAG_HNSW_EF_SEARCH_MAX,
+    o el alcance es pequeño (RAG_EXACT_SEARCH_MAX_CHUNKS), la búsqueda exacta es más barata y completa.
+    """
+    if scope_chunks <= RAG_EXACT_SEARCH_MAX_CHUNKS:
+        return None
+    selectivity = scope_chunks / max(total_chunks, scope_chunks)
+    ef_search = max(math.ceil(candidates / selectivity), RAG_HNSW_EF_SEARCH_MIN)
+    return ef_search if ef_search <= RAG_HNSW_EF_SEARCH_MAX else None
+
+
+def two_stage_documents(scope_versions: int, scope_chunks: int, ef_search,
+                        candidate_documents: int = RAG_TWO_STAGE_DOCUMENTS):
+    """
+    Versiones candidatas de la primera etapa si conviene la búsqueda en dos etapas, o None. Solo sustituye
+    a la búsqueda exacta de alcances mayores que RAG_EXACT_SEARCH_MAX_CHUNKS (sin `ef_search` utilizable)
+    con al menos RAG_TWO_STAGE_MIN_VERSIONS versiones: si el índice HNSW sirve, es más rápido y no depende
+    de que el centroide represente bien al documento.
+    """
+    if candidate_documents <= 0 or ef_search or scope_chunks <= RAG_EXACT_SEARCH_MAX_CHUNKS:
+        return None
+    if scope_versions < max(RAG_TWO_STAGE_MIN_VERSIONS, candidate_documents + 1):
+        return None
+    return candidate_documents
+
+
+def embed_question(question: str):
+    """Obtiene el embedding de la pregunta del usuario."""
+    with observe_stage(ASK_STAGE_SECONDS, stage='embedding', model=OLLAMA_EMBEDDING_MODEL):
+        return get_ollama_embedding(question, model_name=OLLAMA_EMBEDDING_MODEL)
+
+
+def retrieve_chunks(session, user_id, question_embedding, limit: int = RAG_TOP_K,
+                    candidates: int = RAG_CANDIDATE_CHUNKS, lambda_mult: float = RAG_MMR_LAMBDA,
+                    filters: dict = None, candidate_documents: int = RAG_TWO_STAGE_DOCUMENTS) -> list[dict]:
+    """
+    Busca los chunks más similares a la pregunta entre las versiones indexadas del usuario
+    dentro del alcance de `filters` (ver `parse_filters`).
+    Se traen `candidates` resultados con sus embeddings y MMR elige los `limit` finales.
+    En alcances grandes en los que el índice HNSW no sirve, los chunks se buscan solo en las
+    `candidate_documents` versiones más cercanas a la pregunta (ver `two_stage_documents`).
+    Cada resultado incluye su versión, orden y distancia para poder construir el contexto.
+    """
+    filters = filters or {}
+    queries = retrieval_queries(filters)
+    params = {"embedding": question_embedding, "user_id": user_id, "limit": max(candidates, limit), **filters}
+    with observe_stage(ASK_STAGE_SECONDS, stage='vector_sql', model=OLLAMA_EMBEDDING_MODEL):
+        scope = session.execute(text(queries["scope"]), params).one()
+        if not scope.scope_versions:
+            RETRIEVAL_SEARCHES.labels(plan='empty', filtered=str(bool(filters)).lower()).inc()
+            return []
+        ef_search = hnsw_ef_search(scope.scope_chunks, scope.total_chunks, params["limit"])
+        candidate_documents = two_stage_documents(scope.scope_versions, scope.scope_chunks, ef_search, candidate_documents)
+        if candidate_documents:
+            plan = 'two_stage'
+            rows = [dict(row._mapping) for row in session.execute(
+                text(queries["two_stage"]), {**params, "candidate_documents": candidate_documents}).fetchall()]
+        else:
+            rows = []
+            if ef_search:
+                session.execute(text(f"SET LOCAL hnsw.ef_search = {int(ef_search)}"))
+                rows = [dict(row._mapping) for row in session.execute(text(queries["hnsw"]), params).fetchall()]
+            plan = search_plan(ef_search, rows, params["limit"], scope.scope_chunks)
+            if plan != 'hnsw':
+                rows = [dict(row._mapping) for row in session.execute(text(queries["exact"]), params).fetchall()]
+        RETRIEVAL_SEARCHES.labels(plan=plan, filtered=str(bool(filters)).lower()).inc()
+    with observe_stage(ASK_STAGE_SECONDS, stage='mmr', model=OLLAMA_EMBEDDING_MODEL):
+        return diversify(rows, question_embedding, limit, lambda_mult)
+
+
+def search_plan(ef_search, hnsw_rows: list, limit: int, scope_chunks: int) -> str:
+    """`hnsw` si el índice ya devolvió los candidatos; `exact` si no se usó o `hnsw_short` si se quedó corto."""
+    if not ef_search:
+        return 'exact'
+    return 'hnsw' if len(hnsw_rows) >= min(limit, scope_chunks) else 'hnsw_short'
+
+
+def diversify(rows: list[dict], question_embedding, limit: int = RAG_TOP_K, lambda_mult: float = RAG_MMR_LAMBDA) -> list[dict]:
+    """Aplica MMR sobre los candidatos y descarta los embeddings, que ya no se necesitan."""
+    if len(rows) > limit:
+        embeddings = to_matrix([row["embedding"] for row in rows])
+        rows = [rows[i] for i in mmr_select(question_embedding, embeddings, limit, lambda_mult)]
+    for row in rows:
+        row.pop("embedding", None)
+    return rows
+
+
+def _prompt_template(question: str, context: str) -> str:
+    return (
+        f"Basado en el siguiente contexto, responde a la pregunta. "
+        f"Si la respuesta no se encuentra directamente en el contexto, indica que no tienes suficiente información "
+        f"y no intentes inventar la respuesta. Cita las fuentes con su número entre corchetes.\n\n"
+        f"Contexto:\n{context}\n\n"
+        f"Pregunta: {question}\n"
+        f"Respuesta:"
+    )
+
+
+def build_prompt(question: str, retrieved_chunks: list[dict], model_name: str = None):
+    """
+    Construye el prompt para el modelo de generación. Devuelve `(prompt, sources)`:
+    el contexto se empaqueta dentro de la ventana del modelo (ver context_builder).
+    """
+    model_name = model_name or OLLAMA_GENERATION_MODEL
+    with observe_stage(ASK_STAGE_SECONDS, stage='context', model=model_name):
+        context, sources = context_builder.build_context(
+            retrieved_chunks,
+            model_name,
+            prompt_overhead=_prompt_template(question, ""),
+            overlap=CHUNK_OVERLAP,
+        )
+    return _prompt_template(question, context), sources
+
+
+def generate_answer(prompt: str, model_name: str = None) -> str:
+    """Obtiene la respuesta del modelo de generación con num_ctx/num_predict acordes al presupuesto."""
+    model_name = model_name or OLLAMA_GENERATION_MODEL
+    with observe_stage(ASK_STAGE_SECONDS, stage='generation', model=model_name):
+        return get_ollama_generation(prompt, model_name=model_name,
+                                     options=context_builder.generation_options(model_name))
+
+
+def answer_question(session, user_id, question: str, model_name: str = None, filters: dict = None) -> dict:
+    """
+    Ejecuta el flujo RAG completo (embedding, búsqueda y generación) y devuelve
+    el cuerpo JSON de la respuesta. Las excepciones se propagan al llamador.
+    """
+    model_name = model_name or OLLAMA_GENERATION_MODEL
+
+    question_embedding = embed_question(question)
+    if question_embedding is None:
+        raise ValueError("No se pudo generar el embedding de la pregunta.")
+
+    retrieved_chunks = retrieve_chunks(session, user_id, question_embedding, filters=filters)
+    if not retrieved_chunks:
+        return {"answer": NO_CONTEXT_ANSWER}
+
+    prompt_for_llm, sources = build_prompt(question, retrieved_chunks, model_name=model_name)
+    logging.info(f"Enviando prompt al LLM: {prompt_for_llm[:200]}...")
+    return {"answer": generate_answer(prompt_for_llm, model_name=model_name), "sources": sources}
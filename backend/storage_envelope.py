@@ -0,0 +1,86 @@
+# backend/storage_envelope.py
+"""
+Formato de los ficheros cifrados que se guardan en MinIO.
+
+Fernet codifica su salida en base64 (unos 33% más de bytes) y no comprime. El
+sobre binario comprime primero con zstd, según el tipo MIME, y cifra después
+con AES-256-GCM:
+
+    b"DVE" | versión (1 byte) | flags (1 byte) | nonce (12 bytes) | texto cifrado + tag GCM
+
+La cabecera (magic, versión, flags) se autentica como dato asociado. La clave
+de cada fichero sigue siendo una clave Fernet (envuelta con SYSTEM_MASTER_KEY en
+`encryption_key_encrypted`), y sus 32 bytes decodificados son la clave AES. Los
+objetos antiguos, tokens Fernet sin cabecera, se siguen leyendo con `open_envelope`.
+"""
+import os
+import base64
+import struct
+
+import zstandard
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+MAGIC = b"DVE"
+FORMAT_VERSION = 1
+FLAG_ZSTD = 0x01
+_HEADER = struct.Struct("!3sBB")
+_NONCE_SIZE = 12
+
+STORAGE_ZSTD_LEVEL = int(os.getenv("STORAGE_ZSTD_LEVEL", "3"))
+# Formatos que ya van comprimidos (imágenes, ZIP: DOCX/XLSX/PPTX/EPUB): zstd no ganaría casi nada.
+DEFAULT_UNCOMPRESSED_MIMETYPES = (
+    "image/jpeg", "image/png", "image/gif", "image/webp",
+    "application/zip", "application/gzip", "application/x-7z-compressed",
+    "application/epub+zip", "application/vnd.openxmlformats-officedocument.",
+    "audio/", "video/",
+)
+STORAGE_UNCOMPRESSED_MIMETYPES = tuple(
+    m.strip() for m in os.getenv("STORAGE_UNCOMPRESSED_MIMETYPES", ",".join(DEFAULT_UNCOMPRESSED_MIMETYPES)).split(",")
+    if m.strip())
+# Si zstd no ahorra al menos esta fracción, se guarda sin comprimir (y la lectura no paga la descompresión).
+STORAGE_MIN_COMPRESSION_SAVINGS = float(os.getenv("STORAGE_MIN_COMPRESSION_SAVINGS", "0.05"))
+
+
+def should_compress(mimetype: str) -> bool:
+    """Política por tipo MIME; las entradas que acaban en '/' o '.' son prefijos."""
+    mimetype = (mimetype or "").lower()
+    return not any(mimetype == m or (m.endswith(("/", ".")) and mimetype.startswith(m))
+                   for m in STORAGE_UNCOMPRESSED_MIMETYPES)
+
+
+def _aes_key(file_key: bytes) -> bytes:
+    return base64.urlsafe_b64decode(file_key)
+
+
+def is_envelope(data: bytes) -> bool:
+    return data[:len(MAGIC)] == MAGIC
+
+
+def seal(data: bytes, file_key: bytes, mimetype: str = None) -> bytes:
+    """Comprime (si la política lo permite y compensa) y cifra `data` en el sobre binario."""
+    flags, payload = 0, data
+    if data and should_compress(mimetype):
+        compressed = zstandard.ZstdCompressor(level=STORAGE_ZSTD_LEVEL).compress(data)
+        if len(compressed) <= len(data) * (1 - STORAGE_MIN_COMPRESSION_SAVINGS):
+            flags, payload = FLAG_ZSTD, compressed
+
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, flags)
+    nonce = os.urandom(_NONCE_SIZE)
+    return header + nonce + AESGCM(_aes_key(file_key)).encrypt(nonce, payload, header)
+
+
+def open_envelope(data: bytes, file_key: bytes) -> bytes:
+    """Descifra un objeto del sobre binario o, si no tiene cabecera, un token Fernet antiguo."""
+    if not is_envelope(data):
+        return Fernet(file_key).decrypt(data)
+
+    magic, version, flags = _HEADER.unpack_from(data)
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Versión de sobre de almacenamiento no soportada: {version}")
+    header_end = _HEADER.size + _NONCE_SIZE
+    nonce = data[_HEADER.size:header_end]
+    payload = AESGCM(_aes_key(file_key)).decrypt(nonce, data[header_end:], data[:_HEADER.size])
+    if flags & FLAG_ZSTD:
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return payload
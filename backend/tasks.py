@@ -6,7 +6,10 @@ import logging
 from datetime import datetime
 from uuid import UUID as UUIDType # Use UUIDType to avoid clash with uuid.uuid4
 import uuid # For generating new UUIDs
-from celery import Celery
+import time
+import re
+import hashlib
+import unicodedata
 
 # --- Gevent/Eventlet Monkey Patch (add this at the very top if using these pools) ---
 # from gevent import monkey
@@ -16,8 +19,27 @@ from celery import Celery
 # and ensure 'gevent' or 'eventlet' is in your requirements.txt.
 
 # --- SQLAlchemy and Models Imports ---
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+import database
 from database import get_db # Import the database session context manager
+import db_routing
+import storage_envelope
+import text_artifacts
+import ingest_scheduler
+import ingest_admission
+import chunk_dedup
+import model_residency
+import version_retention
+import document_purge
 from models import DocumentVersion, DocumentChunk # Import your SQLAlchemy models
+import metrics
+from metrics import observe_stage, INGEST_STAGE_SECONDS
+from embedding_providers import embed_texts, EMBEDDING_BACKEND
+from ollama_client import get_ollama_embedding, get_ollama_generation # Re-exportadas para los consumidores existentes
+from context_builder import CHUNK_SIZE, CHUNK_OVERLAP
+from office_extraction import UNIT_SEPARATOR, iter_xlsx_units, iter_pptx_units
+from ebook_converter import EBOOK_EXTENSIONS, EbookConversionError, get_converter_pool, reset_converter_pool
 
 # --- External Libraries ---
 from cryptography.fernet import Fernet
@@ -26,8 +48,6 @@ from minio import Minio
 from minio.error import S3Error
 from pypdf import PdfReader
 import io
-import subprocess
-import tempfile
 import pytesseract
 from PIL import Image
 
@@ -36,9 +56,16 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 logger = logging.getLogger(__name__)
 
 # --- Celery Configuration ---
-CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', 'redis://localhost:6379/0')
-CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', 'redis://localhost:6379/0')
-celery_app = Celery('tasks', broker=CELERY_BROKER_URL, backend=CELERY_RESULT_BACKEND)
+# The app itself lives in celery_client.py so the API can enqueue tasks without importing this module.
+from celery_client import celery_app, CELERY_BROKER_URL, CELERY_RESULT_BACKEND
+from celery.signals import worker_process_init
+metrics.connect_celery_signals()
+
+@worker_process_init.connect(weak=False)
+def _reset_db_pool(**kwargs):
+    # Prefork children must not reuse connections opened by the parent before forking.
+    database.engine.dispose(close=False)
+    reset_converter_pool()
 
 # --- Environment Variables (Ensuring they are loaded correctly) ---
 # These should ideally be loaded once at application startup or via your Docker setup.
@@ -52,10 +79,22 @@ SYSTEM_MASTER_KEY = os.getenv('DOCUMENT_ENCRYPTION_KEY')
 if not SYSTEM_MASTER_KEY:
     raise ValueError("DOCUMENT_ENCRYPTION_KEY is not configured in environment variables.")
 
-OLLAMA_API_BASE_URL = os.getenv("OLLAMA_API_BASE_URL", "http://ollama:11434")
 OLLAMA_EMBEDDING_MODEL = os.getenv("OLLAMA_EMBEDDING_MODEL", "nomic-embed-text")
 OLLAMA_GENERATION_MODEL = os.getenv("OLLAMA_GENERATION_MODEL", "phi3:3.8b-mini-4k-instruct-q4_K_M")
-OLLAMA_GENERATION_TIMEOUT = int(os.getenv("OLLAMA_GENERATION_TIMEOUT", "1200"))
+# Chunks embedded and committed per indexing checkpoint; a failed task resumes after the last one.
+INDEX_CHECKPOINT_CHUNKS = int(os.getenv("INDEX_CHECKPOINT_CHUNKS", "256"))
+# Embedding backend and model the vectors come from: chunk contents are only shared within the same one.
+EMBEDDING_MODEL_KEY = f"{EMBEDDING_BACKEND}:{OLLAMA_EMBEDDING_MODEL}"
+# Document-level vector for the two-stage retrieval of /ask (rag_service): centroid of the version's chunks.
+SUMMARY_EMBEDDING_SQL = """
+    UPDATE document_versions
+    SET summary_embedding = (
+        SELECT AVG(cc.chunk_embedding)
+        FROM document_chunks dc
+        JOIN chunk_contents cc ON cc.id = dc.content_id
+        WHERE dc.document_version_id = :version_id)
+    WHERE id = :version_id
+"""
 
 # --- Utility Functions (consider moving these to a 'utils' directory) ---
 
@@ -71,55 +110,42 @@ def get_s3_client():
         secure=secure_connection
     )
 
-def encrypt(data: bytes, key: bytes) -> bytes:
-    f = Fernet(key)
-    return f.encrypt(data)
+def encrypt(data: bytes, key: bytes, mimetype: str = None) -> bytes:
+    return storage_envelope.seal(data, key, mimetype)
 
 def decrypt(data: bytes, key: bytes) -> bytes:
-    f = Fernet(key)
-    return f.decrypt(data)
-
-def get_ollama_embedding(text: str, model_name: str):
-    headers = {'Content-Type': 'application/json'}
-    data = {
-        "model": model_name,
-        "prompt": text
-    }
-    try:
-        response = requests.post(f"{OLLAMA_API_BASE_URL}/api/embeddings", headers=headers, json=data, timeout=OLLAMA_GENERATION_TIMEOUT)
-        response.raise_for_status()
-        return response.json()['embedding']
-    except requests.exceptions.Timeout as e:
-        logger.error(f"Tiempo de espera agotado al obtener embedding de Ollama en {OLLAMA_API_BASE_URL}/api/embeddings: {e}")
-        raise
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error al comunicarse con Ollama para embedding en {OLLAMA_API_BASE_URL}/api/embeddings: {e}")
-        raise
-    except Exception as e:
-        logger.error(f"Error inesperado al obtener embedding de Ollama: {e}")
-        raise
-
-def get_ollama_generation(prompt: str, model_name: str):
-    headers = {'Content-Type': 'application/json'}
-    data = {
-        "model": model_name,
-        "prompt": prompt,
-        "stream": False
-    }
-    try:
-        logger.info(f"Solicitando generación para el modelo '{model_name}' (prompt: {prompt[:100]}...) con timeout {OLLAMA_GENERATION_TIMEOUT}s")
-        response = requests.post(f"{OLLAMA_API_BASE_URL}/api/generate", headers=headers, json=data, timeout=OLLAMA_GENERATION_TIMEOUT)
-        response.raise_for_status()
-        return response.json()['response']
-    except requests.exceptions.Timeout as e:
-        logger.error(f"Tiempo de espera agotado al generar respuesta de Ollama en {OLLAMA_API_BASE_URL}/api/generate: {e}")
-        raise
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error al comunicarse con Ollama en {OLLAMA_API_BASE_URL}/api/generate: {e}")
-        raise
-    except Exception as e:
-        logger.error(f"Error inesperado al obtener generación de Ollama: {e}")
-        raise
+    # Handles both the binary envelope and legacy Fernet objects
+    return storage_envelope.open_envelope(data, key)
+
+# Extractor version per file extension. Bump an entry whenever its extraction changes (library upgrade,
+# OCR languages, converter flags): only the text artifacts of that format are invalidated and re-extracted.
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff']
+EXTRACTOR_VERSIONS = {
+    '.pdf': 'pypdf-1',
+    '.txt': 'utf8-1',
+    **{ext: 'calibre-1' for ext in EBOOK_EXTENSIONS}, # '.mobi' used the 'mobi' package ('mobi-1') before
+    '.docx': 'python-docx-1',
+    '.xlsx': 'openpyxl-readonly-windows-1',
+    '.pptx': 'python-pptx-tables-notes-1',
+    '.epub': 'ebooklib-html2text-1',
+    **{ext: 'tesseract-spa+eng-1' for ext in IMAGE_EXTENSIONS},
+}
+# Bump when normalize_text changes: it invalidates every artifact.
+TEXT_NORMALIZATION_VERSION = 1
+
+def extractor_version_for(filename: str) -> str:
+    file_extension = os.path.splitext(filename)[1].lower()
+    return f"{EXTRACTOR_VERSIONS.get(file_extension, 'unsupported-1')}+norm{TEXT_NORMALIZATION_VERSION}"
+
+_TRAILING_SPACES_RE = re.compile(r'[ \t]+\n')
+_BLANK_LINES_RE = re.compile(r'\n{3,}')
+
+def normalize_text(text: str) -> str:
+    """NFC, no NUL bytes (PostgreSQL rejects them in text columns), '\\n' line endings, no trailing spaces, at most one blank line."""
+    text = unicodedata.normalize('NFC', text).replace('\x00', '')
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    text = _TRAILING_SPACES_RE.sub('\n', text)
+    return _BLANK_LINES_RE.sub('\n\n', text).strip()
 
 def extract_text_from_file_content(file_content_bytes: bytes, filename: str) -> str:
     _, file_extension = os.path.splitext(filename)
@@ -137,20 +163,14 @@ def extract_text_from_file_content(file_content_bytes: bytes, filename: str) ->
             raise
     elif file_extension == '.txt':
         return file_content_bytes.decode('utf-8')
-    elif file_extension == '.mobi':
+    elif file_extension in EBOOK_EXTENSIONS:
         try:
-            from mobi import Mobi # Requires 'mobi' package
-            mobi_book = Mobi(io.BytesIO(file_content_bytes))
-            mobi_book.parse()
-            text_content = ""
-            for chapter in mobi_book.contents:
-                text_content += chapter.content.decode('utf-8', errors='ignore') + "\n"
-            return text_content
-        except ImportError:
-            logger.error("La librería 'mobi' no está instalada. No se puede procesar .mobi")
+            return get_converter_pool().convert_to_text(file_content_bytes, file_extension)
+        except FileNotFoundError:
+            logger.error("calibre-debug (Calibre) no encontrado. Asegúrate de que esté instalado en el contenedor.")
             raise
-        except Exception as e:
-            logger.error(f"Error al extraer texto de MOBI {filename}: {e}", exc_info=True)
+        except EbookConversionError as e:
+            logger.error(f"Error al convertir el ebook {filename} con Calibre: {e}")
             raise
     elif file_extension == '.docx':
         try:
@@ -166,16 +186,8 @@ def extract_text_from_file_content(file_content_bytes: bytes, filename: str) ->
             raise
     elif file_extension == '.xlsx':
         try:
-            from openpyxl import load_workbook # Requires 'openpyxl' package
-            workbook = load_workbook(io.BytesIO(file_content_bytes))
-            text = []
-            for sheet_name in workbook.sheetnames:
-                sheet = workbook[sheet_name]
-                text.append(f"--- Hoja: {sheet_name} ---")
-                for row in sheet.iter_rows():
-                    row_values = [str(cell.value) if cell.value is not None else "" for cell in row]
-                    text.append('\t'.join(row_values))
-            return '\n'.join(text)
+            # Streaming read-only iteration: memory does not grow with the number of rows
+            return UNIT_SEPARATOR.join(iter_xlsx_units(file_content_bytes, filename))
         except ImportError:
             logger.error("La librería 'openpyxl' no está instalada. No se puede procesar .xlsx")
             raise
@@ -184,14 +196,7 @@ def extract_text_from_file_content(file_content_bytes: bytes, filename: str) ->
             raise
     elif file_extension == '.pptx':
         try:
-            from pptx import Presentation # Requires 'python-pptx' package
-            prs = Presentation(io.BytesIO(file_content_bytes))
-            text_runs = []
-            for slide in prs.slides:
-                for shape in slide.shapes:
-                    if hasattr(shape, "text"):
-                        text_runs.append(shape.text)
-            return '\n'.join(text_runs)
+            return UNIT_SEPARATOR.join(iter_pptx_units(file_content_bytes, filename))
         except ImportError:
             logger.error("La librería 'python-pptx' no está instalada. No se puede procesar .pptx")
             raise
@@ -214,44 +219,7 @@ def extract_text_from_file_content(file_content_bytes: bytes, filename: str) ->
         except Exception as e:
             logger.error(f"Error al extraer texto de EPUB {filename}: {e}", exc_info=True)
             raise
-    elif file_extension == '.azw3':
-        temp_input_azw3_path = None
-        temp_output_txt_path = None
-        try:
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.azw3', dir='/tmp') as temp_input:
-                temp_input.write(file_content_bytes)
-                temp_input_azw3_path = temp_input.name
-
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.txt', dir='/tmp') as temp_output:
-                temp_output_txt_path = temp_output.name
-
-            # Ensure calibre's ebook-convert is installed and in PATH
-            command = ["ebook-convert", temp_input_azw3_path, temp_output_txt_path]
-            result = subprocess.run(command, capture_output=True, text=True, check=True)
-
-            if result.returncode != 0:
-                logger.error(f"ebook-convert failed for {filename}. Stderr: {result.stderr}")
-                raise Exception(f"ebook-convert failed: {result.stderr}")
-
-            with open(temp_output_txt_path, 'r', encoding='utf-8') as f:
-                text_content = f.read()
-            return text_content
-
-        except FileNotFoundError:
-            logger.error("ebook-convert (Calibre) no encontrado. Asegúrate de que esté instalado en el contenedor.")
-            raise
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Error en ebook-convert para {filename}: {e}. Salida: {e.stdout}. Error: {e.stderr}", exc_info=True)
-            raise
-        except Exception as e:
-            logger.error(f"Error al extraer texto de AZW3 {filename}: {e}", exc_info=True)
-            raise
-        finally:
-            if temp_input_azw3_path and os.path.exists(temp_input_azw3_path):
-                os.remove(temp_input_azw3_path)
-            if temp_output_txt_path and os.path.exists(temp_output_txt_path):
-                os.remove(temp_output_txt_path)
-    elif file_extension in ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff']:
+    elif file_extension in IMAGE_EXTENSIONS:
         try:
             image = Image.open(io.BytesIO(file_content_bytes))
             # Ensure Tesseract is installed and available in PATH within the container
@@ -269,7 +237,7 @@ def extract_text_from_file_content(file_content_bytes: bytes, filename: str) ->
         # For now, returning empty string for unsupported types, but updating DB status is crucial.
         return ""
 
-def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 100) -> list[str]:
+def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> list[str]:
     chunks = []
     if not text:
         return chunks
@@ -291,6 +259,31 @@ def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 100) -> list[st
             break
     return chunks
 
+# Formats whose extraction yields self-contained text units (spreadsheet row windows with their header, slides)
+UNIT_CHUNKED_EXTENSIONS = {'.xlsx', '.pptx'}
+
+def chunk_units(units, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> list[str]:
+    """Packs text units into chunks without splitting them; a unit longer than a chunk falls back to chunk_text."""
+    chunks = []
+    current = ""
+    for unit in units:
+        unit = unit.strip()
+        if not unit:
+            continue
+        if len(unit) > chunk_size:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.extend(chunk_text(unit, chunk_size, overlap))
+        elif current and len(current) + len(UNIT_SEPARATOR) + len(unit) > chunk_size:
+            chunks.append(current)
+            current = unit
+        else:
+            current = f"{current}{UNIT_SEPARATOR}{unit}" if current else unit
+    if current:
+        chunks.append(current)
+    return chunks
+
 # --- Celery Task for RAG Indexing ---
 
 @celery_app.task(bind=True, max_retries=3, default_retry_delay=60)
@@ -301,6 +294,7 @@ def index_document_for_rag(self, document_version_id_str: str):
     Assumes the file has already been uploaded to MinIO and scanned for viruses.
     """
     logger.info(f"RAG: Starting indexing for document_version_id: {document_version_id_str}")
+    extension = 'other'
 
     # **Use SQLAlchemy ORM with the get_db() context manager**
     with get_db() as db_session:
@@ -312,11 +306,263 @@ def index_document_for_rag(self, document_version_id_str: str):
             document_version = db_session.query(DocumentVersion).filter_by(id=UUIDType(document_version_id_str)).first()
 
             if not document_version:
-                logger.error(f"RAG: Document version not found in DB for indexing {document_version_id_str}.")
-                raise ValueError("Document version record not found for RAG indexing.")
+                # Purged while this task waited in Celery: retrying cannot succeed, release its slot instead.
+                logger.warning(f"RAG: Document version {document_version_id_str} not found in DB (purged?), skipping.")
+                ingest_scheduler.release_version(document_version_id_str)
+                return {"document_version_id": document_version_id_str, "chunks": 0, "skipped": "missing"}
+            if document_version.processed_status == 'deleted':
+                # The document was deleted while this version waited in the queue: purge_document removes it.
+                logger.info(f"RAG: Skipping document_version_id {document_version_id_str}, its document was deleted.")
+                ingest_scheduler.finish(document_version.uploaded_by, document_version.id)
+                return {"document_version_id": document_version_id_str, "chunks": 0, "skipped": "deleted"}
 
             # Update status to 'processing' (using ORM)
             document_version.processed_status = 'processing' # Use 'processed_status' from models.py
             document_version.last_processed_at = datetime.now() # Update timestamp
             db_session.add(document_version)
-            db_session.commit() # Commit here to
\ No newline at end of file
+            db_session.commit() # Commit here to make the 'processing' status visible to the API
+            ingest_scheduler.renew(document_version.uploaded_by, document_version.id) # Keeps the fair-share slot alive
+            extension = metrics.file_extension(document_version.original_filename)
+
+            # 2. Reuse the extracted text artifact when this content was already extracted by the same extractor
+            #    (retries, re-indexing, identical uploads); otherwise download, decrypt and extract.
+            sha256 = (document_version.file_metadata or {}).get('sha256')
+            extractor_version = extractor_version_for(document_version.original_filename)
+            extracted_text = None
+            if sha256:
+                with observe_stage(INGEST_STAGE_SECONDS, stage='artifact_load', extension=extension):
+                    extracted_text = _load_text_artifact(db_session, minio_client, fernet_master, sha256, extractor_version)
+
+            if extracted_text is None:
+                with observe_stage(INGEST_STAGE_SECONDS, stage='download', extension=extension):
+                    response = minio_client.get_object(CEPH_BUCKET_NAME, document_version.ceph_path)
+                    try:
+                        encrypted_data = response.read()
+                    finally:
+                        response.close()
+                        response.release_conn()
+                with observe_stage(INGEST_STAGE_SECONDS, stage='decryption', extension=extension):
+                    file_key = fernet_master.decrypt(_as_bytes(document_version.encryption_key_encrypted))
+                    file_content = decrypt(encrypted_data, file_key)
+                if not sha256: # Versions uploaded before hashes were recorded
+                    sha256 = text_artifacts.content_sha256(file_content)
+                    document_version.file_metadata = {**(document_version.file_metadata or {}), 'sha256': sha256}
+                    extracted_text = _load_text_artifact(db_session, minio_client, fernet_master, sha256, extractor_version)
+
+            if extracted_text is not None:
+                metrics.TEXT_ARTIFACT_LOOKUPS.labels(extension=extension, outcome='hit').inc()
+            else:
+                metrics.TEXT_ARTIFACT_LOOKUPS.labels(extension=extension, outcome='miss').inc()
+                # 3. Extract and normalize the text, and persist it before the (retryable) embedding step
+                with observe_stage(INGEST_STAGE_SECONDS, stage='extraction', extension=extension):
+                    extracted_text = normalize_text(
+                        extract_text_from_file_content(file_content, document_version.original_filename))
+                with observe_stage(INGEST_STAGE_SECONDS, stage='artifact_store', extension=extension):
+                    _store_text_artifact(db_session, minio_client, fernet_master, sha256, extractor_version, extracted_text)
+
+            with observe_stage(INGEST_STAGE_SECONDS, stage='chunking', extension=extension):
+                if extension in UNIT_CHUNKED_EXTENSIONS:
+                    chunks = chunk_units(extracted_text.split(UNIT_SEPARATOR))
+                else:
+                    chunks = chunk_text(extracted_text)
+            logger.info(f"RAG: {len(chunks)} chunks generated for document_version_id: {document_version_id_str}")
+
+            # 4. Embed and store the chunks in checkpointed batches. Each batch is upserted on
+            #    (document_version_id, chunk_order) and committed together with the progress, so a retry
+            #    resumes after the last committed batch instead of starting over.
+            fingerprint = _index_fingerprint(chunks)
+            if document_version.index_fingerprint != fingerprint or document_version.chunks_total != len(chunks):
+                # Different chunks or embedding model than the checkpoint (or no checkpoint): start over
+                db_session.query(DocumentChunk).filter_by(document_version_id=document_version.id).delete()
+                document_version.index_fingerprint = fingerprint
+                document_version.chunks_total = len(chunks)
+                document_version.chunks_indexed = 0
+                db_session.commit()
+            resumed_from = document_version.chunks_indexed
+            if resumed_from:
+                logger.info(f"RAG: Resuming document_version_id {document_version_id_str} at chunk {resumed_from}/{len(chunks)}")
+
+            #    Exact and near-duplicate chunks reuse an existing content: only new ones are embedded, unless a
+            #    restored version still has the embedding in its archive (version_retention.py).
+            dedup_outcomes = {'new': 0, 'exact': 0, 'near': 0}
+            archived = version_retention.archived_embeddings(db_session, document_version.id, EMBEDDING_MODEL_KEY)
+            for batch_start in range(resumed_from, len(chunks), INDEX_CHECKPOINT_CHUNKS):
+                batch = chunks[batch_start:batch_start + INDEX_CHECKPOINT_CHUNKS]
+                with observe_stage(INGEST_STAGE_SECONDS, stage='dedup', extension=extension):
+                    entries = chunk_dedup.plan_batch(db_session, EMBEDDING_MODEL_KEY, batch)
+                with observe_stage(INGEST_STAGE_SECONDS, stage='embedding', extension=extension):
+                    embeddings = _embed_new_entries(entries, batch_start, archived)
+                with observe_stage(INGEST_STAGE_SECONDS, stage='insertion', extension=extension):
+                    chunk_dedup.store_contents(db_session, EMBEDDING_MODEL_KEY, entries, embeddings)
+                    _upsert_chunks(db_session, document_version.id, batch_start, entries)
+                    document_version.chunks_indexed = batch_start + len(batch)
+                    db_session.commit()
+                for entry in entries:
+                    dedup_outcomes[entry["outcome"]] += 1
+
+            # 5. Summary vector of the version, committed together with the 'indexed' status
+            with observe_stage(INGEST_STAGE_SECONDS, stage='summary', extension=extension):
+                db_session.execute(text(SUMMARY_EMBEDDING_SQL), {"version_id": document_version.id})
+
+            document_version.processed_status = 'indexed'
+            document_version.last_processed_at = datetime.now()
+            db_session.add(document_version)
+            if archived:
+                version_retention.drop_archive(db_session, document_version.id)
+            db_session.commit()
+            # Las búsquedas del dueño no irán a una réplica que aún no tenga estos chunks.
+            db_routing.record_write(db_session, document_version.uploaded_by)
+            ingest_scheduler.finish(document_version.uploaded_by, document_version.id)
+            _promote_deferred(db_session)
+            _apply_retention(db_session, document_version.document_id)
+            metrics.INGEST_CHUNKS.labels(extension=extension).inc(len(chunks) - resumed_from)
+            for outcome, count in dedup_outcomes.items():
+                metrics.INGEST_CHUNK_DEDUP.labels(extension=extension, outcome=outcome).inc(count)
+            metrics.INGEST_DOCUMENTS.labels(extension=extension, outcome='indexed').inc()
+            processed = len(chunks) - resumed_from
+            dedup_ratio = round((dedup_outcomes['exact'] + dedup_outcomes['near']) / processed, 3) if processed else 0.0
+            logger.info(f"RAG: Indexing completed for document_version_id: {document_version_id_str} "
+                        f"({processed} chunks: {dedup_outcomes['exact']} exact and {dedup_outcomes['near']} near "
+                        f"duplicates, dedup ratio {dedup_ratio})")
+            return {"document_version_id": document_version_id_str, "chunks": processed,
+                    "dedup": dedup_outcomes, "dedup_ratio": dedup_ratio}
+
+        except Exception as e:
+            db_session.rollback()
+            logger.error(f"RAG: Error indexing document_version_id {document_version_id_str}: {e}", exc_info=True)
+            failed_version = db_session.query(DocumentVersion).filter_by(id=UUIDType(document_version_id_str)).first()
+            if failed_version is None:
+                # The version was purged mid-indexing: nothing left to retry.
+                ingest_scheduler.release_version(document_version_id_str)
+                return {"document_version_id": document_version_id_str, "chunks": 0, "skipped": "missing"}
+            failed_version.processed_status = 'failed'
+            failed_version.last_processed_at = datetime.now()
+            db_session.commit()
+            if self.request.retries >= self.max_retries: # No more retries: the slot goes to the next document
+                ingest_scheduler.finish(failed_version.uploaded_by, failed_version.id)
+                _promote_deferred(db_session)
+            metrics.INGEST_DOCUMENTS.labels(extension=extension, outcome='failed').inc()
+            raise self.retry(exc=e)
+
+def _promote_deferred(db_session):
+    # Uploads deferred by admission control are queued as the backlog drains; never fails the indexing task.
+    try:
+        ingest_admission.promote_deferred(db_session)
+    except Exception as e:
+        db_session.rollback()
+        logger.warning(f"RAG: Could not queue deferred document versions: {e}")
+
+def _apply_retention(db_session, document_id):
+    # A new version may push older ones out of the retention policy; a failure is left to the compactor.
+    try:
+        version_retention.archive_superseded(db_session, document_id=document_id)
+    except Exception as e:
+        db_session.rollback()
+        logger.warning(f"RAG: Could not archive superseded versions of document {document_id}: {e}")
+
+def _embed_new_entries(entries, batch_start, archived):
+    # Embeddings for the 'new' entries, in order: from the version's archive when the chunk text is unchanged.
+    new = [(batch_start + i, entry["text"]) for i, entry in enumerate(entries) if entry["outcome"] == 'new']
+    embeddings = [archived[order][1] if order in archived and archived[order][0] == chunk else None
+                  for order, chunk in new]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        for i, embedding in zip(missing, embed_texts([new[i][1] for i in missing], model_name=OLLAMA_EMBEDDING_MODEL)):
+            embeddings[i] = embedding # embed_texts batches by EMBEDDING_BATCH_SIZE
+    return embeddings
+
+def _index_fingerprint(chunks) -> str:
+    # Identifies what the checkpointed rows were built from: the exact chunks and the embedding model.
+    digest = hashlib.sha256(EMBEDDING_MODEL_KEY.encode('utf-8'))
+    for chunk in chunks:
+        digest.update(b'\0')
+        digest.update(chunk.encode('utf-8'))
+    return digest.hexdigest()
+
+def _upsert_chunks(db_session, document_version_id, first_order, entries):
+    # entries come from chunk_dedup.store_contents; the chunk keeps its own text only if the shared one differs.
+    statement = insert(DocumentChunk).values([
+        {
+            "document_version_id": document_version_id,
+            "chunk_order": first_order + offset,
+            "content_id": entry["content_id"],
+            "chunk_text": None if entry["text"] == entry["content_text"] else entry["text"],
+        }
+        for offset, entry in enumerate(entries)
+    ])
+    db_session.execute(statement.on_conflict_do_update(
+        index_elements=['document_version_id', 'chunk_order'],
+        set_={'content_id': statement.excluded.content_id, 'chunk_text': statement.excluded.chunk_text},
+    ))
+
+def _load_text_artifact(db_session, minio_client, fernet_master, sha256, extractor_version):
+    try:
+        return text_artifacts.load_text(db_session, minio_client, CEPH_BUCKET_NAME, fernet_master, sha256, extractor_version)
+    except Exception as e:
+        # A broken artifact must not block indexing: fall back to extracting from the original file.
+        db_session.rollback()
+        logger.warning(f"RAG: Could not load text artifact {sha256}/{extractor_version}, re-extracting: {e!r}")
+        return None
+
+def _store_text_artifact(db_session, minio_client, fernet_master, sha256, extractor_version, text):
+    try:
+        text_artifacts.store_text(db_session, minio_client, CEPH_BUCKET_NAME, fernet_master, sha256, extractor_version, text)
+    except Exception as e:
+        # Without the artifact a retry only has to extract again.
+        db_session.rollback()
+        logger.warning(f"RAG: Could not store text artifact {sha256}/{extractor_version}: {e}")
+
+def _as_bytes(value) -> bytes:
+    return value if isinstance(value, bytes) else value.encode('utf-8')
+
+# --- Celery Task for /ask job mode ---
+
+@celery_app.task(bind=True, max_retries=None, track_started=True)
+def generate_answer_for_job(self, user_id_str: str, question: str, model_name: str, filters: dict = None):
+    """
+    Runs the full RAG flow for a question queued through /ask job mode.
+    Waits for a free slot of the model before calling Ollama, so the number of
+    concurrent generations per model stays bounded regardless of worker count.
+    `filters` is the raw JSON from the request (already validated by the API).
+    """
+    # Imported here so indexing-only workers never load the RAG query path.
+    import ask_jobs
+    from rag_service import answer_question, parse_filters
+
+    job_id = self.request.id
+    if model_residency.is_loading(model_name):
+        # The model manager is loading it: do not hold a slot (or a worker) while Ollama loads it.
+        logger.info(f"ASK: Model '{model_name}' is loading, job {job_id} will retry.")
+        raise self.retry(countdown=ask_jobs.ASK_MODEL_SLOT_RETRY_SECONDS)
+    if not ask_jobs.acquire_model_slot(model_name, job_id):
+        logger.info(f"ASK: No free slot for model '{model_name}', job {job_id} will retry.")
+        raise self.retry(countdown=ask_jobs.ASK_MODEL_SLOT_RETRY_SECONDS)
+
+    job = ask_jobs.get_job(job_id)
+    if job and job.get('created_at'):
+        metrics.ASK_STAGE_SECONDS.labels(stage='queue_wait', model=model_name).observe(time.time() - float(job['created_at']))
+
+    try:
+        # Solo lectura: puede ir a una réplica al día con las escrituras del usuario.
+        with db_routing.get_read_db(UUIDType(user_id_str)) as db_session:
+            return answer_question(db_session, UUIDType(user_id_str), question, model_name=model_name,
+                                   filters=parse_filters(filters))
+    finally:
+        ask_jobs.release_model_slot(model_name, job_id)
+        ask_jobs.release_user_slot(user_id_str, job_id)
+
+# --- Celery Task for asynchronous document deletion ---
+
+@celery_app.task(bind=True, max_retries=5, default_retry_delay=60)
+def purge_document(self, document_id_str: str):
+    """
+    Removes a tombstoned document (DELETE /documents/<id>): its MinIO objects with multi-object deletes,
+    its chunks in bounded batches and finally its rows. Safe to retry; the storage GC picks up what is left.
+    """
+    with get_db() as db_session:
+        try:
+            return document_purge.purge_document(db_session, get_s3_client(), CEPH_BUCKET_NAME, UUIDType(document_id_str))
+        except Exception as e:
+            db_session.rollback()
+            logger.error(f"PURGE: Error purging document {document_id_str}: {e}", exc_info=True)
+            raise self.retry(exc=e)
@@ -0,0 +1,80 @@
+# backend/text_artifacts.py
+"""
+Artefactos de texto extraído: el texto normalizado de un fichero, cifrado en MinIO.
+
+Extraer texto puede costar minutos (OCR con Tesseract, `ebook-convert` de Calibre),
+y sin artefacto cada reintento de `index_document_for_rag` y cada re-indexación
+vuelve a descargar, descifrar y extraer el original. La clave del artefacto es
+`(content_sha256, extractor_version)`: dos versiones con el mismo contenido lo
+comparten, y subir la versión de un extractor invalida solo los de ese formato.
+
+Cada artefacto tiene su propia clave de fichero envuelta con SYSTEM_MASTER_KEY y
+se guarda con el sobre de storage_envelope.py (zstd + AES-256-GCM).
+"""
+import io
+import uuid
+import hashlib
+import logging
+
+from cryptography.fernet import Fernet
+from sqlalchemy.dialects.postgresql import insert
+
+import storage_envelope
+from models import TextArtifact
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_PREFIX = "text-artifacts"
+
+
+def content_sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _read_object(minio_client, bucket, path) -> bytes:
+    response = minio_client.get_object(bucket, path)
+    try:
+        return response.read()
+    finally:
+        response.close()
+        response.release_conn()
+
+
+def load_text(db_session, minio_client, bucket, fernet_master, sha256: str, extractor_version: str):
+    """Devuelve el texto del artefacto, o None si no existe todavía para esta versión de extractor."""
+    artifact = db_session.query(TextArtifact).filter_by(
+        content_sha256=sha256, extractor_version=extractor_version).first()
+    if artifact is None:
+        return None
+    file_key = fernet_master.decrypt(artifact.encryption_key_encrypted)
+    return storage_envelope.open_envelope(_read_object(minio_client, bucket, artifact.ceph_path), file_key).decode('utf-8')
+
+
+def store_text(db_session, minio_client, bucket, fernet_master, sha256: str, extractor_version: str, text: str) -> bool:
+    """
+    Guarda el texto como artefacto y hace commit. Devuelve False si otro worker ya lo
+    había guardado: en ese caso se borra el objeto recién subido y se conserva el suyo.
+    """
+    file_key = Fernet.generate_key()
+    sealed = storage_envelope.seal(text.encode('utf-8'), file_key, 'text/plain')
+    # Ruta única por escritura: dos workers concurrentes no se pisan el objeto cifrado con claves distintas.
+    ceph_path = f"{ARTIFACT_PREFIX}/{sha256}/{extractor_version}/{uuid.uuid4()}.txt"
+    minio_client.put_object(bucket, ceph_path, io.BytesIO(sealed), len(sealed),
+                            content_type="application/octet-stream")
+
+    result = db_session.execute(
+        insert(TextArtifact).values(
+            content_sha256=sha256,
+            extractor_version=extractor_version,
+            ceph_path=ceph_path,
+            encryption_key_encrypted=fernet_master.encrypt(file_key),
+            text_length=len(text),
+        ).on_conflict_do_nothing(index_elements=['content_sha256', 'extractor_version'])
+    )
+    db_session.commit()
+    if result.rowcount:
+        return True
+
+    logger.info(f"Artefacto de texto {sha256}/{extractor_version} ya guardado por otro worker; se descarta {ceph_path}.")
+    minio_client.remove_object(bucket, ceph_path)
+    return False
@@ -0,0 +1,21 @@
+# backend/valkey_client.py
+import os
+import logging
+
+import redis
+
+# Valkey es compatible con Redis: reutilizamos el broker de Celery salvo que se indique otra URL.
+VALKEY_URL = os.getenv("VALKEY_URL") or os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")
+
+_client = None
+
+def get_valkey():
+    """
+    Devuelve un cliente Valkey/Redis compartido por el proceso.
+    El pool de conexiones de redis-py es seguro entre hilos, así que basta con una instancia.
+    """
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(VALKEY_URL, decode_responses=True)
+        logging.info("Cliente Valkey inicializado.")
+    return _client
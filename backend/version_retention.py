@@ -0,0 +1,249 @@
+# backend/version_retention.py
+"""
+Retención de los vectores de las versiones antiguas.
+
+/ask busca en la última versión de cada documento (o en versiones fijadas con
+`version_ids`), pero cada versión superada conservaba sus chunks, y sus contenidos
+únicos seguían en chunk_contents y en su índice HNSW.
+
+* Política: cada documento conserva en la búsqueda sus RETENTION_KEEP_VERSIONS
+  versiones más recientes (0 desactiva la retención). Los chunks de las anteriores
+  ya indexadas pasan a `archived_chunks` (tabla fría sin índice vectorial, con su
+  texto y su embedding), se borran de document_chunks y la versión queda
+  'archived'. El fichero original sigue en MinIO y se puede descargar.
+* Al indexar una versión nueva, el worker archiva las que quedan fuera de la
+  política en ese documento (`archive_superseded(document_id=...)`).
+* Compactación (`python version_retention.py`, servicio `vector_compactor`): cada
+  RETENTION_COMPACTION_INTERVAL_SECONDS, y como mucho durante
+  RETENTION_COMPACTION_MAX_SECONDS, archiva lo pendiente, borra los contenidos de
+  chunk_contents que ya no usa ningún chunk (`delete_orphan_contents`) y hace
+  VACUUM (ANALYZE) de las tablas, que limpia también el índice HNSW. Cada sentencia
+  lleva como statement_timeout el tiempo que queda.
+* Restaurar una versión (POST /documents/versions/<id>/restore) la vuelve a indexar;
+  los chunks cuyo texto coincide con el archivado reutilizan su embedding
+  (`archived_embeddings`) en lugar de pedirlo a Ollama. La versión queda
+  `retention_pinned` y la política ya no la archiva.
+"""
+import os
+import time
+import logging
+import argparse
+
+from sqlalchemy import text
+from pgvector.sqlalchemy import Vector
+
+import metrics
+from metrics import observe_stage, RETENTION_ROWS, RETENTION_COMPACTION_SECONDS
+
+RETENTION_KEEP_VERSIONS = int(os.getenv("RETENTION_KEEP_VERSIONS", "3"))
+RETENTION_COMPACTION_INTERVAL_SECONDS = int(os.getenv("RETENTION_COMPACTION_INTERVAL_SECONDS", "21600"))
+RETENTION_COMPACTION_MAX_SECONDS = int(os.getenv("RETENTION_COMPACTION_MAX_SECONDS", "900"))
+RETENTION_ARCHIVE_BATCH = int(os.getenv("RETENTION_ARCHIVE_BATCH", "20")) # Versiones por transacción
+RETENTION_GC_BATCH = int(os.getenv("RETENTION_GC_BATCH", "5000")) # Contenidos por transacción
+
+QUERY_CANCELED = '57014' # SQLSTATE de una sentencia cancelada por statement_timeout
+COMPACTED_TABLES = ("document_chunks", "chunk_contents", "chunk_content_bands", "archived_chunks")
+
+# Versiones indexadas fuera de las RETENTION_KEEP_VERSIONS más recientes de su documento.
+SUPERSEDED_SQL = """
+    SELECT id FROM (
+        SELECT dv.id, dv.processed_status, dv.retention_pinned,
+               row_number() OVER (PARTITION BY dv.document_id ORDER BY dv.version_number DESC) AS recency
+        FROM document_versions dv
+        {where}
+    ) versions
+    WHERE recency > :keep AND processed_status = 'indexed' AND NOT retention_pinned
+"""
+
+# Bloquea las versiones para que una restauración o un reintento de la indexación no se cruce con el archivado.
+LOCK_VERSIONS_SQL = """
+    SELECT id FROM document_versions
+    WHERE id = ANY(CAST(:version_ids AS uuid[])) AND processed_status = 'indexed'
+    FOR UPDATE SKIP LOCKED
+"""
+
+ARCHIVE_CHUNKS_SQL = """
+    INSERT INTO archived_chunks (document_version_id, chunk_order, chunk_text, embedding_model, chunk_embedding)
+    SELECT dc.document_version_id, dc.chunk_order, COALESCE(dc.chunk_text, cc.chunk_text),
+           cc.embedding_model, cc.chunk_embedding
+    FROM document_chunks dc
+    JOIN chunk_contents cc ON cc.id = dc.content_id
+    WHERE dc.document_version_id = ANY(CAST(:version_ids AS uuid[]))
+    ON CONFLICT (document_version_id, chunk_order) DO NOTHING
+"""
+
+# chunks_indexed vuelve a 0: una restauración indexa desde el principio (con los embeddings archivados).
+MARK_ARCHIVED_SQL = """
+    UPDATE document_versions
+    SET processed_status = 'archived', chunks_indexed = 0, last_processed_at = now()
+    WHERE id = ANY(CAST(:version_ids AS uuid[]))
+"""
+
+# Contenidos sin ningún chunk que los use, en orden de id para avanzar por la tabla entre lotes. Un worker
+# que iba a reutilizar uno de ellos falla la inserción por la clave foránea y reintenta la tarea.
+DELETE_ORPHAN_CONTENTS_SQL = """
+    DELETE FROM chunk_contents
+    WHERE id IN (
+        SELECT cc.id FROM chunk_contents cc
+        WHERE cc.id > CAST(:after AS uuid)
+          AND NOT EXISTS (SELECT 1 FROM document_chunks dc WHERE dc.content_id = cc.id)
+        ORDER BY cc.id
+        LIMIT :limit
+        FOR UPDATE SKIP LOCKED)
+    RETURNING id
+"""
+
+ARCHIVED_EMBEDDINGS_SQL = """
+    SELECT chunk_order, chunk_text, chunk_embedding
+    FROM archived_chunks
+    WHERE document_version_id = :version_id AND embedding_model = :embedding_model
+"""
+
+
+def _set_timeout(db_session, deadline):
+    if deadline is not None:
+        remaining_ms = max(int((deadline - time.monotonic()) * 1000), 1)
+        db_session.execute(text(f"SET LOCAL statement_timeout = {remaining_ms}"))
+
+
+def _expired(deadline) -> bool:
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def superseded_versions(db_session, document_id=None) -> list:
+    """Ids de las versiones indexadas que la política deja fuera de la búsqueda (de un documento o de todos)."""
+    if RETENTION_KEEP_VERSIONS <= 0:
+        return []
+    where = "WHERE dv.document_id = CAST(:document_id AS uuid)" if document_id else ""
+    params = {"keep": RETENTION_KEEP_VERSIONS, "document_id": str(document_id) if document_id else None}
+    return [row.id for row in db_session.execute(text(SUPERSEDED_SQL.format(where=where)), params)]
+
+
+def archive_versions(db_session, version_ids, deadline=None) -> int:
+    """Archiva los chunks de `version_ids` y los quita de la búsqueda, en una transacción. Devuelve las versiones."""
+    _set_timeout(db_session, deadline)
+    locked = [str(row.id) for row in db_session.execute(text(LOCK_VERSIONS_SQL),
+                                                        {"version_ids": [str(v) for v in version_ids]})]
+    if not locked:
+        db_session.rollback()
+        return 0
+    archived_chunks = db_session.execute(text(ARCHIVE_CHUNKS_SQL), {"version_ids": locked}).rowcount
+    db_session.execute(text("DELETE FROM document_chunks WHERE document_version_id = ANY(CAST(:version_ids AS uuid[]))"),
+                       {"version_ids": locked}) # Los contenidos que quedan sin chunks los poda delete_orphan_contents
+    db_session.execute(text(MARK_ARCHIVED_SQL), {"version_ids": locked})
+    db_session.commit()
+    RETENTION_ROWS.labels(kind='archived_versions').inc(len(locked))
+    RETENTION_ROWS.labels(kind='archived_chunks').inc(archived_chunks)
+    return len(locked)
+
+
+def archive_superseded(db_session, document_id=None, deadline=None) -> int:
+    """Archiva las versiones fuera de la política, por lotes, hasta terminar o hasta `deadline`."""
+    pending = superseded_versions(db_session, document_id)
+    archived = 0
+    for start in range(0, len(pending), RETENTION_ARCHIVE_BATCH):
+        if _expired(deadline):
+            break
+        archived += archive_versions(db_session, pending[start:start + RETENTION_ARCHIVE_BATCH], deadline)
+    if archived:
+        logging.info(f"Retención: {archived} versiones archivadas"
+                     + (f" del documento {document_id}." if document_id else "."))
+    return archived
+
+
+def delete_orphan_contents(db_session, deadline=None) -> int:
+    """Borra los contenidos que ya no usa ningún chunk (y sus bandas LSH), por lotes. Devuelve cuántos."""
+    deleted, after = 0, '00000000-0000-0000-0000-000000000000'
+    while not _expired(deadline):
+        _set_timeout(db_session, deadline)
+        ids = [row.id for row in db_session.execute(text(DELETE_ORPHAN_CONTENTS_SQL),
+                                                    {"after": after, "limit": RETENTION_GC_BATCH})]
+        db_session.commit()
+        deleted += len(ids)
+        if len(ids) < RETENTION_GC_BATCH:
+            break
+        after = str(max(ids))
+    if deleted:
+        RETENTION_ROWS.labels(kind='pruned_contents').inc(deleted)
+    return deleted
+
+
+def vacuum(engine, deadline=None) -> list:
+    """VACUUM (ANALYZE) de las tablas compactadas mientras quede tiempo. Devuelve las tablas completadas."""
+    done = []
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        try:
+            for table in COMPACTED_TABLES:
+                if _expired(deadline):
+                    break
+                if deadline is not None:
+                    remaining_ms = max(int((deadline - time.monotonic()) * 1000), 1)
+                    connection.execute(text(f"SET statement_timeout = {remaining_ms}"))
+                connection.execute(text(f"VACUUM (ANALYZE) {table}"))
+                done.append(table)
+        finally:
+            connection.execute(text("RESET statement_timeout")) # La conexión vuelve al pool (o a PgBouncer)
+    return done
+
+
+def compact(db_session, engine, max_seconds: float = RETENTION_COMPACTION_MAX_SECONDS) -> dict:
+    """Una pasada de compactación acotada a `max_seconds`. Devuelve lo que hizo en cada paso."""
+    deadline = time.monotonic() + max_seconds
+    report = {"archived_versions": 0, "pruned_contents": 0, "vacuumed": []}
+    try:
+        with observe_stage(RETENTION_COMPACTION_SECONDS, step='archive'):
+            report["archived_versions"] = archive_superseded(db_session, deadline=deadline)
+        with observe_stage(RETENTION_COMPACTION_SECONDS, step='gc'):
+            report["pruned_contents"] = delete_orphan_contents(db_session, deadline)
+        if report["archived_versions"] or report["pruned_contents"]:
+            with observe_stage(RETENTION_COMPACTION_SECONDS, step='vacuum'):
+                report["vacuumed"] = vacuum(engine, deadline)
+    except Exception as e:
+        db_session.rollback()
+        if getattr(getattr(e, 'orig', None), 'pgcode', None) != QUERY_CANCELED:
+            raise
+        # Sin tiempo: lo ya confirmado se queda, el resto en la siguiente pasada.
+        logging.warning(f"Compactación interrumpida al agotar {max_seconds}s.")
+    report["seconds"] = round(max_seconds - max(deadline - time.monotonic(), 0), 2)
+    logging.info(f"Compactación: {report}")
+    return report
+
+
+def archived_embeddings(db_session, version_id, embedding_model: str) -> dict:
+    """`{chunk_order: (texto, embedding)}` archivados de la versión con ese modelo de embeddings (vacío si no hay)."""
+    return {row.chunk_order: (row.chunk_text, row.chunk_embedding)
+            for row in db_session.execute(text(ARCHIVED_EMBEDDINGS_SQL).columns(chunk_embedding=Vector(768)),
+                                          {"version_id": version_id, "embedding_model": embedding_model})}
+
+
+def drop_archive(db_session, version_id):
+    """La versión volvió a la búsqueda: su copia archivada sobra. No hace commit."""
+    db_session.execute(text("DELETE FROM archived_chunks WHERE document_version_id = :version_id"),
+                       {"version_id": version_id})
+
+
+def run(max_seconds: float = RETENTION_COMPACTION_MAX_SECONDS, once: bool = False):
+    """Bucle del compactador: una pasada acotada cada RETENTION_COMPACTION_INTERVAL_SECONDS."""
+    from database import SessionLocal, engine
+
+    logging.info(f"Compactador de vectores: conserva {RETENTION_KEEP_VERSIONS} versiones por documento; pasada de "
+                 f"hasta {max_seconds}s cada {RETENTION_COMPACTION_INTERVAL_SECONDS}s.")
+    while True:
+        try:
+            with SessionLocal() as db_session:
+                compact(db_session, engine, max_seconds)
+        except Exception as e:
+            logging.error(f"Error en la compactación de vectores: {e}", exc_info=True)
+        if once:
+            return
+        time.sleep(RETENTION_COMPACTION_INTERVAL_SECONDS)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archiva los vectores de las versiones antiguas y compacta las tablas.")
+    parser.add_argument("--once", action="store_true", help="Una sola pasada (para cron) en lugar del bucle.")
+    parser.add_argument("--max-seconds", type=float, default=RETENTION_COMPACTION_MAX_SECONDS)
+    args = parser.parse_args()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+    metrics.reset_multiprocess_dir()
+    run(args.max_seconds, args.once)